@@ -3,10 +3,12 @@ import uuid
 import re
 import pymysql
 import sys
-import io
 import json
+import time
 from datetime import datetime, timedelta
-from flask import Flask, redirect, url_for, render_template, session, jsonify, request, send_file, flash, abort, send_from_directory
+import logging
+import app_logging
+from flask import Flask, redirect, url_for, render_template, session, jsonify, request, send_file, flash, abort, send_from_directory, stream_with_context, get_template_attribute, has_request_context
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
 from flask_dance.contrib.google import make_google_blueprint, google
 from flask_dance.consumer.storage.session import SessionStorage
@@ -16,17 +18,30 @@ from sqlalchemy import func
 from models import db, CostCenter, EmployeeDetails, SettingsFinance, ExpenseHead, EPV, EPVItem, EPVApproval, EPVAllocation, init_db, CityAssignment, FinanceEntry, SupplementaryDocument
 from pdf_converter import process_files
 from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload, MediaIoBaseDownload
 # Import SMTP email utilities instead of Gmail API email utilities
 from smtp_email_utils import send_approval_email, send_email, send_rejection_notification_email
 from sqlalchemy.orm.exc import NoResultFound
 from werkzeug.utils import secure_filename
-from PyPDF2 import PdfMerger
+from pdf_merge import merge_pdf_files
+from identity import get_identity, load_identity, load_employee, invalidate_identity
+from finance_routing import finance_recipients, invalidate_finance_routing
+from utils import calendar_days_between
+import change_feed  # registers the finance dashboard change listeners
+from notification_counts import get_notification_counts, notification_details
+import autocomplete
+import finance_reports as finance_reports_service
+import drive_file_cache
+import sql_profile
+import city_scope
+import finance_queue
+import record_view
+import notification_digest
+from approvals import (
+    update_split_epv_amounts, check_and_send_split_to_finance, apply_approval, apply_rejection,
+    pending_approvals, decide_pending_approvals
+)
 
-# Set up proper encoding for stdout and stderr to handle Unicode characters
-sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', errors='backslashreplace')
-sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8', errors='backslashreplace')
+logger = logging.getLogger(__name__)
 
 # Helper functions for supplementary documents feature
 
@@ -84,72 +99,14 @@ def send_document_request_email(epv, requested_docs):
 
 def get_parent_folder_id(file_id):
     """Get the parent folder ID of a Google Drive file"""
-    try:
-        # Get credentials from session
-        if 'google_oauth_token' in session:
-            token_info = session['google_oauth_token']
-            credentials = Credentials(
-                token=token_info.get('access_token'),
-                refresh_token=token_info.get('refresh_token'),
-                token_uri='https://oauth2.googleapis.com/token',
-                client_id=os.environ.get('GOOGLE_CLIENT_ID'),
-                client_secret=os.environ.get('GOOGLE_CLIENT_SECRET')
-            )
-
-            # Build the Drive API client
-            from googleapiclient.discovery import build
-            drive_service = build('drive', 'v3', credentials=credentials)
-
-            # Get the file metadata
-            file = drive_service.files().get(fileId=file_id, fields='parents').execute()
-
-            # Return the first parent folder ID
-            if 'parents' in file and file['parents']:
-                return file['parents'][0]
-    except Exception as e:
-        print(f"Error getting parent folder ID: {str(e)}")
-
-    return None
+    from drive_utils import get_parent_folder_id as get_drive_parent_folder_id
+    return get_drive_parent_folder_id(file_id)
 
 def upload_to_drive(file_path, filename, parent_folder_id):
     """Upload a file to Google Drive"""
-    try:
-        # Get credentials from session
-        if 'google_oauth_token' in session:
-            token_info = session['google_oauth_token']
-            credentials = Credentials(
-                token=token_info.get('access_token'),
-                refresh_token=token_info.get('refresh_token'),
-                token_uri='https://oauth2.googleapis.com/token',
-                client_id=os.environ.get('GOOGLE_CLIENT_ID'),
-                client_secret=os.environ.get('GOOGLE_CLIENT_SECRET')
-            )
-
-            # Build the Drive API client
-            from googleapiclient.discovery import build
-            from googleapiclient.http import MediaFileUpload
-            drive_service = build('drive', 'v3', credentials=credentials)
-
-            # File metadata
-            file_metadata = {
-                'name': filename,
-                'parents': [parent_folder_id]
-            }
-
-            # Upload the file
-            media = MediaFileUpload(file_path, resumable=True)
-            file = drive_service.files().create(
-                body=file_metadata,
-                media_body=media,
-                fields='id'
-            ).execute()
-
-            # Return the file ID
-            return file.get('id')
-    except Exception as e:
-        print(f"Error uploading to Google Drive: {str(e)}")
-
-    return None
+    from drive_utils import upload_file_to_drive
+    file_id = upload_file_to_drive(file_path, filename, parent_folder_id)
+    return file_id if file_id != 'local_file' else None
 
 def merge_supplementary_document(epv, supplementary_doc):
     """Merge a supplementary document with the original PDF"""
@@ -160,10 +117,9 @@ def merge_supplementary_document(epv, supplementary_doc):
             # Local file path
             original_pdf_path = epv.file_url[1:]  # Remove leading slash
         else:
-            # Download from Google Drive if needed
+            # Use the local copy of the file in Google Drive
             if epv.drive_file_id:
-                # Download the file from Google Drive
-                original_pdf_path = download_from_drive(epv.drive_file_id)
+                original_pdf_path = drive_file_cache.get_cached_file(epv.drive_file_id)
 
         if not original_pdf_path or not os.path.exists(original_pdf_path):
             raise Exception(f"Original PDF not found: {original_pdf_path}")
@@ -177,11 +133,8 @@ def merge_supplementary_document(epv, supplementary_doc):
         merged_pdf_path = f"uploads/merged_{epv.epv_id}_{datetime.now().strftime('%Y%m%d%H%M%S')}.pdf"
 
         # Merge the PDFs
-        merger = PdfMerger()
-        merger.append(original_pdf_path)
-        merger.append(supplementary_pdf_path)
-        merger.write(merged_pdf_path)
-        merger.close()
+        if not merge_pdf_files([original_pdf_path, supplementary_pdf_path], merged_pdf_path):
+            raise Exception("Failed to merge PDFs")
 
         # Update the EPV record with the new PDF
         epv.file_url = f"/{merged_pdf_path}"
@@ -204,94 +157,21 @@ def merge_supplementary_document(epv, supplementary_doc):
         print(f"Error merging documents: {str(e)}")
         return False
 
-def download_from_drive(file_id):
-    """Download a file from Google Drive"""
-    try:
-        # Get credentials from session
-        if 'google_oauth_token' in session:
-            token_info = session['google_oauth_token']
-            credentials = Credentials(
-                token=token_info.get('access_token'),
-                refresh_token=token_info.get('refresh_token'),
-                token_uri='https://oauth2.googleapis.com/token',
-                client_id=os.environ.get('GOOGLE_CLIENT_ID'),
-                client_secret=os.environ.get('GOOGLE_CLIENT_SECRET')
-            )
-
-            # Build the Drive API client
-            from googleapiclient.discovery import build
-            from io import BytesIO
-            drive_service = build('drive', 'v3', credentials=credentials)
-
-            # Get the file metadata
-            file = drive_service.files().get(fileId=file_id, fields='name').execute()
-            filename = file.get('name', f"drive_file_{file_id}.pdf")
-
-            # Download the file
-            request = drive_service.files().get_media(fileId=file_id)
-            file_content = BytesIO(request.execute())
-
-            # Save the file locally
-            local_path = f"uploads/{filename}"
-            with open(local_path, 'wb') as f:
-                f.write(file_content.getvalue())
-
-            return local_path
-    except Exception as e:
-        print(f"Error downloading from Google Drive: {str(e)}")
-
-    return None
-
 def notify_finance_team(epv, supplementary_doc):
     """Notify the finance team that a supplementary document has been uploaded"""
     try:
-        # Get the finance team emails
-        finance_emails = []
-
-        # Get Finance and Finance Approver users
-        finance_users = EmployeeDetails.query.filter(
-            EmployeeDetails.role.in_(['Finance', 'Finance Approver']),
-            EmployeeDetails.is_active == True
-        ).all()
-
-        # For Finance users, check if they're assigned to the EPV's city or cost center's city
-        # First check if the EPV has a city field set
-        if epv.city:
-            for user in finance_users:
-                if user.role == 'Finance Approver':
-                    # Finance Approvers get all notifications
-                    finance_emails.append(user.email)
-                elif user.role == 'Finance':
-                    # Check if this Finance user is assigned to the EPV's city
-                    city_assignment = CityAssignment.query.filter_by(
-                        employee_id=user.id,
-                        city=epv.city,
-                        is_active=True
-                    ).first()
-                    if city_assignment:
-                        finance_emails.append(user.email)
-        # If EPV doesn't have a city, fall back to cost center's city
-        elif epv.cost_center_id:
-            cost_center = CostCenter.query.get(epv.cost_center_id)
-            if cost_center and cost_center.city:
-                for user in finance_users:
-                    if user.role == 'Finance Approver':
-                        # Finance Approvers get all notifications
-                        finance_emails.append(user.email)
-                    elif user.role == 'Finance':
-                        # Check if this Finance user is assigned to the cost center's city
-                        city_assignment = CityAssignment.query.filter_by(
-                            employee_id=user.id,
-                            city=cost_center.city,
-                            is_active=True
-                        ).first()
-                        if city_assignment:
-                            finance_emails.append(user.email)
-        else:
-            # If no city and no cost center, notify all Finance Approvers
-            for user in finance_users:
-                if user.role == 'Finance Approver':
-                    finance_emails.append(user.email)
+        # Finance Approvers, and the Finance users assigned to the EPV's (or its cost center's) city
+        finance_emails = finance_recipients(epv)
+
+        # Finance staff in digest mode see the upload in their daily digest instead
+        in_digest = notification_digest.digest_recipients(finance_emails)
+        for email in in_digest:
+            notification_digest.add_to_digest(email, epv, 'supplementary_document',
+                                              request.url_root.rstrip('/') if has_request_context() else None,
+                                              detail=supplementary_doc.filename)
+        finance_emails = [email for email in finance_emails if email not in in_digest]
+        if not finance_emails:
+            return True
 
         # Create the email subject and HTML body
         subject = f"Supplementary document uploaded for EPV {epv.epv_id}"
@@ -389,6 +269,12 @@ load_dotenv()
 app = Flask(__name__, static_folder='static', template_folder='templates')
 app.secret_key = os.environ.get('FLASK_SECRET_KEY', 'dev-secret-key')
 
+# Timing record (route, role, SQL and external call time) of every request
+app_logging.init_request_logging(app)
+
+# Per-request SQL statement counts and N+1 detection (SQL_PROFILE)
+sql_profile.init_sql_profile(app)
+
 # Database configuration
 # Get database credentials from environment variables
 db_user = os.environ.get('DB_USER')
@@ -409,11 +295,30 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['GOOGLE_CLIENT_ID'] = os.environ.get('GOOGLE_CLIENT_ID')
 app.config['GOOGLE_CLIENT_SECRET'] = os.environ.get('GOOGLE_CLIENT_SECRET')
 
+# Number of EPV records per page on /epv-records (further pages load on scroll)
+app.config['EPV_RECORDS_PAGE_SIZE'] = int(os.environ.get('EPV_RECORDS_PAGE_SIZE', 50))
+
 # Configure upload folder
 app.config['UPLOAD_FOLDER'] = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads')
 # Create the upload folder if it doesn't exist
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
+# Build new expense documents (convert, merge, upload to Drive) on background workers
+# and let the form poll for the result. With DOCUMENT_JOBS_ASYNC=false they run in the request.
+app.config['DOCUMENT_JOBS_ASYNC'] = os.environ.get('DOCUMENT_JOBS_ASYNC', 'true').lower() in ('1', 'true', 'yes')
+app.config['DOCUMENT_JOBS_FOLDER'] = os.path.join(app.config['UPLOAD_FOLDER'], 'document_jobs')
+
+# Local copies of Drive files served by /download-file and used for supplementary merges
+app.config['DRIVE_FILE_CACHE_FOLDER'] = os.environ.get('DRIVE_FILE_CACHE_DIR') or os.path.join(app.config['UPLOAD_FOLDER'], 'drive_cache')
+
+# Finance dashboard changes: one request waits at most FINANCE_EVENTS_WAIT_SECONDS for a
+# change (0 answers at once), and the browser asks again after FINANCE_EVENTS_RETRY_MS.
+# Changes made by other app processes are picked up by reloading the rows every
+# FINANCE_DASHBOARD_REFRESH_SECONDS.
+app.config['FINANCE_EVENTS_WAIT_SECONDS'] = int(os.environ.get('FINANCE_EVENTS_WAIT_SECONDS', 25))
+app.config['FINANCE_EVENTS_RETRY_MS'] = 3000
+app.config['FINANCE_DASHBOARD_REFRESH_SECONDS'] = int(os.environ.get('FINANCE_DASHBOARD_REFRESH_SECONDS', 120))
+
 # Custom template filters
 @app.template_filter('get_cost_center_name')
 def get_cost_center_name(cost_center):
@@ -433,6 +338,30 @@ def get_cost_center_name(cost_center):
 # Initialize the database with the app
 db.init_app(app)
 
+def start_background_jobs():
+    """
+    Start the background jobs of a server process (idempotent).
+
+    Run by python app.py and wsgi.py only. Scripts that import app (exports,
+    migrations, checks) start none: a short-lived process would claim queued
+    work and exit before finishing it.
+    """
+    # Deliver emails in the background (see mail_queue.py). Disable with MAIL_QUEUE_ENABLED=false
+    # to send inline, e.g. when running several short-lived processes.
+    if os.environ.get('MAIL_QUEUE_ENABLED', 'true').lower() in ('1', 'true', 'yes'):
+        from mail_queue import start_mail_worker
+        start_mail_worker(app)
+
+    # Clear expired finance leases in the background (see finance_queue.py)
+    finance_queue.start_lease_sweeper(app)
+
+    # Send the daily notification digests (see notification_digest.py)
+    notification_digest.start_digest_scheduler(app)
+
+from document_jobs import init_document_jobs
+init_document_jobs(app, app.config['DOCUMENT_JOBS_FOLDER'])
+drive_file_cache.init_drive_file_cache(app.config['DRIVE_FILE_CACHE_FOLDER'])
+
 # Initialize Flask-Login
 login_manager = LoginManager(app)
 login_manager.login_view = 'index'  # Redirect to index instead of login
@@ -442,7 +371,7 @@ login_manager.login_message_category = "info"
 @login_manager.user_loader
 def load_user(user_id):
     try:
-        return EmployeeDetails.query.get(int(user_id))
+        return load_employee(int(user_id))
     except Exception as e:
         print(f"❌ ERROR: Failed to load user {user_id}: {str(e)}")
         return None
@@ -1023,8 +952,53 @@ def update_finance_settings():
 
         flash(f'Maximum days in past for claims set to {max_days_past}.', 'success')
 
+    # Notification emails: one per EPV, or a daily digest
+    notification_mode = request.form.get('notification_mode')
+    if notification_mode is not None:
+        if notification_mode not in notification_digest.NOTIFICATION_MODES:
+            flash('Notification mode must be immediate or digest.', 'error')
+            return redirect(url_for('settings'))
+        _update_finance_setting('notification_mode', notification_mode, 'Notification mode',
+                                'Approval and finance notification emails: immediate, or one daily digest', user_email)
+
+    digest_hour = request.form.get('digest_hour')
+    if digest_hour is not None:
+        try:
+            if not 0 <= int(digest_hour) <= 23:
+                raise ValueError(digest_hour)
+        except (ValueError, TypeError):
+            flash('Digest hour must be a number between 0 and 23.', 'error')
+            return redirect(url_for('settings'))
+        _update_finance_setting('digest_hour', str(int(digest_hour)), 'Digest hour',
+                                'Hour of the day (0-23) at which daily digest emails are sent', user_email)
+
     return redirect(url_for('settings'))
 
+def _update_finance_setting(name, value, label, description, user_email):
+    """Create or update a finance setting, logging the previous value"""
+    setting = SettingsFinance.query.filter_by(setting_name=name).first()
+    if setting:
+        if setting.setting_value == value:
+            return
+        previous_value = setting.setting_value
+        setting.previous_value = previous_value
+        setting.setting_value = value
+        setting.updated_by = user_email
+        setting.updated_on = datetime.now()
+        db.session.commit()
+        flash(f'{label} updated from {previous_value} to {value}.', 'success')
+    else:
+        setting = SettingsFinance(
+            setting_name=name,
+            setting_value=value,
+            description=description,
+            updated_by=user_email,
+            updated_on=datetime.now()
+        )
+        db.session.add(setting)
+        db.session.commit()
+        flash(f'{label} set to {value}.', 'success')
+
 @app.route('/dashboard')
 @login_required
 def dashboard():
@@ -1045,8 +1019,8 @@ def dashboard():
     # Get user info from session for backward compatibility
     user_info = session.get('user_info', {})
 
-    print(f"DEBUG: Dashboard accessed by {user_email}")
-    print(f"DEBUG: Employee role: {employee_role}, Manager: {employee_manager}, ID: {employee_id}")
+    logger.debug("Dashboard accessed by %s", user_email)
+    logger.debug("Employee role: %s, Manager: %s, ID: %s", employee_role, employee_manager, employee_id)
 
     # Get filter options
     expense_heads = ExpenseHead.query.filter_by(is_active=True).all()
@@ -1079,12 +1053,9 @@ def dashboard():
     if employee_role in ['Finance', 'Finance Approver', 'Super Admin']:
         # For Finance users, show only assigned cities
         if employee_role == 'Finance':
-            # Get the employee ID from the email
-            employee = EmployeeDetails.query.filter_by(email=user_email).first()
-            if employee:
-                # Get the city assignments for this employee
-                city_assignments = CityAssignment.query.filter_by(employee_id=employee.id, is_active=True).all()
-                cities = [ca.city for ca in city_assignments if ca.city]
+            identity = get_identity()
+            if identity:
+                cities = list(identity.assigned_cities)
         # For Finance Approver and Super Admin, show all cities
         else:
             # Get all unique cities from cost centers
@@ -1112,24 +1083,24 @@ def dashboard():
 
     # Get real data for scorecards
     try:
+        # Cost centers in scope for the epv_daily_summary rollup (None = all cost centers)
+        scope_cost_center_ids = None
+
         # Base query for EPVs - Finance users see all entries, others see only their own
         if employee_role in ['Finance', 'Finance Approver', 'Super Admin']:
             # Finance users see EPVs based on their assigned cities
             if employee_role == 'Finance':
-                # Get the employee ID from the email
-                employee = EmployeeDetails.query.filter_by(email=user_email).first()
-                if employee:
-                    # Get the city assignments for this employee
-                    city_assignments = CityAssignment.query.filter_by(employee_id=employee.id, is_active=True).all()
-                    assigned_cities = [ca.city for ca in city_assignments if ca.city]
+                identity = get_identity()
+                if identity:
+                    assigned_cities = identity.assigned_cities
 
                     if assigned_cities:
-                        # Get cost centers in the assigned cities
-                        assigned_cost_center_ids = db.session.query(CostCenter.id).filter(CostCenter.city.in_(assigned_cities)).all()
-                        assigned_cost_center_ids = [cc_id[0] for cc_id in assigned_cost_center_ids]
+                        # Cost centers in the assigned cities
+                        assigned_cost_center_ids = list(identity.assigned_cost_center_ids)
 
                         # Base query for EPVs in assigned cost centers
                         base_query = EPV.query.filter(EPV.cost_center_id.in_(assigned_cost_center_ids))
+                        scope_cost_center_ids = assigned_cost_center_ids
 
                         # If city filter is applied, filter by that specific city
                         if city_filter and city_filter in assigned_cities:
@@ -1138,12 +1109,15 @@ def dashboard():
 
                             if city_cost_center_ids:
                                 base_query = EPV.query.filter(EPV.cost_center_id.in_(city_cost_center_ids))
+                                scope_cost_center_ids = city_cost_center_ids
                     else:
                         # If no cities assigned, show no EPVs
                         base_query = EPV.query.filter(EPV.id == -1)  # This will return no results
+                        scope_cost_center_ids = []
                 else:
                     # If employee not found, show no EPVs
                     base_query = EPV.query.filter(EPV.id == -1)  # This will return no results
+                    scope_cost_center_ids = []
             else:
                 # Finance Approver and Super Admin see all EPVs
                 base_query = EPV.query
@@ -1157,6 +1131,7 @@ def dashboard():
                     # Filter EPVs by cost centers in the selected city
                     if city_cost_center_ids:
                         base_query = base_query.filter(EPV.cost_center_id.in_(city_cost_center_ids))
+                        scope_cost_center_ids = city_cost_center_ids
         else:
             # Regular users see only their own EPVs
             base_query = EPV.query.filter(EPV.email_id == user_email)
@@ -1175,75 +1150,31 @@ def dashboard():
         if start_date and end_date:
             base_query = base_query.filter(EPV.submission_date.between(start_date, end_date))
 
-        # Debug the SQL query
-        print(f"DEBUG: Dashboard SQL Query: {str(base_query)}")
-
-        # 1. Pending Claims - Count of EPVs with status 'submitted' or 'pending_approval'
-        pending_query = base_query.filter(EPV.status.in_(['submitted', 'pending_approval']))
-        pending_claims = pending_query.count()
-
-        # 2. Approved This Month - Count of EPVs approved in the current month
-        current_month = datetime.now().month
-        current_year = datetime.now().year
-        approved_this_month_query = base_query.filter(
-            EPV.status == 'approved',
-            db.extract('month', EPV.approved_on) == current_month,
-            db.extract('year', EPV.approved_on) == current_year
-        )
-        approved_this_month = approved_this_month_query.count()
-
-        # 3. Total Amount - Sum of all approved EPVs
-        total_amount_query = base_query.filter(EPV.status == 'approved')
-        total_amount_result = db.session.query(db.func.sum(EPV.total_amount)).filter(
-            EPV.id.in_([epv.id for epv in total_amount_query])
-        ).scalar()
-        total_amount = total_amount_result if total_amount_result else 0
-
-        # 4. Average Processing Time - Based on payment date and manager approval/resubmission date
-        # Import the processing days calculation function
-        from utils import calculate_processing_days
-        from models import EPVApproval, FinanceEntry
-
-        # Get all approved EPVs with finance entries that have payment dates
-        approved_epvs_query = base_query.filter(
-            EPV.status == 'approved',
-            EPV.finance_status == 'processed'
-        ).join(FinanceEntry).filter(FinanceEntry.payment_date.isnot(None))
-
-        approved_epvs = approved_epvs_query.all()
-
-        # Calculate average processing time in business days
-        if approved_epvs:
-            processing_days = []
-
-            # Process all approved EPVs with finance entries
-            for epv in approved_epvs:
-                # Find the finance entry with payment date
-                finance_entry = FinanceEntry.query.filter_by(
-                    epv_id=epv.id
-                ).first()
-
-                # Calculate processing days based on EPV status (regular or resubmitted)
-                if finance_entry and finance_entry.payment_date:
-                    business_days = calculate_processing_days(epv, finance_entry)
-                    processing_days.append(business_days)
-                    print(f"DEBUG: EPV {epv.epv_id} processing days: {business_days}")
-
-            # Calculate average if we have any valid processing times
-            if processing_days:
-                # Calculate average and round to whole number
-                avg_processing_time = round(sum(processing_days) / len(processing_days))
-                print(f"DEBUG: Average processing time: {avg_processing_time} days from {len(processing_days)} EPVs")
-            else:
-                avg_processing_time = 0
-                print("DEBUG: No valid processing times found")
-
+        # Compiling the query to SQL is only worth it when debugging
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Dashboard SQL Query: %s", base_query)
+
+        # Compute all scorecards with grouped SQL. Cost-center scoped views read the
+        # epv_daily_summary rollup; personal views aggregate over the scoped query.
+        from scorecards import get_dashboard_scorecards, get_summary_scorecards
+        if employee_role in ['Finance', 'Finance Approver', 'Super Admin'] and not cost_center_filter:
+            scorecards = get_summary_scorecards(
+                cost_center_ids=scope_cost_center_ids,
+                expense_head=expense_head_filter,
+                start_date=start_date,
+                end_date=end_date
+            )
         else:
-            avg_processing_time = 0
-            print("DEBUG: No approved EPVs with payment dates found")
+            scorecards = get_dashboard_scorecards(base_query)
+
+        pending_claims = scorecards['pending_claims']
+        approved_this_month = scorecards['approved_this_month']
+        total_amount = scorecards['total_amount']
+        avg_processing_time = scorecards['avg_processing_time']
+        logger.debug("Average processing time: %s days", avg_processing_time)
 
     except Exception as e:
-        print(f"ERROR: Failed to get dashboard data: {str(e)}")
+        logger.error("Failed to get dashboard data: %s", e)
         pending_claims = 0
         approved_this_month = 0
         total_amount = 0
@@ -1261,13 +1192,9 @@ def dashboard():
         'avg_processing_days': avg_processing_time  # Add the raw number for comparison in template
     }
 
-    # Debug output - use safe encoding for Unicode characters
-    try:
-        print(f"DEBUG: Dashboard data: {str(dashboard_data)}")
-    except UnicodeEncodeError:
-        print("DEBUG: Dashboard data: [Unicode encoding error - data contains non-ASCII characters]")
-
-    print(f"DEBUG: Filters applied - Expense Head: {expense_head_filter}, Cost Center: {cost_center_filter}, Time Period: {time_period_filter}")
+    logger.debug("Dashboard data: %s", dashboard_data)
+    logger.debug("Filters applied - Expense Head: %s, Cost Center: %s, Time Period: %s",
+                 expense_head_filter, cost_center_filter, time_period_filter)
 
     # Get finance settings
     finance_settings = {}
@@ -1362,6 +1289,11 @@ def edit_cost_center(id):
         cost_center.is_active = 'is_active' in request.form
 
         db.session.commit()
+
+        # A new cost center extends the scope of finance users assigned to its city
+        if is_new:
+            invalidate_identity()
+            invalidate_finance_routing()
         return redirect(url_for('cost_centers'))
 
     return render_template('edit_cost_center_new.html',
@@ -1438,11 +1370,17 @@ def edit_employee(id):
 
         employee.role = request.form.get('role')
         employee.is_active = 'is_active' in request.form
+        notification_mode = request.form.get('notification_mode')
+        employee.notification_mode = notification_mode if notification_mode in notification_digest.NOTIFICATION_MODES else None
 
         if is_new:
             db.session.add(employee)
 
         db.session.commit()
+
+        # The email may have changed, so drop all cached identities
+        invalidate_identity()
+        invalidate_finance_routing()
         return redirect(url_for('employees'))
 
     return render_template('edit_employee_new.html',
@@ -1498,6 +1436,8 @@ def toggle_employee_status(id):
         # Toggle the status
         employee.is_active = not employee.is_active
         db.session.commit()
+        invalidate_identity(employee.email)
+        invalidate_finance_routing()
 
         if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
             return jsonify({'success': True, 'is_active': employee.is_active})
@@ -1608,306 +1548,90 @@ def system_documentation():
     """View for system documentation with flowcharts"""
     return render_template('system_documentation.html', user=session.get('user_info'))
 
-# Finance Reports route (temporarily disabled)
+# Finance Reports route
 @app.route('/finance/reports')
 @login_required
 def finance_reports():
     """Render the finance reports page for Finance Approvers"""
-    # Temporarily disable this route for all users
-    flash('The Reports feature is currently under development and will be available soon.', 'info')
-    return redirect(url_for('dashboard'))
-
-    # Original code (commented out)
     # Check if user is a Finance Approver
-    # if session.get('employee_role') != 'Finance Approver':
-    #     flash('You do not have permission to access this page.', 'danger')
-    #     return redirect(url_for('dashboard'))
-
-    # Get the academic year from settings_finance
-    academic_year = "N/A"
-
-    # Try to get academic_year from SettingsFinance
-    academic_year_setting = SettingsFinance.query.filter_by(setting_name='academic_year').first()
-    if academic_year_setting:
-        academic_year = academic_year_setting.setting_value
-    else:
-        # If not found in settings_finance, check if there's a default value in the code
-        # For now, use the current year as a fallback
-        current_year = datetime.now().year
-        academic_year = f"{current_year}-{current_year+1}"
+    if session.get('employee_role') != 'Finance Approver':
+        flash('You do not have permission to access this page.', 'danger')
+        return redirect(url_for('dashboard'))
 
     # Get all cities for the filter
     cities = db.session.query(CostCenter.city).distinct().all()
-    cities = [city[0] for city in cities if city[0]]
+    cities = sorted(city[0] for city in cities if city[0])
 
     # Get all cost centers for the filter
-    cost_centers = CostCenter.query.filter_by(is_active=True).all()
+    cost_centers = CostCenter.query.filter_by(is_active=True).order_by(CostCenter.costcenter).all()
 
     # Get all expense heads for the filter
-    expense_heads = ExpenseHead.query.filter_by(is_active=True).all()
-
-    # Placeholder for overview data
-    overview_data = {
-        'total_expenses': '0',
-        'total_amount': '₹0',
-        'avg_amount': '₹0',
-        'avg_processing_time': '0 days'
-    }
+    expense_heads = ExpenseHead.query.filter_by(is_active=True).order_by(ExpenseHead.head_name).all()
 
     return render_template(
         'finance_reports.html',
-        academic_year=academic_year,
+        academic_year=finance_reports_service.get_academic_year(),
         cities=cities,
         cost_centers=cost_centers,
         expense_heads=expense_heads,
-        overview_data=overview_data
+        overview_data=finance_reports_service.get_overview_report('current_month')
     )
 
-# API endpoint for overview report data (temporarily disabled)
+# API endpoint for overview report data
 @app.route('/api/reports/overview')
 @login_required
 def api_reports_overview():
     """API endpoint for overview report data"""
-    # Temporarily disable this endpoint
-    return jsonify({'error': 'This feature is currently under development'}), 503
-
-    # Original code (commented out)
     # Check if user is a Finance Approver
-    # if session.get('employee_role') != 'Finance Approver':
-    #     return jsonify({'error': 'Permission denied'}), 403
-
-    # Get query parameters
-    date_range = request.args.get('date_range', 'current_month')
-    city = request.args.get('city', 'all')
-
-    # Calculate date range
-    today = datetime.now()
-    start_date = None
-    end_date = today
-
-    if date_range == 'current_month':
-        start_date = datetime(today.year, today.month, 1)
-    elif date_range == 'last_month':
-        if today.month == 1:
-            start_date = datetime(today.year - 1, 12, 1)
-            end_date = datetime(today.year, 1, 1) - timedelta(days=1)
-        else:
-            start_date = datetime(today.year, today.month - 1, 1)
-            end_date = datetime(today.year, today.month, 1) - timedelta(days=1)
-    elif date_range == 'current_quarter':
-        quarter = (today.month - 1) // 3 + 1
-        start_date = datetime(today.year, (quarter - 1) * 3 + 1, 1)
-    elif date_range == 'last_quarter':
-        quarter = (today.month - 1) // 3 + 1
-        if quarter == 1:
-            start_date = datetime(today.year - 1, 10, 1)
-            end_date = datetime(today.year, 1, 1) - timedelta(days=1)
-        else:
-            start_date = datetime(today.year, (quarter - 2) * 3 + 1, 1)
-            end_date = datetime(today.year, (quarter - 1) * 3 + 1, 1) - timedelta(days=1)
-    elif date_range == 'current_year':
-        start_date = datetime(today.year, 1, 1)
-    elif date_range == 'custom':
-        # Custom date range would be handled with additional parameters
-        # For now, default to current month
-        start_date = datetime(today.year, today.month, 1)
-
-    # Base query for EPVs
-    query = EPV.query.filter(
-        EPV.status.in_(['Approved', 'Finance Processing', 'Finance Approval Pending', 'Processed']),
-        EPV.submitted_on >= start_date,
-        EPV.submitted_on <= end_date
-    )
-
-    # Filter by city if specified
-    if city != 'all':
-        query = query.filter(EPV.city == city)
-
-    # Get all EPVs matching the criteria
-    epvs = query.all()
-
-    # Calculate statistics
-    total_expenses = len(epvs)
-    total_amount = sum(epv.total_amount for epv in epvs if epv.total_amount)
-    avg_amount = total_amount / total_expenses if total_expenses > 0 else 0
-
-    # Calculate average processing time
-    from utils import calculate_processing_days
-    processing_days = []
-    for epv in epvs:
-        if epv.status == 'Processed':
-            # Get the finance entry for this EPV
-            finance_entry = FinanceEntry.query.filter_by(epv_id=epv.id, status='Approved').first()
-            if finance_entry and finance_entry.payment_date:
-                # Get the manager approval date
-                approval = EPVApproval.query.filter_by(epv_id=epv.id, approver_role='Manager', status='Approved').first()
-                if approval and approval.approved_on:
-                    days = calculate_processing_days(approval.approved_on, finance_entry.payment_date)
-                    processing_days.append(days)
-
-    avg_processing_time = sum(processing_days) / len(processing_days) if processing_days else 0
-
-    # Generate monthly trend data (for the current year)
-    monthly_trend = [0] * 12
-    for epv in epvs:
-        if epv.submitted_on.year == today.year:
-            month_index = epv.submitted_on.month - 1
-            monthly_trend[month_index] += epv.total_amount if epv.total_amount else 0
-
-    # Generate category distribution data
-    category_distribution = {}
-    for epv in epvs:
-        # Get expense items for this EPV
-        items = EPVItem.query.filter_by(epv_id=epv.id).all()
-        for item in items:
-            # Get the expense head
-            expense_head = ExpenseHead.query.get(item.expense_head_id)
-            if expense_head:
-                head_name = expense_head.head_name
-                if head_name in category_distribution:
-                    category_distribution[head_name] += item.amount
-                else:
-                    category_distribution[head_name] = item.amount
-
-    # Format the category distribution for the chart
-    category_labels = list(category_distribution.keys())
-    category_values = list(category_distribution.values())
-
-    # Format the response
-    response = {
-        'total_expenses': f"{total_expenses:,}",
-        'total_amount': f"Rs. {total_amount:,.2f}",
-        'avg_amount': f"Rs. {avg_amount:,.2f}",
-        'avg_processing_time': f"{avg_processing_time:.1f} days",
-        'monthly_trend': monthly_trend,
-        'category_distribution': {
-            'labels': category_labels,
-            'values': category_values
-        }
-    }
+    if session.get('employee_role') != 'Finance Approver':
+        return jsonify({'error': 'Permission denied'}), 403
 
-    return jsonify(response)
+    return jsonify(finance_reports_service.get_overview_report(
+        request.args.get('date_range', 'current_month'),
+        request.args.get('city', 'all')
+    ))
 
-# API endpoint for expense trends (temporarily disabled)
+# API endpoint for expense trends
 @app.route('/api/reports/expense-trends')
 @login_required
 def api_reports_expense_trends():
     """API endpoint for expense trends data"""
-    # Temporarily disable this endpoint
-    return jsonify({'error': 'This feature is currently under development'}), 503
-
-    # Original code (commented out)
     # Check if user is a Finance Approver
-    # if session.get('employee_role') != 'Finance Approver':
-    #     return jsonify({'error': 'Permission denied'}), 403
-
-    # Get query parameters
-    time_period = request.args.get('time_period', 'monthly')
-    expense_head = request.args.get('expense_head', 'all')
+    if session.get('employee_role') != 'Finance Approver':
+        return jsonify({'error': 'Permission denied'}), 403
 
-    # Calculate date ranges based on time period
-    today = datetime.now()
-    start_date = datetime(today.year - 1, today.month, 1)  # Default to 1 year ago
+    return jsonify(finance_reports_service.get_expense_trends_report(
+        request.args.get('time_period', 'monthly'),
+        request.args.get('expense_head', 'all')
+    ))
 
-    # Base query for EPVs
-    query = EPV.query.filter(
-        EPV.status.in_(['Approved', 'Finance Processing', 'Finance Approval Pending', 'Processed']),
-        EPV.submitted_on >= start_date
-    )
+# API endpoint for cost center analysis
+@app.route('/api/reports/cost-centers')
+@login_required
+def api_reports_cost_centers():
+    """API endpoint for expenses and processing time per cost center"""
+    # Check if user is a Finance Approver
+    if session.get('employee_role') != 'Finance Approver':
+        return jsonify({'error': 'Permission denied'}), 403
 
-    # Get all EPVs matching the criteria
-    epvs = query.all()
-
-    # Prepare data structure based on time period
-    labels = []
-    values = []
-
-    if time_period == 'monthly':
-        # Generate monthly labels for the past 12 months
-        for i in range(12):
-            month = (today.month - i - 1) % 12 + 1
-            year = today.year if month <= today.month else today.year - 1
-            month_name = datetime(year, month, 1).strftime('%b %Y')
-            labels.insert(0, month_name)
-
-        # Initialize values array
-        values = [0] * 12
-
-        # Calculate monthly totals
-        for epv in epvs:
-            # Calculate months ago
-            months_ago = (today.year - epv.submitted_on.year) * 12 + (today.month - epv.submitted_on.month)
-            if 0 <= months_ago < 12:
-                index = 11 - months_ago
-
-                # If filtering by expense head, only include matching items
-                if expense_head != 'all':
-                    # Get expense items for this EPV
-                    items = EPVItem.query.filter_by(epv_id=epv.id, expense_head_id=expense_head).all()
-                    for item in items:
-                        values[index] += item.amount
-                else:
-                    values[index] += epv.total_amount if epv.total_amount else 0
-
-    elif time_period == 'quarterly':
-        # Generate quarterly labels for the past 4 quarters
-        current_quarter = (today.month - 1) // 3 + 1
-        for i in range(4):
-            quarter = (current_quarter - i - 1) % 4 + 1
-            year = today.year if quarter <= current_quarter else today.year - 1
-            quarter_label = f"Q{quarter} {year}"
-            labels.insert(0, quarter_label)
-
-        # Initialize values array
-        values = [0] * 4
-
-        # Calculate quarterly totals
-        for epv in epvs:
-            epv_quarter = (epv.submitted_on.month - 1) // 3 + 1
-            quarters_ago = (today.year - epv.submitted_on.year) * 4 + (current_quarter - epv_quarter)
-            if 0 <= quarters_ago < 4:
-                index = 3 - quarters_ago
-
-                # If filtering by expense head, only include matching items
-                if expense_head != 'all':
-                    # Get expense items for this EPV
-                    items = EPVItem.query.filter_by(epv_id=epv.id, expense_head_id=expense_head).all()
-                    for item in items:
-                        values[index] += item.amount
-                else:
-                    values[index] += epv.total_amount if epv.total_amount else 0
-
-    elif time_period == 'yearly':
-        # Generate yearly labels for the past 3 years
-        for i in range(3):
-            year = today.year - i
-            labels.insert(0, str(year))
-
-        # Initialize values array
-        values = [0] * 3
-
-        # Calculate yearly totals
-        for epv in epvs:
-            years_ago = today.year - epv.submitted_on.year
-            if 0 <= years_ago < 3:
-                index = 2 - years_ago
-
-                # If filtering by expense head, only include matching items
-                if expense_head != 'all':
-                    # Get expense items for this EPV
-                    items = EPVItem.query.filter_by(epv_id=epv.id, expense_head_id=expense_head).all()
-                    for item in items:
-                        values[index] += item.amount
-                else:
-                    values[index] += epv.total_amount if epv.total_amount else 0
+    return jsonify(finance_reports_service.get_cost_center_report(
+        request.args.get('date_range', 'current_month'),
+        request.args.get('city', 'all')
+    ))
 
-    # Format the response
-    response = {
-        'labels': labels,
-        'values': values
-    }
+# API endpoint for processing time analysis
+@app.route('/api/reports/processing-time')
+@login_required
+def api_reports_processing_time():
+    """API endpoint for average processing time per cost center, city or finance user"""
+    # Check if user is a Finance Approver
+    if session.get('employee_role') != 'Finance Approver':
+        return jsonify({'error': 'Permission denied'}), 403
 
-    return jsonify(response)
+    return jsonify(finance_reports_service.get_processing_time_report(
+        request.args.get('date_range', 'current_month'),
+        request.args.get('group_by', 'cost_center')
+    ))
 
 # Function to handle split invoice submission from main expense form
 def handle_split_invoice_submission(request, session, user_info):
@@ -2176,7 +1900,7 @@ def handle_split_invoice_submission(request, session, user_info):
         print(f"DEBUG: Split invoice saved to database with EPV ID: {epv_id}")
 
         # Step 4: Send approval emails to all approvers
-        from smtp_email_utils import send_split_allocation_approval_email
+        from smtp_email_utils import send_split_allocation_approval_emails
 
         # Get all allocation records from the database
         allocations = EPVAllocation.query.filter_by(epv_id=new_epv.id).all()
@@ -2186,27 +1910,20 @@ def handle_split_invoice_submission(request, session, user_info):
         base_url = request.url_root.rstrip('/')
         print(f"DEBUG: Base URL for approval links: {base_url}")
 
-        # Send individual approval emails for each allocation
+        # Send individual approval emails for each allocation (rendered from one compiled template)
         sent_emails = 0
-        for allocation in allocations:
-            try:
-                print(f"DEBUG: Sending approval email to {allocation.approver_email} for allocation {allocation.cost_center_name}")
-
-                # Send email using the proper split allocation approval email function
-                email_sent, message = send_split_allocation_approval_email(
-                    epv_record=new_epv,
-                    allocation=allocation,
-                    base_url=base_url
-                )
-
-                if email_sent:
-                    sent_emails += 1
-                    print(f"DEBUG: Approval email sent successfully to {allocation.approver_email}")
-                else:
-                    print(f"DEBUG: Failed to send approval email to {allocation.approver_email}: {message}")
+        try:
+            results = send_split_allocation_approval_emails(new_epv, allocations, base_url)
+        except Exception as e:
+            print(f"ERROR: Failed to send allocation approval emails: {str(e)}")
+            results = []
 
-            except Exception as e:
-                print(f"ERROR: Failed to send email to {allocation.approver_email}: {str(e)}")
+        for allocation, (email_sent, message) in zip(allocations, results):
+            if email_sent:
+                sent_emails += 1
+                print(f"DEBUG: Approval email sent successfully to {allocation.approver_email}")
+            else:
+                print(f"DEBUG: Failed to send approval email to {allocation.approver_email}: {message}")
 
         print(f"DEBUG: Sent {sent_emails} out of {len(allocations)} approval emails")
 
@@ -2267,7 +1984,7 @@ def new_expense():
         try:
             # Check if this is a split invoice
             invoice_type = request.form.get('invoice_type', 'standard')
-            print(f"DEBUG: Invoice type: {invoice_type}")
+            logger.debug("Invoice type: %s", invoice_type)
 
             if invoice_type == 'split':
                 # Handle split invoice processing
@@ -2285,17 +2002,17 @@ def new_expense():
             drive_folder_id = None
             cost_center_name = None
 
-            print(f"DEBUG: Selected cost_center_id: {cost_center_id}")
-            print(f"DEBUG: Cost center name from input: {cost_center_name_input}")
+            logger.debug("Selected cost_center_id: %s", cost_center_id)
+            logger.debug("Cost center name from input: %s", cost_center_name_input)
 
-            # List all cost centers and their drive IDs for debugging
-            try:
-                all_cost_centers = CostCenter.query.all()
-                print(f"DEBUG: All cost centers in database:")
-                for cc in all_cost_centers:
-                    print(f"DEBUG: ID: {cc.id}, Name: {cc.costcenter}, Drive ID: {cc.drive_id}")
-            except Exception as e:
-                print(f"ERROR: Failed to list all cost centers: {str(e)}")
+            # List all cost centers and their drive IDs for debugging (reads the whole table)
+            if logger.isEnabledFor(logging.DEBUG):
+                try:
+                    logger.debug("All cost centers in database:")
+                    for cc in CostCenter.query.all():
+                        logger.debug("ID: %s, Name: %s, Drive ID: %s", cc.id, cc.costcenter, cc.drive_id)
+                except Exception as e:
+                    logger.error("Failed to list all cost centers: %s", e)
 
             # Process cost center information
             if cost_center_id:
@@ -2303,7 +2020,7 @@ def new_expense():
                 try:
                     cost_center_id = int(cost_center_id)
                 except ValueError:
-                    print(f"DEBUG: cost_center_id is not an integer: {cost_center_id}")
+                    logger.debug("cost_center_id is not an integer: %s", cost_center_id)
 
                 # Try to get the cost center by ID
                 try:
@@ -2311,28 +2028,28 @@ def new_expense():
                     if cost_center:
                         cost_center_name = cost_center.costcenter
                         drive_folder_id = cost_center.drive_id
-                        print(f"DEBUG: Found cost center by ID: {cost_center_name}, Drive folder ID: {drive_folder_id}")
+                        logger.debug("Found cost center by ID: %s, Drive folder ID: %s", cost_center_name, drive_folder_id)
                     else:
-                        print(f"DEBUG: No cost center found with ID: {cost_center_id}, using name from input")
+                        logger.debug("No cost center found with ID: %s, using name from input", cost_center_id)
                         cost_center_name = cost_center_name_input
                 except Exception as e:
-                    print(f"ERROR: Failed to get cost center by ID: {str(e)}")
+                    logger.error("Failed to get cost center by ID: %s", e)
                     cost_center_name = cost_center_name_input
             else:
                 # No cost center ID provided, use the name from input
-                print(f"DEBUG: No cost center ID provided, using name from input")
+                logger.debug("No cost center ID provided, using name from input")
                 cost_center_name = cost_center_name_input
 
             # If we still don't have a cost center name, use a default
             if not cost_center_name:
                 cost_center_name = "Unknown Cost Center"
-                print(f"WARNING: Using default cost center name: {cost_center_name}")
+                logger.warning("Using default cost center name: %s", cost_center_name)
 
             # Debug request.files
-            print(f"DEBUG: request.files keys: {list(request.files.keys())}")
+            logger.debug("request.files keys: %s", list(request.files.keys()))
             for key in request.files.keys():
                 file = request.files[key]
-                print(f"DEBUG: File key: {key}, filename: {file.filename if file else 'None'}")
+                logger.debug("File key: %s, filename: %s", key, file.filename if file else 'None')
 
             # Generate a unique EPV ID for this expense
             # Format: EPV-YYYYMMDD-COSTCENTER-XXXXXXXXXX (using full cost center name, 10 hex chars from UUID for uniqueness)
@@ -2361,7 +2078,7 @@ def new_expense():
                 descriptions = request.form.getlist('description[]')
                 split_invoices = request.form.getlist('split_invoice[]')
 
-                print(f"DEBUG: Split invoice values: {split_invoices}")
+                logger.debug("Split invoice values: %s", split_invoices)
 
                 # Process each expense item
                 for i in range(len(invoice_dates)):
@@ -2370,7 +2087,7 @@ def new_expense():
                         is_split = False
                         if i < len(split_invoices) and split_invoices[i] == '1':
                             is_split = True
-                            print(f"DEBUG: Expense #{i+1} is marked as a split invoice")
+                            logger.debug("Expense #%s is marked as a split invoice", i + 1)
 
                         expense = {
                             'invoice_date': invoice_dates[i],
@@ -2380,7 +2097,7 @@ def new_expense():
                             'split_invoice': is_split
                         }
                         expense_data['expenses'].append(expense)
-                        print(f"DEBUG: Added expense item: {expense}")
+                        logger.debug("Added expense item: %s", expense)
             # Old format (expenses[i][field])
             else:
                 i = 0
@@ -2402,12 +2119,12 @@ def new_expense():
             # Get amount in words from form or generate it
             if 'amount_in_words' in request.form and request.form.get('amount_in_words'):
                 expense_data['amount_in_words'] = request.form.get('amount_in_words')
-                print(f"DEBUG: Using amount in words from form: {expense_data['amount_in_words']}")
+                logger.debug("Using amount in words from form: %s", expense_data['amount_in_words'])
             else:
                 # Generate amount in words
                 from utils import number_to_words
                 expense_data['amount_in_words'] = number_to_words(total_amount)
-                print(f"DEBUG: Generated amount in words: {expense_data['amount_in_words']}")
+                logger.debug("Generated amount in words: %s", expense_data['amount_in_words'])
 
             # Identify split invoices and collect all expense indices
             split_invoice_indices = []
@@ -2416,12 +2133,12 @@ def new_expense():
                 all_expense_indices.append(i)
                 if expense.get('split_invoice'):
                     split_invoice_indices.append(i)
-                    print(f"DEBUG: Expense #{i+1} is marked as a split invoice, will skip receipt upload")
+                    logger.debug("Expense #%s is marked as a split invoice, will skip receipt upload", i + 1)
 
             # Find the highest index in the expenses
             max_expense_index = max(all_expense_indices) if all_expense_indices else -1
-            print(f"DEBUG: Max expense index: {max_expense_index}")
-            print(f"DEBUG: Split invoice indices: {split_invoice_indices}")
+            logger.debug("Max expense index: %s", max_expense_index)
+            logger.debug("Split invoice indices: %s", split_invoice_indices)
 
             # Check if there are any expenses after a split invoice
             has_expenses_after_split = False
@@ -2430,7 +2147,7 @@ def new_expense():
                 for split_idx in split_invoice_indices:
                     if i > split_idx:
                         has_expenses_after_split = True
-                        print(f"DEBUG: Found expense #{i+1} after split invoice #{split_idx+1}")
+                        logger.debug("Found expense #%s after split invoice #%s", i + 1, split_idx + 1)
                         break
                 if has_expenses_after_split:
                     break
@@ -2439,16 +2156,16 @@ def new_expense():
             expense_files = []
 
             # Print all files for debugging
-            print(f"DEBUG: All files in request.files: {list(request.files.keys())}")
-            print(f"DEBUG: Split invoice indices: {split_invoice_indices}")
+            logger.debug("All files in request.files: %s", list(request.files.keys()))
+            logger.debug("Split invoice indices: %s", split_invoice_indices)
 
             # Get all receipt files
             receipt_files = request.files.getlist('receipt[]')
-            print(f"DEBUG: Found {len(receipt_files)} receipt[] files")
+            logger.debug("Found %s receipt[] files", len(receipt_files))
 
             # Print all receipt files for debugging
             for i, file in enumerate(receipt_files):
-                print(f"DEBUG: Receipt file {i}: {file.filename}")
+                logger.debug("Receipt file %s: %s", i, file.filename)
 
             # Create a mapping of expense index to file
             expense_file_map = {}
@@ -2456,7 +2173,7 @@ def new_expense():
             # First, map the first file to the first expense
             if len(receipt_files) > 0 and receipt_files[0].filename:
                 expense_file_map[0] = receipt_files[0]
-                print(f"DEBUG: Mapped first file {receipt_files[0].filename} to expense index 0")
+                logger.debug("Mapped first file %s to expense index 0", receipt_files[0].filename)
 
             # Now map the remaining files to non-split expenses
             file_index = 1  # Start from the second file
@@ -2465,227 +2182,66 @@ def new_expense():
             while file_index < len(receipt_files) and expense_index <= max_expense_index:
                 # Skip split invoices
                 if expense_index in split_invoice_indices:
-                    print(f"DEBUG: Skipping split invoice at expense index {expense_index}")
+                    logger.debug("Skipping split invoice at expense index %s", expense_index)
                     expense_index += 1
                     continue
 
                 # Map the file to the expense
                 if receipt_files[file_index].filename:
                     expense_file_map[expense_index] = receipt_files[file_index]
-                    print(f"DEBUG: Mapped file {receipt_files[file_index].filename} to expense index {expense_index}")
+                    logger.debug("Mapped file %s to expense index %s", receipt_files[file_index].filename, expense_index)
                     file_index += 1
 
                 expense_index += 1
 
             # Print the final mapping
-            print(f"DEBUG: Final expense to file mapping:")
+            logger.debug("Final expense to file mapping:")
             for exp_idx, file in expense_file_map.items():
-                print(f"DEBUG: Expense {exp_idx} -> {file.filename}")
+                logger.debug("Expense %s -> %s", exp_idx, file.filename)
 
             # Add all files to be processed
             for exp_idx, file in expense_file_map.items():
-                print(f"DEBUG: Adding file for expense {exp_idx}: {file.filename}")
+                logger.debug("Adding file for expense %s: %s", exp_idx, file.filename)
                 expense_files.append(file)
 
-            # Step 1: Generate expense document PDF
-            from pdf_converter import generate_expense_document, REPORTLAB_AVAILABLE
-            expense_pdf_path = generate_expense_document(expense_data)
-
-            if not expense_pdf_path:
-                error_message = 'Failed to generate expense document'
-                if not REPORTLAB_AVAILABLE:
-                    error_message = 'ReportLab library is not available for PDF generation. Please contact your administrator.'
-                return jsonify({
-                    'success': False,
-                    'message': error_message
-                })
-
-            # Debug print expense type
-            print(f"DEBUG: expense_type from form: {request.form.get('expense_type')}")
-
-            # Initialize variables to track file processing status
-            file_url = None
-            file_id = None
-            merged_pdf_path = None
-
-            # Step 2: Process the files if any were uploaded
-            result = None
-            if expense_files:
-                try:
-                    # Process the files: save, convert to PDF, merge with expense document, and upload to Google Drive
-                    result = process_files(
-                        files=expense_files,
-                        drive_folder_id=drive_folder_id,
-                        employee_name=employee_name,
-                        cost_center_name=cost_center_name,
-                        expense_pdf_path=expense_pdf_path
-                    )
-
-                    # Check if file processing was successful
-                    if not result['success']:
-                        error_msg = result.get('error') or "Failed to process files."
-                        user_msg = result.get('user_message') or "There was an issue with the file processing."
-                        return jsonify({
-                            'success': False,
-                            'message': user_msg,
-                            'error': error_msg
-                        })
-
-                    # Store merged PDF path if available
-                    if result.get('merged_pdf'):
-                        merged_pdf_path = result['merged_pdf']
-                        session['merged_pdf_path'] = merged_pdf_path
-
-                    # Check if Google Drive upload was successful
-                    if result.get('drive_file_id') and result.get('drive_file_url'):
-                        file_id = result['drive_file_id']
-                        file_url = result['drive_file_url']
-                        # Store drive file information in session for split invoices
-                        session['drive_file_id'] = file_id
-                        session['drive_file_url'] = file_url
-                        print(f"File uploaded to Google Drive: {file_url}")
-                        print(f"DEBUG: Stored drive file info in session - ID: {file_id}, URL: {file_url}")
-                    else:
-                        # If Drive upload failed, return error
-                        drive_error = result.get('drive_error') or "Failed to upload to Google Drive."
-                        return jsonify({
-                            'success': False,
-                            'message': "File processing completed but Google Drive upload failed.",
-                            'error': drive_error
-                        })
-                except Exception as e:
-                    print(f"Error processing files: {str(e)}")
-                    import traceback
-                    print(f"DEBUG: File processing error traceback: {traceback.format_exc()}")
-                    return jsonify({
-                        'success': False,
-                        'message': 'Error processing files.',
-                        'error': str(e)
-                    })
-            else:
-                # No files uploaded, just upload the expense document to Google Drive
-                try:
-                    # Generate a filename for download
-                    download_filename = f"Expense_{employee_name}_{cost_center_name}_{datetime.now().strftime('%Y-%m-%d')}.pdf"
-
-                    # If drive_folder_id is provided, upload to Google Drive
-                    if drive_folder_id:
-                        from drive_utils import upload_file_to_drive, get_file_url
-                        file_id = upload_file_to_drive(expense_pdf_path, download_filename, drive_folder_id)
-
-                        if file_id and file_id != 'local_file':
-                            file_url = get_file_url(file_id)
-                            # Store drive file information in session for split invoices
-                            session['drive_file_id'] = file_id
-                            session['drive_file_url'] = file_url
-                            print(f"Expense document uploaded to Google Drive: {file_url}")
-                            print(f"DEBUG: Stored drive file info in session - ID: {file_id}, URL: {file_url}")
-                        else:
-                            return jsonify({
-                                'success': False,
-                                'message': 'Failed to upload expense document to Google Drive'
-                            })
-                    else:
-                        return jsonify({
-                            'success': False,
-                            'message': f"No Google Drive folder ID found for the selected cost center: {cost_center_name if cost_center_name else cost_center_id}"
-                        })
-
-                    # Store the PDF path in session for download
-                    session['merged_pdf_path'] = expense_pdf_path
-                    merged_pdf_path = expense_pdf_path
-                except Exception as e:
-                    print(f"Error uploading expense document: {str(e)}")
-                    import traceback
-                    print(f"DEBUG: Document upload error traceback: {traceback.format_exc()}")
-                    return jsonify({
-                        'success': False,
-                        'message': f"Error uploading expense document: {str(e)}"
-                    })
-
-            # Step 3: Now that file processing and Google Drive upload are successful, save to database
-            try:
-                # Create new EPV record
-                new_epv = EPV(
-                    epv_id=epv_id,
-                    email_id=session.get('email', ''),  # Capture the user's email
-                    employee_name=employee_name,
-                    employee_id=employee_id,
-                    from_date=datetime.strptime(request.form.get('from_date'), '%Y-%m-%d'),
-                    to_date=datetime.strptime(request.form.get('to_date'), '%Y-%m-%d'),
-                    payment_to=request.form.get('expense_type', 'General Expense'),  # Default value if not provided
-                    acknowledgement=request.form.get('acknowledgement', 'Yes') if request.form.get('acknowledgement') else None,  # Save acknowledgement
-                    submission_date=datetime.now(),
-                    academic_year=f"{datetime.now().year}-{datetime.now().year + 1}",
-                    cost_center_id=cost_center_id,
-                    cost_center_name=cost_center_name,
-                    city=request.form.get('city', ''),  # Get city from the form
-                    total_amount=float(expense_data['total_amount']),
-                    amount_in_words=expense_data.get('amount_in_words', ''),
-                    status='submitted',
-                    file_url=file_url,  # Add the Google Drive file URL
-                    drive_file_id=file_id  # Add the Google Drive file ID
-                )
-
-                db.session.add(new_epv)
-                db.session.flush()  # Get the ID without committing
-
-                # Add expense items
-                for expense in expense_data['expenses']:
-                    item = EPVItem(
-                        epv_id=new_epv.id,
-                        expense_invoice_date=datetime.strptime(expense['invoice_date'], '%Y-%m-%d'),
-                        expense_head=expense['expense_head'],
-                        description=expense['description'],
-                        amount=float(expense['amount']),
-                        gst=0.0,  # Default value, can be updated later
-                        split_invoice=expense.get('split_invoice', False)  # Include the split invoice flag
-                    )
-                    db.session.add(item)
-
-                db.session.commit()
-                print(f"DEBUG: Saved expense data to database with EPV ID: {epv_id}")
-                print(f"DEBUG: EPV record ID: {new_epv.id}")
-            except Exception as e:
-                db.session.rollback()
-                print(f"ERROR saving expense data to database: {str(e)}")
-                import traceback
-                print(f"DEBUG: Database error traceback: {traceback.format_exc()}")
-                return jsonify({
-                    'success': False,
-                    'message': 'File processing and upload successful, but database save failed.',
-                    'error': str(e)
-                })
-
-            # Store success response for later
-            success_response = {
-                'success': True,
-                'message': 'Expense submitted successfully!',
-                'epv_id': epv_id,
-                'pdf_url': '/download-pdf'
+            # Save the receipts and queue the document job: generate the expense document,
+            # merge the receipts into it, upload to Google Drive and create the EPV
+            from document_jobs import create_document_job, submit_document_job, run_document_job
+            payload = {
+                'expense_data': expense_data,
+                'employee_id': employee_id,
+                'employee_name': employee_name,
+                'from_date': request.form.get('from_date'),
+                'to_date': request.form.get('to_date'),
+                'expense_type': request.form.get('expense_type'),
+                'acknowledgement': request.form.get('acknowledgement', 'Yes') if request.form.get('acknowledgement') else None,
+                'cost_center_id': cost_center_id,
+                'cost_center_name': cost_center_name,
+                'city': request.form.get('city', ''),
+                'drive_folder_id': drive_folder_id
             }
+            job_id = create_document_job(
+                epv_id=epv_id,
+                email=session.get('email', ''),
+                payload=payload,
+                files=expense_files,
+                drive_token=session.get('google_token')
+            )
 
-            # Add drive file URL to response if available
-            if file_url:
-                success_response['drive_file_url'] = file_url
-
-            print("DEBUG: About to create approval record")
-            print(f"DEBUG: Current session data: {session}")
-
-            # Get manager email for approval - but don't send email automatically
-            # The email will be sent when the user clicks the "Send for Approval" button
-            manager_email = session.get('employee_manager', '')
-            print(f"DEBUG: Manager email from session: {manager_email}")
-
-            # Add manager email to the response
-            success_response['manager_email'] = manager_email
-
-            # No need for additional code here, approval record is created above
+            if app.config['DOCUMENT_JOBS_ASYNC']:
+                submit_document_job(job_id)
+                return jsonify({
+                    'success': True,
+                    'message': 'Expense received, preparing the document...',
+                    'epv_id': epv_id,
+                    'job_id': job_id,
+                    'status_url': url_for('document_job_status', job_id=job_id)
+                }), 202
 
-            # Return success
-            return jsonify(success_response)
+            run_document_job(job_id)
+            return document_job_response(job_id)
         except Exception as e:
-            print(f"Unexpected error in expense submission: {str(e)}")
+            logger.error("Unexpected error in expense submission: %s", e)
             return jsonify({
                 'success': False,
                 'message': 'Error submitting expense.',
@@ -2702,6 +2258,41 @@ def new_expense():
                            employees=employees,
                            expense_heads=expense_heads)
 
+def document_job_response(job_id):
+    """
+    JSON status of a document job for the submitter.
+
+    Once the job has completed, the Drive file and PDF are stored in the
+    session (for /download-pdf and split invoices) and the response carries
+    the same fields the synchronous submission used to return.
+    """
+    from models import DocumentJob
+    from document_jobs import get_job_status
+
+    job = db.session.get(DocumentJob, job_id)
+    if not job or job.email != session.get('email', ''):
+        return jsonify({'success': False, 'message': 'Job not found'}), 404
+
+    status = get_job_status(job)
+    status['success'] = job.status != 'failed'
+
+    if job.status == 'completed':
+        result = json.loads(job.result or '{}')
+        if result.get('drive_file_id'):
+            session['drive_file_id'] = result['drive_file_id']
+            session['drive_file_url'] = result['drive_file_url']
+        if result.get('merged_pdf_path'):
+            session['merged_pdf_path'] = result['merged_pdf_path']
+        status['pdf_url'] = '/download-pdf'
+        status['manager_email'] = session.get('employee_manager', '')
+
+    return jsonify(status)
+
+@app.route('/api/document-jobs/<job_id>')
+def document_job_status(job_id):
+    """Progress of a new expense document job, polled by the expense form"""
+    return document_job_response(job_id)
+
 # DISABLED: Old split invoice allocation route - functionality moved to main expense form
 # @app.route('/split-invoice-allocation', methods=['GET', 'POST'])
 def split_invoice_allocation_disabled():
@@ -3644,65 +3235,6 @@ def process_split_allocation_rejection():
         print(f"Error rejecting split allocation: {str(e)}")
         return render_template('error.html', error=f"An error occurred: {str(e)}"), 500
 
-def update_split_epv_amounts(epv):
-    """Update the approved, rejected, and pending amounts for a split EPV"""
-    allocations = EPVAllocation.query.filter_by(epv_id=epv.id).all()
-
-    approved_amount = 0.0
-    rejected_amount = 0.0
-    pending_amount = 0.0
-
-    for allocation in allocations:
-        if allocation.status == 'approved':
-            approved_amount += allocation.allocated_amount
-        elif allocation.status == 'rejected':
-            rejected_amount += allocation.allocated_amount
-        else:  # pending
-            pending_amount += allocation.allocated_amount
-
-    epv.approved_amount = approved_amount
-    epv.rejected_amount = rejected_amount
-    epv.pending_amount = pending_amount
-
-    print(f"DEBUG: Updated EPV {epv.epv_id} amounts - Approved: ₹{approved_amount}, Rejected: ₹{rejected_amount}, Pending: ₹{pending_amount}")
-
-def check_and_send_split_to_finance(epv):
-    """Check if split EPV should be sent to finance and update status accordingly"""
-    allocations = EPVAllocation.query.filter_by(epv_id=epv.id).all()
-
-    # Check if any allocations are still pending
-    pending_count = sum(1 for allocation in allocations if allocation.status == 'pending')
-    approved_count = sum(1 for allocation in allocations if allocation.status == 'approved')
-    rejected_count = sum(1 for allocation in allocations if allocation.status == 'rejected')
-    total_count = len(allocations)
-
-    print(f"DEBUG: Split EPV {epv.epv_id} status - Pending: {pending_count}, Approved: {approved_count}, Rejected: {rejected_count}, Total: {total_count}")
-
-    # CORRECTED LOGIC:
-    # - 'partially_approved' only when NO pending allocations AND some approved + some rejected
-    # - 'approved' when NO pending allocations AND all approved
-    # - 'rejected' when NO pending allocations AND all rejected
-    # - 'pending_approval' when there are still pending allocations
-
-    if pending_count == 0:
-        # All allocations have been processed (no pending)
-        if approved_count > 0 and rejected_count > 0:
-            # Some approved, some rejected - this is partially approved
-            epv.status = 'partially_approved'
-            print(f"DEBUG: Split EPV {epv.epv_id} partially approved - Approved: {approved_count}, Rejected: {rejected_count}, Approved Amount: ₹{epv.approved_amount}")
-        elif approved_count > 0 and rejected_count == 0:
-            # All approved
-            epv.status = 'approved'
-            print(f"DEBUG: Split EPV {epv.epv_id} fully approved - All {approved_count} allocations approved")
-        elif approved_count == 0 and rejected_count > 0:
-            # All rejected
-            epv.status = 'rejected'
-            print(f"DEBUG: Split EPV {epv.epv_id} fully rejected - All {rejected_count} allocations rejected")
-    else:
-        # Still have pending allocations
-        epv.status = 'pending_approval'
-        print(f"DEBUG: Split EPV {epv.epv_id} still pending - Pending: {pending_count}, Approved: {approved_count}, Rejected: {rejected_count}")
-
 # Add an API endpoint to get employee details
 @app.route('/api/employees')
 def get_employees():
@@ -3761,129 +3293,56 @@ def get_finance_settings():
 def get_notifications():
     """Get notifications for the current user"""
     notifications = []
-    user_email = session.get('email')
 
-    # Get pending approval notifications
-    if user_email:
-        # Check if user is an approver for any pending expenses
-        pending_approvals_query = db.session.query(EPVApproval).filter(
-            EPVApproval.approver_email == user_email,
-            EPVApproval.status == 'pending'
-        )
+    identity = get_identity()
+    if not identity:
+        return jsonify(notifications)
 
-        # Get the count and add notification if there are pending approvals
-        if pending_approvals_query.count() > 0:
-            notifications.append({
-                'type': 'approval',
-                'message': f'You have expenses pending your approval',
-                'href': '/epv-records?status=pending_approval',
-                'icon': 'fa-file-signature'
-            })
+    counts = get_notification_counts(identity, session.get('employee_role'))
+
+    if counts['manager_approval']:
+        notifications.append({
+            'type': 'approval',
+            'message': f"You have {counts['manager_approval']} expenses pending your approval",
+            'href': url_for('approval_inbox'),
+            'icon': 'fa-file-signature'
+        })
 
-        # For testing purposes, add another notification
+    if counts['pending_submitted']:
         notifications.append({
             'type': 'pending_approval',
-            'message': 'You have 3 expenses pending approval',
+            'message': f"You have {counts['pending_submitted']} expenses pending approval",
             'href': '/epv-records?status=pending_approval',
             'icon': 'fa-clock'
         })
 
-        # Add another test notification
+    if counts['finance_pending']:
         notifications.append({
             'type': 'finance_pending',
-            'message': 'You have 2 expenses to process',
+            'message': f"You have {counts['finance_pending']} expenses to process",
             'href': '/finance-dashboard',
             'icon': 'fa-file-invoice-dollar'
         })
 
-    # Get finance notifications for finance users
-    if session.get('employee_role') in ['Finance', 'Finance Approver']:
-        # Get assigned cities
-        assigned_cities = []
-        if session.get('employee_role') == 'Finance':
-            # First get the employee ID from the email
-            employee = EmployeeDetails.query.filter_by(email=user_email).first()
-            if employee:
-                # Then get the city assignments for this employee
-                city_assignments = CityAssignment.query.filter_by(employee_id=employee.id, is_active=True).all()
-                assigned_cities = [ca.city for ca in city_assignments]
-
-        # For Finance Approver, show all cities
-        if session.get('employee_role') == 'Finance Approver':
-            # Get all expenses pending finance approval
-            pending_finance_approval = db.session.query(EPV).join(
-                FinanceEntry, EPV.id == FinanceEntry.epv_id
-            ).filter(
-                EPV.finance_status == 'processed',
-                FinanceEntry.status == 'pending'
-            ).count()
-
-            if pending_finance_approval > 0:
-                notifications.append({
-                    'type': 'finance_approval',
-                    'message': f'You have {pending_finance_approval} expenses pending finance approval',
-                    'href': '/finance-dashboard?tab=for_approval',
-                    'icon': 'fa-file-invoice-dollar'
-                })
-
-        # For Finance users, show expenses for their assigned cities
-        elif assigned_cities:
-            # Get expenses pending finance processing for assigned cities
-            # Only count expenses with direct city match to assigned cities
-            direct_city_count = db.session.query(EPV).filter(
-                EPV.status == 'approved',
-                EPV.finance_status == 'pending',
-                EPV.city.in_(assigned_cities)
-            ).count()
-
-            # Then count expenses without city but with cost center city match
-            cost_center_city_count = db.session.query(EPV).join(
-                CostCenter, EPV.cost_center_id == CostCenter.id
-            ).filter(
-                EPV.status == 'approved',
-                EPV.finance_status == 'pending',
-                EPV.city == None,  # Only count expenses without a direct city
-                CostCenter.city.in_(assigned_cities)
-            ).count()
-
-            # Total count
-            pending_finance = direct_city_count + cost_center_city_count
-
-            if pending_finance > 0:
-                notifications.append({
-                    'type': 'finance_pending',
-                    'message': f'You have {pending_finance} expenses to process',
-                    'href': '/finance-dashboard',
-                    'icon': 'fa-file-invoice-dollar'
-                })
+    if counts['finance_approval']:
+        notifications.append({
+            'type': 'finance_approval',
+            'message': f"You have {counts['finance_approval']} expenses pending finance approval",
+            'href': '/finance-dashboard?tab=for_approval',
+            'icon': 'fa-file-invoice-dollar'
+        })
 
     return jsonify(notifications)
 
 # Add an API endpoint to get cost centers
 @app.route('/api/cost-centers')
 def get_cost_centers():
-    # Get search term from request
+    # Get search term and result limit from request
     search_term = request.args.get('term', '')
+    limit = request.args.get('limit', type=int)
 
-    # If search term is provided, filter cost centers by name
-    if search_term:
-        # Search for cost centers whose name contains the search term (case-insensitive)
-        cost_centers = CostCenter.query.filter(
-            CostCenter.costcenter.ilike(f'%{search_term}%'),
-            CostCenter.is_active == True
-        ).all()
-    else:
-        # Get all active cost centers
-        cost_centers = CostCenter.query.filter_by(is_active=True).all()
-
-    # Convert to JSON
-    cost_center_list = [{
-        'id': cc.id,
-        'name': cc.costcenter,
-        'city': cc.city,
-        'value': cc.costcenter,  # For jQuery UI autocomplete
-        'label': cc.costcenter   # For jQuery UI autocomplete
-    } for cc in cost_centers]
+    # Active cost centers whose name contains the search term, from the in-memory index
+    cost_center_list = autocomplete.search('cost_centers', search_term, limit)
 
     print(f"API response for cost centers '{search_term}': {len(cost_center_list)} found")
 
@@ -4051,46 +3510,48 @@ def upload_supplementary(epv_id):
             folder_id = cost_center.drive_id
 
         # Import our PDF utilities
+        from pdf_merge import PDFMerge
         from pdf_utils import merge_supplementary_documents, upload_to_drive
 
-        # Merge all supplementary documents with the original PDF
-        merged_pdf_path = merge_supplementary_documents(epv, uploaded_files, app.config['UPLOAD_FOLDER'])
-
-        if merged_pdf_path:
-            print(f"Successfully merged PDFs: {merged_pdf_path}")
-
-            # Upload the merged PDF to Google Drive
-            if folder_id:
-                # Upload to Google Drive
-                file_name = f"Expense_{epv.employee_name}_{cost_center.costcenter if cost_center else 'Unknown'}_{datetime.now().strftime('%Y-%m-%d')}_supplementary.pdf"
-
-                # Store the old file ID for potential deletion later
-                old_file_id = epv.drive_file_id
-
-                # Upload the new merged file
-                new_file_id = upload_to_drive(merged_pdf_path, file_name, folder_id)
-
-                if new_file_id:
-                    # Update the supplementary document record for the last uploaded document
-                    # (We can't update all of them since the drive_file_id field only stores one ID)
-                    if uploaded_files:
-                        last_doc = SupplementaryDocument.query.filter_by(
-                            epv_id=epv.id,
-                            file_path=uploaded_files[-1][1]
-                        ).first()
-                        if last_doc:
-                            last_doc.drive_file_id = new_file_id
-
-                    # Update the EPV record with the new file ID
-                    epv.drive_file_id = new_file_id
-                    epv.file_url = f"https://drive.google.com/file/d/{new_file_id}/view?usp=drivesdk"
-                    print(f"Updated EPV record with new file ID: {new_file_id}")
-                else:
-                    print("Failed to upload merged PDF to Google Drive")
-                    flash('Documents uploaded but could not be uploaded to Google Drive.', 'warning')
-        else:
-            print("Failed to merge PDFs")
-            flash('Documents uploaded but could not be merged with the original PDF.', 'warning')
+        # Merge all supplementary documents with the original PDF in memory
+        with PDFMerge() as merge:
+            merged_pdf = merge_supplementary_documents(epv, uploaded_files, merge)
+
+            if merged_pdf:
+                print(f"Successfully merged PDFs for {epv.epv_id}")
+
+                # Upload the merged PDF to Google Drive
+                if folder_id:
+                    # Upload to Google Drive
+                    file_name = f"Expense_{epv.employee_name}_{cost_center.costcenter if cost_center else 'Unknown'}_{datetime.now().strftime('%Y-%m-%d')}_supplementary.pdf"
+
+                    # Store the old file ID for potential deletion later
+                    old_file_id = epv.drive_file_id
+
+                    # Upload the new merged file
+                    new_file_id = upload_to_drive(merged_pdf, file_name, folder_id)
+
+                    if new_file_id:
+                        # Update the supplementary document record for the last uploaded document
+                        # (We can't update all of them since the drive_file_id field only stores one ID)
+                        if uploaded_files:
+                            last_doc = SupplementaryDocument.query.filter_by(
+                                epv_id=epv.id,
+                                file_path=uploaded_files[-1][1]
+                            ).first()
+                            if last_doc:
+                                last_doc.drive_file_id = new_file_id
+
+                        # Update the EPV record with the new file ID
+                        epv.drive_file_id = new_file_id
+                        epv.file_url = f"https://drive.google.com/file/d/{new_file_id}/view?usp=drivesdk"
+                        print(f"Updated EPV record with new file ID: {new_file_id}")
+                    else:
+                        print("Failed to upload merged PDF to Google Drive")
+                        flash('Documents uploaded but could not be uploaded to Google Drive.', 'warning')
+            else:
+                print("Failed to merge PDFs")
+                flash('Documents uploaded but could not be merged with the original PDF.', 'warning')
 
         # Update the EPV status regardless of whether PDF merge succeeded or failed
         # This ensures it always goes back to Finance for review
@@ -4162,39 +3623,18 @@ def download_file(epv_id):
 
     # Check if the user has permission to view this record
     user_email = session.get('email')
-    employee = EmployeeDetails.query.filter_by(email=user_email).first()
-    role = employee.role if employee else 'user'
+    identity = get_identity()
+    role = identity.role if identity else 'user'
 
     if role != 'Super Admin' and epv.email_id != user_email:
         print(f"DEBUG: Access denied for user {user_email} to download file for EPV {epv_id}")
         return redirect(url_for('epv_records'))
 
-    # Try to get the file path
+    # Serve the file from the local Drive file cache, downloading it on first view
     file_path = None
-
-    # Skip local file system check since we don't store files locally anymore
-    print(f"Skipping local file check - files are stored only in Google Drive")
-
-    # Skip local merged file check since we don't store files locally anymore
-    print(f"Skipping local merged file check - files are stored only in Google Drive")
-
-    # If we couldn't find the file locally and the EPV has a drive_file_id, try to download from Google Drive
-    if (not file_path or not os.path.exists(file_path)) and epv.drive_file_id and epv.drive_file_id != f"demo_file_id_{epv_id}":
+    if epv.drive_file_id and epv.drive_file_id != f"demo_file_id_{epv_id}":
         try:
-            # Import Google Drive utilities
-            from drive_utils import download_file_from_drive
-
-            # Create a temporary file to store the downloaded content
-            import tempfile
-            temp_dir = tempfile.mkdtemp()
-            temp_file = os.path.join(temp_dir, f"{epv_id}.pdf")
-
-            # Download the file from Google Drive
-            print(f"Attempting to download file from Google Drive with ID: {epv.drive_file_id}")
-            success = download_file_from_drive(epv.drive_file_id, temp_file)
-            if success:
-                file_path = temp_file
-                print(f"Successfully downloaded file from Google Drive: {file_path}")
+            file_path = drive_file_cache.get_cached_file(epv.drive_file_id)
         except Exception as e:
             print(f"Error downloading file from Google Drive: {str(e)}")
 
@@ -4204,11 +3644,13 @@ def download_file(epv_id):
 
     # Return the file for download
     try:
+        # conditional=True answers Range and If-None-Match requests from the cached copy
         return send_file(
             file_path,
             as_attachment=False,  # Display in browser by default
             download_name=f"expense_{epv_id}.pdf",
-            mimetype='application/pdf'
+            mimetype='application/pdf',
+            conditional=True
         )
     except Exception as e:
         print(f"Error downloading file: {str(e)}")
@@ -4233,30 +3675,12 @@ def get_expense_heads():
 # Add an API endpoint to get vendor names
 @app.route('/api/vendors')
 def get_vendors():
-    # Get search term from request
+    # Get search term and result limit from request
     search_term = request.args.get('term', '')
+    limit = request.args.get('limit', type=int)
 
-    # Get distinct vendor names from finance_entry table
-    if search_term:
-        # Search for vendor names that contain the search term (case-insensitive)
-        vendors = db.session.query(FinanceEntry.vendor_name).filter(
-            FinanceEntry.vendor_name.ilike(f'%{search_term}%')
-        ).distinct().all()
-    else:
-        # Get all distinct vendor names
-        vendors = db.session.query(FinanceEntry.vendor_name).distinct().all()
-
-    # Convert to list and filter out None/empty values
-    vendor_list = []
-    for vendor in vendors:
-        if vendor[0] and vendor[0].strip():  # Check if vendor name exists and is not empty
-            vendor_list.append({
-                'value': vendor[0].strip(),
-                'label': vendor[0].strip()
-            })
-
-    # Sort alphabetically and remove duplicates
-    vendor_list = sorted(list({v['value']: v for v in vendor_list}.values()), key=lambda x: x['value'].lower())
+    # Distinct vendor names of previous finance entries, from the in-memory index
+    vendor_list = autocomplete.search('vendors', search_term, limit)
 
     print(f"API response for vendors '{search_term}': {len(vendor_list)} found")
 
@@ -4265,43 +3689,12 @@ def get_vendors():
 # Add an API endpoint to get employee emails for approver selection
 @app.route('/api/employee-emails')
 def get_employee_emails():
-    # Get search term from request
+    # Get search term and result limit from request
     search_term = request.args.get('term', '')
+    limit = request.args.get('limit', type=int)
 
-    # If search term is provided, filter employees by name or email
-    if search_term:
-        # Search for employees whose name or email contains the search term (case-insensitive)
-        employees = EmployeeDetails.query.filter(
-            db.or_(
-                EmployeeDetails.name.ilike(f'%{search_term}%'),
-                EmployeeDetails.email.ilike(f'%{search_term}%')
-            ),
-            EmployeeDetails.is_active == True,
-            EmployeeDetails.email.isnot(None),
-            EmployeeDetails.email != ''
-        ).all()
-    else:
-        # Get all active employees with valid emails
-        employees = EmployeeDetails.query.filter(
-            EmployeeDetails.is_active == True,
-            EmployeeDetails.email.isnot(None),
-            EmployeeDetails.email != ''
-        ).all()
-
-    # Convert to JSON for autocomplete
-    employee_list = []
-    for emp in employees:
-        if emp.email and emp.email.strip():  # Ensure email exists and is not empty
-            employee_list.append({
-                'value': emp.email.strip(),
-                'label': f"{emp.name} ({emp.email})" if emp.name else emp.email,
-                'name': emp.name or '',
-                'email': emp.email.strip(),
-                'employee_id': emp.employee_id or ''
-            })
-
-    # Sort alphabetically by name
-    employee_list = sorted(employee_list, key=lambda x: x['name'].lower() if x['name'] else x['email'].lower())
+    # Active employees whose name or email contains the search term, from the in-memory index
+    employee_list = autocomplete.search('employees', search_term, limit)
 
     print(f"API response for employee emails '{search_term}': {len(employee_list)} found")
 
@@ -4431,7 +3824,7 @@ def send_for_approval():
             return jsonify({'success': False, 'message': 'EPV record not found'}), 404
 
         # Import SMTP email utilities
-        from smtp_email_utils import send_approval_email
+        from smtp_email_utils import send_approval_emails
 
         # Get base URL for approval links
         if request.host.startswith('127.0.0.1') or request.host.startswith('localhost'):
@@ -4444,67 +3837,47 @@ def send_for_approval():
         import uuid
         from models import EPVApproval
 
-        # Send emails to all approvers
-        success_count = 0
+        # Get approver names from employee_details in one query
+        approver_names = dict(
+            db.session.query(EmployeeDetails.email, EmployeeDetails.name)
+            .filter(EmployeeDetails.email.in_(emails))
+            .all()
+        )
+
+        # Create an approval record with a unique token for each approver
+        approvers = []
         for approver_email in emails:
             print(f"DEBUG: Processing approver email: {approver_email}")
-            # Create a unique token for this approval
             token = str(uuid.uuid4())
-            print(f"DEBUG: Generated token: {token}")
 
-            # Get approver name from employee_details
-            approver_name = None
-            approver = EmployeeDetails.query.filter_by(email=approver_email).first()
-            if approver:
-                approver_name = approver.name
-
-            # Create an EPVApproval record
             approval = EPVApproval(
                 epv_id=epv.id,
                 approver_email=approver_email,
-                approver_name=approver_name,
+                approver_name=approver_names.get(approver_email),
                 status='pending',
                 token=token
             )
             db.session.add(approval)
-            print(f"DEBUG: Added approval record to session")
+            approvers.append((approver_email, token))
 
-            # Send the approval email with the token
-            print(f"DEBUG: Sending approval email to {approver_email}")
-            try:
-                success, message_id = send_approval_email(epv, approver_email, base_url, token)
-                print(f"DEBUG: Email send result: {success}, message ID: {message_id}")
-
-                if success:
-                    success_count += 1
-                    # Store approver email in EPV record (legacy support)
-                    if not epv.approver_emails:
-                        epv.approver_emails = approver_email
-                    else:
-                        epv.approver_emails += f", {approver_email}"
-                    print(f"DEBUG: Updated EPV record with approver email")
-                else:
-                    print(f"WARNING: Email sending failed but continuing with approval process. Error: {message_id}")
-                    # Still count as success for the approval process even if email fails
-                    success_count += 1
-                    # Store approver email in EPV record (legacy support)
-                    if not epv.approver_emails:
-                        epv.approver_emails = approver_email
-                    else:
-                        epv.approver_emails += f", {approver_email}"
-                    print(f"DEBUG: Updated EPV record with approver email despite email failure")
-            except Exception as email_error:
-                print(f"ERROR sending email to {approver_email}: {str(email_error)}")
-                import traceback
-                print(f"DEBUG: Email error traceback: {traceback.format_exc()}")
-                # Still count as success for the approval process even if email fails completely
-                success_count += 1
-                # Store approver email in EPV record (legacy support)
-                if not epv.approver_emails:
-                    epv.approver_emails = approver_email
-                else:
-                    epv.approver_emails += f", {approver_email}"
-                print(f"DEBUG: Updated EPV record with approver email despite email exception")
+            # Store approver email in EPV record (legacy support)
+            if not epv.approver_emails:
+                epv.approver_emails = approver_email
+            else:
+                epv.approver_emails += f", {approver_email}"
+
+        # Send the approval emails, rendered from one compiled template.
+        # A failed email does not stop the approval process.
+        try:
+            results = send_approval_emails(epv, approvers, base_url)
+            for (approver_email, _), (success, message_id) in zip(approvers, results):
+                if not success:
+                    print(f"WARNING: Email sending failed for {approver_email} but continuing with approval process. Error: {message_id}")
+        except Exception as email_error:
+            print(f"ERROR sending approval emails: {str(email_error)}")
+            import traceback
+            print(f"DEBUG: Email error traceback: {traceback.format_exc()}")
+        success_count = len(approvers)
 
         # Update the EPV record to indicate approval has been requested
         epv.status = 'pending_approval'
@@ -4564,63 +3937,16 @@ def approve_expense(epv_id):
             else:
                 return render_template('error.html', error="Invalid approval token"), 400
 
-        # Update the legacy fields for backward compatibility
-        epv.approved_by = approver_email
-        epv.approved_on = datetime.now()
-
-        # Check if all approvers have approved
-        all_approved = True
-        any_rejected = False
-
-        # Get all approval records for this EPV
+        # Recompute the EPV's status, and its master invoice's if it is a sub-invoice
         from models import EPVApproval
-        approvals = EPVApproval.query.filter_by(epv_id=epv.id).all()
-
-        for appr in approvals:
-            if appr.status == 'rejected':
-                any_rejected = True
-                break
-            elif appr.status != 'approved':
-                all_approved = False
-
-        # Update the EPV status based on approval status
-        if any_rejected:
-            epv.status = 'rejected'
-        elif all_approved and len(approvals) > 0:
-            epv.status = 'approved'
-
-            # If this is a sub-invoice, check if all sub-invoices of the master are approved
-            if epv.invoice_type == 'sub' and epv.master_invoice_id:
-                # Get the master invoice
-                master_invoice = EPV.query.get(epv.master_invoice_id)
-                if master_invoice:
-                    # Get all sub-invoices for this master
-                    sub_invoices = EPV.query.filter_by(master_invoice_id=master_invoice.id).all()
-
-                    # Check if all sub-invoices are approved
-                    all_subs_approved = True
-                    for sub in sub_invoices:
-                        if sub.status != 'approved':
-                            all_subs_approved = False
-                            break
-
-                    # If all sub-invoices are approved, update the master invoice status
-                    if all_subs_approved and len(sub_invoices) > 0:
-                        master_invoice.split_status = 'fully_approved'
-                        # Also update the master invoice's status to 'approved' so it shows up in finance dashboard
-                        master_invoice.status = 'approved'
-                        master_invoice.approved_by = approver_email
-                        master_invoice.approved_on = datetime.now()
-                        print(f"DEBUG: Updated master invoice {master_invoice.epv_id} status to fully_approved and approved")
-        else:
-            epv.status = 'partially_approved'
-
-            # If this is a sub-invoice, update the master invoice status
-            if epv.invoice_type == 'sub' and epv.master_invoice_id:
-                master_invoice = EPV.query.get(epv.master_invoice_id)
-                if master_invoice and master_invoice.split_status != 'partially_approved':
-                    master_invoice.split_status = 'partially_approved'
-                    print(f"DEBUG: Updated master invoice {master_invoice.epv_id} status to partially_approved")
+        epv_approvals = EPVApproval.query.filter_by(epv_id=epv.id).all()
+        master_invoice = None
+        sub_invoices = []
+        if epv.invoice_type == 'sub' and epv.master_invoice_id:
+            master_invoice = EPV.query.get(epv.master_invoice_id)
+            if master_invoice:
+                sub_invoices = EPV.query.filter_by(master_invoice_id=master_invoice.id).all()
+        apply_approval(epv, epv_approvals, approver_email, master_invoice, sub_invoices)
 
         db.session.commit()
 
@@ -4750,27 +4076,11 @@ def process_rejection(epv_id):
             else:
                 return render_template('error.html', error="Invalid rejection token"), 400
 
-        # Update the legacy fields for backward compatibility
-        epv.rejected_by = approver_email
-        epv.rejected_on = datetime.now()
-        epv.rejection_reason = rejection_reason
-
-        # For split invoices, let check_and_send_split_to_finance handle the status
-        # For regular invoices, if any approver rejects, the entire EPV is rejected
-        if epv.invoice_type == 'split':
-            # For split invoices, update amounts and check if should send to finance
-            update_split_epv_amounts(epv)
-            check_and_send_split_to_finance(epv)
-        else:
-            # For regular invoices, if any approver rejects, the entire EPV is rejected
-            epv.status = 'rejected'
-
-        # If this is a sub-invoice, update the master invoice status
+        # Recompute the EPV's status, and its master invoice's if it is a sub-invoice
+        master_invoice = None
         if epv.invoice_type == 'sub' and epv.master_invoice_id:
             master_invoice = EPV.query.get(epv.master_invoice_id)
-            if master_invoice:
-                master_invoice.split_status = 'rejected'
-                print(f"DEBUG: Updated master invoice {master_invoice.epv_id} status to rejected")
+        apply_rejection(epv, approver_email, rejection_reason, master_invoice=master_invoice)
 
         db.session.commit()
 
@@ -4815,6 +4125,51 @@ def process_rejection(epv_id):
         print(f"Error rejecting expense: {str(e)}")
         return render_template('error.html', error=f"An error occurred: {str(e)}"), 500
 
+# Approver inbox: the EPVs waiting for the current user's decision
+@app.route('/approvals')
+@login_required
+def approval_inbox():
+    pending = pending_approvals(session.get('email'))
+    return render_template('approval_inbox.html',
+                          user=session.get('user_info'),
+                          employee_role=session.get('employee_role'),
+                          pending=pending)
+
+# Approve or reject the EPVs selected in the approver inbox
+@app.route('/approvals/decide', methods=['POST'])
+@login_required
+def decide_approvals():
+    approval_ids = request.form.getlist('approval_ids', type=int)
+    decision = request.form.get('decision')
+    reason = request.form.get('reason', '').strip()
+
+    if decision not in ('approve', 'reject'):
+        flash('Choose whether to approve or reject the selected expenses.', 'error')
+        return redirect(url_for('approval_inbox'))
+    if not approval_ids:
+        flash('Select at least one expense.', 'error')
+        return redirect(url_for('approval_inbox'))
+    if decision == 'reject' and not reason:
+        flash('A rejection reason is required.', 'error')
+        return redirect(url_for('approval_inbox'))
+
+    try:
+        result = decide_pending_approvals(session.get('email'), approval_ids, decision, reason)
+    except Exception as e:
+        print(f"ERROR deciding approvals: {str(e)}")
+        import traceback
+        print(f"DEBUG: Approval inbox error traceback: {traceback.format_exc()}")
+        flash('An error occurred; no expenses were changed. Please try again.', 'error')
+        return redirect(url_for('approval_inbox'))
+
+    decided = result['decided']
+    if decided:
+        action = 'approved' if decision == 'approve' else 'rejected'
+        flash(f"{len(decided)} expense(s) {action}: {', '.join(decided)}", 'success')
+    if result['skipped']:
+        flash(f"{result['skipped']} selected approval(s) were already decided and were skipped.", 'warning')
+    return redirect(url_for('approval_inbox'))
+
 # API endpoint to get notification counts for the current user
 @app.route('/api/notifications/count')
 def get_notification_count():
@@ -4822,10 +4177,6 @@ def get_notification_count():
         return jsonify({'error': 'Not logged in'}), 401
 
     try:
-        # Get the current user's role
-        user_role = session.get('employee_role')
-        user_email = session.get('email')
-
         # Initialize notification counts
         notifications = {
             'total': 0,
@@ -4836,116 +4187,18 @@ def get_notification_count():
         }
 
         # Get employee details
-        employee = EmployeeDetails.query.filter_by(email=user_email).first()
+        identity = get_identity()
 
-        if not employee:
+        if not identity:
             return jsonify(notifications)
 
-        # For all users: Count EPVs pending approval that they submitted
-        if user_role:
-            # Count pending EPVs submitted by this user
-            pending_submitted = EPV.query.filter_by(
-                email_id=user_email,
-                status='pending_approval'
-            ).count()
-
-            notifications['pending_approval'] = pending_submitted
-            notifications['total'] += pending_submitted
-
-            if pending_submitted > 0:
-                notifications['details'].append({
-                    'type': 'pending_approval',
-                    'count': pending_submitted,
-                    'message': f'You have {pending_submitted} expense(s) pending approval'
-                })
-
-        # For managers: Count EPVs waiting for their approval
-        pending_approvals = EPVApproval.query.join(EPV).filter(
-            EPVApproval.approver_email == user_email,
-            EPVApproval.status == 'pending',
-            EPV.status.in_(['pending_approval', 'partially_approved'])
-        ).count()
-
-        if pending_approvals > 0:
-            notifications['pending_approval'] += pending_approvals
-            notifications['total'] += pending_approvals
-            notifications['details'].append({
-                'type': 'manager_approval',
-                'count': pending_approvals,
-                'message': f'You have {pending_approvals} expense(s) to approve'
-            })
-
-        # For Finance role: Count EPVs ready for processing
-        if user_role == 'Finance':
-            # Get assigned cities
-            assigned_cities = CityAssignment.query.filter_by(
-                employee_id=employee.id,
-                is_active=True
-            ).all()
-
-            city_names = [assignment.city for assignment in assigned_cities]
-
-            if city_names:
-                # Count EPVs ready for finance processing
-                # Only count expenses with direct city match to assigned cities
-                direct_city_count = EPV.query.filter(
-                    EPV.status == 'approved',
-                    EPV.city.in_(city_names),
-                    db.or_(EPV.finance_status == 'pending', EPV.finance_status == None)
-                ).count()
-
-                # Then count expenses without city but with cost center city match
-                cost_center_city_count = EPV.query.join(CostCenter).filter(
-                    EPV.status == 'approved',
-                    EPV.city == None,  # Only count expenses without a direct city
-                    CostCenter.city.in_(city_names),
-                    db.or_(EPV.finance_status == 'pending', EPV.finance_status == None)
-                ).count()
-
-                # Total count
-                finance_pending_count = direct_city_count + cost_center_city_count
-
-                notifications['finance_pending'] = finance_pending_count
-                notifications['total'] += finance_pending_count
-
-                if finance_pending_count > 0:
-                    notifications['details'].append({
-                        'type': 'finance_pending',
-                        'count': finance_pending_count,
-                        'message': f'You have {finance_pending_count} expense(s) to process'
-                    })
-
-        # For Finance Approver role: Count finance entries waiting for approval
-        if user_role == 'Finance Approver':
-            # Get assigned cities
-            assigned_cities = CityAssignment.query.filter_by(
-                employee_id=employee.id,
-                is_active=True
-            ).all()
+        counts = get_notification_counts(identity, session.get('employee_role'))
 
-            city_names = [assignment.city for assignment in assigned_cities]
-
-            # Count finance entries pending approval
-            if city_names:
-                finance_approval_count = FinanceEntry.query.join(EPV).join(CostCenter).filter(
-                    FinanceEntry.status == 'pending',
-                    CostCenter.city.in_(city_names)
-                ).count()
-            else:
-                # If no cities assigned, count all pending entries
-                finance_approval_count = FinanceEntry.query.filter_by(
-                    status='pending'
-                ).count()
-
-            notifications['finance_approval'] = finance_approval_count
-            notifications['total'] += finance_approval_count
-
-            if finance_approval_count > 0:
-                notifications['details'].append({
-                    'type': 'finance_approval',
-                    'count': finance_approval_count,
-                    'message': f'You have {finance_approval_count} finance entries to approve'
-                })
+        notifications['pending_approval'] = counts['pending_submitted'] + counts['manager_approval']
+        notifications['finance_pending'] = counts['finance_pending']
+        notifications['finance_approval'] = counts['finance_approval']
+        notifications['total'] = notifications['pending_approval'] + counts['finance_pending'] + counts['finance_approval']
+        notifications['details'] = notification_details(counts)
 
         return jsonify(notifications)
     except Exception as e:
@@ -4959,17 +4212,23 @@ def view_epv_record(epv_id):
         # Get the token from the request
         token = request.args.get('token')
 
-        # Find the EPV record
-        epv = EPV.query.filter_by(epv_id=epv_id).first()
+        # Served from the render cache unless the EPV changed (see record_view.py)
+        cache_key = (
+            epv_id, token, session.get('email'), session.get('employee_role'),
+            bool(session.get('is_cost_center_approver'))
+        )
+        cached = record_view.get_cached_page(cache_key)
+        if cached is not None:
+            return cached
+        generation = record_view.page_generation()
+
+        # Find the EPV record with its items, approvals, allocations and finance entry
+        epv = record_view.load_epv_record(epv_id)
         if not epv:
             return render_template('error.html', error="EPV record not found"), 404
 
-        # Get EPV items
-        epv_items = EPVItem.query.filter_by(epv_id=epv.id).all()
-
-        # Get approval records
-        from models import EPVApproval
-        approvals = EPVApproval.query.filter_by(epv_id=epv.id).all()
+        epv_items = epv.items
+        approvals = epv.approvals
 
         # Check if the user is an approver for this EPV
         is_approver = False
@@ -4978,22 +4237,25 @@ def view_epv_record(epv_id):
 
         if token:
             # Check for regular EPV approval
-            current_approval = EPVApproval.query.filter_by(epv_id=epv.id, token=token).first()
+            current_approval = next((approval for approval in approvals if approval.token == token), None)
             if current_approval:
                 is_approver = True
 
             # Check for split invoice allocation approval (regardless of regular approval)
             if epv.invoice_type == 'split':
-                from models import EPVAllocation
-                split_allocation = EPVAllocation.query.filter_by(token=token).first()
-                if split_allocation and split_allocation.epv_id == epv.id:
+                split_allocation = next((allocation for allocation in epv.allocations if allocation.token == token), None)
+                if split_allocation:
                     is_approver = True
 
-        # Get all employee details for template
-        employee_details = EmployeeDetails.query.all()
+        # Names of the employees the page refers to by email
+        employee_names = record_view.employee_names(
+            [epv.rejected_by]
+            + [approval.approver_email for approval in approvals if not approval.approver_name]
+            + [allocation.approver_email for allocation in epv.allocations if not allocation.approver_name]
+        )
 
         # Render the EPV record view
-        return render_template('epv_record_view.html',
+        html = render_template('epv_record_view.html',
                               epv=epv,
                               epv_items=epv_items,
                               approvals=approvals,
@@ -5001,164 +4263,116 @@ def view_epv_record(epv_id):
                               current_approval=current_approval,
                               split_allocation=split_allocation,
                               token=token,
-                              employee_details=employee_details)
+                              employee_names=employee_names)
+        record_view.cache_page(cache_key, epv, html, generation)
+        return html
 
     except Exception as e:
         print(f"Error viewing EPV record: {str(e)}")
         return render_template('error.html', error=f"An error occurred: {str(e)}"), 500
 
 # Function to calculate TAT (Turn Around Time) for EPV records
-def calculate_tat(record):
+def get_tat_start_date(record):
     """
-    Calculate Turn Around Time (TAT) in days for an EPV record.
+    Date from which the Turn Around Time (TAT) of an EPV record is counted.
 
-    For split invoices: Date of Payment - Date when status changed to "Partially Approved"
-    For other invoices: Date of Payment - Date of Manager Approval
+    For split invoices: Date when status changed to "Partially Approved"
+    (the earliest allocation approval)
+    For other invoices: Date of Manager Approval
 
-    Returns None if TAT cannot be calculated (missing dates)
+    Returns None if the EPV has not been approved yet
     """
-    try:
-        # Get payment date from finance entry
-        payment_date = None
-        if record.finance_entry and record.finance_entry.payment_date:
-            payment_date = record.finance_entry.payment_date
+    if record.invoice_type == 'split':
+        # For split invoices: find when status changed to "partially_approved"
+        # This would be when the first allocation was approved
+        approval_dates = [allocation.action_date for allocation in record.allocations or []
+                          if allocation.status == 'approved' and allocation.action_date]
+        return min(approval_dates) if approval_dates else None
 
-        if not payment_date:
-            return None
+    # For regular invoices: use manager approval date
+    return record.approved_on
 
-        # Calculate start date based on invoice type
-        start_date = None
-
-        if record.invoice_type == 'split':
-            # For split invoices: find when status changed to "partially_approved"
-            # This would be when the first allocation was approved
-            if record.allocations:
-                # Find the earliest approval date among allocations
-                earliest_approval = None
-                for allocation in record.allocations:
-                    if allocation.status == 'approved' and allocation.action_date:
-                        if earliest_approval is None or allocation.action_date < earliest_approval:
-                            earliest_approval = allocation.action_date
-
-                if earliest_approval:
-                    start_date = earliest_approval
-        else:
-            # For regular invoices: use manager approval date
-            if record.approved_on:
-                start_date = record.approved_on
-
-        if not start_date:
-            return None
+def calculate_tat(records):
+    """
+    Calculate Turn Around Time (TAT) in days for EPV records: calendar days
+    from the TAT start date to the payment date, same-day processing being 1 day.
 
-        # Calculate the difference in days using only date parts (ignore time)
-        # Convert both dates to date objects to ensure we're only comparing dates, not times
+    Returns:
+        list: TAT of each record, None where it cannot be calculated (missing dates)
+    """
+    start_dates = []
+    payment_dates = []
+    for record in records:
         try:
-            if hasattr(payment_date, 'date'):
-                payment_date_only = payment_date.date()
-            else:
-                payment_date_only = payment_date
-
-            if hasattr(start_date, 'date'):
-                start_date_only = start_date.date()
-            else:
-                start_date_only = start_date
-
-            delta = payment_date_only - start_date_only
-            # Add 1 to ensure same-day processing shows as 1 day (not 0)
-            return delta.days + 1
+            # Get payment date from finance entry
+            payment_date = record.finance_entry.payment_date if record.finance_entry else None
+            start_dates.append(get_tat_start_date(record) if payment_date else None)
+            payment_dates.append(payment_date)
         except Exception as e:
-            print(f"Error calculating date difference: {e}")
-            return None
+            print(f"Error calculating TAT for EPV {record.epv_id}: {str(e)}")
+            start_dates.append(None)
+            payment_dates.append(None)
 
-    except Exception as e:
-        print(f"Error calculating TAT for EPV {record.epv_id}: {str(e)}")
-        return None
+    return calendar_days_between(start_dates, payment_dates)
 
-# Route to view all EPV records
-@app.route('/epv-records')
-def epv_records():
-    # Check if user is logged in
-    if 'email' not in session:
-        print("DEBUG: User not logged in, redirecting to login")
-        return redirect(url_for('login', next='/epv-records'))
-
-    print(f"DEBUG: EPV Records accessed by {session.get('email')}")
-    print(f"DEBUG: Session data: {session}")
+def get_time_period_range(time_period_filter):
+    """
+    Get the (start_date, end_date) submission date range for a time period filter.
 
-    # Get the user's role
-    user_email = session.get('email')
-    employee = EmployeeDetails.query.filter_by(email=user_email).first()
-    role = employee.role if employee else 'user'
+    Returns (None, None) for 'all' or unknown values.
+    """
+    today = datetime.now().date()
+    if time_period_filter == 'this_month':
+        return datetime(today.year, today.month, 1).date(), today
+    if time_period_filter == 'last_month':
+        if today.month == 1:
+            return datetime(today.year - 1, 12, 1).date(), datetime(today.year, 1, 1).date() - timedelta(days=1)
+        return datetime(today.year, today.month - 1, 1).date(), datetime(today.year, today.month, 1).date() - timedelta(days=1)
+    if time_period_filter == 'this_year':
+        return datetime(today.year, 1, 1).date(), today
+    return None, None
 
-    # Get filter options
-    expense_heads = ExpenseHead.query.filter_by(is_active=True).all()
-    cost_centers = CostCenter.query.filter_by(is_active=True).all()
+def build_epv_records_query(user_email, role, args):
+    """
+    Build the EPV query for the records visible to a user, with the request filters applied.
 
-    # Get filter values from request
-    expense_head_filter = request.args.get('expense_head', '')
-    cost_center_filter = request.args.get('cost_center', '')
-    status_filter = request.args.get('status', '')
-    time_period_filter = request.args.get('time_period', 'all')
-    view_mode = request.args.get('view', '')
-    city_filter = request.args.get('city', '')
+    Role and city scoping:
+    - Super Admin sees all records
+    - Finance sees records in cost centers of their assigned cities
+    - Finance Approver sees all records, optionally narrowed to one city
+    - Everyone else (and finance users in 'my_expenses' view) sees only their own records
 
-    # Get cities for the filter dropdown (for finance users)
-    cities = []
-    if role in ['Finance', 'Finance Approver', 'Super Admin']:
-        # For Finance users, show only assigned cities
-        if role == 'Finance':
-            # Get the employee ID from the email
-            employee = EmployeeDetails.query.filter_by(email=user_email).first()
-            if employee:
-                # Get the city assignments for this employee
-                city_assignments = CityAssignment.query.filter_by(employee_id=employee.id, is_active=True).all()
-                cities = [ca.city for ca in city_assignments if ca.city]
-        # For Finance Approver and Super Admin, show all cities
-        else:
-            # Get all unique cities from cost centers
-            cities = db.session.query(CostCenter.city).distinct().filter(CostCenter.city.isnot(None)).all()
-            cities = [city[0] for city in cities if city[0]]  # Extract city names and filter out None values
+    Args:
+        user_email (str): Email of the current user
+        role (str): Role of the current user
+        args: Request arguments (expense_head, cost_center, status, time_period, view, city)
 
-    # Define time period filter dates
-    today = datetime.now().date()
-    if time_period_filter == 'this_month':
-        start_date = datetime(today.year, today.month, 1).date()
-        end_date = today
-    elif time_period_filter == 'last_month':
-        if today.month == 1:
-            start_date = datetime(today.year - 1, 12, 1).date()
-            end_date = datetime(today.year, 1, 1).date() - timedelta(days=1)
-        else:
-            start_date = datetime(today.year, today.month - 1, 1).date()
-            end_date = datetime(today.year, today.month, 1).date() - timedelta(days=1)
-    elif time_period_filter == 'this_year':
-        start_date = datetime(today.year, 1, 1).date()
-        end_date = today
-    else:  # 'all'
-        start_date = None
-        end_date = None
+    Returns:
+        Query: EPV query without ordering or loader options
+    """
+    expense_head_filter = args.get('expense_head', '')
+    cost_center_filter = args.get('cost_center', '')
+    status_filter = args.get('status', '')
+    time_period_filter = args.get('time_period', 'all')
+    view_mode = args.get('view', '')
+    city_filter = args.get('city', '')
 
-    # Base query for EPV records
     if role == 'Super Admin':
         # Super admins can see all records
-        base_query = EPV.query.options(db.joinedload(EPV.finance_entry)).options(db.joinedload(EPV.sub_invoices)).options(db.joinedload(EPV.allocations))
+        base_query = EPV.query
     elif role in ['Finance', 'Finance Approver'] and view_mode != 'my_expenses':
         # Finance users see records based on their assigned cities
         if role == 'Finance':
-            # Get the employee ID from the email
-            employee = EmployeeDetails.query.filter_by(email=user_email).first()
-            if employee:
-                # Get the city assignments for this employee
-                city_assignments = CityAssignment.query.filter_by(employee_id=employee.id, is_active=True).all()
-                assigned_cities = [ca.city for ca in city_assignments if ca.city]
+            identity = load_identity(user_email)
+            if identity:
+                assigned_cities = identity.assigned_cities
 
                 if assigned_cities:
-                    # Get cost centers in the assigned cities
-                    assigned_cost_center_ids = db.session.query(CostCenter.id).filter(CostCenter.city.in_(assigned_cities)).all()
-                    assigned_cost_center_ids = [cc_id[0] for cc_id in assigned_cost_center_ids]
+                    # Cost centers in the assigned cities
+                    assigned_cost_center_ids = list(identity.assigned_cost_center_ids)
 
                     # Base query for EPVs in assigned cost centers
-                    base_query = EPV.query.options(db.joinedload(EPV.finance_entry)).options(db.joinedload(EPV.sub_invoices)).options(db.joinedload(EPV.allocations)).filter(EPV.cost_center_id.in_(assigned_cost_center_ids))
+                    base_query = EPV.query.filter(EPV.cost_center_id.in_(assigned_cost_center_ids))
 
                     # If city filter is applied, filter by that specific city
                     if city_filter and city_filter in assigned_cities:
@@ -5166,16 +4380,16 @@ def epv_records():
                         city_cost_center_ids = [cc_id[0] for cc_id in city_cost_center_ids]
 
                         if city_cost_center_ids:
-                            base_query = EPV.query.options(db.joinedload(EPV.finance_entry)).options(db.joinedload(EPV.sub_invoices)).options(db.joinedload(EPV.allocations)).filter(EPV.cost_center_id.in_(city_cost_center_ids))
+                            base_query = EPV.query.filter(EPV.cost_center_id.in_(city_cost_center_ids))
                 else:
                     # If no cities assigned, show no EPVs
-                    base_query = EPV.query.options(db.joinedload(EPV.finance_entry)).options(db.joinedload(EPV.sub_invoices)).options(db.joinedload(EPV.allocations)).filter(EPV.id == -1)  # This will return no results
+                    base_query = EPV.query.filter(EPV.id == -1)  # This will return no results
             else:
                 # If employee not found, show no EPVs
-                base_query = EPV.query.options(db.joinedload(EPV.finance_entry)).options(db.joinedload(EPV.sub_invoices)).options(db.joinedload(EPV.allocations)).filter(EPV.id == -1)  # This will return no results
+                base_query = EPV.query.filter(EPV.id == -1)  # This will return no results
         else:
             # Finance Approver can see all records by default
-            base_query = EPV.query.options(db.joinedload(EPV.finance_entry)).options(db.joinedload(EPV.sub_invoices)).options(db.joinedload(EPV.allocations))
+            base_query = EPV.query
 
             # Apply city filter if provided
             if city_filter:
@@ -5188,7 +4402,7 @@ def epv_records():
                     base_query = base_query.filter(EPV.cost_center_id.in_(city_cost_center_ids))
     else:
         # Regular users, admins, and finance users in 'my_expenses' view can only see their own records
-        base_query = EPV.query.options(db.joinedload(EPV.finance_entry)).options(db.joinedload(EPV.sub_invoices)).options(db.joinedload(EPV.allocations)).filter_by(email_id=user_email)
+        base_query = EPV.query.filter_by(email_id=user_email)
 
     # Apply filters
     if expense_head_filter:
@@ -5205,51 +4419,101 @@ def epv_records():
         # Handle status filter with exact match (case sensitive)
         base_query = base_query.filter(EPV.status == status_filter)
 
+    start_date, end_date = get_time_period_range(time_period_filter)
     if start_date and end_date:
         # Filter by submission date
         base_query = base_query.filter(EPV.submission_date.between(start_date, end_date))
 
-    # Debug the SQL query
-    print(f"DEBUG: SQL Query: {str(base_query)}")
+    return base_query
 
-    # Get the filtered records
-    records = base_query.order_by(EPV.submission_date.desc()).all()
+def load_epv_records_page(base_query, cursor=None, page_size=None):
+    """
+    Load one keyset page of EPV records for display, with TAT calculated.
 
-    # Calculate TAT (Turn Around Time) for each record
-    for record in records:
-        record.tat_days = calculate_tat(record)
-        print(f"DEBUG: EPV ID: {record.epv_id}, Employee: {record.employee_name}, Email: {record.email_id}, Status: {record.status}, Type: {record.invoice_type}, TAT: {record.tat_days}")
+    Sub-invoices are not listed on their own (they are shown under their master).
 
-    # Calculate scorecard data
-    total_records = len(records)
-    pending_count = sum(1 for record in records if record.status in ['submitted', 'pending_approval'])
-    approved_count = sum(1 for record in records if record.status == 'approved')
-    rejected_count = sum(1 for record in records if record.status == 'rejected')
+    Returns:
+        tuple: (records, next_cursor)
 
-    # Calculate total amount
-    total_amount = sum(record.total_amount for record in records if record.total_amount)
-    formatted_total_amount = f"Rs. {total_amount:,.2f}"
+    Raises:
+        ValueError: If the cursor is malformed
+    """
+    from pagination import keyset_page
 
-    # Prepare scorecard data
-    scorecard_data = {
-        'total_records': total_records,
-        'pending_count': pending_count,
-        'approved_count': approved_count,
-        'rejected_count': rejected_count,
-        'total_amount': formatted_total_amount
-    }
+    page_query = base_query.filter(db.or_(EPV.invoice_type != 'sub', EPV.invoice_type.is_(None))).options(
+        db.joinedload(EPV.finance_entry),
+        db.selectinload(EPV.sub_invoices),
+        db.selectinload(EPV.allocations)
+    )
+    records, next_cursor = keyset_page(page_query, page_size or app.config['EPV_RECORDS_PAGE_SIZE'], cursor)
+
+    # Calculate TAT (Turn Around Time) for the records on this page
+    for record, tat_days in zip(records, calculate_tat(records)):
+        record.tat_days = tat_days
+
+    return records, next_cursor
+
+# Route to view all EPV records
+@app.route('/epv-records')
+def epv_records():
+    # Check if user is logged in
+    if 'email' not in session:
+        print("DEBUG: User not logged in, redirecting to login")
+        return redirect(url_for('login', next='/epv-records'))
+
+    print(f"DEBUG: EPV Records accessed by {session.get('email')}")
+
+    # Get the user's role
+    user_email = session.get('email')
+    identity = get_identity()
+    role = identity.role if identity else 'user'
+
+    # Get filter options
+    expense_heads = ExpenseHead.query.filter_by(is_active=True).all()
+    cost_centers = CostCenter.query.filter_by(is_active=True).all()
+
+    # Get filter values from request
+    expense_head_filter = request.args.get('expense_head', '')
+    cost_center_filter = request.args.get('cost_center', '')
+    status_filter = request.args.get('status', '')
+    time_period_filter = request.args.get('time_period', 'all')
+    view_mode = request.args.get('view', '')
+    city_filter = request.args.get('city', '')
+
+    # Get cities for the filter dropdown (for finance users)
+    cities = []
+    if role in ['Finance', 'Finance Approver', 'Super Admin']:
+        # For Finance users, show only assigned cities
+        if role == 'Finance':
+            if identity:
+                cities = list(identity.assigned_cities)
+        # For Finance Approver and Super Admin, show all cities
+        else:
+            # Get all unique cities from cost centers
+            cities = db.session.query(CostCenter.city).distinct().filter(CostCenter.city.isnot(None)).all()
+            cities = [city[0] for city in cities if city[0]]  # Extract city names and filter out None values
+
+    # Base query for the EPV records visible to this user
+    base_query = build_epv_records_query(user_email, role, request.args)
+
+    # Get the first page of records; further pages are loaded from /api/epv-records
+    from pagination import parse_page_size
+    page_size = parse_page_size(request.args.get('page_size'), app.config['EPV_RECORDS_PAGE_SIZE'])
+    records, next_cursor = load_epv_records_page(base_query, page_size=page_size)
+
+    # Calculate scorecard data over the whole filtered set with one aggregate query
+    from scorecards import get_records_scorecards
+    scorecard_data = get_records_scorecards(base_query)
+    scorecard_data['total_amount'] = f"Rs. {scorecard_data['total_amount']:,.2f}"
 
-    # Debug output
     print(f"DEBUG: User role: {role}")
-    print(f"DEBUG: Found {len(records)} EPV records")
-    for record in records:
-        print(f"DEBUG: EPV ID: {record.epv_id}, Employee: {record.employee_name}, Email: {record.email_id}, Status: {record.status}")
+    print(f"DEBUG: Showing {len(records)} of {scorecard_data['total_records']} EPV records")
 
     # Return the EPV records template
-    print("DEBUG: Rendering epv_records.html template")
     try:
         return render_template('epv_records_new.html',
                            records=records,
+                           next_cursor=next_cursor,
                            cost_centers=cost_centers,
                            expense_heads=expense_heads,
                            cities=cities,
@@ -5268,6 +4532,84 @@ def epv_records():
         print(f"DEBUG: Traceback: {traceback.format_exc()}")
         return f"Error: {str(e)}", 500
 
+# API endpoint for infinite scroll on the EPV records page
+@app.route('/api/epv-records')
+def api_epv_records():
+    """Return the next page of EPV record rows as rendered HTML plus the cursor for the page after it"""
+    if 'email' not in session:
+        return jsonify({'success': False, 'error': 'Not logged in'}), 401
+
+    user_email = session.get('email')
+    identity = get_identity()
+    role = identity.role if identity else 'user'
+
+    from pagination import parse_page_size
+    page_size = parse_page_size(request.args.get('page_size'), app.config['EPV_RECORDS_PAGE_SIZE'])
+
+    try:
+        base_query = build_epv_records_query(user_email, role, request.args)
+        records, next_cursor = load_epv_records_page(base_query, request.args.get('cursor'), page_size)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+
+    return jsonify({
+        'success': True,
+        'html': render_template('epv_record_rows.html', records=records),
+        'count': len(records),
+        'next_cursor': next_cursor
+    })
+
+# Export EPV records as CSV or XLSX
+@app.route('/epv-records/export')
+def export_epv_records():
+    """
+    Stream all EPV records visible to the user (with the /epv-records filters applied)
+    as CSV or XLSX. Optional start_date / end_date (YYYY-MM-DD) limit the submission dates,
+    e.g. for a full-year dump.
+    """
+    if 'email' not in session:
+        return redirect(url_for('login', next='/epv-records'))
+
+    user_email = session.get('email')
+    identity = get_identity()
+    role = identity.role if identity else 'user'
+
+    export_format = request.args.get('format', 'csv').lower()
+    if export_format not in ['csv', 'xlsx']:
+        return jsonify({'success': False, 'error': f"Unsupported export format: {export_format}"}), 400
+
+    from epv_export import generate_csv, generate_xlsx, OPENPYXL_AVAILABLE
+    if export_format == 'xlsx' and not OPENPYXL_AVAILABLE:
+        return jsonify({'success': False, 'error': 'XLSX export is not available on this server'}), 400
+
+    base_query = build_epv_records_query(user_email, role, request.args)
+
+    # Optional explicit submission date range
+    try:
+        if request.args.get('start_date'):
+            base_query = base_query.filter(EPV.submission_date >= datetime.strptime(request.args['start_date'], '%Y-%m-%d'))
+        if request.args.get('end_date'):
+            end_date = datetime.strptime(request.args['end_date'], '%Y-%m-%d') + timedelta(days=1)
+            base_query = base_query.filter(EPV.submission_date < end_date)
+    except ValueError:
+        return jsonify({'success': False, 'error': 'Dates must be in YYYY-MM-DD format'}), 400
+
+    filename = f"epv_records_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{export_format}"
+    print(f"DEBUG: {user_email} exporting EPV records as {export_format}")
+
+    if export_format == 'xlsx':
+        body = generate_xlsx(base_query)
+        mimetype = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    else:
+        body = generate_csv(base_query)
+        mimetype = 'text/csv'
+
+    return app.response_class(
+        stream_with_context(body),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'}
+    )
+
 # Route to view a specific EPV record
 @app.route('/epv-record/<epv_id>')
 def epv_record(epv_id):
@@ -5277,8 +4619,8 @@ def epv_record(epv_id):
 
     # Get the user's role
     user_email = session.get('email')
-    employee = EmployeeDetails.query.filter_by(email=user_email).first()
-    role = employee.role if employee else 'user'
+    identity = get_identity()
+    role = identity.role if identity else 'user'
 
     # Get the EPV record with finance entry and sub-invoices relationships
     record = EPV.query.options(db.joinedload(EPV.finance_entry)).options(db.joinedload(EPV.sub_invoices)).filter_by(epv_id=epv_id).first_or_404()
@@ -5335,8 +4677,10 @@ def epv_record(epv_id):
             # Fallback to email if name is not found
             rejector_name = record.rejected_by
 
-    # Get all employee details for template
-    employee_details = EmployeeDetails.query.all()
+    # Names of the employees the page refers to by email
+    employee_names = record_view.employee_names(
+        [record.rejected_by] + [approval.approver_email for approval in approvals if not approval.approver_name]
+    )
 
     print(f"DEBUG: User {user_email} viewing EPV record {epv_id}")
     return render_template('epv_record_view.html',
@@ -5349,7 +4693,7 @@ def epv_record(epv_id):
                            user=session.get('user_info'),
                            manager_name=manager_name,
                            rejector_name=rejector_name,
-                           employee_details=employee_details)
+                           employee_names=employee_names)
 
 # Cost Center Admin View
 @app.route('/cost-center-admin')
@@ -5520,26 +4864,27 @@ def check_authentication_and_token():
 
     # For all other routes, ensure user is properly authenticated
     if not current_user.is_authenticated or not session.get('email'):
-        print(f"🔍 DEBUG: Unauthenticated access attempt to {request.path}")
+        logger.debug("Unauthenticated access attempt to %s", request.path)
         session.clear()  # Clear any stale session data
         flash("Please log in to access this page.", "info")
         return redirect(url_for('index'))
 
     # Skip token check if no Google token (for basic functionality)
     if not google.authorized:
-        print(f"🔍 DEBUG: No Google token for user {session.get('email')}")
+        logger.debug("No Google token for user %s", session.get('email'))
         return
 
     # Check if token is valid
     try:
         # Make a simple API call to check token validity
-        resp = google.get('/oauth2/v2/userinfo')
+        with app_logging.external_call('google'):
+            resp = google.get('/oauth2/v2/userinfo')
         if not resp.ok:
             # If token refresh failed, redirect to refresh token page
             flash("Your Google token has expired. Please refresh it.")
             return redirect(url_for('refresh_token', next=request.path))
     except Exception as e:
-        print(f"ERROR: Token validation failed in before_request: {str(e)}")
+        logger.error("Token validation failed in before_request: %s", e)
         # If there's an exception, redirect to refresh token page
         flash("Your Google token has expired. Please refresh it.")
         return redirect(url_for('refresh_token', next=request.path))
@@ -5665,65 +5010,82 @@ def finance_dashboard():
         return redirect(url_for('dashboard'))
 
     # Get the employee's database ID from their email
-    employee = EmployeeDetails.query.filter_by(email=session.get('email')).first()
+    employee = get_identity()
 
     if not employee:
         flash('Error: Could not find your user account.', 'error')
         return redirect(url_for('dashboard'))
 
     # Debug logging for filters
-    print(f"DEBUG: Finance Dashboard accessed by {session.get('email')}")
-    print(f"DEBUG: Employee role: {session.get('employee_role')}")
+    logger.debug("Finance Dashboard accessed by %s", session.get('email'))
+    logger.debug("Employee role: %s", session.get('employee_role'))
+
+    tabs = get_finance_dashboard_tabs(employee, session.get('employee_role'))
+    return render_template(
+        'finance_dashboard.html',
+        user=session.get('user_info'),
+        today=datetime.now(),
+        feed_id=change_feed.FEED_ID,
+        last_event_id=change_feed.last_event_id(),
+        events_retry_ms=app.config['FINANCE_EVENTS_RETRY_MS'],
+        refresh_seconds=app.config['FINANCE_DASHBOARD_REFRESH_SECONDS'],
+        **tabs
+    )
+
 
+def get_finance_dashboard_tabs(employee, role, epv_ids=None):
+    """
+    Rows of each finance dashboard tab for an employee.
+
+    Args:
+        employee (Identity): Finance user or Finance Approver
+        role (str): 'Finance' or 'Finance Approver'
+        epv_ids (list): Only return rows of these EPV primary keys (used to
+            re-render rows named by the change feed)
+
+    Returns:
+        dict: Template variable of each tab -> EPVs or finance entries
+    """
     # Get assigned cities for the employee
-    assigned_cities = CityAssignment.query.filter_by(
-        employee_id=employee.id,
-        is_active=True
-    ).all()
+    city_names = list(employee.assigned_cities)
+    # EPVs of the assigned cities (all EPVs if none are assigned)
+    in_assigned_cities = city_scope.in_cities(city_names)
 
-    city_names = [assignment.city for assignment in assigned_cities]
+    def for_epvs(query, column=EPV.id):
+        return query.filter(column.in_(epv_ids)) if epv_ids is not None else query
 
-    if session.get('employee_role') == 'Finance':
+    if role == 'Finance':
         # For Finance Personnel
 
-        # Get pending EPVs (approved but not processed)
-        pending_epvs = []
-        resubmitted_epvs = []
-        rejected_epvs = []
-        pending_payment_epvs = []
-
-        # Get ALL standard invoices that are approved and have pending/null finance status
-        standard_invoices_query = EPV.query.filter(
+        # Get standard invoices of the assigned cities that are approved and have pending/null finance status
+        standard_invoices = for_epvs(EPV.query.filter(
             EPV.invoice_type == 'standard',
             EPV.status == 'approved',
             (EPV.finance_status == None) | (EPV.finance_status == 'pending'),
-            EPV.document_status != 'documents_uploaded'  # Exclude resubmitted documents
-        )
-
-        standard_invoices = standard_invoices_query.all()
+            EPV.document_status != 'documents_uploaded',  # Exclude resubmitted documents
+            in_assigned_cities
+        )).all()
 
         # Get resubmitted EPVs (documents uploaded after rejection)
-        resubmitted_invoices_query = EPV.query.filter(
+        resubmitted_epvs = for_epvs(EPV.query.filter(
             EPV.invoice_type == 'standard',
             EPV.status == 'approved',
             EPV.finance_status == 'pending',
-            EPV.document_status == 'documents_uploaded'  # These are resubmitted documents
-        )
-
-        resubmitted_invoices = resubmitted_invoices_query.all()
+            EPV.document_status == 'documents_uploaded',  # These are resubmitted documents
+            in_assigned_cities
+        )).all()
 
         # Get rejected EPVs
-        rejected_invoices_query = EPV.query.filter(
+        rejected_epvs = for_epvs(EPV.query.filter(
             EPV.invoice_type == 'standard',
-            EPV.finance_status == 'rejected'
-        )
-
-        rejected_invoices = rejected_invoices_query.all()
+            EPV.finance_status == 'rejected',
+            in_assigned_cities
+        )).all()
 
         # Get EPVs that need payment details (approved by Finance Approver but missing transaction ID or payment date)
         # This query finds finance entries that are approved but have null transaction_id or payment_date
         # For partial payments, check if both sets of fields are complete
-        pending_payment_query = db.session.query(EPV).join(FinanceEntry).filter(
+        pending_payment_epvs = for_epvs(db.session.query(EPV).join(FinanceEntry).filter(
             FinanceEntry.status == 'approved',
             db.or_(
                 # For regular payments: check main transaction_id and payment_date
@@ -5745,518 +5107,219 @@ def finance_dashboard():
                     )
                 )
             ),
-            FinanceEntry.finance_user_id == employee.id  # Only show entries processed by this finance user
-        )
-
-        pending_payment_invoices = pending_payment_query.all()
-
-        # Filter standard invoices by city if the user has assigned cities
-        standard_epvs = []
-        resubmitted_epvs_filtered = []
-        rejected_epvs_filtered = []
-        pending_payment_epvs_filtered = []
-
-        if city_names:
-            for invoice in standard_invoices:
-                # If the EPV has a city field, only show it if the finance person is assigned to that exact city
-                if invoice.city:
-                    if invoice.city in city_names:
-                        standard_epvs.append(invoice)
-                # If EPV doesn't have a city, fall back to the cost center's city
-                elif invoice.cost_center and invoice.cost_center.city in city_names:
-                    standard_epvs.append(invoice)
-                # Also include invoices that don't have a city or cost center
-                elif not invoice.city and not invoice.cost_center:
-                    standard_epvs.append(invoice)
-
-            # Filter resubmitted invoices by city
-            for invoice in resubmitted_invoices:
-                # If the EPV has a city field, only show it if the finance person is assigned to that exact city
-                if invoice.city:
-                    if invoice.city in city_names:
-                        resubmitted_epvs_filtered.append(invoice)
-                # If EPV doesn't have a city, fall back to the cost center's city
-                elif invoice.cost_center and invoice.cost_center.city in city_names:
-                    resubmitted_epvs_filtered.append(invoice)
-                # Also include invoices that don't have a city or cost center
-                elif not invoice.city and not invoice.cost_center:
-                    resubmitted_epvs_filtered.append(invoice)
-
-            # Filter rejected invoices by city
-            for invoice in rejected_invoices:
-                # If the EPV has a city field, only show it if the finance person is assigned to that exact city
-                if invoice.city:
-                    if invoice.city in city_names:
-                        rejected_epvs_filtered.append(invoice)
-                # If EPV doesn't have a city, fall back to the cost center's city
-                elif invoice.cost_center and invoice.cost_center.city in city_names:
-                    rejected_epvs_filtered.append(invoice)
-                # Also include invoices that don't have a city or cost center
-                elif not invoice.city and not invoice.cost_center:
-                    rejected_epvs_filtered.append(invoice)
-
-            # Filter pending payment invoices by city
-            for invoice in pending_payment_invoices:
-                # If the EPV has a city field, only show it if the finance person is assigned to that exact city
-                if invoice.city:
-                    if invoice.city in city_names:
-                        pending_payment_epvs_filtered.append(invoice)
-                # If EPV doesn't have a city, fall back to the cost center's city
-                elif invoice.cost_center and invoice.cost_center.city in city_names:
-                    pending_payment_epvs_filtered.append(invoice)
-                # Also include invoices that don't have a city or cost center
-                elif not invoice.city and not invoice.cost_center:
-                    pending_payment_epvs_filtered.append(invoice)
-        else:
-            # If the user has no assigned cities, show all invoices
-            standard_epvs = standard_invoices
-            resubmitted_epvs_filtered = resubmitted_invoices
-            rejected_epvs_filtered = rejected_invoices
-            pending_payment_epvs_filtered = pending_payment_invoices
+            FinanceEntry.finance_user_id == employee.id,  # Only show entries processed by this finance user
+            in_assigned_cities
+        )).all()
 
         # Get ALL master invoices that are approved and have pending/null finance status
         # For master invoices, we don't filter by city - show all of them
-        master_invoices_query = EPV.query.filter(
+        master_epvs = for_epvs(EPV.query.filter(
             EPV.invoice_type == 'master',
             EPV.status == 'approved',
             (EPV.finance_status == None) | (EPV.finance_status == 'pending')
-        )
-
-        master_epvs = master_invoices_query.all()
+        )).all()
 
-        # Get ALL split invoices that are partially approved and have pending/null finance status
+        # Get split invoices of the assigned cities that are partially approved and have pending/null finance status
         # Split invoices with partially_approved status should be processed by finance
-        split_invoices_query = EPV.query.filter(
+        split_epvs = for_epvs(EPV.query.filter(
             EPV.invoice_type == 'split',
             EPV.status.in_(['approved', 'partially_approved']),  # Include both approved and partially_approved
-            (EPV.finance_status == None) | (EPV.finance_status == 'pending')
-        )
-
-        split_epvs = split_invoices_query.all()
-
-        # Filter split invoices by city if the user has assigned cities
-        split_epvs_filtered = []
-        if city_names:
-            for invoice in split_epvs:
-                # If the EPV has a city field, only show it if the finance person is assigned to that exact city
-                if invoice.city:
-                    if invoice.city in city_names:
-                        split_epvs_filtered.append(invoice)
-                # If EPV doesn't have a city, fall back to the cost center's city
-                elif invoice.cost_center and invoice.cost_center.city in city_names:
-                    split_epvs_filtered.append(invoice)
-                # Also include invoices that don't have a city or cost center
-                elif not invoice.city and not invoice.cost_center:
-                    split_epvs_filtered.append(invoice)
-        else:
-            # If the user has no assigned cities, show all split invoices
-            split_epvs_filtered = split_epvs
+            (EPV.finance_status == None) | (EPV.finance_status == 'pending'),
+            in_assigned_cities
+        )).all()
 
         # Combine the results - include standard, master, and split invoices
-        pending_epvs = standard_epvs + master_epvs + split_epvs_filtered
-        resubmitted_epvs = resubmitted_epvs_filtered
-        rejected_epvs = rejected_epvs_filtered
-        pending_payment_epvs = pending_payment_epvs_filtered
-
-        # Check for EPVs being processed by others
-        # Get the current time
-        current_time = datetime.now()
-
-        # Define a timeout period (e.g., 30 minutes)
-        timeout_period = 30  # minutes
-
-        for epv in pending_epvs:
-            # Check if this EPV is being processed by someone
-            if epv.being_processed_by and epv.processing_started_at:
-                # Calculate how long it's been since processing started
-                time_diff = current_time - epv.processing_started_at
-                minutes_diff = time_diff.total_seconds() / 60
-
-                # If it's been less than the timeout period and it's not this user
-                if minutes_diff < timeout_period and epv.being_processed_by != employee.id:
-                    # Mark this EPV as being processed by someone else
-                    epv.is_locked = True
-                    epv.locked_by = EmployeeDetails.query.get(epv.being_processed_by)
-                    epv.lock_time_remaining = int(timeout_period - minutes_diff)
-                else:
-                    # If it's been longer than the timeout or it's this user, clear the lock
-                    epv.is_locked = False
-                    epv.locked_by = None
-                    epv.lock_time_remaining = 0
-
-                    # If it's been longer than the timeout, clear the processing fields
-                    if minutes_diff >= timeout_period:
-                        epv.being_processed_by = None
-                        epv.processing_started_at = None
-                        db.session.commit()
-            else:
-                # Not being processed
-                epv.is_locked = False
-                epv.locked_by = None
-                epv.lock_time_remaining = 0
+        pending_epvs = standard_invoices + master_epvs + split_epvs
 
-            # No need to check city here as we're using city_names from assignments
+        # Mark EPVs leased by other finance users (see finance_queue.py)
+        finance_queue.annotate_leases(pending_epvs, employee.id)
 
         # Get processed entries for the assigned cities
         if city_names:
-            processed_entries = FinanceEntry.query.join(EPV).join(
-                CostCenter, EPV.cost_center_id == CostCenter.id
-            ).filter(
-                CostCenter.city.in_(city_names)
-            ).order_by(FinanceEntry.entry_date.desc()).all()
-            print(f"DEBUG: Found {len(processed_entries)} processed entries for assigned cities")
+            processed_entries = for_epvs(FinanceEntry.query.join(EPV).filter(
+                in_assigned_cities
+            ), FinanceEntry.epv_id).order_by(FinanceEntry.entry_date.desc()).all()
+            logger.debug("Found %s processed entries for assigned cities", len(processed_entries))
         else:
             # If no cities assigned, show only entries processed by this user
-            processed_entries = FinanceEntry.query.filter_by(
+            processed_entries = for_epvs(FinanceEntry.query.filter_by(
                 finance_user_id=employee.id
-            ).order_by(FinanceEntry.entry_date.desc()).all()
-            print(f"DEBUG: Found {len(processed_entries)} processed entries by this finance user")
-
-        return render_template(
-            'finance_dashboard.html',
-            user=session.get('user_info'),
-            pending_epvs=pending_epvs,
-            resubmitted_epvs=resubmitted_epvs,
-            rejected_epvs=rejected_epvs,
-            pending_payment_epvs=pending_payment_epvs,
-            processed_entries=processed_entries,
-            today=datetime.now()
-        )
-    else:
-        # For Finance Approver
+            ), FinanceEntry.epv_id).order_by(FinanceEntry.entry_date.desc()).all()
+            logger.debug("Found %s processed entries by this finance user", len(processed_entries))
+
+        return {
+            'pending_epvs': pending_epvs,
+            'resubmitted_epvs': resubmitted_epvs,
+            'rejected_epvs': rejected_epvs,
+            'pending_payment_epvs': pending_payment_epvs,
+            'processed_entries': processed_entries
+        }
 
-        # Get entries pending approval
-        pending_approval_entries = []
-        if city_names:
-            # If finance approver has assigned cities, show entries from those cities
-            # Use LEFT JOIN to handle EPVs without cost centers and include direct city matches
-            pending_approval_entries = FinanceEntry.query.join(EPV).outerjoin(CostCenter).filter(
-                FinanceEntry.status == 'pending',
-                EPV.finance_status == 'processed',  # CRITICAL FIX: Only show processed EPVs
-                db.or_(
-                    EPV.city.in_(city_names),  # Direct city match
-                    CostCenter.city.in_(city_names)  # Cost center city match
-                )
-            ).order_by(FinanceEntry.entry_date.desc()).all()
-            print(f"DEBUG: Found {len(pending_approval_entries)} pending approval entries for assigned cities: {city_names}")
-        else:
-            # If no cities assigned, show all pending entries that are processed
-            pending_approval_entries = FinanceEntry.query.join(EPV).filter(
-                FinanceEntry.status == 'pending',
-                EPV.finance_status == 'processed'  # CRITICAL FIX: Only show processed EPVs
-            ).order_by(FinanceEntry.entry_date.desc()).all()
-            print(f"DEBUG: Found {len(pending_approval_entries)} pending approval entries across all cities")
-
-        # Debug: Print details of pending entries
-        for entry in pending_approval_entries:
-            epv_city = entry.epv.city if entry.epv.city else (entry.epv.cost_center.city if entry.epv.cost_center else 'No City')
-            print(f"DEBUG: Pending entry ID {entry.id}, EPV {entry.epv.epv_id}, Status: {entry.status}, Entry Date: {entry.entry_date}, EPV City: {epv_city}, Finance User: {entry.finance_user.name if entry.finance_user else 'Unknown'}")
-
-        # Get approved/rejected entries by this finance approver
-        approved_rejected_entries = FinanceEntry.query.filter(
-            FinanceEntry.approver_id == employee.id,
-            FinanceEntry.status.in_(['approved', 'rejected'])
-        ).order_by(FinanceEntry.approved_on.desc()).all()
-        print(f"DEBUG: Found {len(approved_rejected_entries)} approved/rejected entries by this finance approver")
-
-        return render_template(
-            'finance_dashboard.html',
-            user=session.get('user_info'),
-            pending_approval_entries=pending_approval_entries,
-            approved_rejected_entries=approved_rejected_entries,
-            today=datetime.now()
-        )
+    # For Finance Approver
+
+    # Get entries pending approval from the assigned cities (all cities if none are assigned)
+    pending_approval_entries = for_epvs(FinanceEntry.query.join(EPV).filter(
+        FinanceEntry.status == 'pending',
+        EPV.finance_status == 'processed',  # CRITICAL FIX: Only show processed EPVs
+        in_assigned_cities
+    ), FinanceEntry.epv_id).order_by(FinanceEntry.entry_date.desc()).all()
+    logger.debug("Found %s pending approval entries for assigned cities: %s", len(pending_approval_entries), city_names or 'all')
+
+    # Get approved/rejected entries by this finance approver
+    approved_rejected_entries = for_epvs(FinanceEntry.query.filter(
+        FinanceEntry.approver_id == employee.id,
+        FinanceEntry.status.in_(['approved', 'rejected'])
+    ), FinanceEntry.epv_id).order_by(FinanceEntry.approved_on.desc()).all()
+    logger.debug("Found %s approved/rejected entries by this finance approver", len(approved_rejected_entries))
+
+    return {
+        'pending_approval_entries': pending_approval_entries,
+        'approved_rejected_entries': approved_rejected_entries
+    }
 
-# API endpoint to check for updates in the finance dashboard
-@app.route('/finance-dashboard-content')
+# Template variable holding the rows of each finance dashboard tab
+FINANCE_TAB_ROWS = {
+    'pending': 'pending_epvs',
+    'resubmitted': 'resubmitted_epvs',
+    'pending-payment': 'pending_payment_epvs',
+    'rejected': 'rejected_epvs',
+    'processed': 'processed_entries',
+    'pending-approval': 'pending_approval_entries',
+    'approved-rejected': 'approved_rejected_entries',
+}
+
+# Re-render finance dashboard rows named by the change feed
+@app.route('/finance-dashboard/rows')
 @login_required
-def finance_dashboard_content():
-    # Get the tab ID and current row count from the request
-    tab_id = request.args.get('tab')
-    current_rows_str = request.args.get('current_rows', '0')
-    last_update_time_str = request.args.get('last_update', '0')
+def finance_dashboard_rows():
+    if session.get('employee_role') not in ['Finance', 'Finance Approver']:
+        return jsonify({'success': False, 'message': 'Permission denied'}), 403
 
-    if not tab_id:
-        return jsonify({'has_updates': False})
+    employee = get_identity()
+    if not employee:
+        return jsonify({'success': False, 'message': 'User not found'}), 404
 
     try:
-        current_rows = int(current_rows_str)
-        last_update_time = float(last_update_time_str) if last_update_time_str else 0
+        epv_ids = [int(pk) for pk in request.args.get('epv_ids', '').split(',') if pk.strip()][:200]
     except ValueError:
-        current_rows = 0
-        last_update_time = 0
+        return jsonify({'success': False, 'message': 'Invalid EPV ids'}), 400
+    if not epv_ids:
+        return jsonify({'success': True, 'rows': {}})
+
+    role = session.get('employee_role')
+    role_tabs = change_feed.FINANCE_TABS if role == 'Finance' else change_feed.FINANCE_APPROVER_TABS
+    requested_tabs = [tab for tab in request.args.get('tabs', '').split(',') if tab in role_tabs] or list(role_tabs)
+
+    tabs = get_finance_dashboard_tabs(employee, role, epv_ids=epv_ids)
+    tab_row = get_template_attribute('finance_dashboard_rows.html', 'tab_row')
+
+    # The HTML of each EPV's row in each tab, or None if the row should be removed
+    rows = {}
+    for tab in requested_tabs:
+        items = {}
+        for item in tabs[FINANCE_TAB_ROWS[tab]]:
+            # Finance entries are keyed by their EPV; the newest entry comes first
+            items.setdefault(item.epv_id if isinstance(item, FinanceEntry) else item.id, item)
+        rows[tab] = {str(pk): str(tab_row(tab, items[pk])) if pk in items else None for pk in epv_ids}
+
+    return jsonify({'success': True, 'rows': rows})
+
+# Long poll for finance dashboard changes
+@app.route('/finance-dashboard/events')
+@login_required
+def finance_dashboard_events():
+    """
+    Changes visible to the user after last_id, waiting up to FINANCE_EVENTS_WAIT_SECONDS for one.
 
-    # Convert timestamp to datetime
-    if last_update_time > 0:
-        last_update_datetime = datetime.fromtimestamp(last_update_time / 1000.0)  # Convert from JS milliseconds
-    else:
-        last_update_datetime = datetime.now() - timedelta(minutes=30)  # Default to 30 minutes ago
+    Event ids are per app process (see change_feed.py). If the request reaches
+    another process than the one the ids came from (feed differs), or events
+    were dropped from the buffer, the response asks the browser to resync by
+    reloading its rows.
+    """
+    if session.get('employee_role') not in ['Finance', 'Finance Approver']:
+        return jsonify({'success': False, 'message': 'Permission denied'}), 403
 
-    # Get the employee's database ID from their email
-    employee = EmployeeDetails.query.filter_by(email=session.get('email')).first()
+    employee = get_identity()
     if not employee:
-        return jsonify({'has_updates': False})
-
-    # Check for updates based on the tab ID
-    has_updates = False
+        return jsonify({'success': False, 'message': 'User not found'}), 404
 
+    tabs = change_feed.FINANCE_TABS if session.get('employee_role') == 'Finance' else change_feed.FINANCE_APPROVER_TABS
+    cities = set(employee.assigned_cities)
     try:
-        if session.get('employee_role') == 'Finance':
-            if tab_id == 'pending':
-                # Check for new approved EPVs
-                assigned_cities = CityAssignment.query.filter_by(
-                    employee_id=employee.id,
-                    is_active=True
-                ).all()
-                city_names = [assignment.city for assignment in assigned_cities]
-
-                if city_names:
-                    # Count the current number of pending EPVs
-                    # Only count expenses with direct city match to assigned cities
-                    direct_city_count = EPV.query.filter(
-                        EPV.status.in_(['approved', 'partially_approved']),  # Include both approved and partially_approved
-                        EPV.city.in_(city_names),
-                        db.or_(EPV.finance_status == 'pending', EPV.finance_status == None)
-                    ).count()
-
-                    # Then count expenses without city but with cost center city match
-                    cost_center_city_count = EPV.query.join(CostCenter).filter(
-                        EPV.status.in_(['approved', 'partially_approved']),  # Include both approved and partially_approved
-                        EPV.city == None,  # Only count expenses without a direct city
-                        CostCenter.city.in_(city_names),
-                        db.or_(EPV.finance_status == 'pending', EPV.finance_status == None)
-                    ).count()
-
-                    # Total count
-                    current_count = direct_city_count + cost_center_city_count
-
-                    # Check if the count is different
-                    if current_count != current_rows:
-                        has_updates = True
-                    else:
-                        # Check if any EPV's processing status has changed
-                        recent_updates = EPV.query.outerjoin(CostCenter).filter(
-                            EPV.status.in_(['approved', 'partially_approved']),  # Include both approved and partially_approved
-                            db.or_(
-                                EPV.city.in_(city_names),
-                                CostCenter.city.in_(city_names)
-                            ),
-                            (EPV.finance_status == None) | (EPV.finance_status == 'pending'),
-                            db.or_(
-                                EPV.being_processed_by != None,  # Someone started processing
-                                EPV.processing_started_at > last_update_datetime  # Processing started recently
-                            )
-                        ).count()
-
-                        has_updates = recent_updates > 0
-
-            elif tab_id == 'resubmitted':
-                # Check for new resubmitted EPVs
-                if city_names:
-                    # Count the current number of resubmitted EPVs
-                    current_count = EPV.query.outerjoin(CostCenter).filter(
-                        EPV.status.in_(['approved', 'partially_approved']),  # Include both approved and partially_approved
-                        db.or_(
-                            EPV.city.in_(city_names),
-                            CostCenter.city.in_(city_names)
-                        ),
-                        EPV.finance_status == 'pending',
-                        EPV.document_status == 'documents_uploaded'
-                    ).count()
-                else:
-                    # If no cities assigned, count all resubmitted EPVs
-                    current_count = EPV.query.filter(
-                        EPV.status.in_(['approved', 'partially_approved']),  # Include both approved and partially_approved
-                        EPV.finance_status == 'pending',
-                        EPV.document_status == 'documents_uploaded'
-                    ).count()
-
-                # Check if the count is different
-                if current_count != current_rows:
-                    has_updates = True
-
-            elif tab_id == 'pending-payment':
-                # Check for EPVs that need payment details
-                # This query finds finance entries that are approved but have null transaction_id or payment_date
-                # For partial payments, check if both sets of fields are complete
-                pending_payment_query = db.session.query(EPV).join(FinanceEntry).filter(
-                    FinanceEntry.status == 'approved',
-                    db.or_(
-                        # For regular payments: check main transaction_id and payment_date
-                        db.and_(
-                            FinanceEntry.is_partial_payment == False,
-                            db.or_(
-                                FinanceEntry.transaction_id == None,
-                                FinanceEntry.payment_date == None
-                            )
-                        ),
-                        # For partial payments: check if any of the partial payment fields are missing
-                        db.and_(
-                            FinanceEntry.is_partial_payment == True,
-                            db.or_(
-                                FinanceEntry.transaction_id_1 == None,
-                                FinanceEntry.payment_date_1 == None,
-                                FinanceEntry.transaction_id_2 == None,
-                                FinanceEntry.payment_date_2 == None
-                            )
-                        )
-                    ),
-                    FinanceEntry.finance_user_id == employee.id  # Only show entries processed by this finance user
-                )
+        last_id = int(request.args.get('last_id', ''))
+    except ValueError:
+        last_id = None
 
-                if city_names:
-                    # Filter by city if assigned
-                    # We need to handle this differently since we're already in a query
-                    # First get the IDs of EPVs with direct city match
-                    direct_city_epv_ids = db.session.query(EPV.id).filter(
-                        EPV.city.in_(city_names)
-                    ).all()
-                    direct_city_epv_ids = [id[0] for id in direct_city_epv_ids]
-
-                    # Then get the IDs of EPVs with cost center city match but no direct city
-                    cost_center_city_epv_ids = db.session.query(EPV.id).join(CostCenter).filter(
-                        EPV.city == None,
-                        CostCenter.city.in_(city_names)
-                    ).all()
-                    cost_center_city_epv_ids = [id[0] for id in cost_center_city_epv_ids]
-
-                    # Combine the IDs
-                    all_epv_ids = direct_city_epv_ids + cost_center_city_epv_ids
-
-                    # Filter the query by these IDs
-                    pending_payment_query = pending_payment_query.filter(
-                        EPV.id.in_(all_epv_ids)
-                    )
+    if last_id is None or request.args.get('feed') != change_feed.FEED_ID or change_feed.missed_events(last_id):
+        return jsonify({
+            'success': True,
+            'resync': True,
+            'feed': change_feed.FEED_ID,
+            'last_id': change_feed.last_event_id(),
+            'events': []
+        })
 
-                # Count the current number of pending payment EPVs
-                current_count = pending_payment_query.count()
-
-                # Check if the count is different
-                if current_count != current_rows:
-                    has_updates = True
-
-            elif tab_id == 'rejected':
-                # Check for new rejected EPVs
-                if city_names:
-                    # Count the current number of rejected EPVs
-                    current_count = EPV.query.outerjoin(CostCenter).filter(
-                        db.or_(
-                            EPV.city.in_(city_names),
-                            CostCenter.city.in_(city_names)
-                        ),
-                        EPV.finance_status == 'rejected'
-                    ).count()
-                else:
-                    # If no cities assigned, count all rejected EPVs
-                    current_count = EPV.query.filter(
-                        EPV.finance_status == 'rejected'
-                    ).count()
-
-                # Check if the count is different
-                if current_count != current_rows:
-                    has_updates = True
-
-            elif tab_id == 'processed':
-                # Count the current number of processed entries
-                current_count = FinanceEntry.query.filter(
-                    FinanceEntry.finance_user_id == employee.id
-                ).count()
-
-                # Check if the count is different
-                if current_count != current_rows:
-                    has_updates = True
-                else:
-                    # Check if any entries have been updated recently
-                    recent_updates = FinanceEntry.query.filter(
-                        FinanceEntry.finance_user_id == employee.id,
-                        FinanceEntry.entry_date > last_update_datetime
-                    ).count()
-
-                    has_updates = recent_updates > 0
-
-        else:  # Finance Approver
-            if tab_id == 'pending-approval':
-                # Check for new entries pending approval
-                assigned_cities = CityAssignment.query.filter_by(
-                    employee_id=employee.id,
-                    is_active=True
-                ).all()
-                city_names = [assignment.city for assignment in assigned_cities]
-
-                if city_names:
-                    # Count the current number of pending entries
-                    current_count = FinanceEntry.query.join(EPV).outerjoin(CostCenter).filter(
-                        FinanceEntry.status == 'pending',
-                        EPV.finance_status == 'processed',  # CRITICAL FIX: Only show processed EPVs
-                        db.or_(
-                            EPV.city.in_(city_names),
-                            CostCenter.city.in_(city_names)
-                        )
-                    ).count()
+    # Changes the user cannot see do not end the wait
+    visible = []
+    deadline = time.monotonic() + app.config['FINANCE_EVENTS_WAIT_SECONDS']
+    while not visible:
+        events = change_feed.wait_for_events(last_id, max(deadline - time.monotonic(), 0))
+        if not events:
+            break
+        last_id = events[-1]['id']
+        visible = [
+            {'epv': change['epv'], 'epv_id': change['epv_id'], 'tabs': change['tabs']}
+            for change in events if change_feed.visible_to(change, tabs, cities)
+        ]
+
+    return jsonify({'success': True, 'feed': change_feed.FEED_ID, 'last_id': last_id, 'events': visible})
+
+# Next EPV in the finance work queue
+@app.route('/finance/next')
+@login_required
+def finance_next():
+    """Lease the oldest EPV waiting for processing in the user's cities and open it"""
+    if session.get('employee_role') != 'Finance':
+        flash('You do not have permission to access this page.', 'error')
+        return redirect(url_for('dashboard'))
 
-                    # Check if the count is different
-                    if current_count != current_rows:
-                        has_updates = True
-                    else:
-                        # Check if any entries have been updated recently
-                        recent_updates = FinanceEntry.query.join(EPV).outerjoin(CostCenter).filter(
-                            FinanceEntry.status == 'pending',
-                            EPV.finance_status == 'processed',  # CRITICAL FIX: Only show processed EPVs
-                            db.or_(
-                                EPV.city.in_(city_names),
-                                CostCenter.city.in_(city_names)
-                            ),
-                            FinanceEntry.entry_date > last_update_datetime
-                        ).count()
-
-                        has_updates = recent_updates > 0
-                else:
-                    # If no cities assigned, check all pending entries
-                    current_count = FinanceEntry.query.join(EPV).filter(
-                        FinanceEntry.status == 'pending',
-                        EPV.finance_status == 'processed'  # CRITICAL FIX: Only show processed EPVs
-                    ).count()
-
-                    # Check if the count is different
-                    if current_count != current_rows:
-                        has_updates = True
-                    else:
-                        # Check if any entries have been updated recently
-                        recent_updates = FinanceEntry.query.join(EPV).filter(
-                            FinanceEntry.status == 'pending',
-                            EPV.finance_status == 'processed',  # CRITICAL FIX: Only show processed EPVs
-                            FinanceEntry.entry_date > last_update_datetime
-                        ).count()
-
-                        has_updates = recent_updates > 0
-
-            elif tab_id == 'approved-rejected':
-                # Count the current number of approved/rejected entries
-                current_count = FinanceEntry.query.filter(
-                    FinanceEntry.approver_id == employee.id,
-                    FinanceEntry.status.in_(['approved', 'rejected'])
-                ).count()
-
-                # Check if the count is different
-                if current_count != current_rows:
-                    has_updates = True
-                else:
-                    # Check if any entries have been updated recently
-                    recent_updates = FinanceEntry.query.filter(
-                        FinanceEntry.approver_id == employee.id,
-                        FinanceEntry.status.in_(['approved', 'rejected']),
-                        db.or_(
-                            FinanceEntry.approved_on > last_update_datetime,
-                            FinanceEntry.entry_date > last_update_datetime
-                        )
-                    ).count()
+    employee = get_identity()
+    if not employee:
+        flash('Error: Could not find your user account.', 'error')
+        return redirect(url_for('dashboard'))
 
-                    has_updates = recent_updates > 0
-    except Exception as e:
-        print(f"Error checking for updates: {str(e)}")
-        return jsonify({'has_updates': False})
+    # The finance entry page only opens EPVs of the user's assigned cities
+    city_names = list(employee.assigned_cities)
+    if not city_names:
+        flash('You are not assigned to any cities.', 'error')
+        return redirect(url_for('finance_dashboard'))
+
+    epv = finance_queue.claim_next_epv(employee.id, city_names)
+    if not epv:
+        flash('There are no expenses waiting for processing.', 'info')
+        return redirect(url_for('finance_dashboard'))
 
-    return jsonify({'has_updates': has_updates})
+    print(f"DEBUG: Finance queue leased {epv.epv_id} to {employee.email}")
+    return redirect(url_for('finance_entry', epv_id=epv.epv_id))
+
+# Keep the finance entry page's lease while it is open
+@app.route('/api/finance-queue/<string:epv_id>/renew', methods=['POST'])
+@login_required
+def renew_finance_lease(epv_id):
+    if session.get('employee_role') != 'Finance':
+        return jsonify({'error': 'Permission denied'}), 403
+
+    employee = get_identity()
+    epv_pk = db.session.query(EPV.id).filter_by(epv_id=epv_id).scalar()
+    if not employee or epv_pk is None:
+        return jsonify({'success': False, 'message': 'Expense not found'}), 404
+
+    if not finance_queue.renew_lease(epv_pk, employee.id):
+        return jsonify({
+            'success': False,
+            'message': 'Your lock on this expense has expired and it may be processed by someone else.'
+        }), 409
+    return jsonify({'success': True, 'lease_minutes': finance_queue.FINANCE_LEASE_MINUTES})
 
 # Finance Entry Form
 @app.route('/finance-entry/<string:epv_id>', methods=['GET', 'POST'])
@@ -6288,46 +5351,13 @@ def finance_entry(epv_id):
         return redirect(url_for('finance_dashboard'))
 
     # Get the employee's database ID from their email
-    employee = EmployeeDetails.query.filter_by(email=session.get('email')).first()
+    employee = get_identity()
     if not employee:
         flash('Error: Could not find your user account.', 'error')
         return redirect(url_for('dashboard'))
 
-    # Check if this EPV is being processed by someone else
-    if epv.being_processed_by and epv.processing_started_at:
-        # Calculate how long it's been since processing started
-        current_time = datetime.now()
-        time_diff = current_time - epv.processing_started_at
-        minutes_diff = time_diff.total_seconds() / 60
-
-        # Define a timeout period (e.g., 30 minutes)
-        timeout_period = 30  # minutes
-
-        # If it's been less than the timeout period and it's not this user
-        if minutes_diff < timeout_period and epv.being_processed_by != employee.id:
-            # Get the name of the person processing it
-            processor = EmployeeDetails.query.get(epv.being_processed_by)
-            processor_name = processor.name if processor else 'another user'
-
-            # Show an error message
-            flash(f'This expense is currently being processed by {processor_name}. Please try again later.', 'error')
-            return redirect(url_for('finance_dashboard'))
-        elif minutes_diff >= timeout_period:
-            # If it's been longer than the timeout, clear the processing fields
-            epv.being_processed_by = None
-            epv.processing_started_at = None
-
-    # Claim this EPV for processing
-    epv.being_processed_by = employee.id
-    epv.processing_started_at = datetime.now()
-    db.session.commit()
-
     # Check if EPV is from an assigned city
-    assigned_cities = CityAssignment.query.filter_by(
-        employee_id=employee.id,
-        is_active=True
-    ).all()
-    city_names = [assignment.city for assignment in assigned_cities]
+    city_names = list(employee.assigned_cities)
 
     # For master invoices, check the city of the first sub-invoice
     if epv.invoice_type == 'master':
@@ -6356,6 +5386,13 @@ def finance_entry(epv_id):
             # This is likely a master invoice without a city or cost center
             pass
 
+    # Lease this EPV for processing; fails if another finance user holds an unexpired lease
+    if not finance_queue.claim_epv(epv.id, employee.id):
+        processor = finance_queue.lease_holder(epv)
+        processor_name = processor.name if processor else 'another user'
+        flash(f'This expense is currently being processed by {processor_name}. Please try again later.', 'error')
+        return redirect(url_for('finance_dashboard'))
+
     if request.method == 'POST':
         # Check if this is a partial payment
         is_partial = request.form.get('partial_payment') == 'on'
@@ -6459,7 +5496,8 @@ def finance_entry(epv_id):
         'finance_entry.html',
         user=session.get('user_info'),
         epv=epv,
-        today=datetime.now()
+        today=datetime.now(),
+        lease_minutes=finance_queue.FINANCE_LEASE_MINUTES
     )
 
 # Finance Approval
@@ -6480,19 +5518,15 @@ def finance_approval(entry_id):
 
     # Check if finance approver is assigned to this city
     # Get the employee's database ID from their email
-    employee = EmployeeDetails.query.filter_by(email=session.get('email')).first()
+    employee = get_identity()
     if not employee:
         flash('Error: Could not find your user account.', 'error')
         return redirect(url_for('dashboard'))
 
-    assigned_cities = CityAssignment.query.filter_by(
-        employee_id=employee.id,
-        is_active=True
-    ).all()
-    city_names = [assignment.city for assignment in assigned_cities]
+    city_names = list(employee.assigned_cities)
 
     # If finance approver has assigned cities, check if they can access this EPV
-    if assigned_cities:
+    if city_names:
         # First check if the EPV has a city field
         if epv.city and epv.city not in city_names:
             flash('You are not assigned to approve expenses from this city.', 'error')
@@ -6589,7 +5623,7 @@ def edit_finance_entry(entry_id):
         return redirect(url_for('finance_dashboard'))
 
     # Check if the entry was processed by this user
-    employee = EmployeeDetails.query.filter_by(email=session.get('email')).first()
+    employee = get_identity()
     if not employee or entry.finance_user_id != employee.id:
         flash('You can only edit entries you processed.', 'error')
         return redirect(url_for('finance_dashboard'))
@@ -6881,7 +5915,7 @@ def city_assignments():
             flash(f'This employee is already assigned to {city}.', 'warning')
         else:
             # Get the current user's database ID
-            current_user = EmployeeDetails.query.filter_by(email=session.get('email')).first()
+            current_user = get_identity()
             if not current_user:
                 flash('Error: Could not find your user account.', 'error')
                 return redirect(url_for('city_assignments'))
@@ -6894,6 +5928,8 @@ def city_assignments():
             )
             db.session.add(assignment)
             db.session.commit()
+            invalidate_identity(assignment.employee.email)
+            invalidate_finance_routing()
 
             flash(f'Employee has been assigned to {city}.', 'success')
 
@@ -6928,7 +5964,7 @@ def update_payment_details(entry_id):
         return redirect(url_for('finance_dashboard'))
 
     # Check if the entry was processed by this user
-    employee = EmployeeDetails.query.filter_by(email=session.get('email')).first()
+    employee = get_identity()
     if not employee or entry.finance_user_id != employee.id:
         flash('You can only update payment details for entries you processed.', 'error')
         return redirect(url_for('finance_dashboard'))
@@ -7065,6 +6101,8 @@ def toggle_city_assignment(assignment_id):
     # Toggle the status
     assignment.is_active = not assignment.is_active
     db.session.commit()
+    invalidate_identity(assignment.employee.email)
+    invalidate_finance_routing()
 
     if assignment.is_active:
         flash(f'Assignment has been activated.', 'success')
@@ -7074,6 +6112,9 @@ def toggle_city_assignment(assignment_id):
     return redirect(url_for('city_assignments'))
 
 if __name__ == '__main__':
+    # Leveled, queued log output for the server (see app_logging.py)
+    app_logging.configure_logging()
+
     # Allow OAuth without HTTPS for local development
     os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '1'
 
@@ -7186,25 +6227,27 @@ if __name__ == '__main__':
             # Import gunicorn programmatically for production
             try:
                 from gunicorn.app.wsgiapp import WSGIApplication
-                import sys
 
-                # Configure gunicorn
+                # Configure gunicorn; its workers start the background jobs through wsgi.py
                 sys.argv = [
                     'gunicorn',
                     '--config', 'gunicorn.conf.py',
-                    'app:app'
+                    'wsgi:application'
                 ]
 
                 WSGIApplication("%(prog)s [OPTIONS] [APP_MODULE]").run()
             except ImportError:
                 # Fallback to Flask dev server if gunicorn not available
                 app.logger.warning("Gunicorn not available, using Flask dev server")
+                start_background_jobs()
                 app.run(host=host, port=port, debug=False)
         else:
             # Development mode - disable auto-reload to prevent database commit interruption
             print("🚀 Starting Flask development server with auto-reload DISABLED for testing")
             print("📝 This prevents database commit interruption during form submissions")
+            start_background_jobs()
             app.run(host=host, port=port, debug=debug_mode, use_reloader=False)
 
-# Make the Flask application available as 'application' for WSGI
+# Make the Flask application available as 'application' for WSGI.
+# Servers should load wsgi.application, which also starts the background jobs.
 application = app
@@ -0,0 +1,286 @@
+"""
+Logging setup: per-module levels, a background writer and request timing.
+
+configure_logging() is called once by the server entry point (python
+app.py), not on import, so scripts importing app keep their own output.
+Every record goes through a queue to a single writer thread, so requests
+never wait on console or file I/O, and is written as one JSON object per
+line (LOG_FORMAT=json, the default) or as plain text. LOG_LEVEL and
+LOG_LEVELS (e.g. "pdf_converter=WARNING,app=DEBUG") set the levels. A
+process forked afterwards (e.g. a Gunicorn worker) starts its own writer
+thread.
+
+Code logs through logging.getLogger(__name__) with lazy arguments. Much of
+the code base still reports progress with print(), which goes to stdout
+as is. With LOG_CAPTURE_PRINT=true, configure_logging() also replaces
+sys.stdout so each printed message becomes a record of the printing
+module's logger, at the level named by its prefix ("DEBUG: ...",
+"WARNING: ...", "ERROR: ..."; anything else is INFO), e.g. to get all
+output into LOG_FILE.
+
+init_request_logging(app) adds one record per request to the 'request'
+logger: route, method, status, role, duration, number and time of SQL
+statements (counted by sql_profile) and time spent in external calls
+(Google Drive, SMTP, Google OAuth), which code marks with external_call().
+Requests slower than LOG_SLOW_REQUEST_MS are logged as warnings.
+"""
+
+import atexit
+import contextvars
+import io
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_LEVELS = os.environ.get('LOG_LEVELS', '')
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json').lower()
+LOG_FILE = os.environ.get('LOG_FILE')
+LOG_SLOW_REQUEST_MS = int(os.environ.get('LOG_SLOW_REQUEST_MS', 1000))
+LOG_CAPTURE_PRINT = os.environ.get('LOG_CAPTURE_PRINT', 'false').lower() in ('1', 'true', 'yes')
+
+# Levels of printed messages by their first word
+PRINT_LEVELS = {
+    'DEBUG': logging.DEBUG,
+    'INFO': logging.INFO,
+    'SUCCESS': logging.INFO,
+    'WARNING': logging.WARNING,
+    'ERROR': logging.ERROR,
+    'CRITICAL': logging.CRITICAL,
+}
+
+request_logger = logging.getLogger('request')
+
+_listener = None
+_request_stats = contextvars.ContextVar('request_stats', default=None)
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record, with the record's `fields` merged in"""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', None) or {})
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+def _print_level(message):
+    """Level named by the first word of a printed message, skipping emoji and spaces"""
+    start = 0
+    while start < len(message) and not message[start].isalpha():
+        start += 1
+    end = start
+    while end < len(message) and message[end].isalpha():
+        end += 1
+    return PRINT_LEVELS.get(message[start:end].upper(), logging.INFO)
+
+
+class _PrintToLog(io.TextIOBase):
+    """sys.stdout replacement that logs each print() as a record of the printing module"""
+
+    encoding = 'utf-8'
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._partial = threading.local()
+
+    def writable(self):
+        return True
+
+    def isatty(self):
+        return False
+
+    def fileno(self):
+        return self._stream.fileno()
+
+    def write(self, text):
+        # print() writes the message and its end separately; log once the line is complete
+        buffered = getattr(self._partial, 'text', '') + text
+        if not buffered.endswith('\n'):
+            self._partial.text = buffered
+            return len(text)
+        self._partial.text = ''
+
+        message = buffered.rstrip('\n')
+        if message.strip():
+            # Frame 1 is the code that called print()
+            module = sys._getframe(1).f_globals.get('__name__', 'print')
+            if module == '__main__':
+                module = os.path.splitext(os.path.basename(sys.argv[0] or 'main'))[0]
+            level = _print_level(message)
+            logger = logging.getLogger(module)
+            if logger.isEnabledFor(level):
+                logger.log(level, message)
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+def _start_listener(handler):
+    """Route all records through a new queue to a writer thread for handler"""
+    global _listener
+    log_queue = queue.SimpleQueue()
+    logging.getLogger().handlers[:] = [logging.handlers.QueueHandler(log_queue)]
+    _listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    _listener.start()
+
+
+def _restart_listener_after_fork():
+    # The writer thread does not survive a fork; the parent writes what it had queued
+    if _listener is not None:
+        _start_listener(_listener.handlers[0])
+
+
+def _stop_listener():
+    # Write out what is still queued when the process exits
+    if _listener is not None:
+        _listener.stop()
+
+
+def configure_logging(capture_print=None):
+    """
+    Set up levels, the queue and its writer thread (idempotent).
+
+    Args:
+        capture_print (bool): Also route print() into logging; defaults to LOG_CAPTURE_PRINT
+    """
+    if _listener is not None:
+        return
+
+    output = sys.stdout
+    if hasattr(output, 'reconfigure'):
+        # Console output keeps working for any character the messages contain
+        output.reconfigure(errors='backslashreplace')
+    if LOG_FILE:
+        handler = logging.handlers.WatchedFileHandler(LOG_FILE, encoding='utf-8')
+    else:
+        handler = logging.StreamHandler(output)
+    if LOG_FORMAT == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+
+    logging.getLogger().setLevel(LOG_LEVEL)
+    for item in LOG_LEVELS.split(','):
+        name, _, level = item.partition('=')
+        if name.strip() and level.strip():
+            logging.getLogger(name.strip()).setLevel(level.strip().upper())
+
+    _start_listener(handler)
+    os.register_at_fork(after_in_child=_restart_listener_after_fork)
+    atexit.register(_stop_listener)
+
+    if LOG_CAPTURE_PRINT if capture_print is None else capture_print:
+        sys.stdout = _PrintToLog(output)
+
+
+@contextmanager
+def external_call(kind):
+    """Count the time spent in the block as an external call of this kind (e.g. 'drive')"""
+    stats = _request_stats.get()
+    if stats is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        external = stats['external_ms']
+        external[kind] = external.get(kind, 0) + (time.perf_counter() - started) * 1000
+
+
+def timed_external(kind, func):
+    """Wrap func so that its calls count as external calls of this kind"""
+    def timed(*args, **kwargs):
+        with external_call(kind):
+            return func(*args, **kwargs)
+    return timed
+
+
+def init_request_logging(app):
+    """Log a timing record for every request of app"""
+    from flask import request, session
+    from sql_profile import SqlProfile, activate_profile, deactivate_profile
+
+    def start_request():
+        # Counts only; sql_profile's own request profiles also record statement shapes
+        sql = SqlProfile(track_shapes=False)
+        activate_profile(sql)
+        _request_stats.set({
+            'started': time.perf_counter(),
+            'status': None,
+            'sql': sql,
+            'external_ms': {},
+        })
+
+    def record_status(response):
+        stats = _request_stats.get()
+        if stats is not None:
+            stats['status'] = response.status_code
+        return response
+
+    def log_request(error=None):
+        stats = _request_stats.get()
+        if stats is None:
+            return
+        _request_stats.set(None)
+        sql = stats['sql']
+        deactivate_profile(sql)
+
+        duration_ms = (time.perf_counter() - stats['started']) * 1000
+        status = stats['status'] or (500 if error else None)
+        if request.path.startswith('/static'):
+            level = logging.DEBUG
+        elif duration_ms >= LOG_SLOW_REQUEST_MS:
+            level = logging.WARNING
+        else:
+            level = logging.INFO
+        if not request_logger.isEnabledFor(level):
+            return
+
+        route = request.url_rule.rule if request.url_rule else request.path
+        external_ms = {kind: round(ms, 1) for kind, ms in stats['external_ms'].items()}
+        fields = {
+            'method': request.method,
+            'route': route,
+            'endpoint': request.endpoint,
+            'status': status,
+            'role': session.get('employee_role'),
+            'duration_ms': round(duration_ms, 1),
+            'sql_count': sql.count,
+            'sql_ms': round(sql.total_ms, 1),
+            'external_ms': external_ms,
+        }
+        request_logger.log(
+            level,
+            '%s %s %s %.1fms sql=%d/%.1fms external=%s',
+            request.method, route, status, duration_ms, sql.count, sql.total_ms,
+            ','.join(f"{kind}:{ms}ms" for kind, ms in external_ms.items()) or '-',
+            extra={'fields': fields}
+        )
+
+    # Start timing before the app's own before_request handlers run
+    app.before_request_funcs.setdefault(None, []).insert(0, start_request)
+    app.after_request(record_status)
+    app.teardown_request(log_request)
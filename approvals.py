@@ -0,0 +1,335 @@
+"""
+Approval decisions and the approver inbox.
+
+apply_approval() and apply_rejection() recompute an EPV's status (and its
+master invoice's split status) after one of its approvals was decided, for
+the single approve/reject links and for batch decisions alike. Split EPVs
+take their status from their allocations (update_split_epv_amounts() and
+check_and_send_split_to_finance()).
+
+The approver inbox lists an approver's pending approvals, read through the
+idx_epv_approval_inbox (approver_email, status, epv_id) index.
+decide_pending_approvals() approves or rejects many of them in one
+transaction: the selected approvals, the other approvals and allocations of
+their EPVs, and the master invoices and sub-invoices involved are loaded
+with one query each, each EPV's status is recomputed once, and rejection
+notifications are sent after the commit.
+"""
+
+import logging
+from collections import defaultdict
+from datetime import datetime
+
+from sqlalchemy.orm import contains_eager, joinedload
+
+from models import db, EPV, EPVApproval, EPVAllocation, EmployeeDetails
+
+logger = logging.getLogger(__name__)
+
+# EPV statuses in which approvers still decide
+INBOX_STATUSES = ('pending_approval', 'partially_approved')
+
+
+def update_split_epv_amounts(epv, allocations=None):
+    """Update the approved, rejected, and pending amounts for a split EPV"""
+    if allocations is None:
+        allocations = EPVAllocation.query.filter_by(epv_id=epv.id).all()
+
+    approved_amount = 0.0
+    rejected_amount = 0.0
+    pending_amount = 0.0
+
+    for allocation in allocations:
+        if allocation.status == 'approved':
+            approved_amount += allocation.allocated_amount
+        elif allocation.status == 'rejected':
+            rejected_amount += allocation.allocated_amount
+        else:  # pending
+            pending_amount += allocation.allocated_amount
+
+    epv.approved_amount = approved_amount
+    epv.rejected_amount = rejected_amount
+    epv.pending_amount = pending_amount
+
+    logger.debug("Updated EPV %s amounts - Approved: ₹%s, Rejected: ₹%s, Pending: ₹%s", epv.epv_id, approved_amount, rejected_amount, pending_amount)
+
+
+def check_and_send_split_to_finance(epv, allocations=None):
+    """Check if split EPV should be sent to finance and update status accordingly"""
+    if allocations is None:
+        allocations = EPVAllocation.query.filter_by(epv_id=epv.id).all()
+
+    # Check if any allocations are still pending
+    pending_count = sum(1 for allocation in allocations if allocation.status == 'pending')
+    approved_count = sum(1 for allocation in allocations if allocation.status == 'approved')
+    rejected_count = sum(1 for allocation in allocations if allocation.status == 'rejected')
+    total_count = len(allocations)
+
+    logger.debug("Split EPV %s status - Pending: %s, Approved: %s, Rejected: %s, Total: %s", epv.epv_id, pending_count, approved_count, rejected_count, total_count)
+
+    # CORRECTED LOGIC:
+    # - 'partially_approved' only when NO pending allocations AND some approved + some rejected
+    # - 'approved' when NO pending allocations AND all approved
+    # - 'rejected' when NO pending allocations AND all rejected
+    # - 'pending_approval' when there are still pending allocations
+
+    if pending_count == 0:
+        # All allocations have been processed (no pending)
+        if approved_count > 0 and rejected_count > 0:
+            # Some approved, some rejected - this is partially approved
+            epv.status = 'partially_approved'
+            logger.debug("Split EPV %s partially approved - Approved: %s, Rejected: %s, Approved Amount: ₹%s", epv.epv_id, approved_count, rejected_count, epv.approved_amount)
+        elif approved_count > 0 and rejected_count == 0:
+            # All approved
+            epv.status = 'approved'
+            logger.debug("Split EPV %s fully approved - All %s allocations approved", epv.epv_id, approved_count)
+        elif approved_count == 0 and rejected_count > 0:
+            # All rejected
+            epv.status = 'rejected'
+            logger.debug("Split EPV %s fully rejected - All %s allocations rejected", epv.epv_id, rejected_count)
+    else:
+        # Still have pending allocations
+        epv.status = 'pending_approval'
+        logger.debug("Split EPV %s still pending - Pending: %s, Approved: %s, Rejected: %s", epv.epv_id, pending_count, approved_count, rejected_count)
+
+
+def apply_approval(epv, approvals, approver_email, master_invoice=None, sub_invoices=()):
+    """
+    Update an EPV after one of its approvals was approved.
+
+    Args:
+        epv (EPV): The approved EPV
+        approvals (list): All EPVApproval records of the EPV, already updated
+        approver_email (str): Approver, recorded in the legacy approved_by field
+        master_invoice (EPV): Master invoice, if the EPV is a sub-invoice
+        sub_invoices (list): All sub-invoices of the master invoice
+    """
+    # Update the legacy fields for backward compatibility
+    epv.approved_by = approver_email
+    epv.approved_on = datetime.now()
+
+    # Check if all approvers have approved
+    all_approved = True
+    any_rejected = False
+
+    for appr in approvals:
+        if appr.status == 'rejected':
+            any_rejected = True
+            break
+        elif appr.status != 'approved':
+            all_approved = False
+
+    # Update the EPV status based on approval status
+    if any_rejected:
+        epv.status = 'rejected'
+    elif all_approved and len(approvals) > 0:
+        epv.status = 'approved'
+
+        # If this is a sub-invoice, check if all sub-invoices of the master are approved
+        if master_invoice:
+            all_subs_approved = all(sub.status == 'approved' for sub in sub_invoices)
+
+            # If all sub-invoices are approved, update the master invoice status
+            if all_subs_approved and len(sub_invoices) > 0:
+                master_invoice.split_status = 'fully_approved'
+                # Also update the master invoice's status to 'approved' so it shows up in finance dashboard
+                master_invoice.status = 'approved'
+                master_invoice.approved_by = approver_email
+                master_invoice.approved_on = datetime.now()
+                logger.debug("Updated master invoice %s status to fully_approved and approved", master_invoice.epv_id)
+    else:
+        epv.status = 'partially_approved'
+
+        # If this is a sub-invoice, update the master invoice status
+        if master_invoice and master_invoice.split_status != 'partially_approved':
+            master_invoice.split_status = 'partially_approved'
+            logger.debug("Updated master invoice %s status to partially_approved", master_invoice.epv_id)
+
+
+def apply_rejection(epv, approver_email, rejection_reason, allocations=None, master_invoice=None):
+    """
+    Update an EPV after one of its approvals was rejected.
+
+    Args:
+        epv (EPV): The rejected EPV
+        approver_email (str): Approver, recorded in the legacy rejected_by field
+        rejection_reason (str): Reason given by the approver
+        allocations (list): Allocations of a split EPV; loaded if not given
+        master_invoice (EPV): Master invoice, if the EPV is a sub-invoice
+    """
+    # Update the legacy fields for backward compatibility
+    epv.rejected_by = approver_email
+    epv.rejected_on = datetime.now()
+    epv.rejection_reason = rejection_reason
+
+    # For split invoices, let check_and_send_split_to_finance handle the status
+    # For regular invoices, if any approver rejects, the entire EPV is rejected
+    if epv.invoice_type == 'split':
+        update_split_epv_amounts(epv, allocations)
+        check_and_send_split_to_finance(epv, allocations)
+    else:
+        epv.status = 'rejected'
+
+    # If this is a sub-invoice, update the master invoice status
+    if master_invoice:
+        master_invoice.split_status = 'rejected'
+        logger.debug("Updated master invoice %s status to rejected", master_invoice.epv_id)
+
+
+def pending_approvals(approver_email):
+    """
+    The approvals waiting for an approver's decision, oldest EPV first.
+
+    Returns:
+        list: EPVApproval records with their EPV and allocation (for split
+            invoices) loaded
+    """
+    return EPVApproval.query.join(
+        EPV, EPVApproval.epv_id == EPV.id
+    ).options(
+        contains_eager(EPVApproval.epv),
+        joinedload(EPVApproval.allocation)
+    ).filter(
+        EPVApproval.approver_email == approver_email,
+        EPVApproval.status == 'pending',
+        EPV.status.in_(INBOX_STATUSES)
+    ).order_by(EPV.submission_date, EPV.id, EPVApproval.id).all()
+
+
+def _group_by(records, attribute):
+    grouped = defaultdict(list)
+    for record in records:
+        grouped[getattr(record, attribute)].append(record)
+    return grouped
+
+
+def decide_pending_approvals(approver_email, approval_ids, decision, reason=''):
+    """
+    Approve or reject many of an approver's pending approvals in one transaction.
+
+    Approvals that are not the approver's or are no longer pending are
+    skipped. Commits the current session, or rolls it back and re-raises if
+    anything fails, so either every selected EPV is decided or none is.
+
+    Args:
+        approver_email (str): The approver
+        approval_ids (list): EPVApproval ids selected in the inbox
+        decision (str): 'approve' or 'reject'
+        reason (str): Rejection reason, or approval comments
+
+    Returns:
+        dict: epv_ids of the decided EPVs ('decided') and number of skipped approvals ('skipped')
+    """
+    if decision not in ('approve', 'reject'):
+        raise ValueError(f"Unknown decision: {decision}")
+    approval_ids = set(approval_ids)
+    if not approval_ids:
+        return {'decided': [], 'skipped': 0}
+
+    try:
+        selected = EPVApproval.query.filter(
+            EPVApproval.id.in_(approval_ids),
+            EPVApproval.approver_email == approver_email,
+            EPVApproval.status == 'pending'
+        ).all()
+        if not selected:
+            return {'decided': [], 'skipped': len(approval_ids)}
+
+        epv_pks = {approval.epv_id for approval in selected}
+        epvs = EPV.query.filter(EPV.id.in_(epv_pks)).order_by(EPV.submission_date, EPV.id).all()
+        approvals_by_epv = _group_by(EPVApproval.query.filter(EPVApproval.epv_id.in_(epv_pks)).all(), 'epv_id')
+        allocations_by_epv = _group_by(EPVAllocation.query.filter(EPVAllocation.epv_id.in_(epv_pks)).all(), 'epv_id')
+
+        master_pks = {epv.master_invoice_id for epv in epvs if epv.invoice_type == 'sub' and epv.master_invoice_id}
+        masters = {}
+        subs_by_master = {}
+        if master_pks:
+            masters = {master.id: master for master in EPV.query.filter(EPV.id.in_(master_pks)).all()}
+            subs_by_master = _group_by(EPV.query.filter(EPV.master_invoice_id.in_(master_pks)).all(), 'master_invoice_id')
+
+        selected_by_epv = _group_by(selected, 'epv_id')
+        status = 'approved' if decision == 'approve' else 'rejected'
+        now = datetime.now()
+        decided = []
+        rejected_epv_pks = []
+        rejected_allocation_ids = []
+
+        # Each EPV is recomputed once, after all of its selected approvals are decided
+        for epv in epvs:
+            allocations = allocations_by_epv.get(epv.id, [])
+            allocations_by_id = {allocation.id: allocation for allocation in allocations}
+            decides_epv = False
+
+            for approval in selected_by_epv[epv.id]:
+                approval.status = status
+                approval.action_date = now
+                approval.comments = reason
+
+                allocation = allocations_by_id.get(approval.allocation_id)
+                if allocation is None:
+                    decides_epv = True
+                elif allocation.status == 'pending':
+                    allocation.status = status
+                    allocation.action_date = now
+                    if decision == 'reject':
+                        allocation.rejection_reason = reason
+                        rejected_allocation_ids.append(allocation.id)
+
+            master_invoice = masters.get(epv.master_invoice_id) if epv.invoice_type == 'sub' else None
+            if not decides_epv:
+                # Split allocation decisions only move the allocations' totals
+                update_split_epv_amounts(epv, allocations)
+                check_and_send_split_to_finance(epv, allocations)
+            elif decision == 'approve':
+                apply_approval(
+                    epv, approvals_by_epv[epv.id], approver_email,
+                    master_invoice, subs_by_master.get(epv.master_invoice_id, [])
+                )
+            else:
+                apply_rejection(epv, approver_email, reason, allocations, master_invoice)
+                rejected_epv_pks.append(epv.id)
+            decided.append(epv.epv_id)
+
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    logger.debug("%s %s %s EPVs from the approval inbox", approver_email, status, len(decided))
+    _send_rejection_notifications(approver_email, reason, rejected_epv_pks, rejected_allocation_ids)
+    return {'decided': decided, 'skipped': len(approval_ids) - len(selected)}
+
+
+def _send_rejection_notifications(approver_email, rejection_reason, epv_pks, allocation_ids):
+    """Notify the submitters of the rejected EPVs and split allocations"""
+    if not epv_pks and not allocation_ids:
+        return
+    try:
+        from smtp_email_utils import send_rejection_notification_email, send_split_allocation_rejection_notification
+
+        approver_name = approver_email
+        approver = EmployeeDetails.query.filter_by(email=approver_email).first()
+        if approver:
+            approver_name = f"{approver.name} ({approver_email})"
+
+        # Reloaded together: the commit expired them, and each would otherwise refresh on its own
+        rejected_epvs = EPV.query.filter(EPV.id.in_(epv_pks)).all() if epv_pks else []
+        rejected_allocations = []
+        if allocation_ids:
+            rejected_allocations = EPVAllocation.query.options(joinedload(EPVAllocation.epv)).filter(
+                EPVAllocation.id.in_(allocation_ids)
+            ).all()
+
+        for epv in rejected_epvs:
+            success, message_id = send_rejection_notification_email(
+                epv_record=epv,
+                rejected_by=approver_name,
+                rejection_reason=rejection_reason
+            )
+            if not success:
+                logger.warning("Failed to send rejection notification email for %s: %s", epv.epv_id, message_id)
+        for allocation in rejected_allocations:
+            send_split_allocation_rejection_notification(allocation.epv, allocation, rejection_reason)
+    except Exception as e:
+        # The decisions are committed; a failed notification must not undo them
+        logger.exception("Error sending rejection notification emails: %s", e)
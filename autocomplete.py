@@ -0,0 +1,264 @@
+"""
+In-memory autocomplete for cost centers, employees and vendors.
+
+Each dataset is kept as an AutocompleteIndex: the lowercased search text of
+every row, a sorted list of the words in those texts for prefix lookups and
+a trigram index for substring lookups, so a keystroke never scans a table.
+Matches are ranked (text starts with the term, then a word starts with it,
+then anywhere) and only the top `limit` are returned.
+
+Indexes are built on first use and rebuilt every AUTOCOMPLETE_REFRESH_SECONDS.
+In between, committed changes to cost centers, employees and finance entries
+are applied to them row by row by the session listeners below.
+"""
+
+import bisect
+import heapq
+import logging
+import os
+import threading
+import time
+
+import session_changes
+from models import db, CostCenter, EmployeeDetails, FinanceEntry
+
+logger = logging.getLogger(__name__)
+
+# Full rebuilds pick up changes made by other processes and vendor names no longer used
+AUTOCOMPLETE_REFRESH_SECONDS = int(os.environ.get('AUTOCOMPLETE_REFRESH_SECONDS', 3600))
+AUTOCOMPLETE_DEFAULT_LIMIT = 20
+AUTOCOMPLETE_MAX_LIMIT = 100
+
+
+def _trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class AutocompleteIndex:
+    """Prefix and trigram index over rows identified by a key"""
+
+    def __init__(self):
+        self._rows = {}        # key -> (text, sort_key, item)
+        self._words = []       # sorted (word, key)
+        self._trigrams = {}    # trigram -> set of keys
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._rows)
+
+    def add(self, key, text, item, sort_key=None):
+        """
+        Add or replace a row.
+
+        Args:
+            key: Row identity (e.g. primary key)
+            text (str): Text searched for the term
+            item (dict): JSON returned for the row
+            sort_key (str): Order among equally ranked matches (default: text)
+        """
+        text = (text or '').lower()
+        with self._lock:
+            self.remove(key)
+            self._rows[key] = (text, sort_key if sort_key is not None else text, item)
+            for word in set(text.split()):
+                bisect.insort(self._words, (word, key))
+            for trigram in _trigrams(text):
+                self._trigrams.setdefault(trigram, set()).add(key)
+
+    def remove(self, key):
+        with self._lock:
+            row = self._rows.pop(key, None)
+            if row is None:
+                return
+            text = row[0]
+            for word in set(text.split()):
+                i = bisect.bisect_left(self._words, (word, key))
+                if i < len(self._words) and self._words[i] == (word, key):
+                    del self._words[i]
+            for trigram in _trigrams(text):
+                keys = self._trigrams.get(trigram)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self._trigrams[trigram]
+
+    def _word_prefix_keys(self, term):
+        keys = set()
+        i = bisect.bisect_left(self._words, (term,))
+        while i < len(self._words) and self._words[i][0].startswith(term):
+            keys.add(self._words[i][1])
+            i += 1
+        return keys
+
+    def search(self, term, limit=AUTOCOMPLETE_DEFAULT_LIMIT):
+        """
+        Best matches for a term.
+
+        Terms of three or more characters match anywhere in the text; shorter
+        terms match the start of a word.
+
+        Returns:
+            list: Items of the top `limit` matches
+        """
+        term = (term or '').strip().lower()
+        with self._lock:
+            if not term:
+                return [row[2] for row in heapq.nsmallest(limit, self._rows.values(), key=lambda row: row[1])]
+
+            if len(term) >= 3:
+                postings = sorted((self._trigrams.get(t, ()) for t in _trigrams(term)), key=len)
+                candidates = set(postings[0]).intersection(*postings[1:]) if postings else set()
+            else:
+                candidates = self._word_prefix_keys(term)
+
+            ranked = []
+            for key in candidates:
+                text, sort_key, item = self._rows[key]
+                position = text.find(term)
+                if position < 0:
+                    continue
+                if position == 0:
+                    rank = 0
+                elif ' ' + term in text:
+                    rank = 1
+                else:
+                    rank = 2
+                ranked.append((rank, sort_key, item))
+            return [item for _, _, item in heapq.nsmallest(limit, ranked, key=lambda match: match[:2])]
+
+
+def _cost_center_row(cc):
+    item = {
+        'id': cc['id'],
+        'name': cc['costcenter'],
+        'city': cc['city'],
+        'value': cc['costcenter'],  # For jQuery UI autocomplete
+        'label': cc['costcenter']   # For jQuery UI autocomplete
+    }
+    return cc['costcenter'], item, (cc['costcenter'] or '').lower()
+
+
+def _employee_row(emp):
+    email = emp['email'].strip()
+    item = {
+        'value': email,
+        'label': f"{emp['name']} ({emp['email']})" if emp['name'] else emp['email'],
+        'name': emp['name'] or '',
+        'email': email,
+        'employee_id': emp['employee_id'] or ''
+    }
+    return f"{emp['name'] or ''} {email}", item, (emp['name'] or email).lower()
+
+
+def _vendor_row(vendor_name):
+    vendor_name = vendor_name.strip()
+    return vendor_name, {'value': vendor_name, 'label': vendor_name}, vendor_name.lower()
+
+
+def _load_cost_centers(index):
+    for cc in db.session.query(CostCenter.id, CostCenter.costcenter, CostCenter.city).filter(
+        CostCenter.is_active == True
+    ):
+        index.add(cc.id, *_cost_center_row(cc._mapping))
+
+
+def _load_employees(index):
+    for emp in db.session.query(
+        EmployeeDetails.id, EmployeeDetails.email, EmployeeDetails.name, EmployeeDetails.employee_id
+    ).filter(
+        EmployeeDetails.is_active == True,
+        EmployeeDetails.email.isnot(None),
+        EmployeeDetails.email != ''
+    ):
+        if emp.email.strip():
+            index.add(emp.id, *_employee_row(emp._mapping))
+
+
+def _load_vendors(index):
+    for (vendor_name,) in db.session.query(FinanceEntry.vendor_name).distinct():
+        if vendor_name and vendor_name.strip():
+            # Vendor names differing only in case or spacing are listed once
+            index.add(vendor_name.strip().lower(), *_vendor_row(vendor_name))
+
+
+_LOADERS = {
+    'cost_centers': _load_cost_centers,
+    'employees': _load_employees,
+    'vendors': _load_vendors,
+}
+
+_indexes = {}
+_loaded_at = {}
+_load_lock = threading.Lock()
+
+
+def get_index(name):
+    """The index of a dataset, (re)built from the database when due"""
+    index = _indexes.get(name)
+    if index is not None and time.monotonic() - _loaded_at[name] < AUTOCOMPLETE_REFRESH_SECONDS:
+        return index
+    with _load_lock:
+        index = _indexes.get(name)
+        if index is None or time.monotonic() - _loaded_at[name] >= AUTOCOMPLETE_REFRESH_SECONDS:
+            index = AutocompleteIndex()
+            _LOADERS[name](index)
+            _indexes[name] = index
+            _loaded_at[name] = time.monotonic()
+            logger.debug("Built %s autocomplete index with %s entries", name, len(index))
+    return index
+
+
+def search(name, term, limit=None):
+    """
+    Autocomplete matches of a dataset.
+
+    Args:
+        name (str): 'cost_centers', 'employees' or 'vendors'
+        term (str): Text typed so far
+        limit (int): Maximum matches (default AUTOCOMPLETE_DEFAULT_LIMIT)
+    """
+    limit = min(limit or AUTOCOMPLETE_DEFAULT_LIMIT, AUTOCOMPLETE_MAX_LIMIT)
+    return get_index(name).search(term, limit)
+
+
+def collect_autocomplete_changes(flushed, objects, changes):
+    """Snapshot changed rows; they are applied to loaded indexes on commit"""
+    if not _indexes:
+        return
+    for obj in objects:
+        if flushed.is_deleted(obj):
+            if isinstance(obj, CostCenter):
+                changes.append(('cost_centers', obj.id, None))
+            elif isinstance(obj, EmployeeDetails):
+                changes.append(('employees', obj.id, None))
+        elif isinstance(obj, CostCenter):
+            if obj.is_active is False:
+                changes.append(('cost_centers', obj.id, None))
+            else:
+                changes.append(('cost_centers', obj.id, _cost_center_row(
+                    {'id': obj.id, 'costcenter': obj.costcenter, 'city': obj.city})))
+        elif isinstance(obj, EmployeeDetails):
+            if obj.is_active is False or not (obj.email and obj.email.strip()):
+                changes.append(('employees', obj.id, None))
+            else:
+                changes.append(('employees', obj.id, _employee_row(
+                    {'email': obj.email, 'name': obj.name, 'employee_id': obj.employee_id})))
+        elif isinstance(obj, FinanceEntry) and obj.vendor_name and obj.vendor_name.strip():
+            changes.append(('vendors', obj.vendor_name.strip().lower(), _vendor_row(obj.vendor_name)))
+
+
+def apply_autocomplete_changes(changes):
+    for name, key, row in changes:
+        index = _indexes.get(name)
+        if index is None:
+            continue
+        if row is None:
+            index.remove(key)
+        else:
+            index.add(key, *row)
+
+
+session_changes.register(
+    'autocomplete_changes', (CostCenter, EmployeeDetails, FinanceEntry),
+    collect_autocomplete_changes, apply_autocomplete_changes, pending=list
+)
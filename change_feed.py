@@ -0,0 +1,182 @@
+"""
+In-process feed of finance dashboard changes.
+
+Whenever a transaction that changed an EPV, FinanceEntry or EPVAllocation is
+committed, an event is published naming the EPV, its city and the finance
+dashboard tabs the change can affect (before and after the change). The
+finance dashboard long-polls /finance-dashboard/events and re-renders only
+the rows named in the events.
+
+Events are kept in a bounded in-memory buffer, so a client asking with its
+last event id receives what it missed. The feed is per process and its ids
+are only meaningful together with FEED_ID: with several app processes (or
+after a restart) the dashboard resyncs by reloading its rows, and reloads
+them periodically to pick up changes made by other processes.
+"""
+
+import threading
+import time
+import uuid
+from collections import deque
+
+from sqlalchemy import inspect
+
+import session_changes
+from models import EPV, FinanceEntry, EPVAllocation, CostCenter
+
+# Events kept for clients that reconnect
+FEED_BUFFER_SIZE = 1000
+
+# Identifies this process's feed; event ids of another feed mean nothing here
+FEED_ID = uuid.uuid4().hex
+
+# Finance dashboard tabs by role
+FINANCE_TABS = ('pending', 'resubmitted', 'pending-payment', 'rejected', 'processed')
+FINANCE_APPROVER_TABS = ('pending-approval', 'approved-rejected')
+
+# Tabs a finance entry appears in, by entry status
+ENTRY_STATUS_TABS = {
+    'pending': {'pending-approval', 'processed'},
+    'approved': {'approved-rejected', 'pending-payment', 'processed'},
+    'rejected': {'approved-rejected', 'processed'},
+}
+
+_events = deque(maxlen=FEED_BUFFER_SIZE)
+_condition = threading.Condition()
+_last_id = 0
+
+
+def epv_tabs(status, finance_status, document_status):
+    """Finance dashboard tabs an EPV in this state is listed in"""
+    tabs = set()
+    if status in ('approved', 'partially_approved') and finance_status in (None, 'pending'):
+        tabs.add('resubmitted' if document_status == 'documents_uploaded' else 'pending')
+    if finance_status == 'rejected':
+        tabs.add('rejected')
+    return tabs
+
+
+def publish(changes):
+    """
+    Publish committed changes.
+
+    Args:
+        changes (dict): EPV primary key -> {'epv_id', 'city', 'tabs'}
+    """
+    global _last_id
+    if not changes:
+        return
+    with _condition:
+        for epv_pk, change in changes.items():
+            _last_id += 1
+            _events.append({
+                'id': _last_id,
+                'epv': epv_pk,
+                'epv_id': change['epv_id'],
+                'city': change['city'],
+                'tabs': sorted(change['tabs']),
+                'time': time.time()
+            })
+        _condition.notify_all()
+
+
+def last_event_id():
+    with _condition:
+        return _last_id
+
+
+def missed_events(after_id):
+    """True if events after after_id were dropped from the buffer, or after_id is unknown"""
+    with _condition:
+        if after_id > _last_id:
+            return True
+        return bool(_events) and _events[0]['id'] > after_id + 1
+
+
+def wait_for_events(after_id, timeout):
+    """
+    Events published after after_id, waiting up to timeout seconds for one.
+
+    Returns:
+        list: Events in publish order (empty on timeout)
+    """
+    with _condition:
+        if _last_id <= after_id:
+            _condition.wait(timeout)
+        return [e for e in _events if e['id'] > after_id]
+
+
+def _old_value(state, name):
+    history = state.attrs[name].history
+    if history.deleted:
+        return history.deleted[0]
+    return getattr(state.object, name)
+
+
+def _epv_city(session, epv, cost_center_cities):
+    """City used to route an EPV to finance users: its own city, else its cost center's"""
+    if epv.invoice_type == 'master':
+        # Master invoices are shown to every finance user
+        return None
+    if epv.city:
+        return epv.city
+    if epv.cost_center_id:
+        # Looked up once per flush: many EPVs of one cost center may change together
+        if epv.cost_center_id not in cost_center_cities:
+            cost_center = session.get(CostCenter, epv.cost_center_id)
+            cost_center_cities[epv.cost_center_id] = cost_center.city if cost_center else None
+        return cost_center_cities[epv.cost_center_id]
+    return None
+
+
+def _record(session, changes, epv, tabs, cost_center_cities):
+    if not tabs or epv is None:
+        return
+    if epv.id not in changes:
+        changes[epv.id] = {'epv_id': epv.epv_id, 'city': _epv_city(session, epv, cost_center_cities), 'tabs': set()}
+    change = changes[epv.id]
+    change['tabs'].update(tabs)
+
+
+def collect_finance_changes(flushed, objects, changes):
+    """Remember the dashboard changes of this flush until the transaction commits"""
+    session = flushed.session
+    cost_center_cities = {}
+    with session.no_autoflush:
+        for obj in objects:
+            if isinstance(obj, EPV):
+                state = inspect(obj)
+                tabs = epv_tabs(obj.status, obj.finance_status, obj.document_status)
+                if not flushed.is_new(obj):
+                    tabs |= epv_tabs(_old_value(state, 'status'), _old_value(state, 'finance_status'),
+                                     _old_value(state, 'document_status'))
+                _record(session, changes, obj, tabs, cost_center_cities)
+
+            elif isinstance(obj, FinanceEntry):
+                state = inspect(obj)
+                tabs = set(ENTRY_STATUS_TABS.get(obj.status, ()))
+                if not flushed.is_new(obj):
+                    tabs |= ENTRY_STATUS_TABS.get(_old_value(state, 'status'), set())
+                _record(session, changes, session.get(EPV, obj.epv_id), tabs, cost_center_cities)
+
+            elif isinstance(obj, EPVAllocation):
+                epv = session.get(EPV, obj.epv_id)
+                if epv is not None:
+                    _record(session, changes, epv, epv_tabs(epv.status, epv.finance_status, epv.document_status), cost_center_cities)
+
+
+session_changes.register('finance_changes', (EPV, FinanceEntry, EPVAllocation), collect_finance_changes, publish)
+
+
+def visible_to(change, tabs, cities):
+    """
+    True if an event concerns a user with these tabs and assigned cities.
+
+    Users without assigned cities, and EPVs without a city, are not filtered
+    by city (as on the dashboard).
+    """
+    if not set(change['tabs']) & set(tabs):
+        return False
+    if cities and change['city'] and change['city'] not in cities:
+        return False
+    return True
@@ -0,0 +1,50 @@
+"""
+Which EPVs a finance user handles, by city.
+
+An EPV belongs to its own city, or to its cost center's city when it has
+none. A finance user with assigned cities handles the EPVs of those cities
+and the EPVs with neither a city nor a cost center (including a cost_center_id
+whose cost center no longer exists); a finance user without assigned cities
+handles every EPV.
+
+in_cities() states this as one SQL condition on EPV, so the finance
+dashboard tabs and notification counts filter in the database instead of
+loading every EPV and its cost center and filtering in Python. It needs no
+join: the cost center side is a subquery on the indexed costcenter.city.
+"""
+
+from sqlalchemy import exists, func, select, true
+
+from models import db, EPV, CostCenter
+
+
+def effective_city():
+    """City of an EPV: its own city, else its cost center's (requires the cost center join)"""
+    return func.coalesce(func.nullif(EPV.city, ''), CostCenter.city)
+
+
+def in_cities(city_names):
+    """
+    Condition on EPV matching the EPVs handled by a finance user with these cities.
+
+    Args:
+        city_names (list): The user's assigned cities; empty for all cities
+
+    Returns:
+        ColumnElement: Condition for a query over EPV
+    """
+    if not city_names:
+        return true()
+    city_names = list(city_names)
+    return db.or_(
+        EPV.city.in_(city_names),
+        db.and_(
+            db.or_(EPV.city == None, EPV.city == ''),
+            db.or_(
+                EPV.cost_center_id == None,
+                EPV.cost_center_id.in_(select(CostCenter.id).where(CostCenter.city.in_(city_names))),
+                # A deleted cost center counts as no cost center
+                ~exists().where(CostCenter.id == EPV.cost_center_id)
+            )
+        )
+    )
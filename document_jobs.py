@@ -0,0 +1,456 @@
+"""
+Background pipeline for new expense submissions.
+
+Submitting an expense only saves the receipts to disk and records a
+document_jobs row; a pool of worker threads then generates the expense
+document, converts and merges the receipts, uploads the result to Google
+Drive and finally creates the EPV. The browser polls the job's status
+(see document_job_status in app.py) until it completes.
+"""
+
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from werkzeug.utils import secure_filename
+
+from models import db, DocumentJob, EPV, EPVItem
+
+logger = logging.getLogger(__name__)
+
+# Number of documents processed in parallel
+DOCUMENT_JOB_WORKERS = int(os.environ.get('DOCUMENT_JOB_WORKERS', 2))
+
+# Job stages and the progress shown for them
+STAGE_PROGRESS = {
+    'queued': 0,
+    'generating_document': 10,
+    'processing_files': 30,
+    'uploading': 70,
+    'saving': 90,
+    'completed': 100,
+}
+
+# Each process touches its unfinished jobs every JOB_HEARTBEAT_SECONDS. A queued or
+# processing job not touched for STALE_JOB_MINUTES belongs to a process that is gone
+# (restart, crash) and is failed.
+JOB_HEARTBEAT_SECONDS = 60
+STALE_JOB_MINUTES = 5
+
+_executor = None
+_app = None
+_upload_root = None
+_table_ready = False
+
+# Jobs this process has queued or is processing
+_running_jobs = set()
+_running_lock = threading.Lock()
+_heartbeat_thread = None
+
+# Google tokens of queued jobs. Kept in memory only, never written to the database.
+_drive_tokens = {}
+
+
+def init_document_jobs(app, upload_root):
+    """
+    Set up the worker pool.
+
+    Args:
+        app: Flask application, used for the database configuration
+        upload_root (str): Directory under which each job keeps its uploads
+    """
+    global _executor, _app, _upload_root
+    _app = app
+    _upload_root = upload_root
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=DOCUMENT_JOB_WORKERS, thread_name_prefix='document-job')
+
+
+def _ensure_table():
+    """Create the jobs table on first use and fail jobs left over from a restart"""
+    global _table_ready
+    if _table_ready:
+        return
+
+    DocumentJob.__table__.create(db.engine, checkfirst=True)
+    _fail_interrupted_jobs()
+    _table_ready = True
+
+
+def _fail_interrupted_jobs(job_ids=None):
+    """
+    Fail unfinished jobs whose process stopped touching them.
+
+    The Google token of a job only lives in memory, so such jobs cannot be
+    resumed by another process.
+
+    Args:
+        job_ids: Only check these jobs; None checks all
+
+    Returns:
+        int: Number of jobs failed
+    """
+    table = DocumentJob.__table__
+    stale = db.and_(
+        table.c.status.in_(['queued', 'processing']),
+        table.c.updated_at < datetime.now() - timedelta(minutes=STALE_JOB_MINUTES)
+    )
+    if job_ids is not None:
+        stale = db.and_(stale, table.c.id.in_(list(job_ids)))
+    with db.engine.begin() as conn:
+        interrupted = conn.execute(db.select(table.c.id, table.c.upload_dir).where(stale)).all()
+        if interrupted:
+            # Repeat the staleness test so a job touched meanwhile is left alone
+            conn.execute(table.update().where(stale, table.c.id.in_([row.id for row in interrupted])).values(
+                status='failed',
+                error='Interrupted by a server restart',
+                message='Processing was interrupted. Please submit the expense again.',
+                updated_at=datetime.now()
+            ))
+    for row in interrupted:
+        logger.warning("Document job %s was interrupted, marked failed", row.id)
+        if row.upload_dir:
+            shutil.rmtree(row.upload_dir, ignore_errors=True)
+    return len(interrupted)
+
+
+def _touch_running_jobs():
+    """Mark this process's unfinished jobs as alive"""
+    with _running_lock:
+        job_ids = list(_running_jobs)
+    if not job_ids:
+        return
+    table = DocumentJob.__table__
+    with db.engine.begin() as conn:
+        conn.execute(table.update().where(
+            table.c.id.in_(job_ids),
+            table.c.status.in_(['queued', 'processing'])
+        ).values(updated_at=datetime.now()))
+
+
+def _heartbeat_loop():
+    while True:
+        time.sleep(JOB_HEARTBEAT_SECONDS)
+        try:
+            with _app.app_context():
+                _touch_running_jobs()
+                _fail_interrupted_jobs()
+        except Exception as e:
+            logger.exception("Document job heartbeat error: %s", e)
+
+
+def _start_heartbeat():
+    """Start the heartbeat thread of this process, once it has jobs (idempotent)"""
+    global _heartbeat_thread
+    with _running_lock:
+        if _heartbeat_thread is not None and _heartbeat_thread.is_alive():
+            return
+        _heartbeat_thread = threading.Thread(target=_heartbeat_loop, name='document-job-heartbeat', daemon=True)
+        _heartbeat_thread.start()
+
+
+def _update_job(job_id, **values):
+    """Update a job row immediately, outside the caller's session"""
+    if 'stage' in values and 'progress' not in values:
+        values['progress'] = STAGE_PROGRESS.get(values['stage'], 0)
+    values['updated_at'] = datetime.now()
+    table = DocumentJob.__table__
+    with db.engine.begin() as conn:
+        conn.execute(table.update().where(table.c.id == job_id).values(**values))
+
+
+def create_document_job(epv_id, email, payload, files, drive_token=None):
+    """
+    Persist the uploads of a new expense and record its job.
+
+    Args:
+        epv_id (str): EPV ID the expense will be saved under
+        email (str): Submitter email
+        payload (dict): Form data needed to build the document and the EPV
+        files (list): Uploaded receipt files (werkzeug FileStorage), in expense order
+        drive_token (dict): Google OAuth token of the submitter, for the Drive upload
+
+    Returns:
+        str: Job ID
+    """
+    from pdf_converter import allowed_file
+
+    _ensure_table()
+
+    job_id = uuid.uuid4().hex
+    upload_dir = os.path.join(_upload_root, job_id)
+    os.makedirs(upload_dir, exist_ok=True)
+
+    file_paths = []
+    invalid_files = []
+    for index, file in enumerate(files):
+        filename = secure_filename(file.filename or '')
+        if not filename or not allowed_file(filename):
+            invalid_files.append(file.filename or 'Unknown file')
+            continue
+        # Prefix keeps the receipts in submission order
+        path = os.path.join(upload_dir, f"{index:03d}_{filename}")
+        file.save(path)
+        file_paths.append(path)
+
+    payload = dict(payload, file_paths=file_paths, invalid_files=invalid_files)
+
+    job = DocumentJob(
+        id=job_id,
+        epv_id=epv_id,
+        email=email,
+        status='queued',
+        stage='queued',
+        progress=0,
+        upload_dir=upload_dir,
+        payload=json.dumps(payload)
+    )
+    db.session.add(job)
+    db.session.commit()
+
+    _drive_tokens[job_id] = drive_token
+    with _running_lock:
+        _running_jobs.add(job_id)
+    _start_heartbeat()
+    logger.debug("Created document job %s for %s with %s files", job_id, epv_id, len(file_paths))
+    return job_id
+
+
+def submit_document_job(job_id):
+    """Queue a job on the worker pool"""
+    _executor.submit(_run_in_app_context, job_id)
+
+
+def _run_in_app_context(job_id):
+    with _app.app_context():
+        try:
+            run_document_job(job_id)
+        finally:
+            db.session.remove()
+
+
+def run_document_job(job_id):
+    """
+    Build the document of a job and create its EPV.
+
+    Runs on a worker thread, or inline when the pipeline is disabled. Must be
+    called inside an application context.
+
+    Returns:
+        bool: True if the EPV was created
+    """
+    from drive_utils import use_drive_token
+
+    job = db.session.get(DocumentJob, job_id)
+    if not job or job.status not in ('queued', 'processing'):
+        with _running_lock:
+            _running_jobs.discard(job_id)
+        return False
+
+    payload = json.loads(job.payload)
+    upload_dir = job.upload_dir
+    drive_token = _drive_tokens.pop(job_id, None)
+
+    try:
+        _update_job(job_id, status='processing', stage='generating_document')
+        with use_drive_token(drive_token):
+            outcome = _build_document(job_id, payload)
+
+        if not outcome['success']:
+            _update_job(job_id, status='failed', message=outcome['message'], error=outcome.get('error'),
+                        completed_at=datetime.now())
+            return False
+
+        _update_job(job_id, stage='saving')
+        _save_epv(job.epv_id, job.email, payload, outcome['file_url'], outcome['file_id'])
+
+        _update_job(
+            job_id,
+            status='completed',
+            stage='completed',
+            message='Expense submitted successfully!',
+            result=json.dumps({
+                'drive_file_id': outcome['file_id'],
+                'drive_file_url': outcome['file_url'],
+                'merged_pdf_path': outcome.get('merged_pdf_path'),
+                'warnings': outcome.get('warnings', [])
+            }),
+            completed_at=datetime.now()
+        )
+        logger.debug("Document job %s completed, EPV %s saved", job_id, job.epv_id)
+        return True
+
+    except Exception as e:
+        db.session.rollback()
+        logger.exception("Document job %s failed: %s", job_id, e)
+        _update_job(job_id, status='failed', message='Error submitting expense.', error=str(e),
+                    completed_at=datetime.now())
+        return False
+    finally:
+        with _running_lock:
+            _running_jobs.discard(job_id)
+        if upload_dir:
+            shutil.rmtree(upload_dir, ignore_errors=True)
+
+
+def _build_document(job_id, payload):
+    """
+    Generate the expense document, merge the receipts into it and upload to Drive.
+
+    Returns:
+        dict: success, file_id, file_url, merged_pdf_path, warnings, or message/error on failure
+    """
+    from pdf_converter import generate_expense_document, process_files, REPORTLAB_AVAILABLE
+
+    expense_data = payload['expense_data']
+    drive_folder_id = payload.get('drive_folder_id')
+    employee_name = payload.get('employee_name')
+    cost_center_name = payload.get('cost_center_name')
+
+    # Step 1: Generate expense document PDF
+    expense_pdf_path = generate_expense_document(expense_data)
+    if not expense_pdf_path:
+        message = 'Failed to generate expense document'
+        if not REPORTLAB_AVAILABLE:
+            message = 'ReportLab library is not available for PDF generation. Please contact your administrator.'
+        return {'success': False, 'message': message}
+
+    # Step 2: Convert and merge the receipts, then upload to Google Drive
+    if payload['file_paths'] or payload['invalid_files']:
+        _update_job(job_id, stage='processing_files')
+        result = process_files(
+            files=payload['file_paths'],
+            drive_folder_id=drive_folder_id,
+            employee_name=employee_name,
+            cost_center_name=cost_center_name,
+            expense_pdf_path=expense_pdf_path
+        )
+
+        if not result['success']:
+            return {
+                'success': False,
+                'message': result.get('user_message') or "There was an issue with the file processing.",
+                'error': result.get('error') or "Failed to process files."
+            }
+
+        if not (result.get('drive_file_id') and result.get('drive_file_url')):
+            return {
+                'success': False,
+                'message': "File processing completed but Google Drive upload failed.",
+                'error': result.get('drive_error') or "Failed to upload to Google Drive."
+            }
+
+        warnings = result.get('warnings', []) + [
+            f"Problem with {name}: Invalid file or file type not allowed" for name in payload['invalid_files']
+        ]
+        return {
+            'success': True,
+            'file_id': result['drive_file_id'],
+            'file_url': result['drive_file_url'],
+            'merged_pdf_path': None,
+            'warnings': warnings
+        }
+
+    # No receipts, just upload the expense document to Google Drive
+    _update_job(job_id, stage='uploading')
+    if not drive_folder_id:
+        return {
+            'success': False,
+            'message': f"No Google Drive folder ID found for the selected cost center: {cost_center_name or payload.get('cost_center_id')}"
+        }
+
+    from drive_utils import upload_file_to_drive, get_file_url
+    download_filename = f"Expense_{employee_name}_{cost_center_name}_{datetime.now().strftime('%Y-%m-%d')}.pdf"
+    file_id = upload_file_to_drive(expense_pdf_path, download_filename, drive_folder_id)
+    if not file_id or file_id == 'local_file':
+        return {'success': False, 'message': 'Failed to upload expense document to Google Drive'}
+
+    # The expense document is kept for /download-pdf
+    return {
+        'success': True,
+        'file_id': file_id,
+        'file_url': get_file_url(file_id),
+        'merged_pdf_path': expense_pdf_path,
+        'warnings': []
+    }
+
+
+def _save_epv(epv_id, email, payload, file_url, file_id):
+    """Create the EPV and its expense items"""
+    expense_data = payload['expense_data']
+    now = datetime.now()
+
+    new_epv = EPV(
+        epv_id=epv_id,
+        email_id=email,
+        employee_name=payload.get('employee_name'),
+        employee_id=payload.get('employee_id'),
+        from_date=datetime.strptime(payload['from_date'], '%Y-%m-%d'),
+        to_date=datetime.strptime(payload['to_date'], '%Y-%m-%d'),
+        payment_to=payload.get('expense_type') or 'General Expense',
+        acknowledgement=payload.get('acknowledgement') or None,
+        submission_date=now,
+        academic_year=f"{now.year}-{now.year + 1}",
+        cost_center_id=payload.get('cost_center_id'),
+        cost_center_name=payload.get('cost_center_name'),
+        city=payload.get('city', ''),
+        total_amount=float(expense_data['total_amount']),
+        amount_in_words=expense_data.get('amount_in_words', ''),
+        status='submitted',
+        file_url=file_url,
+        drive_file_id=file_id
+    )
+    db.session.add(new_epv)
+    db.session.flush()  # Get the ID without committing
+
+    for expense in expense_data['expenses']:
+        db.session.add(EPVItem(
+            epv_id=new_epv.id,
+            expense_invoice_date=datetime.strptime(expense['invoice_date'], '%Y-%m-%d'),
+            expense_head=expense['expense_head'],
+            description=expense['description'],
+            amount=float(expense['amount']),
+            gst=0.0,  # Default value, can be updated later
+            split_invoice=expense.get('split_invoice', False)
+        ))
+
+    db.session.commit()
+    return new_epv
+
+
+def get_job_status(job):
+    """
+    JSON-serialisable status of a job for the polling endpoint.
+
+    A job whose process went away is failed here, so the browser stops
+    polling even if no other process has swept it yet.
+
+    Args:
+        job (DocumentJob): Job row
+    """
+    if job.status in ('queued', 'processing') and _fail_interrupted_jobs([job.id]):
+        db.session.refresh(job)
+    status = {
+        'job_id': job.id,
+        'epv_id': job.epv_id,
+        'status': job.status,
+        'stage': job.stage,
+        'progress': job.progress,
+        'done': job.status in ('completed', 'failed'),
+        'message': job.message,
+    }
+    if job.status == 'failed':
+        status['error'] = job.error
+    if job.result:
+        result = json.loads(job.result)
+        if result.get('drive_file_url'):
+            status['drive_file_url'] = result['drive_file_url']
+        if result.get('warnings'):
+            status['warnings'] = result['warnings']
+    return status
@@ -0,0 +1,220 @@
+"""
+Local disk cache of Google Drive files.
+
+get_cached_file() returns the path of a local copy of a Drive file, so
+/download-file and supplementary document merges read expense PDFs from disk
+instead of downloading them on every view. Copies are content addressed:
+each is stored as <drive file id>.<version>, the version being the file's
+md5Checksum in Drive (or a hash of its modifiedTime for files without one),
+and a download is checked against the checksum before it is used.
+
+A copy is trusted for DRIVE_FILE_CACHE_REVALIDATE_SECONDS; after that one
+metadata call checks that the version in Drive is unchanged before the copy
+is served again. The least recently used copies are deleted once the cache
+exceeds DRIVE_FILE_CACHE_MAX_BYTES. Concurrent requests for the same file
+wait for a single download.
+
+The cache directory can be shared by several app processes: copies are
+written to a temporary file and renamed into place, and a process adopts
+copies written by another after revalidating them.
+"""
+
+import hashlib
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+DRIVE_FILE_CACHE_MAX_BYTES = int(os.environ.get('DRIVE_FILE_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+DRIVE_FILE_CACHE_REVALIDATE_SECONDS = int(os.environ.get('DRIVE_FILE_CACHE_REVALIDATE_SECONDS', 300))
+
+_cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads', 'drive_cache')
+
+# file id -> {'path', 'version', 'size', 'checked_at'}, least recently used first
+_entries = OrderedDict()
+_total_bytes = 0
+_lock = threading.Lock()
+
+# file id -> [lock, number of threads using it], so one thread downloads a file at a time
+_file_locks = {}
+
+
+def init_drive_file_cache(cache_dir):
+    """
+    Use cache_dir for the cache and index the copies already in it.
+
+    Copies found on disk are revalidated with Drive before they are first served.
+    """
+    global _cache_dir, _total_bytes
+    os.makedirs(cache_dir, exist_ok=True)
+    with _lock:
+        _cache_dir = cache_dir
+        _entries.clear()
+        _total_bytes = 0
+        found = []
+        for name in os.listdir(cache_dir):
+            path = os.path.join(cache_dir, name)
+            file_id, _, version = name.partition('.')
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if '.part-' in name:
+                # Left behind by a process that stopped mid-download
+                if time.time() - stat.st_mtime > 3600:
+                    _remove(path)
+                continue
+            if not version:
+                continue
+            found.append((stat.st_mtime, file_id, version, path, stat.st_size))
+        for _, file_id, version, path, size in sorted(found):
+            _entries[file_id] = {'path': path, 'version': version, 'size': size, 'checked_at': 0}
+            _total_bytes += size
+    logger.debug("Drive file cache in %s holds %s files (%s bytes)", cache_dir, len(found), _total_bytes)
+
+
+@contextmanager
+def _file_lock(file_id):
+    with _lock:
+        entry = _file_locks.setdefault(file_id, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with _lock:
+            entry[1] -= 1
+            if not entry[1]:
+                del _file_locks[file_id]
+
+
+def _fresh_entry(file_id):
+    """The cache entry of a file if it can be served without asking Drive"""
+    with _lock:
+        entry = _entries.get(file_id)
+        if entry is None or time.time() - entry['checked_at'] >= DRIVE_FILE_CACHE_REVALIDATE_SECONDS:
+            return None
+        _entries.move_to_end(file_id)
+        return entry
+
+
+def _version(metadata):
+    if metadata.get('md5Checksum'):
+        return metadata['md5Checksum']
+    return hashlib.md5((metadata.get('modifiedTime') or '').encode()).hexdigest()
+
+
+def _md5(path):
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _store(file_id, path, version, size):
+    """Record a copy, delete the one it replaces and evict down to the size limit"""
+    global _total_bytes
+    evicted = []
+    with _lock:
+        old = _entries.pop(file_id, None)
+        if old is not None:
+            _total_bytes -= old['size']
+            if old['path'] != path:
+                evicted.append(old['path'])
+        _entries[file_id] = {'path': path, 'version': version, 'size': size, 'checked_at': time.time()}
+        _total_bytes += size
+        # Never evict the copy being served
+        while _total_bytes > DRIVE_FILE_CACHE_MAX_BYTES and len(_entries) > 1:
+            _, entry = _entries.popitem(last=False)
+            _total_bytes -= entry['size']
+            evicted.append(entry['path'])
+    for old_path in evicted:
+        # Readers that already opened a copy keep reading it after the unlink
+        _remove(old_path)
+
+
+def _revalidated(file_id):
+    """Mark a file's copy as checked against Drive now"""
+    with _lock:
+        entry = _entries.get(file_id)
+        if entry is not None:
+            entry['checked_at'] = time.time()
+            _entries.move_to_end(file_id)
+        return entry
+
+
+def get_cached_file(file_id):
+    """
+    Path of a local copy of a Drive file, downloading or revalidating it as needed.
+
+    Drive calls use the current user's or job's Google token (see drive_utils).
+    If Drive cannot be reached, the last copy is served as is.
+
+    Args:
+        file_id (str): ID of the file in Drive
+
+    Returns:
+        str: Path of the copy, or None if the file could not be downloaded
+    """
+    entry = _fresh_entry(file_id)
+    if entry is not None and os.path.exists(entry['path']):
+        return entry['path']
+
+    from drive_utils import get_file_metadata, download_file_from_drive
+
+    with _file_lock(file_id):
+        # Another thread may have fetched it while this one waited
+        entry = _fresh_entry(file_id)
+        if entry is not None and os.path.exists(entry['path']):
+            return entry['path']
+
+        with _lock:
+            entry = _entries.get(file_id)
+
+        metadata = get_file_metadata(file_id, fields='id, md5Checksum, modifiedTime, size')
+        if metadata is None:
+            if entry is not None and os.path.exists(entry['path']):
+                logger.warning("Could not revalidate Drive file %s, serving the cached copy", file_id)
+                return entry['path']
+            return None
+
+        version = _version(metadata)
+        if entry is not None and entry['version'] == version and os.path.exists(entry['path']):
+            _revalidated(file_id)
+            return entry['path']
+
+        path = os.path.join(_cache_dir, f"{file_id}.{version}")
+        if os.path.exists(path):
+            # Downloaded by another process
+            _store(file_id, path, version, os.path.getsize(path))
+            return path
+
+        os.makedirs(_cache_dir, exist_ok=True)
+        part_path = f"{path}.part-{uuid.uuid4().hex}"
+        logger.debug("Downloading Drive file %s into the file cache", file_id)
+        if not download_file_from_drive(file_id, part_path):
+            _remove(part_path)
+            return None
+
+        if metadata.get('md5Checksum') and _md5(part_path) != metadata['md5Checksum']:
+            logger.error("Download of Drive file %s does not match its checksum", file_id)
+            _remove(part_path)
+            return None
+
+        os.replace(part_path, path)
+        _store(file_id, path, version, os.path.getsize(path))
+        return path
+
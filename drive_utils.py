@@ -1,8 +1,38 @@
+"""
+Google Drive access for uploads, links and downloads.
+
+get_drive_service() returns one Drive client per Google credential, cached
+for DRIVE_SERVICE_CACHE_TTL seconds, built from the Drive discovery document
+bundled with google-api-python-client (parsed once per process). The client
+is shared between threads: each request is sent over an HTTP connection of
+the calling thread, since httplib2 connections are not thread-safe.
+
+Files larger than DRIVE_UPLOAD_CHUNK_SIZE are uploaded in resumable chunks;
+every request is retried up to DRIVE_NUM_RETRIES times with exponential
+backoff on rate limits, server errors and connection errors. Uploads ask for the new
+file's link in the same request, so get_file_url() after an upload needs no
+further call.
+
+DRIVE_API_ROOT_URL points the client at another server with the Drive v3
+API, e.g. a local fake Drive server for testing.
+"""
+
 import os
 import io
+import json
+import random
+import threading
+import time
+import httplib2
+from contextlib import contextmanager
 from dotenv import load_dotenv
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload, MediaIoBaseDownload
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+from googleapiclient.errors import HttpError
+from googleapiclient.http import HttpRequest, MediaFileUpload, MediaIoBaseDownload, MediaIoBaseUpload, build_http
+
+from app_logging import timed_external
+from cache import TTLCache
 
 # Load environment variables
 load_dotenv()
@@ -10,44 +40,105 @@ load_dotenv()
 # If modifying these scopes, delete the file token.pickle.
 SCOPES = ['https://www.googleapis.com/auth/drive']
 
-def get_credentials():
-    """Get valid user credentials from Flask-Dance.
+DRIVE_API_ROOT_URL = os.environ.get('DRIVE_API_ROOT_URL')
+DRIVE_NUM_RETRIES = int(os.environ.get('DRIVE_NUM_RETRIES', 5))
+# Resumable chunks must be a multiple of 256 KiB
+DRIVE_UPLOAD_CHUNK_SIZE = int(os.environ.get('DRIVE_UPLOAD_CHUNK_SIZE', 8 * 1024 * 1024))
+DRIVE_DOWNLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+# Backoff before retry n is DRIVE_RETRY_BASE_SECONDS * 2**n plus up to a second of jitter
+DRIVE_RETRY_BASE_SECONDS = 1
+DRIVE_RETRY_STATUSES = (429, 500, 502, 503, 504)
+DRIVE_SERVICE_CACHE_TTL = 3600
 
-    Returns:
-        Credentials, the obtained credential.
+# Drive clients by credential, and links of files looked up or uploaded
+_services = TTLCache(maxsize=256, ttl=DRIVE_SERVICE_CACHE_TTL)
+_file_urls = TTLCache(maxsize=1024, ttl=DRIVE_SERVICE_CACHE_TTL)
+
+_discovery_document = None
+_thread_http = threading.local()
+
+# Google token used by background jobs, which have no Flask session
+_job_credentials = threading.local()
+
+@contextmanager
+def use_drive_token(token_info, client_id=None, client_secret=None):
+    """Use the given Google OAuth token for Drive calls made by this thread.
+
+    Args:
+        token_info: Token dict as stored in session['google_token']
+        client_id: OAuth client ID (defaults to GOOGLE_CLIENT_ID)
+        client_secret: OAuth client secret (defaults to GOOGLE_CLIENT_SECRET)
     """
+    _job_credentials.token = {
+        'google_token': token_info,
+        'GOOGLE_CLIENT_ID': client_id or os.environ.get('GOOGLE_CLIENT_ID'),
+        'GOOGLE_CLIENT_SECRET': client_secret or os.environ.get('GOOGLE_CLIENT_SECRET')
+    }
     try:
-        # Import Flask session and other required modules
-        from flask import session, current_app
-        from google.oauth2.credentials import Credentials
+        yield
+    finally:
+        _job_credentials.token = None
 
-        # Check if we have a token in the session
-        if 'google_token' not in session:
-            print("No Google token found in session")
-            return None
+def _token_source():
+    """The thread's job token if set, otherwise the Flask session"""
+    token = getattr(_job_credentials, 'token', None)
+    if token:
+        return token, {}
+    from flask import session, current_app
+    return session, current_app.config
 
-        # Get token from session
-        token_info = session['google_token']
+def _get_token():
+    """The Google token and OAuth client of the current user or job.
 
-        # Check if token_info is a dictionary and has access_token
-        if not isinstance(token_info, dict) or 'access_token' not in token_info:
-            print("Invalid token format in session")
-            return None
+    Returns:
+        tuple: (token_info, client_id, client_secret), or None if unavailable
+    """
+    # Background jobs pass their token explicitly, requests use the session
+    session, config = _token_source()
 
-        # Create credentials object
-        client_id = current_app.config.get('GOOGLE_CLIENT_ID') or session.get('GOOGLE_CLIENT_ID')
-        client_secret = current_app.config.get('GOOGLE_CLIENT_SECRET') or session.get('GOOGLE_CLIENT_SECRET')
+    # Check if we have a token in the session
+    if 'google_token' not in session:
+        print("No Google token found in session")
+        return None
 
-        if not client_id or not client_secret:
-            print("Missing client_id or client_secret")
+    # Get token from session
+    token_info = session['google_token']
+
+    # Check if token_info is a dictionary and has access_token
+    if not isinstance(token_info, dict) or 'access_token' not in token_info:
+        print("Invalid token format in session")
+        return None
+
+    client_id = config.get('GOOGLE_CLIENT_ID') or session.get('GOOGLE_CLIENT_ID')
+    client_secret = config.get('GOOGLE_CLIENT_SECRET') or session.get('GOOGLE_CLIENT_SECRET')
+
+    if not client_id or not client_secret:
+        print("Missing client_id or client_secret")
+        return None
+
+    return token_info, client_id, client_secret
+
+def get_credentials(token=None):
+    """Get valid user credentials from Flask-Dance.
+
+    Args:
+        token: (token_info, client_id, client_secret) as returned by _get_token (default: looked up)
+
+    Returns:
+        Credentials, the obtained credential.
+    """
+    try:
+        from google.oauth2.credentials import Credentials
+
+        token = token or _get_token()
+        if not token:
             return None
+        token_info, client_id, client_secret = token
 
         # Check if we have a refresh token
         refresh_token = token_info.get('refresh_token')
         if not refresh_token:
             print("WARNING: No refresh token available. Token will not be refreshable.")
-        else:
-            print("Refresh token is available")
 
         # Create credentials object
         creds = Credentials(
@@ -66,21 +157,65 @@ def get_credentials():
         print(f"ERROR creating credentials: {str(e)}")
         return None
 
+def _get_discovery_document():
+    """Drive v3 discovery document, parsed once and pointed at DRIVE_API_ROOT_URL if set"""
+    global _discovery_document
+    if _discovery_document is None:
+        document = json.loads(get_static_doc('drive', 'v3'))
+        if DRIVE_API_ROOT_URL:
+            root_url = DRIVE_API_ROOT_URL.rstrip('/') + '/'
+            document['rootUrl'] = root_url
+            document['baseUrl'] = root_url + document['servicePath']
+        _discovery_document = document
+    return _discovery_document
+
+def _get_thread_http():
+    """HTTP connection of the calling thread"""
+    http = getattr(_thread_http, 'http', None)
+    if http is None:
+        http = _thread_http.http = build_http()
+        # Drive time shows up in the request timing log
+        http.request = timed_external('drive', http.request)
+    return http
+
+def _build_service(creds):
+    import google_auth_httplib2
+
+    def build_request(http, *args, **kwargs):
+        # Send each request over this thread's connection, authorized with the shared credentials
+        return HttpRequest(google_auth_httplib2.AuthorizedHttp(creds, http=_get_thread_http()), *args, **kwargs)
+
+    return build_from_document(
+        _get_discovery_document(),
+        http=google_auth_httplib2.AuthorizedHttp(creds, http=build_http()),
+        requestBuilder=build_request
+    )
+
 def get_drive_service():
     """Get a Google Drive service instance.
 
+    The service is cached per credential and safe to use from several threads.
+
     Returns:
         Drive service instance.
     """
-    creds = get_credentials()
-    if not creds:
+    token = _get_token()
+    if not token:
         print("No credentials available for Google Drive service")
         return None
 
+    token_info, client_id, client_secret = token
+    # Refreshed access tokens stay in the cached credentials, so key by the refresh token
+    key = (client_id, token_info.get('refresh_token') or token_info['access_token'])
+
+    def load():
+        creds = get_credentials(token)
+        if not creds:
+            return None
+        return _build_service(creds)
+
     try:
-        # Build the service
-        service = build('drive', 'v3', credentials=creds)
-        return service
+        return _services.get_or_load(key, load)
     except Exception as e:
         print(f"ERROR creating Drive service: {str(e)}")
 
@@ -102,12 +237,39 @@ def upload_file_to_drive(file_path, file_name, folder_id=None):
     Returns:
         ID of the uploaded file, or None if upload failed
     """
-    try:
-        # Check if the file exists
-        if not os.path.exists(file_path):
-            print(f"ERROR: File not found: {file_path}")
-            return None
+    # Check if the file exists
+    if not os.path.exists(file_path):
+        print(f"ERROR: File not found: {file_path}")
+        return None
+
+    resumable = os.path.getsize(file_path) > DRIVE_UPLOAD_CHUNK_SIZE
+    return _upload_media(
+        lambda: MediaFileUpload(file_path, chunksize=DRIVE_UPLOAD_CHUNK_SIZE, resumable=resumable),
+        file_name, folder_id
+    )
+
+def upload_stream_to_drive(stream, file_name, folder_id=None, mimetype='application/pdf'):
+    """Upload the contents of a binary stream (e.g. a merged PDF) to Google Drive.
+
+    Args:
+        stream: Readable, seekable binary stream
+        file_name: Name to give the file in Drive
+        folder_id: ID of the folder to upload to (optional)
+        mimetype: MIME type of the content
 
+    Returns:
+        ID of the uploaded file, 'local_file' on credential errors, or None if upload failed
+    """
+    resumable = stream.seek(0, io.SEEK_END) > DRIVE_UPLOAD_CHUNK_SIZE
+    stream.seek(0)
+    return _upload_media(
+        lambda: MediaIoBaseUpload(stream, mimetype=mimetype, chunksize=DRIVE_UPLOAD_CHUNK_SIZE, resumable=resumable),
+        file_name, folder_id
+    )
+
+def _upload_media(make_media, file_name, folder_id=None):
+    """Create a Drive file from a media upload, with the common error handling"""
+    try:
         # Get Drive service
         service = get_drive_service()
         if not service:
@@ -124,14 +286,24 @@ def upload_file_to_drive(file_path, file_name, folder_id=None):
         if folder_id:
             file_metadata['parents'] = [folder_id]
 
-        # Upload the file
-        # Use non-resumable upload to avoid token refresh issues
-        media = MediaFileUpload(file_path, resumable=False)
-        file = service.files().create(
+        # Upload the file, asking for its link in the same request
+        media = make_media()
+        request = service.files().create(
             body=file_metadata,
             media_body=media,
-            fields='id'
-        ).execute()
+            fields='id, webViewLink'
+        )
+        if media.resumable():
+            file = None
+            while file is None:
+                status, file = _next_chunk(request, file_name)
+                if status:
+                    print(f"DEBUG: Uploaded {int(status.progress() * 100)}% of {file_name}")
+        else:
+            file = request.execute(num_retries=DRIVE_NUM_RETRIES)
+
+        if file.get('webViewLink'):
+            _file_urls.set(file.get('id'), file.get('webViewLink'))
 
         print(f"SUCCESS: File uploaded to Drive with ID: {file.get('id')}")
         return file.get('id')
@@ -157,14 +329,32 @@ def upload_file_to_drive(file_path, file_name, folder_id=None):
 
         return None
 
-def get_file_url(file_id):
-    """Get the URL for a file in Google Drive.
+def _next_chunk(request, file_name):
+    """Upload the next chunk of a resumable upload, retrying it with backoff on transient errors.
+
+    The client library's own retries resend an already consumed stream, so
+    chunks are retried here: after a failure the next call asks Drive how much
+    it received and resends the chunk from there.
+    """
+    for attempt in range(DRIVE_NUM_RETRIES + 1):
+        try:
+            return request.next_chunk()
+        except (HttpError, OSError, httplib2.HttpLib2Error) as e:
+            if attempt == DRIVE_NUM_RETRIES or (isinstance(e, HttpError) and e.resp.status not in DRIVE_RETRY_STATUSES):
+                raise
+            delay = DRIVE_RETRY_BASE_SECONDS * 2 ** attempt + random.random()
+            print(f"WARNING: Upload of {file_name} interrupted ({str(e)}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+def get_file_metadata(file_id, fields='id, name, parents, webViewLink'):
+    """Get metadata of a file in Google Drive in one call.
 
     Args:
         file_id: ID of the file in Drive
+        fields: Comma-separated metadata fields to return
 
     Returns:
-        URL to access the file, or None if retrieval failed
+        dict of the requested fields, or None if retrieval failed
     """
     try:
         service = get_drive_service()
@@ -172,16 +362,41 @@ def get_file_url(file_id):
             print("ERROR: Could not get Drive service")
             return None
 
-        # Get the file to ensure it exists and get its permissions
-        file = service.files().get(fileId=file_id, fields='webViewLink').execute()
-
-        # Return the web view link
-        return file.get('webViewLink')
+        file = service.files().get(fileId=file_id, fields=fields).execute(num_retries=DRIVE_NUM_RETRIES)
+        if file.get('webViewLink'):
+            _file_urls.set(file_id, file.get('webViewLink'))
+        return file
 
     except Exception as e:
-        print(f"ERROR getting file URL: {str(e)}")
+        print(f"ERROR getting file metadata: {str(e)}")
         return None
 
+def get_file_url(file_id):
+    """Get the URL for a file in Google Drive.
+
+    Links of files uploaded or looked up by this process are returned without a call.
+
+    Args:
+        file_id: ID of the file in Drive
+
+    Returns:
+        URL to access the file, or None if retrieval failed
+    """
+    url = _file_urls.get(file_id)
+    if url:
+        return url
+
+    # Get the file to ensure it exists and get its permissions
+    file = get_file_metadata(file_id, fields='webViewLink')
+    return file.get('webViewLink') if file else None
+
+def get_parent_folder_id(file_id):
+    """Get the ID of the first parent folder of a file in Google Drive, or None"""
+    file = get_file_metadata(file_id, fields='parents')
+    if file and file.get('parents'):
+        return file['parents'][0]
+    return None
+
 def get_or_create_folder(folder_name, parent_folder_id=None):
     """Get a folder by name, or create it if it doesn't exist.
 
@@ -203,7 +418,8 @@ def get_or_create_folder(folder_name, parent_folder_id=None):
         if parent_folder_id:
             query += f" and '{parent_folder_id}' in parents"
 
-        results = service.files().list(q=query, spaces='drive', fields='files(id, name)').execute()
+        results = service.files().list(q=query, spaces='drive', fields='files(id, name)').execute(
+            num_retries=DRIVE_NUM_RETRIES)
         items = results.get('files', [])
 
         # If folder exists, return its ID
@@ -220,7 +436,7 @@ def get_or_create_folder(folder_name, parent_folder_id=None):
         if parent_folder_id:
             folder_metadata['parents'] = [parent_folder_id]
 
-        folder = service.files().create(body=folder_metadata, fields='id').execute()
+        folder = service.files().create(body=folder_metadata, fields='id').execute(num_retries=DRIVE_NUM_RETRIES)
         print(f"Created new folder: {folder_name} with ID: {folder.get('id')}")
         return folder.get('id')
 
@@ -233,7 +449,7 @@ def download_file_from_drive(file_id, output_path):
 
     Args:
         file_id: ID of the file in Drive
-        output_path: Path where to save the downloaded file
+        output_path: Path where to save the downloaded file, or a writable binary stream
 
     Returns:
         True if download was successful, False otherwise
@@ -247,21 +463,24 @@ def download_file_from_drive(file_id, output_path):
         # Get the file
         request = service.files().get_media(fileId=file_id)
 
-        # Download the file
-        with io.BytesIO() as fh:
-            downloader = MediaIoBaseDownload(fh, request)
+        # Download the file in chunks, straight to its destination
+        fh = open(output_path, 'wb') if isinstance(output_path, str) else output_path
+        try:
+            downloader = MediaIoBaseDownload(fh, request, chunksize=DRIVE_DOWNLOAD_CHUNK_SIZE)
             done = False
             while not done:
-                status, done = downloader.next_chunk()
+                status, done = downloader.next_chunk(num_retries=DRIVE_NUM_RETRIES)
                 print(f"Download {int(status.progress() * 100)}%")
-
-            # Save the file
-            with open(output_path, 'wb') as f:
-                f.write(fh.getvalue())
+        finally:
+            if fh is not output_path:
+                fh.close()
 
         print(f"File downloaded to: {output_path}")
         return True
 
     except Exception as e:
         print(f"ERROR downloading file: {str(e)}")
+        # Don't leave a truncated file behind
+        if isinstance(output_path, str) and os.path.exists(output_path):
+            os.remove(output_path)
         return False
@@ -0,0 +1,194 @@
+"""
+Compiled Jinja templates for notification emails (templates/email).
+
+Templates are compiled once per process and kept in the environment's cache.
+The rules in templates/email/email.css are inlined into each template's
+class attributes as it is loaded, so the CSS work is also done once instead
+of on every message. This module does not need a Flask application context,
+so it can be used from the mail worker and from scripts.
+"""
+
+import logging
+import os
+import re
+from datetime import datetime
+
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+
+logger = logging.getLogger(__name__)
+
+EMAIL_TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates', 'email')
+EMAIL_STYLESHEET = 'email.css'
+
+# Templates compiled when the module is imported
+EMAIL_TEMPLATES = [
+    'approval_request.html',
+    'rejection_notification.html',
+    'split_allocation_approval.html',
+    'split_allocation_rejection.html',
+    'split_invoice_approval.html',
+    'finance_entry_rejection.html',
+    'notification_digest.html',
+]
+
+_CSS_COMMENT = re.compile(r'/\*.*?\*/', re.S)
+_CSS_RULE = re.compile(r'\.([\w-]+)\s*\{([^}]*)\}')
+_START_TAG = re.compile(r'<([a-zA-Z][\w-]*)(\s[^<>]*?)?(/?)>')
+_CLASS_ATTR = re.compile(r'\sclass="([^"]*)"')
+_STYLE_ATTR = re.compile(r'\sstyle="([^"]*)"')
+
+
+def load_stylesheet(path):
+    """
+    Parse a stylesheet of single-class rules.
+
+    Returns:
+        dict: class name -> declarations (without the trailing semicolon)
+    """
+    with open(path, encoding='utf-8') as f:
+        css = _CSS_COMMENT.sub('', f.read())
+
+    styles = {}
+    for class_name, body in _CSS_RULE.findall(css):
+        declarations = [d.strip() for d in body.split(';') if d.strip()]
+        if class_name in styles:
+            declarations = [styles[class_name]] + declarations
+        styles[class_name] = '; '.join(declarations)
+    return styles
+
+
+def inline_css(source, styles):
+    """
+    Replace class attributes with the matching inline styles.
+
+    Classes not found in the stylesheet are left in the class attribute.
+    """
+    def replace_tag(match):
+        tag, attributes, self_closing = match.group(1), match.group(2) or '', match.group(3)
+
+        class_match = _CLASS_ATTR.search(attributes)
+        if not class_match:
+            return match.group(0)
+
+        class_names = class_match.group(1).split()
+        declarations = [styles[name] for name in class_names if name in styles]
+        if not declarations:
+            return match.group(0)
+        remaining = [name for name in class_names if name not in styles]
+
+        style_match = _STYLE_ATTR.search(attributes)
+        if style_match:
+            declarations.append(style_match.group(1).strip().rstrip(';'))
+            attributes = _STYLE_ATTR.sub('', attributes, count=1)
+
+        # Later declarations of a property override earlier ones
+        properties = {}
+        for declaration in '; '.join(declarations).split(';'):
+            if ':' in declaration:
+                name, value = declaration.split(':', 1)
+                properties.pop(name.strip(), None)
+                properties[name.strip()] = value.strip()
+        style = '; '.join(f"{name}: {value}" for name, value in properties.items())
+
+        replacement = f' class="{" ".join(remaining)}"' if remaining else ''
+        replacement += f' style="{style};"'
+        attributes = _CLASS_ATTR.sub(lambda m: replacement, attributes, count=1)
+        return f'<{tag}{attributes}{self_closing}>'
+
+    return _START_TAG.sub(replace_tag, source)
+
+
+class InlineCSSLoader(FileSystemLoader):
+    """FileSystemLoader that inlines the email stylesheet into template source"""
+
+    def __init__(self, searchpath, stylesheet):
+        super().__init__(searchpath)
+        self.styles = load_stylesheet(os.path.join(searchpath, stylesheet))
+
+    def get_source(self, environment, template):
+        source, filename, uptodate = super().get_source(environment, template)
+        return inline_css(source, self.styles), filename, uptodate
+
+
+def format_money(value, grouped=True):
+    """Format an amount with two decimals, e.g. 1,234.50 (or 1234.50 without grouping)"""
+    if value is None:
+        value = 0
+    return f"{value:,.2f}" if grouped else f"{value:.2f}"
+
+
+def format_dmy(value):
+    """Format a date as DD-MM-YYYY, passing through values that are not dates"""
+    return value.strftime('%d-%m-%Y') if hasattr(value, 'strftime') else value
+
+
+def format_date_range(epv_record):
+    """'from to to' date range of an EPV, or N/A"""
+    if not (epv_record.from_date and epv_record.to_date):
+        return 'N/A'
+    return f"{format_dmy(epv_record.from_date)} to {format_dmy(epv_record.to_date)}"
+
+
+email_env = Environment(
+    loader=InlineCSSLoader(EMAIL_TEMPLATE_DIR, EMAIL_STYLESHEET),
+    autoescape=select_autoescape(['html']),
+    # Templates only change on deploy, skip the per-render mtime check
+    auto_reload=False,
+    trim_blocks=True,
+    lstrip_blocks=True
+)
+email_env.filters['money'] = format_money
+email_env.filters['dmy'] = format_dmy
+email_env.filters['date_range'] = format_date_range
+
+
+def get_email_template(name):
+    """Return a compiled email template (compiled on first use, then cached)"""
+    return email_env.get_template(name)
+
+
+def render_email(name, **context):
+    """
+    Render one email template.
+
+    Args:
+        name (str): Template file name in templates/email
+        **context: Template variables
+
+    Returns:
+        str: Rendered HTML
+    """
+    context.setdefault('now', datetime.now())
+    return get_email_template(name).render(**context)
+
+
+def render_email_batch(name, contexts, **shared):
+    """
+    Render one template for many recipients.
+
+    The template is looked up once and rendered per context, with the shared
+    variables (e.g. the EPV) merged into each.
+
+    Args:
+        name (str): Template file name in templates/email
+        contexts (list): Per-recipient template variables
+        **shared: Variables common to every message
+
+    Returns:
+        list: Rendered HTML, in the order of contexts
+    """
+    template = get_email_template(name)
+    shared.setdefault('now', datetime.now())
+    return [template.render(**{**shared, **context}) for context in contexts]
+
+
+def preload_email_templates():
+    """Compile all email templates up front"""
+    for name in EMAIL_TEMPLATES:
+        try:
+            get_email_template(name)
+        except Exception as e:
+            logger.error("Failed to compile email template %s: %s", name, e)
+
+
+preload_email_templates()
@@ -0,0 +1,214 @@
+"""
+Streaming export of EPV records to CSV or XLSX.
+
+Each EPV is exported as one row per expense item and per split allocation
+(or a single row if it has neither), with the EPV and finance entry columns
+repeated on every row. EPVs are read in id-ordered keyset batches, so memory
+stays flat no matter how many rows are exported.
+"""
+
+import csv
+import io
+import logging
+import os
+import tempfile
+
+from models import db, EPV, EPVItem, EPVAllocation, FinanceEntry
+
+logger = logging.getLogger(__name__)
+
+try:
+    from openpyxl import Workbook
+    OPENPYXL_AVAILABLE = True
+except ImportError:
+    logger.warning("openpyxl not available. XLSX export will be disabled.")
+    OPENPYXL_AVAILABLE = False
+
+# Number of EPVs fetched per batch
+EXPORT_BATCH_SIZE = 500
+
+# Size of the chunks an XLSX file is streamed in
+XLSX_CHUNK_SIZE = 64 * 1024
+
+EXPORT_COLUMNS = [
+    # EPV
+    ('EPV ID', lambda epv, fe, kind, line: epv.epv_id),
+    ('Submission Date', lambda epv, fe, kind, line: epv.submission_date),
+    ('Academic Year', lambda epv, fe, kind, line: epv.academic_year),
+    ('Employee Name', lambda epv, fe, kind, line: epv.employee_name),
+    ('Employee Email', lambda epv, fe, kind, line: epv.email_id),
+    ('Employee ID', lambda epv, fe, kind, line: epv.employee_id),
+    ('Cost Center', lambda epv, fe, kind, line: epv.cost_center_name),
+    ('City', lambda epv, fe, kind, line: epv.city),
+    ('Payment To', lambda epv, fe, kind, line: epv.payment_to),
+    ('From Date', lambda epv, fe, kind, line: epv.from_date),
+    ('To Date', lambda epv, fe, kind, line: epv.to_date),
+    ('Invoice Type', lambda epv, fe, kind, line: epv.invoice_type),
+    ('EPV Total Amount', lambda epv, fe, kind, line: epv.total_amount),
+    ('Status', lambda epv, fe, kind, line: epv.status),
+    ('Finance Status', lambda epv, fe, kind, line: epv.finance_status),
+    ('Approved By', lambda epv, fe, kind, line: epv.approved_by),
+    ('Approved On', lambda epv, fe, kind, line: epv.approved_on),
+    # Expense item or allocation
+    ('Line Type', lambda epv, fe, kind, line: kind),
+    ('Invoice Date', lambda epv, fe, kind, line: line.expense_invoice_date if kind == 'item' else None),
+    ('Expense Head', lambda epv, fe, kind, line: line.expense_head if line is not None else None),
+    ('Description', lambda epv, fe, kind, line: line.description if line is not None else None),
+    ('GST', lambda epv, fe, kind, line: line.gst if kind == 'item' else None),
+    ('Line Amount', lambda epv, fe, kind, line: line.amount if kind == 'item' else (line.allocated_amount if kind == 'allocation' else None)),
+    ('Allocation Cost Center', lambda epv, fe, kind, line: line.cost_center_name if kind == 'allocation' else None),
+    ('Allocation Approver', lambda epv, fe, kind, line: line.approver_email if kind == 'allocation' else None),
+    ('Allocation Status', lambda epv, fe, kind, line: line.status if kind == 'allocation' else None),
+    # Finance entry
+    ('Vendor Name', lambda epv, fe, kind, line: fe.vendor_name if fe else None),
+    ('Journal Entry', lambda epv, fe, kind, line: fe.journal_entry if fe else None),
+    ('Payment Voucher', lambda epv, fe, kind, line: fe.payment_voucher if fe else None),
+    ('Finance Amount', lambda epv, fe, kind, line: fe.amount if fe else None),
+    ('FCRA Status', lambda epv, fe, kind, line: fe.fcra_status if fe else None),
+    ('Transaction ID', lambda epv, fe, kind, line: fe.transaction_id if fe else None),
+    ('Payment Date', lambda epv, fe, kind, line: fe.payment_date if fe else None),
+    ('Finance Entry Status', lambda epv, fe, kind, line: fe.status if fe else None),
+    ('Finance Approved On', lambda epv, fe, kind, line: fe.approved_on if fe else None),
+]
+
+
+def export_header():
+    """Column headings of the export"""
+    return [name for name, _ in EXPORT_COLUMNS]
+
+
+def _rows_for(model, epv_ids):
+    """Plain rows (no ORM objects) of a child table for a batch of EPV ids, in id order"""
+    table = model.__table__
+    return db.session.execute(
+        db.select(table).where(table.c.epv_id.in_(epv_ids)).order_by(table.c.id)
+    ).all()
+
+
+def _epv_rows(epv_ids):
+    """Plain EPV rows for a batch of ids, in id order"""
+    table = EPV.__table__
+    return db.session.execute(
+        db.select(table).where(table.c.id.in_(epv_ids)).order_by(table.c.id)
+    ).all()
+
+
+def iter_export_rows(base_query, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Yield export rows (lists of values) for every EPV matched by base_query.
+
+    EPVs are fetched in keyset batches on id, with their items, allocations and
+    finance entries loaded in one query each per batch. Plain rows are used
+    instead of ORM objects so nothing accumulates in the session.
+
+    Args:
+        base_query: Scoped EPV query (e.g. from build_epv_records_query)
+        batch_size (int): Number of EPVs per batch
+    """
+    id_query = base_query.with_entities(EPV.id).order_by(None)
+    last_id = 0
+
+    while True:
+        epv_ids = [row[0] for row in id_query.filter(EPV.id > last_id).order_by(EPV.id).limit(batch_size)]
+        if not epv_ids:
+            break
+        last_id = epv_ids[-1]
+
+        epvs = _epv_rows(epv_ids)
+
+        lines_by_epv = {}
+        for item in _rows_for(EPVItem, epv_ids):
+            lines_by_epv.setdefault(item.epv_id, []).append(('item', item))
+        for allocation in _rows_for(EPVAllocation, epv_ids):
+            lines_by_epv.setdefault(allocation.epv_id, []).append(('allocation', allocation))
+
+        finance_entries = {}
+        for entry in _rows_for(FinanceEntry, epv_ids):
+            finance_entries.setdefault(entry.epv_id, entry)
+
+        for epv in epvs:
+            finance_entry = finance_entries.get(epv.id)
+            for kind, line in lines_by_epv.get(epv.id) or [('epv', None)]:
+                yield [value(epv, finance_entry, kind, line) for _, value in EXPORT_COLUMNS]
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if hasattr(value, 'strftime'):
+        return value.isoformat(sep=' ') if hasattr(value, 'hour') else value.isoformat()
+    return value
+
+
+def generate_csv(base_query, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Yield the export as CSV text chunks of batch_size rows each.
+
+    Args:
+        base_query: Scoped EPV query
+        batch_size (int): Number of rows buffered per chunk
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(export_header())
+
+    row_count = 0
+    for row in iter_export_rows(base_query, batch_size):
+        writer.writerow([_csv_value(value) for value in row])
+        row_count += 1
+        if row_count % batch_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+
+    yield buffer.getvalue()
+
+
+def write_xlsx(base_query, output, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Write the export as an XLSX workbook using openpyxl's write-only mode,
+    which flushes rows to disk instead of keeping them in memory.
+
+    Args:
+        base_query: Scoped EPV query
+        output: File path or binary file object to write to
+        batch_size (int): Number of EPVs per batch
+
+    Returns:
+        int: Number of data rows written
+    """
+    if not OPENPYXL_AVAILABLE:
+        raise RuntimeError("XLSX export requires openpyxl")
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet('EPV Records')
+    sheet.append(export_header())
+
+    row_count = 0
+    for row in iter_export_rows(base_query, batch_size):
+        sheet.append(row)
+        row_count += 1
+
+    workbook.save(output)
+    return row_count
+
+
+def generate_xlsx(base_query, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Yield the export as XLSX bytes in fixed-size chunks.
+
+    The workbook has to be complete before it can be sent (it is a zip file),
+    so it is built in a temporary file which is removed once streamed.
+    """
+    fd, path = tempfile.mkstemp(suffix='.xlsx', prefix='epv_export_')
+    os.close(fd)
+    try:
+        write_xlsx(base_query, path, batch_size)
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(XLSX_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+    finally:
+        os.remove(path)
@@ -0,0 +1,277 @@
+"""
+Maintenance of the epv_daily_summary rollup.
+
+The rollup holds one row per (submission day, cost center, city, status,
+expense head, approval month) with EPV counts, amounts and processing-time
+totals, so scorecards can read O(days x dimensions) rows instead of scanning
+the epv table.
+
+Rows are grouped into buckets of (submission day, cost center). Whenever an
+EPV or one of its EPVItem, EPVApproval, EPVAllocation or FinanceEntry rows is
+flushed, the buckets it belongs to (before and after the change) are
+recomputed from the source tables inside the same transaction. See the
+after_flush listener in models.py. If that refresh fails, the buckets are
+recorded in epv_summary_dirty_bucket instead, and refresh_dirty_buckets()
+recomputes them before the dashboard scorecards next read the rollup.
+
+Processing days are counted with the holiday calendar of the moment a bucket
+is recomputed, so run rebuild_epv_summary.py after changing the calendar.
+"""
+
+from datetime import datetime, date, timedelta
+
+from sqlalchemy import select, delete, insert, and_, or_, func
+
+from models import EPV, EPVItem, FinanceEntry, EPVDailySummary, EPVSummaryDirtyBucket
+from utils import calculate_processing_days_batch
+
+# Expense head value used for the "all heads" rollup rows
+ALL_EXPENSE_HEADS = ''
+
+# Number of EPVs summarised per batch during a full rebuild
+REBUILD_BATCH_SIZE = 1000
+
+
+def _day(value):
+    """Return the calendar day of a date/datetime value"""
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return datetime.strptime(str(value)[:10], '%Y-%m-%d').date()
+
+
+def _bucket_condition(buckets):
+    """SQL condition matching EPVs that fall into any of the given buckets"""
+    conditions = []
+    for summary_date, cost_center_id in buckets:
+        day_start = datetime(summary_date.year, summary_date.month, summary_date.day)
+        if cost_center_id is None:
+            cost_center_match = EPV.cost_center_id.is_(None)
+        else:
+            cost_center_match = EPV.cost_center_id == cost_center_id
+        conditions.append(and_(
+            cost_center_match,
+            EPV.submission_date >= day_start,
+            EPV.submission_date < day_start + timedelta(days=1)
+        ))
+    return or_(*conditions)
+
+
+def _summary_bucket_condition(buckets):
+    """SQL condition matching summary rows belonging to any of the given buckets"""
+    conditions = []
+    for summary_date, cost_center_id in buckets:
+        if cost_center_id is None:
+            cost_center_match = EPVDailySummary.cost_center_id.is_(None)
+        else:
+            cost_center_match = EPVDailySummary.cost_center_id == cost_center_id
+        conditions.append(and_(EPVDailySummary.summary_date == summary_date, cost_center_match))
+    return or_(*conditions)
+
+
+def _processing_days(connection, epv_ids):
+    """
+    Business days from manager approval (or latest resubmission) to payment
+    for the processed EPVs among epv_ids, in two queries.
+
+    Returns:
+        dict: epv id -> processing days (0 when no start date is recorded)
+    """
+    payment_dates = dict(connection.execute(
+        select(FinanceEntry.epv_id, func.max(FinanceEntry.payment_date))
+        .where(FinanceEntry.epv_id.in_(epv_ids), FinanceEntry.payment_date.isnot(None))
+        .group_by(FinanceEntry.epv_id)
+    ).all())
+    if not payment_dates:
+        return {}
+
+    return calculate_processing_days_batch(payment_dates, connection)
+
+
+def _accumulate(connection, epv_rows, totals):
+    """
+    Add the contribution of a batch of EPV rows to the rollup totals.
+
+    Args:
+        connection: SQLAlchemy connection in the current transaction
+        epv_rows (list): Rows of (id, submission_date, cost_center_id, city,
+            status, finance_status, approved_on, total_amount)
+        totals (dict): Rollup key -> [epv_count, total_amount, processed_count, processing_days_total]
+    """
+    if not epv_rows:
+        return
+
+    epv_ids = [row.id for row in epv_rows]
+
+    heads_by_epv = {}
+    for epv_id, expense_head in connection.execute(
+        select(EPVItem.epv_id, EPVItem.expense_head)
+        .where(EPVItem.epv_id.in_(epv_ids))
+        .distinct()
+    ):
+        if expense_head:
+            heads_by_epv.setdefault(epv_id, set()).add(expense_head)
+
+    processed_ids = [row.id for row in epv_rows
+                     if row.status == 'approved' and row.finance_status == 'processed']
+    processing_days = _processing_days(connection, processed_ids) if processed_ids else {}
+
+    for row in epv_rows:
+        if row.submission_date is None:
+            continue
+        approved_month = row.approved_on.strftime('%Y-%m') if row.status == 'approved' and row.approved_on else ''
+        processed = row.id in processing_days
+
+        for expense_head in [ALL_EXPENSE_HEADS] + sorted(heads_by_epv.get(row.id, ())):
+            key = (_day(row.submission_date), row.cost_center_id, row.city or '',
+                   row.status or '', expense_head, approved_month)
+            measures = totals.setdefault(key, [0, 0.0, 0, 0])
+            measures[0] += 1
+            measures[1] += row.total_amount or 0
+            if processed:
+                measures[2] += 1
+                measures[3] += processing_days[row.id]
+
+
+def _epv_columns():
+    return select(EPV.id, EPV.submission_date, EPV.cost_center_id, EPV.city, EPV.status,
+                  EPV.finance_status, EPV.approved_on, EPV.total_amount)
+
+
+def _insert_totals(connection, totals):
+    """Insert rollup rows for the accumulated totals"""
+    if not totals:
+        return
+
+    now = datetime.now()
+    connection.execute(insert(EPVDailySummary), [
+        {
+            'summary_date': summary_date,
+            'cost_center_id': cost_center_id,
+            'city': city,
+            'status': status,
+            'expense_head': expense_head,
+            'approved_month': approved_month,
+            'epv_count': epv_count,
+            'total_amount': total_amount,
+            'processed_count': processed_count,
+            'processing_days_total': processing_days_total,
+            'updated_at': now
+        }
+        for (summary_date, cost_center_id, city, status, expense_head, approved_month),
+            (epv_count, total_amount, processed_count, processing_days_total) in totals.items()
+    ])
+
+
+def refresh_buckets(connection, buckets):
+    """
+    Recompute the rollup rows for the given (submission day, cost center) buckets.
+
+    Args:
+        connection: SQLAlchemy connection in the current transaction
+        buckets (set): (date, cost_center_id) pairs to recompute
+    """
+    buckets = {(_day(summary_date), cost_center_id) for summary_date, cost_center_id in buckets
+               if summary_date is not None}
+    if not buckets:
+        return
+
+    totals = {}
+    epv_rows = connection.execute(_epv_columns().where(_bucket_condition(buckets))).all()
+    _accumulate(connection, epv_rows, totals)
+
+    connection.execute(delete(EPVDailySummary).where(_summary_bucket_condition(buckets)))
+    _insert_totals(connection, totals)
+
+
+def buckets_for_epv_ids(connection, epv_ids):
+    """Look up the current buckets of the given EPV ids"""
+    if not epv_ids:
+        return set()
+    rows = connection.execute(
+        select(EPV.submission_date, EPV.cost_center_id).where(EPV.id.in_(list(epv_ids)))
+    ).all()
+    return {(_day(submission_date), cost_center_id) for submission_date, cost_center_id in rows}
+
+
+def mark_buckets_dirty(connection, buckets, epv_ids=()):
+    """
+    Record buckets whose refresh failed, for refresh_dirty_buckets().
+
+    Args:
+        connection: SQLAlchemy connection in the current transaction
+        buckets (set): (date, cost_center_id) pairs to recompute later
+        epv_ids (set): EPV ids whose current buckets are to be recomputed too
+    """
+    buckets = {(_day(summary_date), cost_center_id) for summary_date, cost_center_id in buckets
+               if summary_date is not None}
+    buckets |= buckets_for_epv_ids(connection, epv_ids)
+    buckets = {bucket for bucket in buckets if bucket[0] is not None}
+    if not buckets:
+        return
+
+    now = datetime.now()
+    connection.execute(insert(EPVSummaryDirtyBucket), [
+        {'summary_date': summary_date, 'cost_center_id': cost_center_id, 'marked_at': now}
+        for summary_date, cost_center_id in buckets
+    ])
+
+
+def refresh_dirty_buckets(connection):
+    """
+    Recompute the buckets recorded by mark_buckets_dirty().
+
+    The dirty rows are deleted before the buckets are recomputed, in the same
+    transaction, so concurrent callers do not recompute the same buckets.
+
+    Args:
+        connection: SQLAlchemy connection in its own transaction
+
+    Returns:
+        int: Number of buckets recomputed
+    """
+    dirty = connection.execute(
+        select(EPVSummaryDirtyBucket.id, EPVSummaryDirtyBucket.summary_date, EPVSummaryDirtyBucket.cost_center_id)
+    ).all()
+    if not dirty:
+        return 0
+
+    claimed = connection.execute(
+        delete(EPVSummaryDirtyBucket).where(EPVSummaryDirtyBucket.id.in_([row.id for row in dirty]))
+    ).rowcount
+    if not claimed:
+        return 0
+
+    buckets = {(_day(row.summary_date), row.cost_center_id) for row in dirty}
+    refresh_buckets(connection, buckets)
+    return len(buckets)
+
+
+def rebuild_daily_summary(connection, batch_size=REBUILD_BATCH_SIZE):
+    """
+    Rebuild the whole rollup from the source tables (used for backfills).
+
+    EPVs are read in id-ordered batches so memory only grows with the number
+    of rollup rows, not with the number of EPVs.
+
+    Returns:
+        int: Number of rollup rows written
+    """
+    totals = {}
+    last_id = 0
+    while True:
+        epv_rows = connection.execute(
+            _epv_columns().where(EPV.id > last_id).order_by(EPV.id).limit(batch_size)
+        ).all()
+        if not epv_rows:
+            break
+        _accumulate(connection, epv_rows, totals)
+        last_id = epv_rows[-1].id
+
+    connection.execute(delete(EPVDailySummary))
+    connection.execute(delete(EPVSummaryDirtyBucket))
+    _insert_totals(connection, totals)
+    return len(totals)
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""
+Export EPV records (with items, allocations and finance entries) to CSV or XLSX.
+
+Examples:
+    python export_epv_records.py --start-date 2024-04-01 --end-date 2025-03-31 -o epv_2024_25.csv
+    python export_epv_records.py --format xlsx --user finance.user@akanksha.org -o pune.xlsx
+
+Without --user all EPVs are exported. With --user the export is limited to the
+records that user sees on /epv-records (same role and city scoping).
+"""
+import argparse
+import os
+import sys
+from datetime import datetime, timedelta
+
+# Add current directory to path so we can import the app
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from app import app, build_epv_records_query
+from models import EPV, EmployeeDetails
+from epv_export import generate_csv, write_xlsx
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Export EPV records to CSV or XLSX')
+    parser.add_argument('--format', choices=['csv', 'xlsx'], default='csv', help='Output format (default: csv)')
+    parser.add_argument('-o', '--output', required=True, help='Output file path')
+    parser.add_argument('--user', help='Limit the export to the records visible to this user email')
+    parser.add_argument('--start-date', help='First submission date to include (YYYY-MM-DD)')
+    parser.add_argument('--end-date', help='Last submission date to include (YYYY-MM-DD)')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+
+    with app.app_context():
+        if args.user:
+            employee = EmployeeDetails.query.filter_by(email=args.user).first()
+            if not employee:
+                print(f"❌ Employee not found: {args.user}")
+                sys.exit(1)
+            base_query = build_epv_records_query(args.user, employee.role, {})
+        else:
+            base_query = EPV.query
+
+        if args.start_date:
+            base_query = base_query.filter(EPV.submission_date >= datetime.strptime(args.start_date, '%Y-%m-%d'))
+        if args.end_date:
+            end_date = datetime.strptime(args.end_date, '%Y-%m-%d') + timedelta(days=1)
+            base_query = base_query.filter(EPV.submission_date < end_date)
+
+        print(f"Exporting EPV records to {args.output}...")
+        try:
+            if args.format == 'xlsx':
+                write_xlsx(base_query, args.output)
+            else:
+                with open(args.output, 'w', newline='', encoding='utf-8') as f:
+                    for chunk in generate_csv(base_query):
+                        f.write(chunk)
+            print(f"✅ Export written to {args.output}")
+        except Exception as e:
+            print(f"❌ Export failed: {str(e)}")
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
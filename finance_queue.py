@@ -0,0 +1,239 @@
+"""
+Finance work queue: leases on the EPVs finance users are processing.
+
+A finance user holds a lease on an EPV while its finance entry page is open
+(EPV.being_processed_by, EPV.processing_started_at being the time the lease
+was taken or last renewed). Leases are taken with a single conditional
+UPDATE that only matches a free, expired or own lease, so two users opening
+the same EPV cannot both get it. The entry page renews the lease while it
+stays open; a lease not renewed for FINANCE_LEASE_MINUTES expires, and a
+background sweeper clears expired leases every FINANCE_LEASE_SWEEP_SECONDS.
+
+claim_next_epv() leases the oldest EPV waiting for finance processing in a
+user's cities, for the "Process next" button on the finance dashboard.
+"""
+
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import case, select, update
+
+from city_scope import in_cities
+from models import db, EPV, EmployeeDetails
+
+logger = logging.getLogger(__name__)
+
+FINANCE_LEASE_MINUTES = int(os.environ.get('FINANCE_LEASE_MINUTES', 30))
+FINANCE_LEASE_SWEEP_SECONDS = int(os.environ.get('FINANCE_LEASE_SWEEP_SECONDS', 60))
+
+# EPVs tried per claim_next_epv() call before giving up on a busy queue
+CLAIM_NEXT_CANDIDATES = 10
+
+_app = None
+_sweeper_thread = None
+_stopping = threading.Event()
+
+
+def _lease_cutoff(now):
+    """Leases taken or renewed before this time have expired"""
+    return now - timedelta(minutes=FINANCE_LEASE_MINUTES)
+
+
+def _claimable(employee_id, now):
+    """Condition on EPV: not leased, lease expired, or leased by this employee"""
+    return db.or_(
+        EPV.being_processed_by == None,
+        EPV.being_processed_by == employee_id,
+        EPV.processing_started_at == None,
+        EPV.processing_started_at < _lease_cutoff(now)
+    )
+
+
+def claim_epv(epv_pk, employee_id):
+    """
+    Lease an EPV for processing, or renew the employee's own lease on it.
+
+    Commits the current session.
+
+    Args:
+        epv_pk (int): Primary key of the EPV
+        employee_id (int): Employee taking the lease
+
+    Returns:
+        bool: True if the employee now holds the lease
+    """
+    now = datetime.now()
+    result = db.session.execute(
+        update(EPV)
+        .where(EPV.id == epv_pk, _claimable(employee_id, now))
+        .values(being_processed_by=employee_id, processing_started_at=now)
+        .execution_options(synchronize_session='fetch')
+    )
+    db.session.commit()
+    return result.rowcount == 1
+
+
+def renew_lease(epv_pk, employee_id):
+    """
+    Extend the employee's lease on an EPV.
+
+    Returns:
+        bool: False if the employee no longer holds the lease (it expired and
+            was taken by someone else, or the EPV was processed)
+    """
+    now = datetime.now()
+    result = db.session.execute(
+        update(EPV)
+        .where(EPV.id == epv_pk, EPV.being_processed_by == employee_id)
+        .values(processing_started_at=now)
+        .execution_options(synchronize_session='fetch')
+    )
+    db.session.commit()
+    return result.rowcount == 1
+
+
+def lease_holder(epv):
+    """
+    The employee holding an unexpired lease on an EPV.
+
+    Returns:
+        EmployeeDetails: The holder, or None if the EPV is free
+    """
+    if not epv.being_processed_by or not epv.processing_started_at:
+        return None
+    if epv.processing_started_at < _lease_cutoff(datetime.now()):
+        return None
+    return db.session.get(EmployeeDetails, epv.being_processed_by)
+
+
+def annotate_leases(epvs, employee_id):
+    """
+    Set is_locked, locked_by and lock_time_remaining on EPVs for the finance dashboard.
+
+    An EPV is locked if another employee holds an unexpired lease on it. The
+    holders are loaded in one query.
+    """
+    now = datetime.now()
+    cutoff = _lease_cutoff(now)
+    locked = [
+        epv for epv in epvs
+        if epv.being_processed_by and epv.processing_started_at
+        and epv.processing_started_at >= cutoff and epv.being_processed_by != employee_id
+    ]
+    holder_ids = {epv.being_processed_by for epv in locked}
+    holders = {}
+    if holder_ids:
+        holders = {
+            employee.id: employee
+            for employee in EmployeeDetails.query.filter(EmployeeDetails.id.in_(holder_ids)).all()
+        }
+
+    for epv in epvs:
+        epv.is_locked = False
+        epv.locked_by = None
+        epv.lock_time_remaining = 0
+    for epv in locked:
+        epv.is_locked = True
+        epv.locked_by = holders.get(epv.being_processed_by)
+        remaining = epv.processing_started_at - cutoff
+        epv.lock_time_remaining = int(remaining.total_seconds() // 60)
+
+
+def claim_next_epv(employee_id, city_names):
+    """
+    Lease the oldest EPV waiting for finance processing in the employee's cities.
+
+    Waiting EPVs are those on the finance dashboard's pending and resubmitted
+    tabs: approved standard and split EPVs in the cities, and master EPVs.
+
+    Args:
+        employee_id (int): Finance user taking the lease
+        city_names (list): The user's assigned cities; empty for all cities
+
+    Returns:
+        EPV: The leased EPV, or None if nothing is waiting
+    """
+    now = datetime.now()
+    candidates = select(EPV.id).where(
+        db.or_(
+            db.and_(EPV.invoice_type == 'standard', EPV.status == 'approved', in_cities(city_names)),
+            db.and_(
+                EPV.invoice_type == 'split',
+                EPV.status.in_(['approved', 'partially_approved']),
+                in_cities(city_names)
+            ),
+            db.and_(EPV.invoice_type == 'master', EPV.status == 'approved')
+        ),
+        db.or_(EPV.finance_status == None, EPV.finance_status == 'pending'),
+        _claimable(employee_id, now)
+    ).order_by(
+        # Continue with an EPV this user already holds before taking a new one
+        case((EPV.being_processed_by == employee_id, 0), else_=1),
+        EPV.submission_date,
+        EPV.id
+    ).limit(CLAIM_NEXT_CANDIDATES)
+
+    for epv_pk in db.session.execute(candidates).scalars().all():
+        # Another user may take a candidate between the SELECT and the UPDATE
+        if claim_epv(epv_pk, employee_id):
+            return db.session.get(EPV, epv_pk)
+    return None
+
+
+def release_expired_leases():
+    """
+    Clear the leases that have expired.
+
+    Returns:
+        int: Number of leases cleared
+    """
+    result = db.session.execute(
+        update(EPV)
+        .where(EPV.being_processed_by != None, EPV.processing_started_at < _lease_cutoff(datetime.now()))
+        .values(being_processed_by=None, processing_started_at=None)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    return result.rowcount
+
+
+def _sweeper_loop():
+    logger.debug("Finance lease sweeper started (leases expire after %s min)", FINANCE_LEASE_MINUTES)
+    while not _stopping.wait(FINANCE_LEASE_SWEEP_SECONDS):
+        try:
+            with _app.app_context():
+                released = release_expired_leases()
+            if released:
+                logger.debug("Released %s expired finance leases", released)
+        except Exception as e:
+            logger.exception("Finance lease sweeper error: %s", e)
+            time.sleep(FINANCE_LEASE_SWEEP_SECONDS)
+
+
+def start_lease_sweeper(app):
+    """
+    Start the background sweeper of expired leases for this process (idempotent).
+
+    Args:
+        app: Flask application, used for the database configuration
+    """
+    global _sweeper_thread, _app
+
+    if _sweeper_thread is not None and _sweeper_thread.is_alive():
+        return _sweeper_thread
+
+    _app = app
+    _stopping.clear()
+    _sweeper_thread = threading.Thread(target=_sweeper_loop, name='finance-lease-sweeper', daemon=True)
+    _sweeper_thread.start()
+    return _sweeper_thread
+
+
+def stop_lease_sweeper(timeout=None):
+    """Stop the sweeper thread"""
+    _stopping.set()
+    if _sweeper_thread is not None:
+        _sweeper_thread.join(timeout)
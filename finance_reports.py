@@ -0,0 +1,328 @@
+"""
+Aggregations behind the finance reports page (/finance/reports).
+
+Every report is answered with grouped SQL over EPV, EPVItem and
+EPVAllocation, in a fixed number of queries whatever the number of vouchers,
+and returned as compact JSON series ({'labels': [...], 'values': [...]}) for
+static/js/finance_reports.js. Results are cached for REPORTS_CACHE_TTL
+seconds per academic year, date range and filter.
+
+Reports cover vouchers approved by their managers (approved or partially
+approved). Sub-invoices are left out since their master invoice carries the
+amount, and split invoices are attributed to cost centers and expense heads
+through their allocations.
+"""
+
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, func, literal, union_all
+
+from cache import TTLCache
+from city_scope import effective_city
+from models import db, EPV, EPVItem, EPVAllocation, CostCenter, FinanceEntry, EmployeeDetails, SettingsFinance
+from utils import business_days_between, processing_start_subquery
+
+REPORTS_CACHE_TTL = int(os.environ.get('REPORTS_CACHE_TTL', 300))
+
+REPORTED_STATUSES = ('approved', 'partially_approved')
+
+MONTH_LABELS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+
+_reports = TTLCache(maxsize=256, ttl=REPORTS_CACHE_TTL)
+
+
+def get_academic_year():
+    """Academic year from settings_finance, or the one starting this calendar year"""
+    def load():
+        setting = SettingsFinance.query.filter_by(setting_name='academic_year').first()
+        if setting and setting.setting_value:
+            return setting.setting_value
+        current_year = datetime.now().year
+        return f"{current_year}-{current_year + 1}"
+    return _reports.get_or_load('academic_year', load)
+
+
+def get_report_date_range(date_range, today=None):
+    """
+    Submission date range of a report filter.
+
+    Returns:
+        tuple: (start, end) datetimes, end exclusive
+    """
+    today = today or datetime.now()
+    this_month = datetime(today.year, today.month, 1)
+    quarter_month = (today.month - 1) // 3 * 3 + 1
+    this_quarter = datetime(today.year, quarter_month, 1)
+    tomorrow = datetime(today.year, today.month, today.day) + timedelta(days=1)
+
+    if date_range == 'last_month':
+        return _add_months(this_month, -1), this_month
+    if date_range == 'current_quarter':
+        return this_quarter, tomorrow
+    if date_range == 'last_quarter':
+        return _add_months(this_quarter, -3), this_quarter
+    if date_range == 'current_year':
+        return datetime(today.year, 1, 1), tomorrow
+    # current_month, and custom until the page has inputs for it
+    return this_month, tomorrow
+
+
+def _add_months(day, months):
+    month_index = day.year * 12 + day.month - 1 + months
+    return datetime(month_index // 12, month_index % 12 + 1, 1)
+
+
+def _cached(name, params, load):
+    return _reports.get_or_load((name, get_academic_year()) + tuple(params), load)
+
+
+def _reported_conditions(start, end, city=None):
+    conditions = [
+        EPV.status.in_(REPORTED_STATUSES),
+        db.or_(EPV.invoice_type != 'sub', EPV.invoice_type.is_(None)),
+        EPV.submission_date >= start,
+        EPV.submission_date < end,
+    ]
+    if city and city != 'all':
+        conditions.append(effective_city() == city)
+    return conditions
+
+
+def _reported_epv_ids(start, end, city=None):
+    """SELECT of the ids of the EPVs a report covers"""
+    return select(EPV.id).outerjoin(CostCenter, EPV.cost_center_id == CostCenter.id).where(
+        *_reported_conditions(start, end, city)
+    )
+
+
+def _expense_lines(epv_ids):
+    """
+    Subquery of (epv_id, cost_center_id, expense_head, amount) lines: the
+    allocations of split invoices and the items of other invoices
+    """
+    items = select(
+        EPVItem.epv_id.label('epv_id'),
+        EPV.cost_center_id.label('cost_center_id'),
+        EPVItem.expense_head.label('expense_head'),
+        EPVItem.amount.label('amount')
+    ).join(EPV, EPVItem.epv_id == EPV.id).where(
+        EPVItem.epv_id.in_(epv_ids),
+        db.or_(EPV.invoice_type != 'split', EPV.invoice_type.is_(None))
+    )
+    allocations = select(
+        EPVAllocation.epv_id.label('epv_id'),
+        EPVAllocation.cost_center_id.label('cost_center_id'),
+        func.coalesce(EPVAllocation.expense_head, literal('Unspecified')).label('expense_head'),
+        EPVAllocation.allocated_amount.label('amount')
+    ).join(EPV, EPVAllocation.epv_id == EPV.id).where(
+        EPVAllocation.epv_id.in_(epv_ids),
+        EPV.invoice_type == 'split'
+    )
+    return union_all(items, allocations).subquery()
+
+
+def _average_processing_days(group_column, epv_ids, joins=()):
+    """
+    Average business days from processing start to payment per group, in one
+    query grouped by (group, start day, payment day).
+
+    Returns:
+        dict: group value -> average days
+    """
+    starts = processing_start_subquery(epv_ids)
+    start_day = func.date(starts.c.started_on)
+    payment_day = func.date(FinanceEntry.payment_date)
+
+    query = select(group_column, start_day, payment_day, func.count()).select_from(EPV).join(
+        FinanceEntry, FinanceEntry.epv_id == EPV.id
+    ).join(
+        starts, starts.c.epv_id == EPV.id
+    )
+    for target, on in joins:
+        query = query.outerjoin(target, on)
+    rows = db.session.execute(query.where(
+        EPV.id.in_(epv_ids),
+        EPV.finance_status == 'processed',
+        FinanceEntry.payment_date.isnot(None)
+    ).group_by(group_column, start_day, payment_day)).all()
+
+    days = business_days_between([row[1] for row in rows], [row[2] for row in rows])
+    totals = {}
+    for (group, _, _, count), pair_days in zip(rows, days):
+        total = totals.setdefault(group, [0, 0])
+        total[0] += pair_days * count
+        total[1] += count
+    return {group: total_days / count for group, (total_days, count) in totals.items()}
+
+
+def get_overview_report(date_range, city='all', today=None):
+    """
+    Totals, monthly amounts of the current year, amounts per expense head and
+    average processing time of the EPVs submitted in a date range.
+    """
+    today = today or datetime.now()
+    start, end = get_report_date_range(date_range, today)
+
+    def load():
+        epv_ids = _reported_epv_ids(start, end, city)
+
+        total_expenses, total_amount = db.session.execute(
+            select(func.count(EPV.id), func.coalesce(func.sum(EPV.total_amount), 0)).where(EPV.id.in_(epv_ids))
+        ).one()
+
+        month = db.extract('month', EPV.submission_date)
+        monthly_trend = [0] * 12
+        for month_number, amount in db.session.execute(
+            select(month, func.sum(EPV.total_amount)).where(
+                EPV.id.in_(epv_ids),
+                db.extract('year', EPV.submission_date) == today.year
+            ).group_by(month)
+        ):
+            monthly_trend[int(month_number) - 1] = round(float(amount or 0), 2)
+
+        lines = _expense_lines(epv_ids)
+        categories = db.session.execute(
+            select(lines.c.expense_head, func.sum(lines.c.amount)).group_by(lines.c.expense_head)
+            .order_by(func.sum(lines.c.amount).desc())
+        ).all()
+
+        processing_days = _average_processing_days(literal(1), epv_ids).get(1, 0)
+
+        total_amount = float(total_amount or 0)
+        avg_amount = total_amount / total_expenses if total_expenses else 0
+        return {
+            'total_expenses': f"{total_expenses:,}",
+            'total_amount': f"Rs. {total_amount:,.2f}",
+            'avg_amount': f"Rs. {avg_amount:,.2f}",
+            'avg_processing_time': f"{processing_days:.1f} days",
+            'monthly_trend': monthly_trend,
+            'category_distribution': {
+                'labels': [head for head, _ in categories],
+                'values': [round(float(amount or 0), 2) for _, amount in categories]
+            }
+        }
+
+    return _cached('overview', (start, end, city), load)
+
+
+def get_expense_trends_report(time_period, expense_head='all', today=None):
+    """
+    Amounts of the last 12 months, 4 quarters or 3 years, optionally for one
+    expense head, from one query grouped by submission month.
+    """
+    today = today or datetime.now()
+    this_month = datetime(today.year, today.month, 1)
+
+    if time_period == 'quarterly':
+        quarter_start = datetime(today.year, (today.month - 1) // 3 * 3 + 1, 1)
+        periods = [_add_months(quarter_start, -3 * i) for i in range(3, -1, -1)]
+        labels = [f"Q{(p.month - 1) // 3 + 1} {p.year}" for p in periods]
+        period_of = lambda year, month: f"Q{(month - 1) // 3 + 1} {year}"
+    elif time_period == 'yearly':
+        periods = [datetime(today.year - i, 1, 1) for i in range(2, -1, -1)]
+        labels = [str(p.year) for p in periods]
+        period_of = lambda year, month: str(year)
+    else:
+        periods = [_add_months(this_month, -i) for i in range(11, -1, -1)]
+        labels = [f"{MONTH_LABELS[p.month - 1]} {p.year}" for p in periods]
+        period_of = lambda year, month: f"{MONTH_LABELS[month - 1]} {year}"
+
+    start = periods[0]
+    end = _add_months(this_month, 1)
+
+    def load():
+        epv_ids = _reported_epv_ids(start, end)
+        year = db.extract('year', EPV.submission_date)
+        month = db.extract('month', EPV.submission_date)
+
+        if expense_head and expense_head != 'all':
+            lines = _expense_lines(epv_ids)
+            query = select(year, month, func.sum(lines.c.amount)).select_from(lines).join(
+                EPV, EPV.id == lines.c.epv_id
+            ).where(lines.c.expense_head == expense_head)
+        else:
+            query = select(year, month, func.sum(EPV.total_amount)).where(EPV.id.in_(epv_ids))
+
+        totals = dict.fromkeys(labels, 0)
+        for year_value, month_value, amount in db.session.execute(query.group_by(year, month)):
+            label = period_of(int(year_value), int(month_value))
+            if label in totals:
+                totals[label] += float(amount or 0)
+
+        return {'labels': labels, 'values': [round(totals[label], 2) for label in labels]}
+
+    return _cached('expense_trends', (time_period, expense_head, start, end), load)
+
+
+def get_cost_center_report(date_range, city='all', today=None):
+    """Expense count, amounts and average processing time per cost center"""
+    start, end = get_report_date_range(date_range, today)
+
+    def load():
+        epv_ids = _reported_epv_ids(start, end, city)
+        lines = _expense_lines(epv_ids)
+
+        rows = db.session.execute(
+            select(
+                lines.c.cost_center_id,
+                CostCenter.costcenter,
+                CostCenter.city,
+                func.count(func.distinct(lines.c.epv_id)),
+                func.sum(lines.c.amount)
+            ).select_from(lines).outerjoin(
+                CostCenter, CostCenter.id == lines.c.cost_center_id
+            ).group_by(
+                lines.c.cost_center_id, CostCenter.costcenter, CostCenter.city
+            ).order_by(func.sum(lines.c.amount).desc())
+        ).all()
+
+        processing_days = _average_processing_days(EPV.cost_center_id, epv_ids)
+
+        cost_centers = []
+        for cost_center_id, name, cc_city, count, amount in rows:
+            amount = float(amount or 0)
+            cost_centers.append({
+                'cost_center': name or 'Unassigned',
+                'city': cc_city or '',
+                'total_expenses': count,
+                'total_amount': round(amount, 2),
+                'avg_amount': round(amount / count, 2) if count else 0,
+                'avg_processing_days': round(processing_days.get(cost_center_id, 0), 1)
+            })
+
+        return {
+            'labels': [row['cost_center'] for row in cost_centers],
+            'values': [row['total_amount'] for row in cost_centers],
+            'rows': cost_centers
+        }
+
+    return _cached('cost_centers', (start, end, city), load)
+
+
+def get_processing_time_report(date_range, group_by='cost_center', today=None):
+    """Average processing time in business days per cost center, city or finance user"""
+    start, end = get_report_date_range(date_range, today)
+
+    def load():
+        epv_ids = _reported_epv_ids(start, end)
+        if group_by == 'city':
+            averages = _average_processing_days(
+                effective_city(), epv_ids, joins=[(CostCenter, EPV.cost_center_id == CostCenter.id)]
+            )
+        elif group_by == 'finance_user':
+            averages = _average_processing_days(
+                EmployeeDetails.name, epv_ids, joins=[(EmployeeDetails, FinanceEntry.finance_user_id == EmployeeDetails.id)]
+            )
+        else:
+            averages = _average_processing_days(
+                CostCenter.costcenter, epv_ids, joins=[(CostCenter, EPV.cost_center_id == CostCenter.id)]
+            )
+
+        ranked = sorted(averages.items(), key=lambda item: item[1], reverse=True)
+        return {
+            'labels': [group or 'Unassigned' for group, _ in ranked],
+            'values': [round(days, 1) for _, days in ranked]
+        }
+
+    return _cached('processing_time', (start, end, group_by), load)
@@ -0,0 +1,106 @@
+"""
+Which finance staff are notified about an EPV.
+
+Finance Approvers are notified about every EPV; Finance users about the EPVs
+of the cities they are assigned to. An EPV's city is its own, else its cost
+center's.
+
+The routing table (Finance Approver emails, Finance user emails per city and
+the city of each cost center) is loaded with two queries and cached for
+FINANCE_ROUTING_TTL seconds, so finance_recipients() answers from memory.
+Call invalidate_finance_routing() after changing employees, city assignments
+or cost center cities.
+"""
+
+import os
+
+from cache import TTLCache
+from models import db, EmployeeDetails, CityAssignment, CostCenter
+
+# Other processes see staff and city changes after at most this many seconds
+FINANCE_ROUTING_TTL = int(os.environ.get('FINANCE_ROUTING_TTL', 300))
+
+_routing = TTLCache(maxsize=1, ttl=FINANCE_ROUTING_TTL)
+
+
+class FinanceRouting:
+    """Finance staff emails by role and city, and the city of each cost center"""
+
+    def __init__(self, approver_emails, emails_by_city, cost_center_cities):
+        self.approver_emails = approver_emails
+        self.emails_by_city = emails_by_city
+        self.cost_center_cities = cost_center_cities
+
+    def city_of(self, epv):
+        """City an EPV is routed by: its own, else its cost center's"""
+        if epv.city:
+            return epv.city
+        if epv.cost_center_id:
+            return self.cost_center_cities.get(epv.cost_center_id)
+        return None
+
+    def recipients(self, city):
+        """Emails of the Finance Approvers and the Finance users assigned to city"""
+        if not city:
+            return list(self.approver_emails)
+        return list(self.approver_emails) + [
+            email for email in self.emails_by_city.get(city, ()) if email not in self.approver_emails
+        ]
+
+
+def _load_routing():
+    rows = db.session.query(
+        EmployeeDetails.email, EmployeeDetails.role, CityAssignment.city
+    ).outerjoin(
+        CityAssignment, db.and_(
+            CityAssignment.employee_id == EmployeeDetails.id,
+            CityAssignment.is_active == True
+        )
+    ).filter(
+        EmployeeDetails.role.in_(['Finance', 'Finance Approver']),
+        EmployeeDetails.is_active == True
+    ).all()
+
+    approver_emails = []
+    emails_by_city = {}
+    for email, role, city in rows:
+        if role == 'Finance Approver':
+            if email not in approver_emails:
+                approver_emails.append(email)
+        elif city:
+            emails = emails_by_city.setdefault(city, [])
+            if email not in emails:
+                emails.append(email)
+
+    cost_center_cities = dict(
+        db.session.query(CostCenter.id, CostCenter.city).filter(CostCenter.city != None).all()
+    )
+    return FinanceRouting(
+        tuple(approver_emails),
+        {city: tuple(emails) for city, emails in emails_by_city.items()},
+        cost_center_cities
+    )
+
+
+def get_finance_routing():
+    """The routing table, from the cache if possible"""
+    return _routing.get_or_load('routing', _load_routing)
+
+
+def finance_recipients(epv):
+    """
+    Emails of the finance staff to notify about an EPV.
+
+    Args:
+        epv (EPV): The expense
+
+    Returns:
+        list: Finance Approver emails, then the Finance users of the EPV's city
+    """
+    routing = get_finance_routing()
+    return routing.recipients(routing.city_of(epv))
+
+
+def invalidate_finance_routing():
+    """Reload the routing table on next use"""
+    _routing.clear()
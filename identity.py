@@ -0,0 +1,137 @@
+"""
+Identity of the logged-in employee.
+
+get_identity() returns the current employee's details, role, assigned cities
+and the ids of the cost centers in those cities. It is loaded once per
+request (kept on flask.g) and cached across requests for IDENTITY_CACHE_TTL
+seconds, so routes no longer query employee_details and city_assignment
+themselves. Call invalidate_identity() after changing an employee or their
+city assignments.
+
+The cache holds plain values, not ORM instances; Identity.employee attaches
+an EmployeeDetails to the current session without querying the database.
+"""
+
+import os
+
+from flask import g, has_app_context, session
+from sqlalchemy.orm import make_transient_to_detached
+
+from cache import TTLCache
+from models import db, EmployeeDetails, CityAssignment, CostCenter
+
+# Other processes see employee and city changes after at most this many seconds
+IDENTITY_CACHE_TTL = int(os.environ.get('IDENTITY_CACHE_TTL', 300))
+IDENTITY_CACHE_SIZE = int(os.environ.get('IDENTITY_CACHE_SIZE', 1024))
+
+EMPLOYEE_COLUMNS = ('id', 'email', 'employee_id', 'manager', 'manager_name', 'name', 'role', 'is_active')
+
+_identities = TTLCache(maxsize=IDENTITY_CACHE_SIZE, ttl=IDENTITY_CACHE_TTL)
+_emails_by_id = TTLCache(maxsize=IDENTITY_CACHE_SIZE, ttl=IDENTITY_CACHE_TTL)
+
+
+class Identity:
+    """Cached details of an employee and their city scope"""
+
+    def __init__(self, values, assigned_cities, assigned_cost_center_ids):
+        self.values = values
+        self.assigned_cities = assigned_cities
+        self.assigned_cost_center_ids = assigned_cost_center_ids
+
+    def __getattr__(self, name):
+        # id, email, name, role, manager... as on EmployeeDetails
+        try:
+            return self.__dict__['values'][name]
+        except KeyError:
+            raise AttributeError(name)
+
+    @property
+    def employee(self):
+        """EmployeeDetails of this identity, attached to the current session"""
+        employee = EmployeeDetails(**self.values)
+        make_transient_to_detached(employee)
+        return db.session.merge(employee, load=False)
+
+
+def _load_identity(email):
+    employee = db.session.query(*[getattr(EmployeeDetails, c) for c in EMPLOYEE_COLUMNS]).filter(
+        EmployeeDetails.email == email
+    ).first()
+    if not employee:
+        return None
+
+    assigned_cities = [city for (city,) in db.session.query(CityAssignment.city).filter(
+        CityAssignment.employee_id == employee.id,
+        CityAssignment.is_active == True
+    ).all() if city]
+
+    assigned_cost_center_ids = []
+    if assigned_cities:
+        assigned_cost_center_ids = [cc_id for (cc_id,) in db.session.query(CostCenter.id).filter(
+            CostCenter.city.in_(assigned_cities)
+        ).all()]
+
+    return Identity(dict(employee._mapping), tuple(assigned_cities), tuple(assigned_cost_center_ids))
+
+
+def load_identity(email):
+    """
+    Identity of an employee by email, from the cache if possible.
+
+    Returns:
+        Identity, or None if there is no employee with this email
+    """
+    if not email:
+        return None
+    identity = _identities.get_or_load(email, lambda: _load_identity(email))
+    if identity:
+        _emails_by_id.set(identity.id, email)
+    return identity
+
+
+def get_identity():
+    """
+    Identity of the logged-in employee for this request.
+
+    Returns:
+        Identity, or None if nobody is logged in or the employee does not exist
+    """
+    email = session.get('email')
+    cached = g.get('identity')
+    if cached is not None and cached.email == email:
+        return cached
+
+    identity = load_identity(email)
+    g.identity = identity
+    return identity
+
+
+def load_employee(employee_pk):
+    """
+    EmployeeDetails by primary key for the login manager, without a query when cached.
+
+    Returns:
+        EmployeeDetails attached to the current session, or None
+    """
+    email = _emails_by_id.get(employee_pk)
+    if email is None:
+        email = db.session.query(EmployeeDetails.email).filter(EmployeeDetails.id == employee_pk).scalar()
+    identity = load_identity(email)
+    return identity.employee if identity else None
+
+
+def invalidate_identity(email=None):
+    """
+    Drop cached identities after an employee or their city assignments change.
+
+    Args:
+        email (str): Employee whose identity changed, or None to drop all
+            (e.g. when an email address or cost center city changed)
+    """
+    if email:
+        _identities.invalidate(email)
+    else:
+        _identities.clear()
+        _emails_by_id.clear()
+    if has_app_context():
+        g.pop('identity', None)
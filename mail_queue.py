@@ -0,0 +1,224 @@
+"""
+Background delivery queue for outgoing email.
+
+send_message() stores the message in the outgoing_email table and returns
+immediately; a daemon worker thread delivers queued messages over the pooled
+SMTP connection and retries failures with exponential backoff. Because the
+queue lives in the database, messages queued before a restart are still sent.
+"""
+
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+from models import db, OutgoingEmail
+
+logger = logging.getLogger(__name__)
+
+# Retry schedule: RETRY_BASE_SECONDS * 2 ** (attempt - 1), capped at RETRY_MAX_SECONDS
+MAX_ATTEMPTS = 6
+RETRY_BASE_SECONDS = 30
+RETRY_MAX_SECONDS = 60 * 60
+
+# Seconds the worker sleeps when the queue is empty (it is woken early on enqueue)
+POLL_INTERVAL_SECONDS = 15
+
+# Rows claimed per worker pass
+CLAIM_BATCH_SIZE = 20
+
+# A message left in 'sending' this long (worker died mid-send) is retried
+STALE_SENDING_SECONDS = 10 * 60
+
+_worker_thread = None
+_ready = threading.Event()
+_wakeup = threading.Event()
+_stopping = threading.Event()
+_app = None
+
+
+def is_worker_running():
+    """True if the background worker of this process is alive and accepting messages"""
+    return _ready.is_set() and _worker_thread is not None and _worker_thread.is_alive()
+
+
+def retry_delay(attempts):
+    """Seconds to wait before the next delivery attempt"""
+    return min(RETRY_BASE_SECONDS * 2 ** max(attempts - 1, 0), RETRY_MAX_SECONDS)
+
+
+def enqueue_email(sender, to, subject, html_content):
+    """
+    Queue an email for background delivery.
+
+    The row is inserted and committed on its own connection, so the caller's
+    session transaction is left untouched.
+
+    Returns:
+        int: Id of the queued outgoing_email row
+    """
+    table = OutgoingEmail.__table__
+    with _app.app_context():
+        with db.engine.begin() as conn:
+            result = conn.execute(table.insert().values(
+                sender=sender,
+                recipient=to,
+                subject=subject,
+                html_content=html_content,
+                status='pending',
+                attempts=0,
+                next_attempt_at=datetime.now(),
+                created_at=datetime.now()
+            ))
+            email_id = result.inserted_primary_key[0]
+
+    logger.debug("Queued email %s to %s: %s", email_id, to, subject)
+    _wakeup.set()
+    return email_id
+
+
+def _claim_due_emails(conn, now):
+    """
+    Claim up to CLAIM_BATCH_SIZE due messages.
+
+    Each row is claimed with a conditional UPDATE, so when several app
+    processes run a worker only one of them sends a given message.
+    """
+    table = OutgoingEmail.__table__
+
+    # Messages stuck in 'sending' belong to a worker that died
+    conn.execute(table.update().where(
+        table.c.status == 'sending',
+        table.c.next_attempt_at < now - timedelta(seconds=STALE_SENDING_SECONDS)
+    ).values(status='pending'))
+
+    candidates = conn.execute(
+        db.select(table.c.id)
+        .where(table.c.status == 'pending', table.c.next_attempt_at <= now)
+        .order_by(table.c.next_attempt_at, table.c.id)
+        .limit(CLAIM_BATCH_SIZE)
+    ).scalars().all()
+
+    claimed = []
+    for email_id in candidates:
+        result = conn.execute(table.update().where(
+            table.c.id == email_id,
+            table.c.status == 'pending'
+        ).values(status='sending', next_attempt_at=now))
+        if result.rowcount:
+            claimed.append(email_id)
+
+    if not claimed:
+        return []
+    return conn.execute(db.select(table).where(table.c.id.in_(claimed)).order_by(table.c.id)).all()
+
+
+def _record_result(email, success, message):
+    table = OutgoingEmail.__table__
+    attempts = email.attempts + 1
+
+    if success:
+        values = {'status': 'sent', 'attempts': attempts, 'sent_at': datetime.now(), 'last_error': None}
+    elif attempts >= MAX_ATTEMPTS:
+        logger.error("Giving up on email %s to %s after %s attempts: %s", email.id, email.recipient, attempts, message)
+        values = {'status': 'failed', 'attempts': attempts, 'last_error': message}
+    else:
+        delay = retry_delay(attempts)
+        logger.debug("Email %s failed (attempt %s), retrying in %ss: %s", email.id, attempts, delay, message)
+        values = {
+            'status': 'pending',
+            'attempts': attempts,
+            'last_error': message,
+            'next_attempt_at': datetime.now() + timedelta(seconds=delay)
+        }
+
+    with db.engine.begin() as conn:
+        conn.execute(table.update().where(table.c.id == email.id).values(**values))
+
+
+def process_queue():
+    """
+    Deliver all messages that are currently due.
+
+    Must be called inside an application context.
+
+    Returns:
+        int: Number of messages attempted
+    """
+    from smtp_email_utils import deliver_message
+
+    attempted = 0
+    while not _stopping.is_set():
+        with db.engine.begin() as conn:
+            emails = _claim_due_emails(conn, datetime.now())
+        if not emails:
+            break
+
+        for email in emails:
+            try:
+                success, message = deliver_message(email.sender, email.recipient, email.subject, email.html_content)
+            except Exception as e:
+                success, message = False, str(e)
+            _record_result(email, success, message)
+            attempted += 1
+
+    return attempted
+
+
+def _worker_loop():
+    # Until the table exists send_message keeps delivering inline
+    while not _stopping.is_set():
+        try:
+            with _app.app_context():
+                OutgoingEmail.__table__.create(db.engine, checkfirst=True)
+            break
+        except Exception as e:
+            logger.error("Could not create outgoing_email table: %s", e)
+            _stopping.wait(POLL_INTERVAL_SECONDS)
+    if _stopping.is_set():
+        return
+    _ready.set()
+
+    logger.debug("Mail queue worker started")
+    while not _stopping.is_set():
+        try:
+            with _app.app_context():
+                process_queue()
+        except Exception as e:
+            logger.exception("Mail queue worker error: %s", e)
+            time.sleep(POLL_INTERVAL_SECONDS)
+
+        _wakeup.wait(POLL_INTERVAL_SECONDS)
+        _wakeup.clear()
+
+
+def start_mail_worker(app):
+    """
+    Start the background delivery worker for this process (idempotent).
+
+    Args:
+        app: Flask application, used for the database configuration
+    """
+    global _worker_thread, _app
+
+    if _worker_thread is not None and _worker_thread.is_alive():
+        return _worker_thread
+
+    _app = app
+    _stopping.clear()
+    _ready.clear()
+    _worker_thread = threading.Thread(target=_worker_loop, name='mail-queue-worker', daemon=True)
+    _worker_thread.start()
+    return _worker_thread
+
+
+def stop_mail_worker(timeout=None):
+    """Stop the worker after its current message and close pooled connections"""
+    from smtp_email_utils import smtp_pool
+
+    _stopping.set()
+    _ready.clear()
+    _wakeup.set()
+    if _worker_thread is not None:
+        _worker_thread.join(timeout)
+    smtp_pool.close_all()
@@ -1,11 +1,17 @@
+import logging
+
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy import inspect
 from datetime import datetime
 from flask_login import UserMixin
+
+import session_changes
 # Removed OAuth imports since we're not using OAuth storage anymore
 
 db = SQLAlchemy()
 
+logger = logging.getLogger(__name__)
+
 class CostCenter(db.Model):
     __tablename__ = 'costcenter'
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
@@ -28,6 +34,7 @@ class EmployeeDetails(UserMixin, db.Model):
     name = db.Column(db.String(100), nullable=True)
     role = db.Column(db.String(50), nullable=True)  # 'Super Admin', 'School Admin', 'Central Admin', 'Pune Staff', 'Mumbai Staff', 'Finance', 'Finance Approver'
     is_active = db.Column(db.Boolean, default=True)
+    notification_mode = db.Column(db.String(20), nullable=True)  # 'immediate' or 'digest'; None follows the notification_mode setting
 
     # Relationship with assigned cities (for Finance personnel)
     city_assignments = db.relationship('CityAssignment', foreign_keys='CityAssignment.employee_id', backref='employee', lazy=True)
@@ -234,6 +241,10 @@ class EPVApproval(db.Model):
     Model to store approval status for each approver of an EPV
     """
     __tablename__ = 'epv_approval'
+    __table_args__ = (
+        # Approver inbox: an approver's pending approvals
+        db.Index('idx_epv_approval_inbox', 'approver_email', 'status', 'epv_id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     epv_id = db.Column(db.Integer, db.ForeignKey('epv.id'), nullable=False)
@@ -356,6 +367,172 @@ class SupplementaryDocument(db.Model):
     def __repr__(self):
         return f"<SupplementaryDocument {self.id} for EPV {self.epv_id}>"
 
+class EPVDailySummary(db.Model):
+    """
+    Pre-aggregated EPV scorecard rollup, one row per
+    (submission day, cost center, city, status, expense head, approval month).
+    Maintained by epv_summary on every flush that touches an EPV.
+    """
+    __tablename__ = 'epv_daily_summary'
+    __table_args__ = (
+        db.Index('idx_epv_summary_bucket', 'summary_date', 'cost_center_id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    # Dimensions
+    summary_date = db.Column(db.Date, nullable=False)  # EPV submission day
+    cost_center_id = db.Column(db.Integer, nullable=True, index=True)
+    city = db.Column(db.String(50), nullable=False, default='')
+    status = db.Column(db.String(20), nullable=False, default='', index=True)
+    expense_head = db.Column(db.String(100), nullable=False, default='')  # '' = all expense heads
+    approved_month = db.Column(db.String(7), nullable=False, default='')  # YYYY-MM of approved_on for approved EPVs
+
+    # Measures
+    epv_count = db.Column(db.Integer, nullable=False, default=0)
+    total_amount = db.Column(db.Float, nullable=False, default=0.0)
+    processed_count = db.Column(db.Integer, nullable=False, default=0)  # Approved, finance-processed and paid
+    processing_days_total = db.Column(db.Integer, nullable=False, default=0)  # Sum of business days to payment
+
+    updated_at = db.Column(db.DateTime, default=datetime.now)
+
+    def __repr__(self):
+        return f"<EPVDailySummary {self.summary_date} {self.cost_center_id} {self.status}>"
+
+class EPVSummaryDirtyBucket(db.Model):
+    """
+    epv_daily_summary bucket (submission day, cost center) whose refresh
+    failed. Recomputed by epv_summary.refresh_dirty_buckets() before the
+    dashboard scorecards read the rollup.
+    """
+    __tablename__ = 'epv_summary_dirty_bucket'
+
+    id = db.Column(db.Integer, primary_key=True)
+    summary_date = db.Column(db.Date, nullable=False)
+    cost_center_id = db.Column(db.Integer, nullable=True)
+    marked_at = db.Column(db.DateTime, default=datetime.now)
+
+    def __repr__(self):
+        return f"<EPVSummaryDirtyBucket {self.summary_date} {self.cost_center_id}>"
+
+class OutgoingEmail(db.Model):
+    """
+    Outgoing email queued for background delivery by mail_queue.
+    Failed sends are retried with exponential backoff until max attempts.
+    """
+    __tablename__ = 'outgoing_email'
+    __table_args__ = (
+        db.Index('idx_outgoing_email_due', 'status', 'next_attempt_at'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    sender = db.Column(db.String(255), nullable=False)
+    recipient = db.Column(db.Text, nullable=False)
+    subject = db.Column(db.String(500), nullable=False)
+    html_content = db.Column(db.Text(length=16777215), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending, sending, sent, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    sent_at = db.Column(db.DateTime, nullable=True)
+
+    def __repr__(self):
+        return f"<OutgoingEmail {self.id} {self.status} to {self.recipient}>"
+
+class NotificationDigestItem(db.Model):
+    """
+    Notification waiting for its recipient's next digest email, sent by
+    notification_digest. At most one per recipient, EPV and allocation; rows
+    are deleted once the digest is sent.
+    """
+    __tablename__ = 'notification_digest_item'
+    __table_args__ = (
+        db.UniqueConstraint('recipient', 'epv_id', 'allocation_id', name='uq_notification_digest_item'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    recipient = db.Column(db.String(100), nullable=False, index=True)
+    # No foreign key: items are written on their own connection while the caller's
+    # transaction may still hold a lock on the EPV row
+    epv_id = db.Column(db.Integer, nullable=False)
+    kind = db.Column(db.String(30), nullable=False)  # approval, split_allocation, supplementary_document
+    token = db.Column(db.String(100), nullable=True)  # Approval or allocation token for the record link
+    allocation_id = db.Column(db.Integer, nullable=False, default=0)  # Split invoice allocation; 0 for other items
+    detail = db.Column(db.String(255), nullable=True)  # e.g. the uploaded document's file name
+    base_url = db.Column(db.String(255), nullable=True)  # Base URL of the links, from the request that queued it
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    claimed_at = db.Column(db.DateTime, nullable=True, index=True)  # Set while a digest containing it is sent
+
+    def __repr__(self):
+        return f"<NotificationDigestItem {self.kind} EPV {self.epv_id} for {self.recipient}>"
+
+class DocumentJob(db.Model):
+    """
+    Background job building the document of a new expense: generate the
+    expense PDF, convert and merge the receipts, upload to Google Drive and
+    create the EPV. Run by document_jobs.
+    """
+    __tablename__ = 'document_jobs'
+
+    id = db.Column(db.String(32), primary_key=True)  # Job ID returned to the browser
+    epv_id = db.Column(db.String(50), nullable=False, index=True)  # EPV created when the job completes
+    email = db.Column(db.String(100), nullable=False, index=True)  # Submitter
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, processing, completed, failed
+    stage = db.Column(db.String(50), nullable=True)  # Current step, shown while polling
+    progress = db.Column(db.Integer, nullable=False, default=0)  # Percentage
+    upload_dir = db.Column(db.String(500), nullable=True)  # Where the uploaded receipts are kept until processed
+    payload = db.Column(db.Text, nullable=False)  # JSON form data needed to build the document and EPV
+    result = db.Column(db.Text, nullable=True)  # JSON: Drive file, warnings
+    message = db.Column(db.Text, nullable=True)  # User-facing message
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
+    completed_at = db.Column(db.DateTime, nullable=True)
+
+    def __repr__(self):
+        return f"<DocumentJob {self.id} {self.status} {self.epv_id}>"
+
+# Models whose changes affect the epv_daily_summary rollup of their EPV
+SUMMARY_CHILD_MODELS = (EPVItem, EPVApproval, EPVAllocation, FinanceEntry)
+
+def refresh_epv_daily_summary(flushed, objects, changes):
+    """Recompute the rollup buckets touched by this flush, in the same transaction"""
+    session = flushed.session
+    buckets = set()
+    child_epv_ids = set()
+
+    for obj in objects:
+        if isinstance(obj, EPV):
+            state = inspect(obj)
+            old_dates = state.attrs.submission_date.history.deleted or [obj.submission_date]
+            old_cost_centers = state.attrs.cost_center_id.history.deleted or [obj.cost_center_id]
+            buckets.add((obj.submission_date, obj.cost_center_id))
+            buckets.add((old_dates[0], old_cost_centers[0]))
+        elif obj.epv_id is not None:
+            child_epv_ids.add(obj.epv_id)
+
+    if not buckets and not child_epv_ids:
+        return
+
+    from epv_summary import refresh_buckets, buckets_for_epv_ids, mark_buckets_dirty
+    connection = session.connection()
+    try:
+        with connection.begin_nested():
+            buckets |= buckets_for_epv_ids(connection, child_epv_ids)
+            refresh_buckets(connection, buckets)
+    except Exception:
+        # Never fail the EPV transaction because of the rollup; the buckets are
+        # recomputed the next time the scorecards read it
+        logger.exception("Error refreshing EPV daily summary")
+        try:
+            with connection.begin_nested():
+                mark_buckets_dirty(connection, buckets, child_epv_ids)
+        except Exception:
+            logger.exception("Error marking EPV daily summary buckets dirty; run rebuild_epv_summary.py")
+
+session_changes.register('epv_daily_summary', (EPV,) + SUMMARY_CHILD_MODELS, refresh_epv_daily_summary)
+
 # User and OAuth models removed - using EmployeeDetails for Flask-Login instead
 
 # Sync function removed - no longer needed since we use EmployeeDetails directly for authentication
@@ -369,6 +546,16 @@ def init_db(app):
 
         inspector = inspect(db.engine)
 
+        # Add the notification preference column to an existing employee_details table
+        # (before the first query of EmployeeDetails, which selects it)
+        if inspector.has_table('employee_details'):
+            columns = [col['name'] for col in inspector.get_columns('employee_details')]
+            if 'notification_mode' not in columns:
+                print("Adding notification_mode column to employee_details table")
+                with db.engine.connect() as conn:
+                    conn.execute(db.text('ALTER TABLE employee_details ADD COLUMN notification_mode VARCHAR(20)'))
+                    conn.commit()
+
         # Initialize cost centers if the table is empty
         if not inspector.has_table('costcenter') or CostCenter.query.count() == 0:
             # List of cost centers to add
@@ -531,6 +718,16 @@ def init_db(app):
                     "setting_name": "max_days_processing",
                     "setting_value": "5",
                     "description": "Maximum number of days for processing expenses (SOP)"
+                },
+                {
+                    "setting_name": "notification_mode",
+                    "setting_value": "immediate",
+                    "description": "Approval and finance notification emails: immediate, or one daily digest"
+                },
+                {
+                    "setting_name": "digest_hour",
+                    "setting_value": "8",
+                    "description": "Hour of the day (0-23) at which daily digest emails are sent"
                 }
             ]
 
@@ -649,3 +846,12 @@ def init_db(app):
                         conn.commit()
                 else:
                     print(f"{field_name} column already exists in finance_entry table")
+
+        # Add the approver inbox index to an existing epv_approval table
+        if inspector.has_table('epv_approval'):
+            indexes = [index['name'] for index in inspector.get_indexes('epv_approval')]
+            if 'idx_epv_approval_inbox' not in indexes:
+                print("Adding idx_epv_approval_inbox index to epv_approval table")
+                for index in EPVApproval.__table__.indexes:
+                    if index.name == 'idx_epv_approval_inbox':
+                        index.create(bind=db.engine)
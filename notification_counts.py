@@ -0,0 +1,176 @@
+"""
+Notification badge counts.
+
+get_notification_counts() computes every count shown in the navigation bar
+for a user in a single SELECT (one scalar subquery per count) and caches the
+result per user for NOTIFICATION_CACHE_TTL seconds. Both /api/notifications
+and /api/notifications/count are served from it.
+
+Committed changes to EPVs, approvals and finance entries invalidate the
+counts they affect: the submitter's and approver's counts directly (and,
+when an EPV's status changes, the counts of every approver it is still
+pending with), and the counts of all finance users by moving to a new
+finance generation.
+"""
+
+import os
+import threading
+
+from sqlalchemy import func, select, literal, inspect
+
+import session_changes
+from cache import TTLCache
+from city_scope import in_cities
+from models import db, EPV, EPVApproval, FinanceEntry
+
+NOTIFICATION_CACHE_TTL = int(os.environ.get('NOTIFICATION_CACHE_TTL', 60))
+NOTIFICATION_CACHE_SIZE = 1024
+
+FINANCE_ROLES = ('Finance', 'Finance Approver')
+
+_counts = TTLCache(maxsize=NOTIFICATION_CACHE_SIZE, ttl=NOTIFICATION_CACHE_TTL)
+_finance_generation = 0
+_generation_lock = threading.Lock()
+
+
+def _count(query):
+    return select(func.count()).select_from(query.subquery()).scalar_subquery()
+
+
+def _load_counts(email, role, city_names):
+    columns = [
+        # EPVs this user submitted that are waiting for approval
+        _count(select(EPV.id).where(
+            EPV.email_id == email,
+            EPV.status == 'pending_approval'
+        )).label('pending_submitted'),
+        # EPVs waiting for this user's approval
+        _count(select(EPVApproval.id).join(EPV, EPVApproval.epv_id == EPV.id).where(
+            EPVApproval.approver_email == email,
+            EPVApproval.status == 'pending',
+            EPV.status.in_(['pending_approval', 'partially_approved'])
+        )).label('manager_approval'),
+    ]
+
+    if role == 'Finance' and city_names:
+        # EPVs ready for finance processing in the assigned cities
+        columns.append(_count(select(EPV.id).where(
+            EPV.status == 'approved',
+            db.or_(EPV.finance_status == 'pending', EPV.finance_status == None),
+            in_cities(city_names)
+        )).label('finance_pending'))
+    else:
+        columns.append(literal(0).label('finance_pending'))
+
+    if role == 'Finance Approver':
+        # Finance entries waiting for approval, as on the finance dashboard
+        query = select(FinanceEntry.id).join(EPV, FinanceEntry.epv_id == EPV.id).where(
+            FinanceEntry.status == 'pending',
+            EPV.finance_status == 'processed',
+            in_cities(city_names)
+        )
+        columns.append(_count(query).label('finance_approval'))
+    else:
+        columns.append(literal(0).label('finance_approval'))
+
+    row = db.session.execute(select(*columns)).one()
+    return dict(row._mapping)
+
+
+def get_notification_counts(identity, role):
+    """
+    Notification counts of a user, from the cache if possible.
+
+    Args:
+        identity (Identity): Logged-in employee (see identity.get_identity)
+        role (str): Employee role from the session
+
+    Returns:
+        dict: pending_submitted, manager_approval, finance_pending, finance_approval
+    """
+    city_names = tuple(identity.assigned_cities)
+    key = (identity.email, role, city_names, _finance_generation if role in FINANCE_ROLES else None)
+    return _counts.get_or_load(key, lambda: _load_counts(identity.email, role, list(city_names)))
+
+
+def invalidate_notification_counts(emails=(), finance=False):
+    """
+    Drop cached counts after a change.
+
+    Args:
+        emails: Users whose own counts changed
+        finance (bool): True if counts of finance users may have changed
+    """
+    global _finance_generation
+    if finance:
+        # Finance entries of older generations are never read again and age out of the cache
+        with _generation_lock:
+            _finance_generation += 1
+    if emails:
+        emails = set(emails)
+        _counts.invalidate_where(lambda key: key[0] in emails)
+
+
+def collect_notification_changes(flushed, objects, changes):
+    """Remember whose counts this flush changed until the transaction commits"""
+    # EPVs whose status changed drop out of (or into) their approvers' manager_approval counts
+    status_changed = set()
+    for obj in objects:
+        if isinstance(obj, EPV):
+            changes['emails'].add(obj.email_id)
+            changes['finance'] = True
+            if obj.id is not None and (flushed.is_deleted(obj) or inspect(obj).attrs.status.history.has_changes()):
+                status_changed.add(obj.id)
+        elif isinstance(obj, EPVApproval):
+            changes['emails'].add(obj.approver_email)
+        elif isinstance(obj, FinanceEntry):
+            changes['finance'] = True
+
+    if status_changed:
+        changes['emails'].update(flushed.session.execute(
+            select(EPVApproval.approver_email).where(
+                EPVApproval.epv_id.in_(status_changed),
+                EPVApproval.status == 'pending'
+            ).distinct()
+        ).scalars())
+
+
+def invalidate_committed_changes(changes):
+    invalidate_notification_counts(changes['emails'], changes['finance'])
+
+
+session_changes.register(
+    'notification_changes', (EPV, EPVApproval, FinanceEntry),
+    collect_notification_changes, invalidate_committed_changes,
+    pending=lambda: {'emails': set(), 'finance': False}
+)
+
+
+def notification_details(counts):
+    """Count endpoint details of the non-zero counts"""
+    details = []
+    if counts['pending_submitted']:
+        details.append({
+            'type': 'pending_approval',
+            'count': counts['pending_submitted'],
+            'message': f"You have {counts['pending_submitted']} expense(s) pending approval"
+        })
+    if counts['manager_approval']:
+        details.append({
+            'type': 'manager_approval',
+            'count': counts['manager_approval'],
+            'message': f"You have {counts['manager_approval']} expense(s) to approve"
+        })
+    if counts['finance_pending']:
+        details.append({
+            'type': 'finance_pending',
+            'count': counts['finance_pending'],
+            'message': f"You have {counts['finance_pending']} expense(s) to process"
+        })
+    if counts['finance_approval']:
+        details.append({
+            'type': 'finance_approval',
+            'count': counts['finance_approval'],
+            'message': f"You have {counts['finance_approval']} finance entries to approve"
+        })
+    return details
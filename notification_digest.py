@@ -0,0 +1,348 @@
+"""
+Daily digest of approval and finance notification emails.
+
+A recipient in digest mode (the notification_mode finance setting, or the
+employee's own notification_mode, which overrides it) gets no email per EPV.
+add_to_digest() stores the notification as a NotificationDigestItem instead,
+at most one per recipient, EPV and allocation, so an EPV sent for approval
+twice is only listed once while each allocation of a split EPV keeps its own
+link. Every day after the digest_hour setting, a background thread
+sends each recipient one email with all their outstanding approve/reject
+links and uploaded documents, then deletes the items. Approvals and
+allocations decided in the meantime are left out.
+
+Only one app process sends a day's digests: it claims the day by updating
+the digest_last_sent setting with a conditional UPDATE, and each recipient's
+items are claimed the same way before they are sent. A notification that
+arrives for a claimed item releases the claim, so the item survives the
+digest being sent and goes out with the next one. Digests are sent with
+send_message(), so the mail queue delivers and retries them.
+"""
+
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy.exc import IntegrityError
+
+from models import db, EPV, EPVApproval, EPVAllocation, EmployeeDetails, SettingsFinance, NotificationDigestItem
+
+logger = logging.getLogger(__name__)
+
+DIGEST_CHECK_SECONDS = int(os.environ.get('DIGEST_CHECK_SECONDS', 300))
+
+DEFAULT_NOTIFICATION_MODE = 'immediate'
+DEFAULT_DIGEST_HOUR = 8
+NOTIFICATION_MODES = ('immediate', 'digest')
+
+# Items claimed this long ago that still exist (the sender died mid-send) are sent again
+STALE_CLAIM_SECONDS = 10 * 60
+
+_app = None
+_scheduler_thread = None
+_stopping = threading.Event()
+
+
+def _setting(name, default):
+    setting = SettingsFinance.query.filter_by(setting_name=name).first()
+    return setting.setting_value if setting and setting.setting_value else default
+
+
+def digest_hour():
+    """Hour of the day after which the daily digests are sent"""
+    try:
+        hour = int(_setting('digest_hour', DEFAULT_DIGEST_HOUR))
+    except ValueError:
+        return DEFAULT_DIGEST_HOUR
+    return hour if 0 <= hour <= 23 else DEFAULT_DIGEST_HOUR
+
+
+def digest_recipients(emails):
+    """
+    Which of these recipients get a daily digest instead of individual emails.
+
+    Args:
+        emails (list): Recipient emails
+
+    Returns:
+        set: The emails in digest mode
+    """
+    emails = {email for email in emails if email}
+    if not emails:
+        return set()
+
+    # Callers are often mid-transaction; flushing their changes here would hold
+    # locks that add_to_digest()'s own connection then waits for
+    with db.session.no_autoflush:
+        default_mode = _setting('notification_mode', DEFAULT_NOTIFICATION_MODE)
+        modes = {
+            email.lower(): mode
+            for email, mode in db.session.query(EmployeeDetails.email, EmployeeDetails.notification_mode).filter(
+                EmployeeDetails.email.in_(emails | {email.lower() for email in emails})
+            ).all()
+        }
+    return {email for email in emails if (modes.get(email.lower()) or default_mode) == 'digest'}
+
+
+def add_to_digest(recipient, epv, kind, base_url=None, token=None, allocation_id=None, detail=None):
+    """
+    Hold a notification for the recipient's next digest.
+
+    The row is written on its own connection, so the caller's session
+    transaction is left untouched.
+
+    Args:
+        recipient (str): Recipient email
+        epv (EPV): The EPV the notification is about
+        kind (str): 'approval', 'split_allocation' or 'supplementary_document'
+        base_url (str): Base URL of the links in the digest
+        token (str): Approval or allocation token of the record link
+        allocation_id (int): Allocation of a split invoice approval
+        detail (str): Shown with the item, e.g. a document's file name
+
+    Returns:
+        bool: True if added, False if the recipient's digest already lists the
+            EPV (or allocation); the entry then keeps the latest link
+    """
+    table = NotificationDigestItem.__table__
+    key = {'recipient': recipient, 'epv_id': epv.id, 'allocation_id': allocation_id or 0}
+    values = {'kind': kind, 'token': token, 'detail': detail, 'base_url': base_url}
+
+    try:
+        with db.engine.begin() as conn:
+            conn.execute(table.insert().values(created_at=datetime.now(), **key, **values))
+        logger.debug("Added %s of %s to the digest of %s", kind, epv.epv_id, recipient)
+        return True
+    except IntegrityError:
+        pass
+
+    # Releasing a claim keeps a digest being sent right now from deleting the
+    # item (see _send_digest); it goes out again with the next digest
+    with db.engine.begin() as conn:
+        conn.execute(table.update().where(*[table.c[name] == value for name, value in key.items()]).values(
+            claimed_at=None, **values
+        ))
+    logger.debug("%s is already in the digest of %s", epv.epv_id, recipient)
+    return False
+
+
+def _claim_day(today):
+    """Claim sending the digests of today; False if another process already did"""
+    table = SettingsFinance.__table__
+    value = today.isoformat()
+    with db.engine.begin() as conn:
+        claimed = conn.execute(table.update().where(
+            table.c.setting_name == 'digest_last_sent',
+            table.c.setting_value != value
+        ).values(setting_value=value, updated_on=datetime.now())).rowcount
+    if claimed:
+        return True
+
+    try:
+        with db.engine.begin() as conn:
+            conn.execute(table.insert().values(
+                setting_name='digest_last_sent',
+                setting_value=value,
+                description='Date the daily notification digests were last sent',
+                updated_on=datetime.now()
+            ))
+        return True
+    except IntegrityError:
+        # Already sent today, or another process created the setting first
+        return False
+
+
+def _claim_items(recipient):
+    """
+    Claim the recipient's unclaimed items.
+
+    Returns:
+        list: The claimed NotificationDigestItem records
+    """
+    table = NotificationDigestItem.__table__
+    # Whole seconds: MySQL DATETIME drops microseconds, and the claim is matched on this value
+    claimed_at = datetime.now().replace(microsecond=0)
+    with db.engine.begin() as conn:
+        claimed = conn.execute(table.update().where(
+            table.c.recipient == recipient,
+            table.c.claimed_at == None
+        ).values(claimed_at=claimed_at)).rowcount
+    if not claimed:
+        return []
+    return NotificationDigestItem.query.filter_by(recipient=recipient, claimed_at=claimed_at).order_by(
+        NotificationDigestItem.created_at, NotificationDigestItem.id
+    ).all()
+
+
+def _outstanding_entries(items):
+    """
+    Digest entries of the items whose approval or allocation is still pending.
+
+    Returns:
+        tuple: approvals, allocations and documents, lists of dicts with the
+            EPV and the item (and its allocation)
+    """
+    epvs = {epv.id: epv for epv in EPV.query.filter(EPV.id.in_({item.epv_id for item in items})).all()}
+
+    tokens = [item.token for item in items if item.kind == 'approval' and item.token]
+    pending_tokens = set()
+    if tokens:
+        pending_tokens = {
+            token for (token,) in db.session.query(EPVApproval.token).filter(
+                EPVApproval.token.in_(tokens),
+                EPVApproval.status == 'pending'
+            ).all()
+        }
+
+    allocation_ids = [item.allocation_id for item in items if item.kind == 'split_allocation' and item.allocation_id]
+    pending_allocations = {}
+    if allocation_ids:
+        pending_allocations = {
+            allocation.id: allocation
+            for allocation in EPVAllocation.query.filter(
+                EPVAllocation.id.in_(allocation_ids),
+                EPVAllocation.status == 'pending'
+            ).all()
+        }
+
+    approvals, allocations, documents = [], [], []
+    for item in items:
+        epv = epvs.get(item.epv_id)
+        if epv is None:
+            continue
+        if item.kind == 'approval' and item.token in pending_tokens:
+            approvals.append({'epv': epv, 'item': item})
+        elif item.kind == 'split_allocation' and item.allocation_id in pending_allocations:
+            allocations.append({'epv': epv, 'item': item, 'allocation': pending_allocations[item.allocation_id]})
+        elif item.kind == 'supplementary_document':
+            documents.append({'epv': epv, 'item': item})
+    return approvals, allocations, documents
+
+
+def _send_digest(recipient):
+    """
+    Send one recipient's digest and delete its items.
+
+    Returns:
+        bool: True if a digest email was sent
+    """
+    from email_templates import render_email
+    from smtp_email_utils import send_message
+
+    items = _claim_items(recipient)
+    if not items:
+        return False
+
+    approvals, allocations, documents = _outstanding_entries(items)
+    sent = False
+    count = len(approvals) + len(allocations) + len(documents)
+    if count:
+        base_url = next((item.base_url for item in items if item.base_url), '')
+        html_content = render_email(
+            'notification_digest.html',
+            approvals=approvals,
+            allocations=allocations,
+            documents=documents,
+            base_url=base_url
+        )
+        sender_email = os.environ.get('SMTP_USERNAME', "expense.system@akanksha.org")
+        subject = f"Expense System Daily Digest: {count} item(s) for you"
+        success, message = send_message(sender_email, recipient, subject, html_content)
+        if not success:
+            # Leave the items claimed; once the claim is stale they go out with the next digests
+            logger.error("Failed to send the digest to %s: %s", recipient, message)
+            return False
+        sent = True
+
+    # Items whose claim was released by a newer notification meanwhile are kept
+    table = NotificationDigestItem.__table__
+    with db.engine.begin() as conn:
+        conn.execute(table.delete().where(
+            table.c.id.in_([item.id for item in items]),
+            table.c.claimed_at == items[0].claimed_at
+        ))
+    logger.debug("Sent digest of %s item(s) to %s (%s no longer pending)", count, recipient, len(items) - count)
+    return sent
+
+
+def send_digests():
+    """
+    Send the digest of every recipient with waiting items.
+
+    Must be called inside an application context.
+
+    Returns:
+        int: Number of digest emails sent
+    """
+    table = NotificationDigestItem.__table__
+    with db.engine.begin() as conn:
+        # Items of a digest whose sender died mid-send
+        conn.execute(table.update().where(
+            table.c.claimed_at < datetime.now() - timedelta(seconds=STALE_CLAIM_SECONDS)
+        ).values(claimed_at=None))
+        recipients = conn.execute(
+            db.select(table.c.recipient).where(table.c.claimed_at == None).distinct()
+        ).scalars().all()
+
+    sent = 0
+    for recipient in recipients:
+        try:
+            if _send_digest(recipient):
+                sent += 1
+        except Exception as e:
+            logger.exception("Failed to send the digest to %s: %s", recipient, e)
+    return sent
+
+
+def send_due_digests(now=None):
+    """
+    Send today's digests if digest_hour has passed and no process has sent them yet.
+
+    Returns:
+        int: Number of digest emails sent
+    """
+    now = now or datetime.now()
+    if now.hour < digest_hour() or not _claim_day(now.date()):
+        return 0
+    sent = send_digests()
+    logger.debug("Sent %s notification digests for %s", sent, now.date())
+    return sent
+
+
+def _scheduler_loop():
+    logger.debug("Notification digest scheduler started (checks every %ss)", DIGEST_CHECK_SECONDS)
+    while not _stopping.wait(DIGEST_CHECK_SECONDS):
+        try:
+            with _app.app_context():
+                send_due_digests()
+        except Exception as e:
+            logger.exception("Notification digest scheduler error: %s", e)
+            time.sleep(DIGEST_CHECK_SECONDS)
+
+
+def start_digest_scheduler(app):
+    """
+    Start the background sender of the daily digests for this process (idempotent).
+
+    Args:
+        app: Flask application, used for the database configuration
+    """
+    global _scheduler_thread, _app
+
+    if _scheduler_thread is not None and _scheduler_thread.is_alive():
+        return _scheduler_thread
+
+    _app = app
+    _stopping.clear()
+    _scheduler_thread = threading.Thread(target=_scheduler_loop, name='notification-digest', daemon=True)
+    _scheduler_thread.start()
+    return _scheduler_thread
+
+
+def stop_digest_scheduler(timeout=None):
+    """Stop the scheduler thread"""
+    _stopping.set()
+    if _scheduler_thread is not None:
+        _scheduler_thread.join(timeout)
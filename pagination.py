@@ -0,0 +1,86 @@
+"""
+Keyset (cursor) pagination for EPV listings.
+
+Pages are ordered by (submission_date DESC, id DESC) and each page starts
+strictly after the last row of the previous one, so fetching page N costs the
+same as fetching page 1 regardless of how many EPVs exist.
+"""
+
+import base64
+from datetime import datetime
+
+from sqlalchemy import and_, or_
+
+from models import EPV
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+def encode_cursor(record):
+    """Encode the (submission_date, id) position of a record as an opaque cursor"""
+    submission_date = record.submission_date.isoformat() if record.submission_date else ''
+    raw = f"{submission_date}|{record.id}"
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """
+    Decode a cursor produced by encode_cursor.
+
+    Returns:
+        tuple: (submission_date or None, id)
+
+    Raises:
+        ValueError: If the cursor is malformed
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+        submission_date, record_id = raw.rsplit('|', 1)
+        return (datetime.fromisoformat(submission_date) if submission_date else None), int(record_id)
+    except Exception:
+        raise ValueError(f"Invalid cursor: {cursor}")
+
+
+def parse_page_size(value, default=DEFAULT_PAGE_SIZE):
+    """Parse a page_size request argument, clamped to 1..MAX_PAGE_SIZE"""
+    try:
+        page_size = int(value) if value else default
+    except (TypeError, ValueError):
+        page_size = default
+    return max(1, min(page_size, MAX_PAGE_SIZE))
+
+
+def keyset_page(query, page_size, cursor=None):
+    """
+    Fetch one page of EPVs ordered by newest submission first.
+
+    EPVs without a submission date sort last (MySQL DESC ordering).
+
+    Args:
+        query: EPV query with scope and filters applied
+        page_size (int): Number of records per page
+        cursor (str): Cursor returned for the previous page, or None for the first page
+
+    Returns:
+        tuple: (records, next_cursor) where next_cursor is None on the last page
+    """
+    if cursor:
+        submission_date, record_id = decode_cursor(cursor)
+        if submission_date is None:
+            query = query.filter(EPV.submission_date.is_(None), EPV.id < record_id)
+        else:
+            query = query.filter(or_(
+                EPV.submission_date < submission_date,
+                and_(EPV.submission_date == submission_date, EPV.id < record_id),
+                EPV.submission_date.is_(None)
+            ))
+
+    records = query.order_by(EPV.submission_date.desc(), EPV.id.desc()).limit(page_size + 1).all()
+
+    next_cursor = None
+    if len(records) > page_size:
+        records = records[:page_size]
+        next_cursor = encode_cursor(records[-1])
+
+    return records, next_cursor
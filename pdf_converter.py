@@ -2,16 +2,23 @@ import os
 import uuid
 import tempfile
 import sys
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
 from werkzeug.utils import secure_filename
 from flask import url_for
 
+logger = logging.getLogger(__name__)
+
 # Import Jinja2 for templating
 try:
     import jinja2
     JINJA2_AVAILABLE = True
 except ImportError:
-    print("WARNING: Jinja2 not available. PDF document generation will be disabled.")
+    logger.warning("Jinja2 not available. PDF document generation will be disabled.")
     JINJA2_AVAILABLE = False
 
 # Try to import HTML to PDF conversion libraries
@@ -19,7 +26,7 @@ try:
     import pdfkit
     PDFKIT_AVAILABLE = True
 except ImportError:
-    print("WARNING: pdfkit not available. Will try other PDF generation methods.")
+    logger.warning("pdfkit not available. Will try other PDF generation methods.")
     PDFKIT_AVAILABLE = False
 
 # WeasyPrint requires system libraries that might not be available
@@ -36,49 +43,63 @@ try:
     from reportlab.lib.units import inch, cm
     from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
     REPORTLAB_AVAILABLE = True
-    print("ReportLab successfully imported")
+    logger.debug("ReportLab successfully imported")
 except ImportError as e:
-    print(f"WARNING: ReportLab import error: {str(e)}. Will try other PDF generation methods.")
+    logger.warning("ReportLab import error: %s. Will try other PDF generation methods.", e)
 
 # Import Google Drive utilities
 try:
-    from drive_utils import upload_file_to_drive, get_file_url
+    from drive_utils import upload_stream_to_drive, get_file_url
     DRIVE_UTILS_AVAILABLE = True
 except ImportError:
-    print("WARNING: Google Drive utilities not available. Files will not be uploaded to Drive.")
+    logger.warning("Google Drive utilities not available. Files will not be uploaded to Drive.")
     DRIVE_UTILS_AVAILABLE = False
 
 # Try to import PDF libraries, but provide fallbacks if they're not available
 # Force PyPDF2 to be available since we've installed it
 PYPDF2_AVAILABLE = True
 try:
-    from PyPDF2 import PdfMerger
-    print("PyPDF2 successfully imported")
+    from pdf_merge import PDFMerge, merge_pdf_files
+    logger.debug("PyPDF2 successfully imported")
 except ImportError as e:
-    print(f"WARNING: PyPDF2 import error: {str(e)}. PDF merging will be disabled.")
+    logger.warning("PyPDF2 import error: %s. PDF merging will be disabled.", e)
     PYPDF2_AVAILABLE = False
 
 # Force img2pdf to be available since we've installed it
 IMG2PDF_AVAILABLE = True
 try:
     import img2pdf
-    print("img2pdf successfully imported")
+    logger.debug("img2pdf successfully imported")
 except ImportError as e:
-    print(f"WARNING: img2pdf import error: {str(e)}. Will use PIL for image conversion.")
+    logger.warning("img2pdf import error: %s. Will use PIL for image conversion.", e)
     IMG2PDF_AVAILABLE = False
 
 # Force PIL to be available since we've installed it
 PIL_AVAILABLE = True
 try:
-    from PIL import Image
-    print("PIL successfully imported")
+    from PIL import Image, ImageOps
+    logger.debug("PIL successfully imported")
 except ImportError as e:
-    print(f"WARNING: PIL import error: {str(e)}. Image conversion will be disabled.")
+    logger.warning("PIL import error: %s. Image conversion will be disabled.", e)
     PIL_AVAILABLE = False
 
 # Use temporary directory instead of permanent pdf_uploads
 import tempfile
 UPLOAD_DIR = tempfile.gettempdir()  # Use system temp directory
+
+# Receipt images larger than an A4 page at this resolution are downscaled and
+# recompressed as JPEG before they are embedded in the PDF
+PDF_IMAGE_DPI = int(os.environ.get('PDF_IMAGE_DPI', 150))
+PDF_IMAGE_JPEG_QUALITY = int(os.environ.get('PDF_IMAGE_JPEG_QUALITY', 85))
+A4_SIZE_INCHES = (8.27, 11.69)
+
+# Number of processes converting receipts to PDF in parallel. They are started
+# with 'spawn': forking the server, which runs background threads, could copy a
+# lock held by one of them into the child
+PDF_CONVERSION_WORKERS = int(os.environ.get('PDF_CONVERSION_WORKERS', min(4, os.cpu_count() or 1)))
+PDF_CONVERSION_START_METHOD = os.environ.get('PDF_CONVERSION_START_METHOD', 'spawn')
+_conversion_pool = None
+_conversion_pool_lock = threading.Lock()
 TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
 STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
 
@@ -135,7 +156,7 @@ def generate_expense_document(expense_data):
 
         # Generate PDF directly using ReportLab
         if not REPORTLAB_AVAILABLE:
-            print("ReportLab is not available. Cannot generate expense document.")
+            logger.warning("ReportLab is not available. Cannot generate expense document.")
             return None
 
         try:
@@ -197,12 +218,12 @@ def generate_expense_document(expense_data):
             # Add logo
             logo_path = '/Users/admin/Downloads/EPV/static/images/logo.png'
             if os.path.exists(logo_path):
-                print(f"DEBUG: Logo found at {logo_path}")
+                logger.debug("Logo found at %s", logo_path)
                 logo = Image(logo_path, width=1.5*inch, height=0.75*inch)
                 elements.append(logo)
                 elements.append(Spacer(1, 0.1*inch))
             else:
-                print(f"DEBUG: Logo not found at {logo_path}")
+                logger.debug("Logo not found at %s", logo_path)
 
             # Create a table for the header with title, date and EPV ID
             header_style = ParagraphStyle(
@@ -245,7 +266,7 @@ def generate_expense_document(expense_data):
                     date_obj = datetime.strptime(from_date, '%Y-%m-%d')
                     from_date = date_obj.strftime('%d-%m-%Y')
             except Exception as e:
-                print(f"Error formatting from_date: {e}")
+                logger.error("Error formatting from_date: %s", e)
 
             try:
                 # Handle datetime objects
@@ -256,7 +277,7 @@ def generate_expense_document(expense_data):
                     date_obj = datetime.strptime(to_date, '%Y-%m-%d')
                     to_date = date_obj.strftime('%d-%m-%Y')
             except Exception as e:
-                print(f"Error formatting to_date: {e}")
+                logger.error("Error formatting to_date: %s", e)
 
             info_data = [
                 [Paragraph("<b>Employee ID:</b>", normal_style), data.get('employee_id', ''),
@@ -299,7 +320,7 @@ def generate_expense_document(expense_data):
                             date_obj = datetime.strptime(invoice_date, '%Y-%m-%d')
                             invoice_date = date_obj.strftime('%d-%m-%Y')
                 except Exception as e:
-                    print(f"Error formatting date: {e}")
+                    logger.error("Error formatting date: %s", e)
 
                 expense_data.append([
                     str(i+1),
@@ -459,21 +480,63 @@ def generate_expense_document(expense_data):
 
             # Build the PDF
             doc.build(elements)
-            print(f"Generated expense document PDF using ReportLab: {output_pdf}")
+            logger.debug("Generated expense document PDF using ReportLab: %s", output_pdf)
             return output_pdf
 
         except Exception as e:
-            print(f"Error generating PDF with ReportLab: {str(e)}")
+            logger.error("Error generating PDF with ReportLab: %s", e)
             return None
 
     except Exception as e:
-        print(f"Error generating expense document: {str(e)}")
+        logger.error("Error generating expense document: %s", e)
         return None
 
+def downscale_image(file_path, dpi=None, quality=None):
+    """
+    Downscale and recompress an image that is larger than an A4 page at the given DPI
+
+    Phone photos are usually several times the resolution needed for a
+    printed receipt, which makes the merged PDF slow to upload and download.
+
+    Args:
+        file_path: Path to the image
+        dpi: Target resolution (default PDF_IMAGE_DPI)
+        quality: JPEG quality of the recompressed image (default PDF_IMAGE_JPEG_QUALITY)
+
+    Returns:
+        Path to the downscaled JPEG, or None if the image is already small enough
+    """
+    dpi = dpi or PDF_IMAGE_DPI
+    quality = quality or PDF_IMAGE_JPEG_QUALITY
+
+    with Image.open(file_path) as original:
+        # Apply the EXIF orientation, it is lost when the image is re-encoded
+        image = ImageOps.exif_transpose(original)
+
+        max_long_side = A4_SIZE_INCHES[1] * dpi
+        max_short_side = A4_SIZE_INCHES[0] * dpi
+        scale = min(max_long_side / max(image.size), max_short_side / min(image.size))
+        if scale >= 1:
+            return None
+
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+
+        new_size = (max(1, int(image.width * scale)), max(1, int(image.height * scale)))
+        image = image.resize(new_size, Image.LANCZOS)
+
+        scaled_path = os.path.splitext(file_path)[0] + '_scaled.jpg'
+        image.save(scaled_path, 'JPEG', quality=quality, optimize=True, dpi=(dpi, dpi))
+
+    logger.debug("Downscaled %s to %sx%s at %s DPI", file_path, new_size[0], new_size[1], dpi)
+    return scaled_path
+
 def convert_to_pdf(file_path):
     """
     Convert a file to PDF
 
+    Images larger than an A4 page at PDF_IMAGE_DPI are downscaled first.
+
     Args:
         file_path: Path to the file to convert
 
@@ -481,12 +544,12 @@ def convert_to_pdf(file_path):
         Path to the converted PDF file, or None if conversion failed
     """
     if not file_path or not os.path.exists(file_path):
-        print(f"File not found: {file_path}")
+        logger.warning("File not found: %s", file_path)
         return None
 
     # If the file is already a PDF, just return it
     if file_path.lower().endswith('.pdf'):
-        print(f"File is already a PDF: {file_path}")
+        logger.debug("File is already a PDF: %s", file_path)
         return file_path
 
     # Get the file extension
@@ -495,47 +558,162 @@ def convert_to_pdf(file_path):
     # Create a PDF filename
     pdf_path = os.path.splitext(file_path)[0] + '.pdf'
 
+    scaled_path = None
     try:
+        # Downscale large images before embedding them
+        source_path = file_path
+        if PIL_AVAILABLE and file_ext in ['.jpg', '.jpeg', '.png', '.gif']:
+            try:
+                scaled_path = downscale_image(file_path)
+                if scaled_path:
+                    source_path = scaled_path
+                    file_ext = '.jpg'
+            except Exception as e:
+                logger.warning("Error downscaling %s, using the original: %s", file_path, e)
+
         # Method 1: Use img2pdf for image conversion (best quality)
         if IMG2PDF_AVAILABLE and file_ext in ['.jpg', '.jpeg', '.png']:
             try:
-                print(f"Converting {file_path} to PDF using img2pdf")
-                with open(file_path, "rb") as image_file:
-                    pdf_bytes = img2pdf.convert(image_file.read())
-                    with open(pdf_path, "wb") as pdf_file:
-                        pdf_file.write(pdf_bytes)
+                logger.debug("Converting %s to PDF using img2pdf", source_path)
+                with open(pdf_path, "wb") as pdf_file:
+                    img2pdf.convert(source_path, outputstream=pdf_file)
 
                 if os.path.exists(pdf_path) and os.path.getsize(pdf_path) > 0:
-                    print(f"Successfully converted to PDF: {pdf_path}")
+                    logger.debug("Successfully converted to PDF: %s", pdf_path)
                     return pdf_path
             except Exception as e:
-                print(f"Error converting with img2pdf: {str(e)}")
+                logger.error("Error converting with img2pdf: %s", e)
 
         # Method 2: Use PIL for image conversion
         if PIL_AVAILABLE and file_ext in ['.jpg', '.jpeg', '.png', '.gif']:
             try:
-                print(f"Converting {file_path} to PDF using PIL")
-                image = Image.open(file_path)
-
-                # Convert to RGB if the image is in RGBA mode (e.g., PNG with transparency)
-                if image.mode == 'RGBA':
-                    image = image.convert('RGB')
+                logger.debug("Converting %s to PDF using PIL", source_path)
+                with Image.open(source_path) as image:
+                    # Convert to RGB if the image is in RGBA mode (e.g., PNG with transparency)
+                    if image.mode in ('RGBA', 'P', 'LA'):
+                        image = image.convert('RGB')
 
-                image.save(pdf_path, "PDF", resolution=100.0)
+                    image.save(pdf_path, "PDF", resolution=float(PDF_IMAGE_DPI) if scaled_path else 100.0)
 
                 if os.path.exists(pdf_path) and os.path.getsize(pdf_path) > 0:
-                    print(f"Successfully converted to PDF: {pdf_path}")
+                    logger.debug("Successfully converted to PDF: %s", pdf_path)
                     return pdf_path
             except Exception as e:
-                print(f"Error converting with PIL: {str(e)}")
+                logger.error("Error converting with PIL: %s", e)
 
-        # If we get here, conversion failed
-        print(f"Failed to convert {file_path} to PDF")
+        # If we get here, conversion failed, don't leave a partial PDF behind
+        logger.error("Failed to convert %s to PDF", file_path)
+        if os.path.exists(pdf_path):
+            os.remove(pdf_path)
         return None
 
     except Exception as e:
-        print(f"Unexpected error converting to PDF: {str(e)}")
+        logger.error("Unexpected error converting to PDF: %s", e)
         return None
+    finally:
+        if scaled_path and os.path.exists(scaled_path):
+            os.remove(scaled_path)
+
+def _convert_file(file_path):
+    """Convert one file, returning (pdf_path, error)"""
+    try:
+        pdf_path = convert_to_pdf(file_path)
+        return pdf_path, None if pdf_path else 'Failed to convert file to PDF'
+    except Exception as e:
+        return None, f"Error converting {os.path.basename(file_path)}: {str(e)}"
+
+class _RecordCollector(logging.Handler):
+    """Keeps (level, message) of each record, to be logged by the parent process"""
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append((record.levelno, record.getMessage()))
+
+def _convert_file_in_worker(file_path, level):
+    """
+    Process pool task: _convert_file(), plus the messages it logged.
+
+    A worker process has no log writer of its own, so its messages are
+    returned and logged by the parent (see _log_worker_records).
+
+    Returns:
+        Tuple of (pdf_path, error, records), records being (level, message) pairs
+    """
+    collector = _RecordCollector()
+    logger.setLevel(level)
+    logger.propagate = False
+    logger.addHandler(collector)
+    try:
+        pdf_path, error = _convert_file(file_path)
+    finally:
+        logger.removeHandler(collector)
+    return pdf_path, error, collector.records
+
+def _log_worker_records(records):
+    for level, message in records:
+        logger.log(level, "%s", message)
+
+def _get_conversion_pool():
+    """Process pool shared by all conversions, created on first use"""
+    global _conversion_pool
+    with _conversion_pool_lock:
+        if _conversion_pool is None:
+            _conversion_pool = ProcessPoolExecutor(
+                max_workers=PDF_CONVERSION_WORKERS,
+                mp_context=multiprocessing.get_context(PDF_CONVERSION_START_METHOD)
+            )
+        return _conversion_pool
+
+def _reset_conversion_pool():
+    global _conversion_pool
+    with _conversion_pool_lock:
+        if _conversion_pool is not None:
+            _conversion_pool.shutdown(wait=False, cancel_futures=True)
+        _conversion_pool = None
+
+def convert_files_to_pdf(file_paths):
+    """
+    Convert several files to PDF in parallel
+
+    Conversion is CPU bound, so it runs on a bounded process pool of
+    PDF_CONVERSION_WORKERS processes. Falls back to converting in this
+    process if the pool cannot be used. Messages the workers log, and the
+    error of each file that fails, are logged by this process.
+
+    Args:
+        file_paths: Paths of the files to convert
+
+    Returns:
+        List of (pdf_path or None, error or None), in the order of file_paths
+    """
+    # PDFs need no conversion, and a single image is not worth the round trip
+    pending = [i for i, path in enumerate(file_paths) if not path.lower().endswith('.pdf')]
+    results = [(path, None) if path.lower().endswith('.pdf') else None for path in file_paths]
+
+    if len(pending) > 1 and PDF_CONVERSION_WORKERS > 1:
+        try:
+            pool = _get_conversion_pool()
+            level = logger.getEffectiveLevel()
+            futures = {i: pool.submit(_convert_file_in_worker, file_paths[i], level) for i in pending}
+            for i, future in futures.items():
+                pdf_path, error, records = future.result()
+                _log_worker_records(records)
+                results[i] = (pdf_path, error)
+        except BrokenProcessPool as e:
+            logger.warning("PDF conversion pool failed, converting sequentially: %s", e)
+            _reset_conversion_pool()
+        except Exception as e:
+            logger.warning("Could not use PDF conversion pool, converting sequentially: %s", e)
+
+    for i in pending:
+        if results[i] is None:
+            results[i] = _convert_file(file_paths[i])
+        if results[i][1]:
+            logger.error("Could not convert %s: %s", os.path.basename(file_paths[i]), results[i][1])
+    return results
 
 def merge_pdfs(pdf_files):
     """
@@ -548,58 +726,31 @@ def merge_pdfs(pdf_files):
         Path to the merged PDF file, or None if merging failed
     """
     if not pdf_files:
-        print("No PDF files to merge")
+        logger.debug("No PDF files to merge")
         return None
 
     # If there's only one PDF, just return it
     if len(pdf_files) == 1:
-        print(f"Only one PDF file, no need to merge: {pdf_files[0]}")
+        logger.debug("Only one PDF file, no need to merge: %s", pdf_files[0])
         return pdf_files[0]
 
     # Check if PyPDF2 is available
     if not PYPDF2_AVAILABLE:
-        print("PyPDF2 not available, cannot merge PDFs")
+        logger.warning("PyPDF2 not available, cannot merge PDFs")
         return pdf_files[0]  # Return the first PDF
 
-    try:
-        # Create a merger object
-        merger = PdfMerger()
-
-        # Add each PDF to the merger
-        for pdf in pdf_files:
-            if os.path.exists(pdf) and os.path.getsize(pdf) > 0:
-                try:
-                    print(f"Attempting to add {pdf} to merger...")
-                    merger.append(pdf)
-                    print(f"✅ Successfully added {pdf} to merger")
-                except Exception as e:
-                    print(f"❌ Error adding {pdf} to merger: {str(e)}")
-                    print(f"Error type: {type(e).__name__}")
-                    import traceback
-                    print(f"Traceback: {traceback.format_exc()}")
-                    # Continue with other files even if one fails
-                    continue
-            else:
-                print(f"⚠️ Skipping {pdf} - file doesn't exist or is empty")
-
-        # Create a unique filename for the merged PDF
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        merged_filename = f"merged_{timestamp}_{uuid.uuid4().hex[:8]}.pdf"
-        merged_path = os.path.join(UPLOAD_DIR, merged_filename)
-
-        # Write the merged PDF to file
-        merger.write(merged_path)
-        merger.close()
-
-        if os.path.exists(merged_path) and os.path.getsize(merged_path) > 0:
-            print(f"Successfully merged PDFs: {merged_path}")
-            return merged_path
-        else:
-            print(f"Failed to create merged PDF: {merged_path}")
-            return None
+    # Create a unique filename for the merged PDF
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    merged_filename = f"merged_{timestamp}_{uuid.uuid4().hex[:8]}.pdf"
+    merged_path = os.path.join(UPLOAD_DIR, merged_filename)
 
+    try:
+        merged_path = merge_pdf_files(pdf_files, merged_path)
+        if merged_path:
+            logger.debug("Successfully merged PDFs: %s", merged_path)
+        return merged_path
     except Exception as e:
-        print(f"Error merging PDFs: {str(e)}")
+        logger.error("Error merging PDFs: %s", e)
         return None
 
 def process_files(files, drive_folder_id=None, employee_name=None, cost_center_name=None, expense_pdf_path=None):
@@ -617,16 +768,16 @@ def process_files(files, drive_folder_id=None, employee_name=None, cost_center_n
         Dictionary with processing results
     """
     if not files:
-        print("No files provided to process_files function")
+        logger.warning("No files provided to process_files function")
         return {
             'success': False,
             'error': 'No files provided',
             'user_message': 'No files were uploaded. Please select at least one file.'
         }
 
-    print(f"Processing {len(files)} files in process_files function")
+    logger.debug("Processing %s files in process_files function", len(files))
     for i, file in enumerate(files):
-        print(f"File {i+1}: {file.filename if hasattr(file, 'filename') else 'No filename'}")
+        logger.debug("File %s: %s", i + 1, file.filename if hasattr(file, 'filename') else 'No filename')
 
     # Track processing results for each file
     processing_results = []
@@ -639,8 +790,10 @@ def process_files(files, drive_folder_id=None, employee_name=None, cost_center_n
         # If expense_pdf_path is provided, add it to the beginning of pdf_files
         if expense_pdf_path and os.path.exists(expense_pdf_path):
             pdf_files.append(expense_pdf_path)
-            print(f"Added expense document PDF to the beginning: {expense_pdf_path}")
+            logger.debug("Added expense document PDF to the beginning: %s", expense_pdf_path)
 
+        # Step 1: Save uploaded files and collect the files to convert, in order
+        to_convert = []  # (file_result, path, is_saved_upload)
         for file in files:
             # Skip the expense PDF path if it's already in pdf_files
             if isinstance(file, str) and file == expense_pdf_path:
@@ -649,23 +802,15 @@ def process_files(files, drive_folder_id=None, employee_name=None, cost_center_n
             # Handle string file paths (already existing files)
             if isinstance(file, str) and os.path.exists(file):
                 file_result = {
+                    'filename': os.path.basename(file),
                     'original_filename': os.path.basename(file),
-                    'success': False
+                    'success': False,
+                    'error': None,
+                    'saved_path': file,
+                    'pdf_path': None
                 }
                 processing_results.append(file_result)
-
-                # If it's already a PDF, just add it to pdf_files
-                if file.lower().endswith('.pdf'):
-                    pdf_files.append(file)
-                    file_result['pdf_path'] = file
-                    file_result['success'] = True
-                else:
-                    # Try to convert to PDF
-                    pdf_path = convert_to_pdf(file)
-                    if pdf_path:
-                        pdf_files.append(pdf_path)
-                        file_result['pdf_path'] = pdf_path
-                        file_result['success'] = True
+                to_convert.append((file_result, file, False))
             # Handle file objects from request.files
             elif file and hasattr(file, 'filename') and file.filename and allowed_file(file.filename):
                 file_result = {
@@ -675,6 +820,7 @@ def process_files(files, drive_folder_id=None, employee_name=None, cost_center_n
                     'saved_path': None,
                     'pdf_path': None
                 }
+                processing_results.append(file_result)
 
                 try:
                     # Create a unique temporary filename
@@ -692,26 +838,12 @@ def process_files(files, drive_folder_id=None, employee_name=None, cost_center_n
                     file.save(file_path)
                     saved_files.append(file_path)
                     file_result['saved_path'] = file_path
-
-                    # Convert to PDF
-                    pdf_path = convert_to_pdf(file_path)
-                    if pdf_path:
-                        pdf_files.append(pdf_path)
-                        file_result['pdf_path'] = pdf_path
-                        file_result['success'] = True
-
-                        # Remove the original file if it's different from the PDF
-                        if pdf_path != file_path and os.path.exists(file_path):
-                            os.remove(file_path)
-                    else:
-                        file_result['error'] = 'Failed to convert file to PDF'
+                    to_convert.append((file_result, file_path, True))
 
                 except Exception as e:
                     error_msg = f"Error processing file {file.filename}: {str(e)}"
-                    print(error_msg)
+                    logger.error("%s", error_msg)
                     file_result['error'] = error_msg
-
-                processing_results.append(file_result)
             else:
                 # Invalid file
                 processing_results.append({
@@ -722,6 +854,21 @@ def process_files(files, drive_folder_id=None, employee_name=None, cost_center_n
                     'pdf_path': None
                 })
 
+        # Step 2: Convert all files to PDF in parallel, results come back in input order
+        conversions = convert_files_to_pdf([path for _, path, _ in to_convert])
+
+        for (file_result, file_path, is_saved_upload), (pdf_path, error) in zip(to_convert, conversions):
+            if pdf_path:
+                pdf_files.append(pdf_path)
+                file_result['pdf_path'] = pdf_path
+                file_result['success'] = True
+
+                # Remove the original upload if it's different from the PDF
+                if is_saved_upload and pdf_path != file_path and os.path.exists(file_path):
+                    os.remove(file_path)
+            else:
+                file_result['error'] = error or 'Failed to convert file to PDF'
+
         # Check if any files were processed successfully
         if not pdf_files:
             # No PDFs were created
@@ -744,102 +891,99 @@ def process_files(files, drive_folder_id=None, employee_name=None, cost_center_n
         # No need to generate expense document here anymore
         # It's now handled in the app.py route
 
-        # Merge PDFs if there are any
-        merged_pdf = None
-        merge_error = None
-        if pdf_files:
-            try:
-                merged_pdf = merge_pdfs(pdf_files)
-                if not merged_pdf:
-                    merge_error = "Failed to merge PDF files"
-            except Exception as e:
-                merge_error = f"Error merging PDFs: {str(e)}"
-                print(merge_error)
-
-            # Clean up individual PDF files if merging was successful
-            if merged_pdf and merged_pdf not in pdf_files:
-                for pdf in pdf_files:
-                    if os.path.exists(pdf):
-                        os.remove(pdf)
-
-        # Upload to Google Drive if a folder ID is provided and the merged PDF exists
-        drive_file_id = None
-        drive_file_url = None
-        drive_error = None
-
-        # Check if we should attempt Google Drive upload
-        drive_upload_attempted = False
-
-        if merged_pdf and drive_folder_id and DRIVE_UTILS_AVAILABLE:
-            drive_upload_attempted = True
-            try:
-                print(f"Uploading merged PDF to Google Drive folder: {drive_folder_id}")
-
-                # Validate drive folder ID
-                if not drive_folder_id or drive_folder_id.strip() == "":
-                    drive_error = "Google Drive folder ID is empty or invalid"
-                    print(f"ERROR: {drive_error}")
-                else:
-                    # Create a meaningful filename
-                    date_str = datetime.now().strftime('%Y-%m-%d')
-                    filename_parts = []
-
-                    if employee_name:
-                        filename_parts.append(f"Expense_{employee_name}")
+        # Merge the PDFs in memory and upload the merged stream. The merge
+        # releases its buffers when the block exits.
+        with PDFMerge() as merge:
+            merged_pdf = None
+            merge_error = None
+            if pdf_files:
+                try:
+                    for pdf in pdf_files:
+                        merge.append(pdf, label=os.path.basename(pdf))
+                    if merge.page_count:
+                        merged_pdf = merge.write()
                     else:
-                        filename_parts.append("Expense")
+                        merge_error = "Failed to merge PDF files"
+                except Exception as e:
+                    merge_error = f"Error merging PDFs: {str(e)}"
+                    logger.error("%s", merge_error)
 
-                    if cost_center_name:
-                        filename_parts.append(cost_center_name)
+            # Upload to Google Drive if a folder ID is provided and the merged PDF exists
+            drive_file_id = None
+            drive_file_url = None
+            drive_error = None
 
-                    filename_parts.append(date_str)
-                    drive_filename = "_".join(filename_parts) + ".pdf"
+            # Check if we should attempt Google Drive upload
+            drive_upload_attempted = False
 
-                    print(f"DEBUG: Uploading file with name: {drive_filename}")
+            if merged_pdf and drive_folder_id and DRIVE_UTILS_AVAILABLE:
+                drive_upload_attempted = True
+                try:
+                    logger.debug("Uploading merged PDF to Google Drive folder: %s", drive_folder_id)
 
-                    # Upload to Google Drive
-                    drive_file_id = upload_file_to_drive(merged_pdf, drive_filename, drive_folder_id)
+                    # Validate drive folder ID
+                    if not drive_folder_id or drive_folder_id.strip() == "":
+                        drive_error = "Google Drive folder ID is empty or invalid"
+                        logger.error("%s", drive_error)
+                    else:
+                        # Create a meaningful filename
+                        date_str = datetime.now().strftime('%Y-%m-%d')
+                        filename_parts = []
 
-                    if drive_file_id and drive_file_id != 'local_file':
-                        print(f"SUCCESS: Uploaded to Drive with ID: {drive_file_id}")
-                        # Get the file URL
-                        drive_file_url = get_file_url(drive_file_id)
-                        if drive_file_url:
-                            print(f"SUCCESS: Drive file URL: {drive_file_url}")
+                        if employee_name:
+                            filename_parts.append(f"Expense_{employee_name}")
+                        else:
+                            filename_parts.append("Expense")
+
+                        if cost_center_name:
+                            filename_parts.append(cost_center_name)
+
+                        filename_parts.append(date_str)
+                        drive_filename = "_".join(filename_parts) + ".pdf"
+
+                        logger.debug("Uploading file with name: %s", drive_filename)
+
+                        # Upload to Google Drive
+                        drive_file_id = upload_stream_to_drive(merged_pdf, drive_filename, drive_folder_id)
+
+                        if drive_file_id and drive_file_id != 'local_file':
+                            logger.info("Uploaded to Drive with ID: %s", drive_file_id)
+                            # Get the file URL
+                            drive_file_url = get_file_url(drive_file_id)
+                            if drive_file_url:
+                                logger.info("Drive file URL: %s", drive_file_url)
+                            else:
+                                logger.warning("Could not retrieve Drive file URL")
+                        elif drive_file_id == 'local_file':
+                            logger.info("Merged PDF was not uploaded to Google Drive")
+                            # No error, just a different path
+                            drive_file_id = None
+                            drive_error = "The file was saved locally instead of being uploaded to Google Drive. You can download it below."
                         else:
-                            print("WARNING: Could not retrieve Drive file URL")
-                    elif drive_file_id == 'local_file':
-                        print(f"INFO: File saved locally instead of uploading to Google Drive: {merged_pdf}")
-                        # No error, just a different path
-                        drive_file_id = None
-                        drive_error = "The file was saved locally instead of being uploaded to Google Drive. You can download it below."
+                            drive_error = "Failed to upload file to Google Drive. The upload process did not return a file ID."
+                            logger.error("%s", drive_error)
+                except Exception as e:
+                    error_details = str(e)
+                    if "invalid_grant" in error_details.lower():
+                        drive_error = "Google Drive authentication failed. Please ask your administrator to refresh the Google API credentials."
+                    elif "permission" in error_details.lower():
+                        drive_error = "Permission denied when uploading to Google Drive. Please check folder permissions."
+                    elif "not found" in error_details.lower() or "404" in error_details:
+                        drive_error = f"Google Drive folder not found: {drive_folder_id}"
                     else:
-                        drive_error = "Failed to upload file to Google Drive. The upload process did not return a file ID."
-                        print(f"ERROR: {drive_error}")
-            except Exception as e:
-                error_details = str(e)
-                if "invalid_grant" in error_details.lower():
-                    drive_error = "Google Drive authentication failed. Please ask your administrator to refresh the Google API credentials."
-                elif "permission" in error_details.lower():
-                    drive_error = "Permission denied when uploading to Google Drive. Please check folder permissions."
-                elif "not found" in error_details.lower() or "404" in error_details:
-                    drive_error = f"Google Drive folder not found: {drive_folder_id}"
-                else:
-                    drive_error = f"Error uploading to Google Drive: {error_details}"
-                print(f"ERROR: {drive_error}")
-        elif not DRIVE_UTILS_AVAILABLE:
-            drive_error = "Google Drive integration is not available. Required libraries are missing."
-            print(f"ERROR: {drive_error}")
-        elif not drive_folder_id:
-            drive_error = "No Google Drive folder ID provided. Check cost center settings."
-            print(f"WARNING: {drive_error}")
+                        drive_error = f"Error uploading to Google Drive: {error_details}"
+                    logger.error("%s", drive_error)
+            elif not DRIVE_UTILS_AVAILABLE:
+                drive_error = "Google Drive integration is not available. Required libraries are missing."
+                logger.error("%s", drive_error)
+            elif not drive_folder_id:
+                drive_error = "No Google Drive folder ID provided. Check cost center settings."
+                logger.warning("%s", drive_error)
 
         # Clean up temporary files after Google Drive upload
         cleanup_files = []
         cleanup_files.extend(saved_files)
         cleanup_files.extend(pdf_files)
-        if merged_pdf:
-            cleanup_files.append(merged_pdf)
 
         # Remove duplicates and clean up
         cleanup_files = list(set(cleanup_files))
@@ -847,16 +991,16 @@ def process_files(files, drive_folder_id=None, employee_name=None, cost_center_n
             try:
                 if os.path.exists(temp_file):
                     os.remove(temp_file)
-                    print(f"🗑️ Cleaned up temporary file: {temp_file}")
+                    logger.debug("Cleaned up temporary file: %s", temp_file)
             except Exception as e:
-                print(f"⚠️ Could not clean up {temp_file}: {e}")
+                logger.warning("Could not clean up %s: %s", temp_file, e)
 
         # Return the results (without local file paths since they're deleted)
         result = {
             'success': merged_pdf is not None,
             'saved_files': [],  # Don't return local paths since files are deleted
             'pdf_files': [],    # Don't return local paths since files are deleted
-            'merged_pdf': None, # Don't return local path since file is deleted
+            'merged_pdf': None, # The merged PDF only existed in memory
             'processing_results': processing_results,
             'drive_upload_attempted': drive_upload_attempted
         }
@@ -891,7 +1035,7 @@ def process_files(files, drive_folder_id=None, employee_name=None, cost_center_n
 
     except Exception as e:
         error_msg = f"Error processing files: {str(e)}"
-        print(error_msg)
+        logger.error("%s", error_msg)
         return {
             'success': False,
             'error': error_msg,
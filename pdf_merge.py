@@ -0,0 +1,158 @@
+"""
+In-memory PDF merging.
+
+PDFMerge merges PDFs given as file paths, bytes or file objects. Files on
+disk are memory-mapped instead of copied, and the merged document is written
+to a spooled stream that only spills to an anonymous temporary file when it
+grows past PDF_MERGE_SPOOL_BYTES, so no intermediate files are left in the
+temp directory. Use it as a context manager so the sources and the output
+are always closed:
+
+    with PDFMerge() as merge:
+        merge.append(expense_pdf_path)
+        merge.append(drive_bytes, label='original')
+        stream = merge.write()
+        upload_stream_to_drive(stream, file_name, folder_id)
+"""
+
+import io
+import logging
+import mmap
+import os
+import tempfile
+
+from PyPDF2 import PdfReader, PdfWriter
+
+logger = logging.getLogger(__name__)
+
+# Merged documents up to this size are kept in memory
+PDF_MERGE_SPOOL_BYTES = int(os.environ.get('PDF_MERGE_SPOOL_BYTES', 32 * 1024 * 1024))
+
+
+class PDFMerge:
+    """Merge PDFs into a single stream"""
+
+    def __init__(self, spool_bytes=None):
+        self.spool_bytes = spool_bytes or PDF_MERGE_SPOOL_BYTES
+        self.page_count = 0
+        self.errors = []
+        self._writer = PdfWriter()
+        self._sources = []
+        self._output = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def _open_source(self, source):
+        """Return a readable stream for a path, bytes or file object"""
+        if isinstance(source, (str, os.PathLike)):
+            f = open(source, 'rb')
+            self._sources.append(f)
+            if os.fstat(f.fileno()).st_size == 0:
+                raise ValueError('file is empty')
+            stream = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._sources.append(stream)
+            return stream
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            return io.BytesIO(source)
+        source.seek(0)
+        return source
+
+    def append(self, source, label=None):
+        """
+        Append all pages of a PDF.
+
+        A source that cannot be read is skipped and recorded in self.errors,
+        so one bad receipt does not fail the whole merge.
+
+        Args:
+            source: Path, bytes or seekable file object of the PDF
+            label (str): Name used in log messages (defaults to the path)
+
+        Returns:
+            bool: True if the PDF was added
+        """
+        label = label or (source if isinstance(source, (str, os.PathLike)) else 'in-memory PDF')
+        try:
+            reader = PdfReader(self._open_source(source), strict=False)
+            self._writer.append(reader)
+            self.page_count += len(reader.pages)
+            logger.debug("Added %s to merge (%s pages)", label, len(reader.pages))
+            return True
+        except Exception as e:
+            logger.error("Failed to add %s to merge: %s", label, e)
+            self.errors.append(f"{label}: {str(e)}")
+            return False
+
+    def write(self, stream=None):
+        """
+        Write the merged PDF.
+
+        Args:
+            stream: Writable binary stream (default: a spooled temporary file
+                owned by this object and closed with it)
+
+        Returns:
+            The stream, positioned at the start
+        """
+        if not self.page_count:
+            raise ValueError('No pages to merge')
+
+        if stream is None:
+            if self._output is None:
+                self._output = tempfile.SpooledTemporaryFile(max_size=self.spool_bytes)
+            stream = self._output
+            stream.seek(0)
+            stream.truncate()
+
+        self._writer.write(stream)
+        stream.seek(0)
+        return stream
+
+    def save(self, path):
+        """Write the merged PDF to a file, returning the path"""
+        try:
+            with open(path, 'wb') as f:
+                self.write(f)
+        except Exception:
+            if os.path.exists(path):
+                os.remove(path)
+            raise
+        return path
+
+    def close(self):
+        """Release the sources and the output stream"""
+        self._writer.close()
+        for source in reversed(self._sources):
+            try:
+                source.close()
+            except Exception:
+                pass
+        self._sources = []
+        if self._output is not None:
+            self._output.close()
+            self._output = None
+
+
+def merge_pdf_files(sources, output_path):
+    """
+    Merge PDFs into a file.
+
+    Args:
+        sources: PDF paths, bytes or file objects, in page order
+        output_path (str): Where to write the merged PDF
+
+    Returns:
+        str: output_path, or None if nothing could be merged
+    """
+    with PDFMerge() as merge:
+        for source in sources:
+            merge.append(source)
+        if not merge.page_count:
+            logger.error("No PDF pages to merge")
+            return None
+        return merge.save(output_path)
@@ -5,15 +5,10 @@ Utility functions for handling PDF files, including merging and uploading to Goo
 
 import os
 import io
-import uuid
 import tempfile
-from datetime import datetime
-from PyPDF2 import PdfMerger, PdfReader
+from PyPDF2 import PdfReader
 from werkzeug.utils import secure_filename
-from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload, MediaIoBaseDownload
-from flask import session
+from pdf_merge import merge_pdf_files
 
 def validate_pdf(file):
     """
@@ -87,25 +82,8 @@ def merge_pdfs(pdf_files, output_path):
             print("ERROR: No PDF files provided for merging")
             return False
 
-        # Create a PDF merger
-        merger = PdfMerger()
-
-        # Add each PDF file to the merger
-        for pdf_file in pdf_files:
-            if not os.path.exists(pdf_file):
-                print(f"WARNING: PDF file not found: {pdf_file}")
-                continue
-
-            try:
-                merger.append(pdf_file)
-                print(f"✅ Added to merger: {pdf_file}")
-            except Exception as e:
-                print(f"ERROR: Failed to add {pdf_file} to merger: {str(e)}")
-                continue
-
-        # Write the merged PDF
-        merger.write(output_path)
-        merger.close()
+        if not merge_pdf_files(pdf_files, output_path):
+            return False
 
         print(f"✅ Successfully merged PDFs to: {output_path}")
         return True
@@ -122,133 +100,57 @@ def download_from_drive(file_id, output_path):
 
     Args:
         file_id: The ID of the file in Google Drive
-        output_path: The path where the file should be saved
+        output_path: The path where the file should be saved, or a writable binary stream
 
     Returns:
         True if successful, False otherwise
     """
-    try:
-        # Check if we have Google token in session
-        if 'google_token' not in session:
-            print("ERROR: No Google token in session")
-            return False
-
-        # Create credentials from session token
-        credentials = Credentials(
-            token=session['google_token']['access_token'],
-            refresh_token=session['google_token']['refresh_token'],
-            token_uri='https://oauth2.googleapis.com/token',
-            client_id=os.environ.get('GOOGLE_CLIENT_ID'),
-            client_secret=os.environ.get('GOOGLE_CLIENT_SECRET')
-        )
-
-        # Build the Drive API client
-        drive_service = build('drive', 'v3', credentials=credentials)
-
-        # Download the file
-        request = drive_service.files().get_media(fileId=file_id)
-        fh = io.FileIO(output_path, 'wb')
-        downloader = MediaIoBaseDownload(fh, request)
-        done = False
-        while done is False:
-            status, done = downloader.next_chunk()
-        fh.close()
-
-        print(f"Successfully downloaded file from Drive: {output_path}")
-        return True
-    except Exception as e:
-        print(f"Error downloading file from Drive: {str(e)}")
-        import traceback
-        print(traceback.format_exc())
-        return False
+    from drive_utils import download_file_from_drive
+    return download_file_from_drive(file_id, output_path)
 
 def upload_to_drive(file_path, filename, parent_folder_id):
     """
     Upload a file to Google Drive.
 
     Args:
-        file_path: The path to the file to upload
+        file_path: The path to the file to upload, or a readable binary stream of a PDF
         filename: The name to give the file in Google Drive
         parent_folder_id: The ID of the folder to upload to
 
     Returns:
         The ID of the uploaded file, or None if upload failed
     """
-    try:
-        # Check if we have Google token in session
-        if 'google_token' not in session:
-            print("ERROR: No Google token in session")
-            return None
-
-        # Create credentials from session token
-        credentials = Credentials(
-            token=session['google_token']['access_token'],
-            refresh_token=session['google_token']['refresh_token'],
-            token_uri='https://oauth2.googleapis.com/token',
-            client_id=os.environ.get('GOOGLE_CLIENT_ID'),
-            client_secret=os.environ.get('GOOGLE_CLIENT_SECRET')
-        )
-
-        # Build the Drive API client
-        drive_service = build('drive', 'v3', credentials=credentials)
-
-        # File metadata
-        file_metadata = {
-            'name': filename,
-            'parents': [parent_folder_id]
-        }
-
-        # Upload the file
-        media = MediaFileUpload(file_path, resumable=True)
-        file = drive_service.files().create(
-            body=file_metadata,
-            media_body=media,
-            fields='id'
-        ).execute()
-
-        print(f"Successfully uploaded file to Drive: {file.get('id')}")
-        return file.get('id')
-    except Exception as e:
-        print(f"Error uploading file to Drive: {str(e)}")
-        import traceback
-        print(traceback.format_exc())
-        return None
-
-def merge_supplementary_documents(epv, supplementary_files, upload_folder):
+    from drive_utils import upload_file_to_drive, upload_stream_to_drive
+    if isinstance(file_path, str):
+        file_id = upload_file_to_drive(file_path, filename, parent_folder_id)
+    else:
+        file_id = upload_stream_to_drive(file_path, filename, parent_folder_id)
+    return file_id if file_id != 'local_file' else None
+
+def merge_supplementary_documents(epv, supplementary_files, merge):
     """
     Merge supplementary documents with the original EPV document.
 
+    The original PDF is read from the local Drive file cache and merged with
+    the supplementary files without writing intermediate files.
+
     Args:
         epv: The EPV record
         supplementary_files: A list of tuples (filename, file_path) of supplementary files
-        upload_folder: The folder where uploaded files are stored
+        merge: PDFMerge that receives the pages and owns the merged output
 
     Returns:
-        The path to the merged PDF, or None if merging failed
+        A stream with the merged PDF (closed with merge), or None if merging failed
     """
+    converted_files = []
     try:
-        # Create a unique filename for the merged PDF
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        random_hex = uuid.uuid4().hex[:8]
-        merged_pdf_path = os.path.join(upload_folder, f"merged_{epv.epv_id}_{timestamp}_{random_hex}.pdf")
-
-        # Create a PDF merger
-        merger = PdfMerger()
-
-        # Download the original PDF from Google Drive if available
-        original_pdf_path = None
+        # Read the original PDF from the local copy of the file in Google Drive
         if epv.drive_file_id:
             try:
-                # Create a temporary file for the original PDF
-                original_pdf_path = os.path.join(upload_folder, f"original_{epv.epv_id}_{random_hex}.pdf")
-
-                # Download the file from Google Drive
-                success = download_from_drive(epv.drive_file_id, original_pdf_path)
-                if success:
-                    print(f"Downloaded original PDF from Drive: {original_pdf_path}")
-
-                    # Add the original PDF to the merger
-                    merger.append(original_pdf_path)
+                from drive_file_cache import get_cached_file
+                original_pdf = get_cached_file(epv.drive_file_id)
+                if original_pdf:
+                    merge.append(original_pdf, label=f"original PDF of {epv.epv_id}")
                 else:
                     print("Failed to download original PDF from Drive")
             except Exception as e:
@@ -260,28 +162,35 @@ def merge_supplementary_documents(epv, supplementary_files, upload_folder):
         for filename, file_path in supplementary_files:
             try:
                 if file_path.lower().endswith('.pdf'):
-                    merger.append(file_path)
-                    print(f"Added supplementary PDF to merger: {file_path}")
+                    merge.append(file_path, label=filename)
                 else:
                     # Convert non-PDF files to PDF
                     from pdf_converter import convert_to_pdf
                     pdf_path = convert_to_pdf(file_path)
                     if pdf_path:
-                        merger.append(pdf_path)
-                        print(f"Added converted PDF to merger: {pdf_path}")
+                        converted_files.append(pdf_path)
+                        merge.append(pdf_path, label=filename)
                     else:
                         print(f"Failed to convert {file_path} to PDF")
             except Exception as e:
                 print(f"Error adding {file_path} to merger: {str(e)}")
 
-        # Write the merged PDF
-        merger.write(merged_pdf_path)
-        merger.close()
+        if not merge.page_count:
+            print("Error merging PDFs: no pages to merge")
+            return None
 
-        print(f"Successfully merged PDFs: {merged_pdf_path}")
-        return merged_pdf_path
+        merged_pdf = merge.write()
+        print(f"Successfully merged PDFs for {epv.epv_id} ({merge.page_count} pages)")
+        return merged_pdf
     except Exception as e:
         print(f"Error merging PDFs: {str(e)}")
         import traceback
         print(traceback.format_exc())
         return None
+    finally:
+        # Converted PDFs are only needed until the merged PDF is written
+        for pdf_path in converted_files:
+            try:
+                os.remove(pdf_path)
+            except OSError:
+                pass
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""
+Rebuild the epv_daily_summary rollup from the EPV tables.
+
+The rollup is kept up to date on every EPV change, so this only needs to be
+run once after deploying it, to backfill after direct SQL edits, or after
+changing the holiday calendar (BUSINESS_HOLIDAYS / BUSINESS_HOLIDAYS_FILE).
+"""
+import os
+import sys
+import urllib.parse
+from flask import Flask
+from dotenv import load_dotenv
+
+# Add current directory to path so we can import models
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from models import db, EPVDailySummary, EPVSummaryDirtyBucket
+from epv_summary import rebuild_daily_summary
+
+# Load environment variables
+load_dotenv()
+
+# Initialize Flask app
+app = Flask(__name__)
+
+# Database configuration
+db_user = os.environ.get('DB_USER')
+db_password = os.environ.get('DB_PASSWORD')
+db_host = os.environ.get('DB_HOST')
+db_port = os.environ.get('DB_PORT', '3306')
+db_name = os.environ.get('DB_NAME')
+
+# URL encode the password to handle special characters like @
+encoded_password = urllib.parse.quote_plus(db_password) if db_password else ''
+
+app.config['SQLALCHEMY_DATABASE_URI'] = f"mysql+pymysql://{db_user}:{encoded_password}@{db_host}:{db_port}/{db_name}"
+app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+db.init_app(app)
+
+def main():
+    with app.app_context():
+        # Make sure the rollup tables exist
+        EPVDailySummary.__table__.create(db.engine, checkfirst=True)
+        EPVSummaryDirtyBucket.__table__.create(db.engine, checkfirst=True)
+
+        print("Rebuilding epv_daily_summary...")
+        try:
+            with db.engine.begin() as conn:
+                row_count = rebuild_daily_summary(conn)
+            print(f"✅ epv_daily_summary rebuilt with {row_count} rows")
+        except Exception as e:
+            print(f"❌ Error rebuilding epv_daily_summary: {str(e)}")
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
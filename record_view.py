@@ -0,0 +1,124 @@
+"""
+Data and render cache of the EPV record page (/epv-record/<epv_id>).
+
+load_epv_record() loads an EPV with everything the page shows: the cost
+center, master invoice and finance entry (with its finance user and
+approver) in the main query, and the items, approvals, allocations and
+supplementary documents in one query each. employee_names() resolves only
+the employees the page names.
+
+Approvers open the page from email links, often several times. The rendered
+page is cached for RECORD_VIEW_CACHE_TTL seconds per EPV, token and viewer;
+committing a change to the EPV, its items, approvals, allocations, finance
+entry or documents (or to its master or sub invoices) drops its pages.
+Changes made by other app processes are seen after at most the TTL.
+"""
+
+import os
+import threading
+
+from sqlalchemy.orm import joinedload, selectinload
+
+import session_changes
+from cache import TTLCache
+from models import (
+    db, EPV, EPVItem, EPVApproval, EPVAllocation, FinanceEntry, EmployeeDetails, SupplementaryDocument
+)
+
+RECORD_VIEW_CACHE_TTL = int(os.environ.get('RECORD_VIEW_CACHE_TTL', 60))
+RECORD_VIEW_CACHE_SIZE = 512
+
+# (epv_id, token, viewer email, role, cost center approver) -> rendered page
+_pages = TTLCache(maxsize=RECORD_VIEW_CACHE_SIZE, ttl=RECORD_VIEW_CACHE_TTL)
+# EPV primary key -> epv_ids of the cached pages showing that EPV
+_shown_on = TTLCache(maxsize=RECORD_VIEW_CACHE_SIZE * 4, ttl=RECORD_VIEW_CACHE_TTL)
+
+# Moves on every invalidation, so a page rendered from data older than a change is not cached
+_generation = 0
+_generation_lock = threading.Lock()
+
+
+def load_epv_record(epv_id):
+    """
+    EPV with the relationships the record page shows, loaded up front.
+
+    Returns:
+        EPV, or None if there is no EPV with this epv_id
+    """
+    return EPV.query.options(
+        joinedload(EPV.cost_center),
+        joinedload(EPV.master_invoice),
+        joinedload(EPV.finance_entry).joinedload(FinanceEntry.finance_user),
+        joinedload(EPV.finance_entry).joinedload(FinanceEntry.approver),
+        selectinload(EPV.items),
+        selectinload(EPV.approvals),
+        selectinload(EPV.allocations),
+        selectinload(EPV.supplementary_documents)
+    ).filter(EPV.epv_id == epv_id).first()
+
+
+def employee_names(emails):
+    """
+    Names of the employees with these emails, in one query.
+
+    Returns:
+        dict: email -> name, for the emails of known employees
+    """
+    emails = {email for email in emails if email}
+    if not emails:
+        return {}
+    return {
+        email: name
+        for email, name in db.session.query(EmployeeDetails.email, EmployeeDetails.name).filter(
+            EmployeeDetails.email.in_(emails)
+        ).all()
+        if name
+    }
+
+
+def get_cached_page(key):
+    return _pages.get(key)
+
+
+def page_generation():
+    """Current generation, to pass to cache_page() for a page about to be loaded"""
+    return _generation
+
+
+def cache_page(key, epv, html, generation):
+    """Cache a rendered record page of epv under key, unless records changed since generation"""
+    if generation != _generation:
+        return
+    _pages.set(key, html)
+    shown = [epv.id, epv.master_invoice_id] + [sub.id for sub in epv.sub_invoices or []]
+    for pk in shown:
+        if pk:
+            epv_ids = set(_shown_on.get(pk, ()))
+            epv_ids.add(epv.epv_id)
+            _shown_on.set(pk, frozenset(epv_ids))
+
+
+def invalidate_record_pages(epv_pks):
+    """Drop the cached pages showing any of these EPVs"""
+    global _generation
+    with _generation_lock:
+        _generation += 1
+    epv_ids = set()
+    for pk in epv_pks:
+        epv_ids.update(_shown_on.get(pk, ()))
+        _shown_on.invalidate(pk)
+    if epv_ids:
+        _pages.invalidate_where(lambda key: key[0] in epv_ids)
+
+
+def collect_record_changes(flushed, objects, changes):
+    """Remember which EPVs this flush changed until the transaction commits"""
+    for obj in objects:
+        changes.add(obj.id if isinstance(obj, EPV) else obj.epv_id)
+
+
+session_changes.register(
+    'record_view_changes',
+    (EPV, EPVItem, EPVApproval, EPVAllocation, FinanceEntry, SupplementaryDocument),
+    collect_record_changes, invalidate_record_pages, pending=set
+)
@@ -0,0 +1,217 @@
+"""
+Scorecard aggregation for the dashboard.
+
+All scorecard numbers are computed with grouped SQL, so the cost of a
+dashboard load does not depend on how many vouchers the user can see.
+Scopes that can be expressed in cost-center terms are answered from the
+epv_daily_summary rollup (see epv_summary.py); other scopes (e.g. a user's
+own EPVs) are aggregated directly over the scoped EPV query.
+"""
+
+import logging
+from datetime import datetime
+
+from sqlalchemy import func, case, and_
+
+from models import db, EPV, EPVApproval, FinanceEntry, EPVDailySummary
+from epv_summary import refresh_dirty_buckets
+from utils import business_days_between, RESUBMISSION_APPROVER
+
+logger = logging.getLogger(__name__)
+
+# Status groups used by the scorecards
+PENDING_STATUSES = ['submitted', 'pending_approval']
+
+
+def _scoped_epv_ids(base_query):
+    """Turn a scoped EPV query into a SELECT of EPV ids usable inside IN (...)"""
+    scoped = base_query.with_entities(EPV.id).order_by(None).subquery()
+    return db.select(scoped.c.id)
+
+
+def get_scorecard_counts(base_query, now=None):
+    """
+    Compute pending, approved-this-month and total approved amount in one query.
+
+    Args:
+        base_query: Scoped EPV query (role, city and filter conditions applied)
+        now (datetime): Reference time for "this month" (defaults to now)
+
+    Returns:
+        tuple: (pending_claims, approved_this_month, total_amount)
+    """
+    now = now or datetime.now()
+    is_approved = EPV.status == 'approved'
+
+    row = db.session.query(
+        func.sum(case((EPV.status.in_(PENDING_STATUSES), 1), else_=0)),
+        func.sum(case((and_(
+            is_approved,
+            db.extract('month', EPV.approved_on) == now.month,
+            db.extract('year', EPV.approved_on) == now.year
+        ), 1), else_=0)),
+        func.sum(case((is_approved, EPV.total_amount), else_=0))
+    ).filter(EPV.id.in_(_scoped_epv_ids(base_query))).one()
+
+    pending_claims, approved_this_month, total_amount = row
+    return int(pending_claims or 0), int(approved_this_month or 0), float(total_amount or 0)
+
+
+def get_average_processing_days(base_query):
+    """
+    Average processing time in business days for processed EPVs in scope.
+
+    Processing starts at the latest resubmission date if the EPV was resubmitted,
+    otherwise at the first manager approval, and ends at the payment date (see
+    utils.calculate_processing_days). Rows are grouped by (start day, payment day)
+    in SQL, so only distinct date pairs are returned regardless of EPV count.
+
+    Args:
+        base_query: Scoped EPV query (role, city and filter conditions applied)
+
+    Returns:
+        int: Average business days, rounded (0 when nothing has been paid)
+    """
+    resubmissions = db.session.query(
+        EPVApproval.epv_id.label('epv_id'),
+        func.max(EPVApproval.action_date).label('action_date')
+    ).filter(
+        EPVApproval.status == 'resubmitted',
+        EPVApproval.approver_email == RESUBMISSION_APPROVER
+    ).group_by(EPVApproval.epv_id).subquery()
+
+    manager_approvals = db.session.query(
+        EPVApproval.epv_id.label('epv_id'),
+        func.min(EPVApproval.action_date).label('action_date')
+    ).filter(
+        EPVApproval.status == 'approved'
+    ).group_by(EPVApproval.epv_id).subquery()
+
+    start_day = func.date(func.coalesce(resubmissions.c.action_date, manager_approvals.c.action_date))
+    payment_day = func.date(FinanceEntry.payment_date)
+
+    date_pairs = db.session.query(
+        start_day, payment_day, func.count(EPV.id)
+    ).join(
+        FinanceEntry, FinanceEntry.epv_id == EPV.id
+    ).outerjoin(
+        resubmissions, resubmissions.c.epv_id == EPV.id
+    ).outerjoin(
+        manager_approvals, manager_approvals.c.epv_id == EPV.id
+    ).filter(
+        EPV.id.in_(_scoped_epv_ids(base_query)),
+        EPV.status == 'approved',
+        EPV.finance_status == 'processed',
+        FinanceEntry.payment_date.isnot(None)
+    ).group_by(start_day, payment_day).all()
+
+    # EPVs without an approval date still count, with 0 processing days
+    days = business_days_between([started_on for started_on, _, _ in date_pairs], [paid_on for _, paid_on, _ in date_pairs])
+    total_days = sum(pair_days * count for pair_days, (_, _, count) in zip(days, date_pairs))
+    total_epvs = sum(count for _, _, count in date_pairs)
+
+    if not total_epvs:
+        return 0
+    return round(total_days / total_epvs)
+
+
+def get_dashboard_scorecards(base_query, now=None):
+    """
+    Compute all dashboard scorecards for a scoped EPV query.
+
+    Args:
+        base_query: Scoped EPV query (role, city and filter conditions applied)
+        now (datetime): Reference time for "this month" (defaults to now)
+
+    Returns:
+        dict: pending_claims, approved_this_month, total_amount, avg_processing_time
+    """
+    pending_claims, approved_this_month, total_amount = get_scorecard_counts(base_query, now)
+
+    return {
+        'pending_claims': pending_claims,
+        'approved_this_month': approved_this_month,
+        'total_amount': total_amount,
+        'avg_processing_time': get_average_processing_days(base_query)
+    }
+
+
+def get_summary_scorecards(cost_center_ids=None, expense_head='', start_date=None, end_date=None, now=None):
+    """
+    Compute dashboard scorecards from the epv_daily_summary rollup in one query.
+
+    Args:
+        cost_center_ids (list): Cost centers in scope (None for all cost centers)
+        expense_head (str): Expense head filter ('' for all heads)
+        start_date (date): First submission day to include
+        end_date (date): Last submission day to include
+        now (datetime): Reference time for "this month" (defaults to now)
+
+    Returns:
+        dict: pending_claims, approved_this_month, total_amount, avg_processing_time
+    """
+    now = now or datetime.now()
+    is_approved = EPVDailySummary.status == 'approved'
+
+    # Buckets whose refresh failed when their EPVs changed
+    try:
+        with db.engine.begin() as connection:
+            refresh_dirty_buckets(connection)
+    except Exception:
+        logger.exception("Error recomputing dirty EPV daily summary buckets")
+
+    query = db.session.query(
+        func.sum(case((EPVDailySummary.status.in_(PENDING_STATUSES), EPVDailySummary.epv_count), else_=0)),
+        func.sum(case((and_(
+            is_approved,
+            EPVDailySummary.approved_month == now.strftime('%Y-%m')
+        ), EPVDailySummary.epv_count), else_=0)),
+        func.sum(case((is_approved, EPVDailySummary.total_amount), else_=0)),
+        func.sum(EPVDailySummary.processed_count),
+        func.sum(EPVDailySummary.processing_days_total)
+    ).filter(EPVDailySummary.expense_head == (expense_head or ''))
+
+    if cost_center_ids is not None:
+        query = query.filter(EPVDailySummary.cost_center_id.in_(cost_center_ids))
+    if start_date and end_date:
+        query = query.filter(EPVDailySummary.summary_date.between(start_date, end_date))
+
+    pending_claims, approved_this_month, total_amount, processed_count, processing_days_total = query.one()
+
+    avg_processing_time = 0
+    if processed_count:
+        avg_processing_time = round((processing_days_total or 0) / processed_count)
+
+    return {
+        'pending_claims': int(pending_claims or 0),
+        'approved_this_month': int(approved_this_month or 0),
+        'total_amount': float(total_amount or 0),
+        'avg_processing_time': avg_processing_time
+    }
+
+
+def get_records_scorecards(base_query):
+    """
+    Compute the /epv-records scorecards for a scoped EPV query in one query.
+
+    Args:
+        base_query: Scoped EPV query (role, city and filter conditions applied)
+
+    Returns:
+        dict: total_records, pending_count, approved_count, rejected_count, total_amount
+    """
+    total_records, pending_count, approved_count, rejected_count, total_amount = db.session.query(
+        func.count(EPV.id),
+        func.sum(case((EPV.status.in_(PENDING_STATUSES), 1), else_=0)),
+        func.sum(case((EPV.status == 'approved', 1), else_=0)),
+        func.sum(case((EPV.status == 'rejected', 1), else_=0)),
+        func.sum(EPV.total_amount)
+    ).filter(EPV.id.in_(_scoped_epv_ids(base_query))).one()
+
+    return {
+        'total_records': int(total_records or 0),
+        'pending_count': int(pending_count or 0),
+        'approved_count': int(approved_count or 0),
+        'rejected_count': int(rejected_count or 0),
+        'total_amount': float(total_amount or 0)
+    }
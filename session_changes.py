@@ -0,0 +1,115 @@
+"""
+One after_flush walk for every module that acts on database changes.
+
+The epv_daily_summary rollup (models), the finance dashboard feed
+(change_feed), the notification counts, the autocomplete indexes and the EPV
+record page cache all need the objects a flush inserted, changed or deleted.
+Instead of each listening to after_flush and scanning session.new,
+session.dirty and session.deleted itself, they register() a collector: after
+every flush the objects are walked once, grouped by class, and each
+collector is given the objects of the classes it watches.
+
+Collectors with an apply function gather their changes on the session until
+the transaction ends: apply runs once the transaction commits, and the
+changes are dropped if it rolls back. A collector without one acts in the
+flush itself, inside the transaction.
+"""
+
+import logging
+from collections import namedtuple
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+logger = logging.getLogger(__name__)
+
+Collector = namedtuple('Collector', 'name classes collect apply pending')
+
+_collectors = []
+
+
+class FlushedObjects:
+    """The objects a flush inserted, changed or deleted, grouped by class"""
+
+    def __init__(self, session):
+        self.session = session
+        self._by_class = {}
+        for obj in session.new:
+            self._add(obj)
+        for obj in session.dirty:
+            # Dirty objects may have no net change (e.g. an attribute set to its own value)
+            if session.is_modified(obj):
+                self._add(obj)
+        for obj in session.deleted:
+            self._add(obj)
+
+    def _add(self, obj):
+        self._by_class.setdefault(type(obj), []).append(obj)
+
+    def __bool__(self):
+        return bool(self._by_class)
+
+    def of(self, classes):
+        """Objects of the flush that are instances of any of these classes"""
+        return [obj for cls, objs in self._by_class.items() if issubclass(cls, classes) for obj in objs]
+
+    def is_new(self, obj):
+        return obj in self.session.new
+
+    def is_deleted(self, obj):
+        return obj in self.session.deleted
+
+
+def register(name, classes, collect, apply=None, pending=dict):
+    """
+    Add a collector to the after_flush walk.
+
+    Args:
+        name (str): Name of the collector, keys its changes on the session
+        classes (tuple): Model classes whose flushed objects the collector is given
+        collect: collect(flushed, objects, changes) records the changes of one
+            flush: flushed is the FlushedObjects, objects the ones of classes,
+            changes what the transaction collected so far (None without apply)
+        apply: apply(changes) acts on the changes once the transaction commits;
+            None if collect acts in the flush itself
+        pending: Returns the empty changes of a transaction
+    """
+    _collectors.append(Collector(name, tuple(classes), collect, apply, pending))
+
+
+@event.listens_for(Session, 'after_flush')
+def collect_flush_changes(session, flush_context):
+    """Hand the objects of this flush to each collector"""
+    flushed = FlushedObjects(session)
+    if not flushed:
+        return
+    for collector in _collectors:
+        objects = flushed.of(collector.classes)
+        if not objects:
+            continue
+        if collector.apply is None:
+            collector.collect(flushed, objects, None)
+            continue
+        pending = session.info.setdefault('flush_changes', {})
+        if collector.name not in pending:
+            pending[collector.name] = collector.pending()
+        collector.collect(flushed, objects, pending[collector.name])
+
+
+@event.listens_for(Session, 'after_commit')
+def apply_committed_changes(session):
+    pending = session.info.pop('flush_changes', None)
+    if not pending:
+        return
+    for collector in _collectors:
+        if collector.name in pending:
+            try:
+                collector.apply(pending[collector.name])
+            except Exception:
+                # The transaction is committed; one collector must not keep the others from running
+                logger.exception("Error applying committed %s", collector.name)
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_flush_changes(session):
+    session.info.pop('flush_changes', None)
@@ -0,0 +1,239 @@
+"""
+SQL statement profiling and N+1 detection.
+
+Every SQL statement executed while a profile is active is recorded under its
+shape: the statement with parameter lists, numbers and quoted strings
+collapsed, so that "SELECT ... WHERE cost_center.id = ?" issued once per row
+is one shape executed many times. A shape executed SQL_N_PLUS_ONE_THRESHOLD
+times or more in one profile is reported as a suspected N+1 pattern, usually
+a lazy-loaded relationship touched inside a loop.
+
+init_sql_profile(app) profiles every request when SQL_PROFILE is enabled
+(by default only with FLASK_ENV=development). Responses then carry the
+X-SQL-Count, X-SQL-Time-Ms and X-SQL-Repeated headers, N+1 suspects are
+logged as warnings, and /debug/sql-profile lists the most recent requests
+to Super Admins.
+
+profile_queries() and query_budget() profile any block of code, e.g. a test
+client request:
+
+    with query_budget(15):
+        client.get('/finance-dashboard')
+"""
+
+import logging
+import os
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+SQL_PROFILE_ENABLED = os.environ.get(
+    'SQL_PROFILE', 'true' if os.environ.get('FLASK_ENV') == 'development' else 'false'
+).lower() == 'true'
+SQL_N_PLUS_ONE_THRESHOLD = int(os.environ.get('SQL_N_PLUS_ONE_THRESHOLD', 5))
+SQL_PROFILE_HISTORY = int(os.environ.get('SQL_PROFILE_HISTORY', 50))
+
+logger = logging.getLogger(__name__)
+
+# Profiles active in this context; nested ones (a test around a request) all record
+_active = ContextVar('sql_profiles', default=())
+_listening = False
+_listen_lock = threading.Lock()
+
+# Most recent request profiles, newest last
+_history = deque(maxlen=SQL_PROFILE_HISTORY)
+
+_PARAMETER_LIST = re.compile(r"\(\s*(?:\?|%s|%\(\w+\)s|:\w+)(?:\s*,\s*(?:\?|%s|%\(\w+\)s|:\w+))+\s*\)")
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def statement_shape(statement):
+    """Statement with whitespace, parameter lists and literals collapsed"""
+    shape = _WHITESPACE.sub(' ', statement).strip()
+    shape = _STRING.sub('?', shape)
+    shape = _NUMBER.sub('?', shape)
+    return _PARAMETER_LIST.sub('(...)', shape)
+
+
+class SqlProfile:
+    """SQL statements executed while the profile was active, grouped by shape"""
+
+    def __init__(self, label=None, track_shapes=True):
+        self.label = label
+        self.started_at = datetime.now()
+        self.count = 0
+        self.total_ms = 0.0
+        # shape -> [executions, milliseconds]; left empty if only counting
+        self.shapes = {}
+        self.track_shapes = track_shapes
+
+    def record(self, statement, elapsed_ms):
+        self.count += 1
+        self.total_ms += elapsed_ms
+        if not self.track_shapes:
+            return
+        entry = self.shapes.setdefault(statement_shape(statement), [0, 0.0])
+        entry[0] += 1
+        entry[1] += elapsed_ms
+
+    def repeated(self, threshold=None):
+        """
+        Shapes executed at least threshold times, most executed first.
+
+        Returns:
+            list: (shape, executions, milliseconds) tuples
+        """
+        threshold = threshold or SQL_N_PLUS_ONE_THRESHOLD
+        return sorted(
+            ((shape, count, ms) for shape, (count, ms) in self.shapes.items() if count >= threshold),
+            key=lambda item: (-item[1], -item[2])
+        )
+
+    def report(self, limit=10):
+        """Text summary of the profile, most executed shapes first"""
+        lines = [f"{self.count} SQL statements in {self.total_ms:.1f}ms"]
+        ranked = sorted(self.shapes.items(), key=lambda item: (-item[1][0], -item[1][1]))
+        for shape, (count, ms) in ranked[:limit]:
+            lines.append(f"  {count:4d}x {ms:8.1f}ms  {shape[:200]}")
+        return '\n'.join(lines)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _active.get() and context is not None:
+        context._sql_profile_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profiles = _active.get()
+    started = getattr(context, '_sql_profile_started', None)
+    if profiles and started is not None:
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        for profile in profiles:
+            profile.record(statement, elapsed_ms)
+
+
+def _listen():
+    """Attach the cursor listeners to all engines, once"""
+    global _listening
+    with _listen_lock:
+        if _listening:
+            return
+        from sqlalchemy import event
+        from sqlalchemy.engine import Engine
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        _listening = True
+
+
+def activate_profile(profile):
+    """Start recording statements in profile, in this context, until deactivate_profile()"""
+    _listen()
+    _active.set(_active.get() + (profile,))
+
+
+def deactivate_profile(profile):
+    """Stop recording statements in profile"""
+    _active.set(tuple(active for active in _active.get() if active is not profile))
+
+
+@contextmanager
+def profile_queries(label=None):
+    """
+    Record the SQL statements executed in the block.
+
+    Args:
+        label (str): Name shown for the profile, e.g. the route
+
+    Yields:
+        SqlProfile: Filled in as statements execute
+    """
+    _listen()
+    profile = SqlProfile(label)
+    token = _active.set(_active.get() + (profile,))
+    try:
+        yield profile
+    finally:
+        _active.reset(token)
+
+
+@contextmanager
+def query_budget(max_statements, max_repeated=None):
+    """
+    Fail with AssertionError if the block executes more than max_statements statements
+    or repeats one statement shape max_repeated times or more (default SQL_N_PLUS_ONE_THRESHOLD).
+    """
+    with profile_queries() as profile:
+        yield profile
+    if profile.count > max_statements:
+        raise AssertionError(f"Query budget of {max_statements} exceeded\n{profile.report()}")
+    repeated = profile.repeated(max_repeated)
+    if repeated:
+        raise AssertionError(
+            f"Suspected N+1 queries ({repeated[0][1]}x {repeated[0][0][:200]})\n{profile.report()}"
+        )
+
+
+def init_sql_profile(app):
+    """Profile every request of app and add /debug/sql-profile, if SQL_PROFILE is enabled"""
+    if not SQL_PROFILE_ENABLED:
+        return
+
+    from flask import request, g, render_template, session, flash, redirect, url_for
+    from flask_login import login_required
+
+    def start_profile():
+        route = request.url_rule.rule if request.url_rule else request.path
+        g.sql_profile = SqlProfile(f"{request.method} {route}")
+        activate_profile(g.sql_profile)
+
+    def add_profile_headers(response):
+        profile = g.get('sql_profile')
+        if profile is None:
+            return response
+        repeated = profile.repeated()
+        response.headers['X-SQL-Count'] = str(profile.count)
+        response.headers['X-SQL-Time-Ms'] = f"{profile.total_ms:.1f}"
+        response.headers['X-SQL-Repeated'] = str(len(repeated))
+        return response
+
+    def finish_profile(error=None):
+        profile = g.pop('sql_profile', None)
+        if profile is None:
+            return
+        deactivate_profile(profile)
+        if request.path.startswith('/static') or request.endpoint == 'sql_profile':
+            return
+        _history.append(profile)
+        for shape, count, ms in profile.repeated():
+            logger.warning("Suspected N+1 in %s: %dx (%.1fms) %s", profile.label, count, ms, shape[:300])
+
+    @login_required
+    def sql_profile():
+        # The profiles hold every user's statements and routes
+        if session.get('employee_role') != 'Super Admin':
+            flash('You do not have permission to access this page.', 'error')
+            return redirect(url_for('dashboard'))
+        profiles = list(reversed(_history))
+        return render_template(
+            'sql_profile.html',
+            profiles=profiles,
+            threshold=SQL_N_PLUS_ONE_THRESHOLD
+        )
+
+    # Profile the app's own before_request handlers too
+    app.before_request_funcs.setdefault(None, []).insert(0, start_profile)
+    app.after_request(add_profile_headers)
+    app.teardown_request(finish_profile)
+    app.add_url_rule('/debug/sql-profile', 'sql_profile', sql_profile)
+    logger.debug("SQL profiling enabled (N+1 threshold %s)", SQL_N_PLUS_ONE_THRESHOLD)
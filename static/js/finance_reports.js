@@ -303,7 +303,7 @@ function updateOverviewData() {
     showLoading();
     
     // Fetch data from API
-    fetch(`/api/reports/overview?date_range=${dateRange}&city=${city}`)
+    fetch(`/api/reports/overview?date_range=${dateRange}&city=${encodeURIComponent(city)}`)
         .then(response => response.json())
         .then(data => {
             // Update stats
@@ -350,7 +350,7 @@ function updateExpenseTrends() {
     showLoading();
     
     // Fetch data from API
-    fetch(`/api/reports/expense-trends?time_period=${timePeriod}&expense_head=${expenseHead}`)
+    fetch(`/api/reports/expense-trends?time_period=${timePeriod}&expense_head=${encodeURIComponent(expenseHead)}`)
         .then(response => response.json())
         .then(data => {
             // Update expense trend chart
@@ -414,21 +414,95 @@ function exportDetailedData() {
     alert('Export functionality will be implemented soon.');
 }
 
-// Placeholder functions for other updates (to be implemented)
+// Update cost center analysis
 function updateCostCenterAnalysis() {
-    // Placeholder - will be implemented
+    const dateRange = document.getElementById('costCenterDateRange').value;
+    const city = document.getElementById('costCenterCity').value;
+    
+    // Show loading indicator
     showLoading();
-    setTimeout(hideLoading, 500);
+    
+    // Fetch data from API
+    fetch(`/api/reports/cost-centers?date_range=${dateRange}&city=${encodeURIComponent(city)}`)
+        .then(response => response.json())
+        .then(data => {
+            // Update cost center chart
+            costCenterChart.data.labels = data.labels;
+            costCenterChart.data.datasets[0].data = data.values;
+            costCenterChart.update();
+            
+            // Update cost center table
+            updateCostCenterTable(data.rows);
+            
+            // Hide loading indicator
+            hideLoading();
+        })
+        .catch(error => {
+            console.error('Error fetching cost center analysis:', error);
+            hideLoading();
+            showError('Failed to load cost center analysis. Please try again.');
+        });
 }
 
+// Update cost center table
+function updateCostCenterTable(rows) {
+    const tableBody = document.getElementById('costCenterTableBody');
+    tableBody.innerHTML = '';
+    
+    if (rows.length === 0) {
+        const row = tableBody.insertRow();
+        const cell = row.insertCell();
+        cell.colSpan = 6;
+        cell.className = 'text-center text-muted';
+        cell.textContent = 'No expenses found for the selected filters.';
+        return;
+    }
+    
+    rows.forEach(data => {
+        const row = tableBody.insertRow();
+        [
+            data.cost_center,
+            data.city,
+            data.total_expenses.toLocaleString(),
+            'Rs. ' + data.total_amount.toLocaleString(),
+            'Rs. ' + data.avg_amount.toLocaleString(),
+            data.avg_processing_days.toFixed(1) + ' days'
+        ].forEach(value => {
+            row.insertCell().textContent = value;
+        });
+    });
+}
+
+// Update processing time data
 function updateProcessingTimeData() {
-    // Placeholder - will be implemented
+    const dateRange = document.getElementById('processingDateRange').value;
+    const groupBy = document.getElementById('processingGroupBy').value;
+    
+    // Show loading indicator
     showLoading();
-    setTimeout(hideLoading, 500);
+    
+    // Fetch data from API
+    fetch(`/api/reports/processing-time?date_range=${dateRange}&group_by=${groupBy}`)
+        .then(response => response.json())
+        .then(data => {
+            // Update processing time chart
+            processingTimeChart.data.labels = data.labels;
+            processingTimeChart.data.datasets[0].data = data.values;
+            processingTimeChart.update();
+            
+            // Hide loading indicator
+            hideLoading();
+        })
+        .catch(error => {
+            console.error('Error fetching processing time data:', error);
+            hideLoading();
+            showError('Failed to load processing time data. Please try again.');
+        });
 }
 
+// Placeholder function for the detailed report (to be implemented)
 function updateDetailedReport() {
     // Placeholder - will be implemented
     showLoading();
     setTimeout(hideLoading, 500);
-}
+}
\ No newline at end of file
@@ -1,3 +1,27 @@
+import bisect
+import os
+from datetime import datetime, date, timedelta
+
+# Optional: NumPy counts business days for large batches in one call
+try:
+    import numpy
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+# Public holidays excluded from business days, as YYYY-MM-DD dates: a comma
+# separated list in BUSINESS_HOLIDAYS and/or a file with one date per line
+BUSINESS_HOLIDAYS = os.environ.get('BUSINESS_HOLIDAYS', '')
+BUSINESS_HOLIDAYS_FILE = os.environ.get('BUSINESS_HOLIDAYS_FILE', '')
+
+# Batches at least this large are counted with NumPy when it is installed
+NUMPY_BATCH_SIZE = 256
+
+# Resubmissions are recorded as a system approval row
+RESUBMISSION_APPROVER = 'system@webapporbit.com'
+
+_holidays = None
+
 def number_to_words(num):
     """Convert a number to words representation"""
     units = ['', 'One', 'Two', 'Three', 'Four', 'Five', 'Six', 'Seven', 'Eight', 'Nine', 'Ten', 'Eleven', 'Twelve', 'Thirteen', 'Fourteen', 'Fifteen', 'Sixteen', 'Seventeen', 'Eighteen', 'Nineteen']
@@ -42,9 +66,109 @@ def number_to_words(num):
     final_result = result.strip() + ' Only'
     return final_result.capitalize()
 
+def _to_date(value):
+    """Calendar day of a date, datetime or 'YYYY-MM-DD[ HH:MM:SS]' string"""
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return datetime.strptime(str(value)[:10], '%Y-%m-%d').date()
+
+def get_holidays():
+    """
+    Holidays excluded from business days, from BUSINESS_HOLIDAYS and BUSINESS_HOLIDAYS_FILE.
+
+    Returns:
+        tuple: Sorted dates of the holidays that fall on weekdays
+    """
+    global _holidays
+    if _holidays is not None:
+        return _holidays
+
+    values = BUSINESS_HOLIDAYS.split(',')
+    if BUSINESS_HOLIDAYS_FILE:
+        try:
+            with open(BUSINESS_HOLIDAYS_FILE) as f:
+                values.extend(line.split('#')[0] for line in f)
+        except OSError as e:
+            print(f"WARNING: Could not read holiday calendar {BUSINESS_HOLIDAYS_FILE}: {str(e)}")
+
+    holidays = set()
+    for value in values:
+        value = value.strip()
+        if not value:
+            continue
+        try:
+            day = datetime.strptime(value, '%Y-%m-%d').date()
+        except ValueError:
+            print(f"WARNING: Ignoring invalid holiday date '{value}'")
+            continue
+        # Weekends are never business days anyway
+        if day.weekday() < 5:
+            holidays.add(day)
+
+    _holidays = tuple(sorted(holidays))
+    return _holidays
+
+def _weekdays_between(start, end):
+    """Monday-Friday days from start to end inclusive, without iterating (start <= end)"""
+    days = (end - start).days + 1
+    weeks, remainder = divmod(days, 7)
+    weekday = start.weekday()
+    return weeks * 5 + sum(1 for i in range(remainder) if (weekday + i) % 7 < 5)
+
+def business_days_between(start_dates, end_dates, holidays=None):
+    """
+    Business days between pairs of dates, for whole batches at once.
+
+    Each count includes both the start and end day and excludes weekends and
+    holidays; a same-day pair counts as 1, a missing date or an end before
+    the start as 0. Large batches are counted with numpy.busday_count when
+    NumPy is installed, others in closed form.
+
+    Args:
+        start_dates (list): Start dates (date, datetime, string or None)
+        end_dates (list): End dates, paired with start_dates
+        holidays (tuple): Sorted weekday holidays (default: get_holidays())
+
+    Returns:
+        list: Business days of each pair
+    """
+    holidays = get_holidays() if holidays is None else holidays
+    starts = [_to_date(value) for value in start_dates]
+    ends = [_to_date(value) for value in end_dates]
+
+    counts = [0] * len(starts)
+    pairs = []
+    for i, (start, end) in enumerate(zip(starts, ends)):
+        if start is None or end is None or end < start:
+            continue
+        if start == end:
+            counts[i] = 1
+        else:
+            pairs.append(i)
+
+    if NUMPY_AVAILABLE and len(pairs) >= NUMPY_BATCH_SIZE:
+        busdays = numpy.busday_count(
+            numpy.array([starts[i] for i in pairs], dtype='datetime64[D]'),
+            numpy.array([ends[i] + timedelta(days=1) for i in pairs], dtype='datetime64[D]'),
+            holidays=numpy.array(holidays, dtype='datetime64[D]')
+        )
+        for i, count in zip(pairs, busdays.tolist()):
+            counts[i] = count
+        return counts
+
+    for i in pairs:
+        start, end = starts[i], ends[i]
+        holiday_count = bisect.bisect_right(holidays, end) - bisect.bisect_left(holidays, start)
+        counts[i] = _weekdays_between(start, end) - holiday_count
+    return counts
+
 def calculate_business_days(start_date, end_date):
     """
-    Calculate the number of business days (excluding weekends) between two dates.
+    Calculate the number of business days (excluding weekends and holidays) between two dates.
 
     Args:
         start_date (datetime): The start date
@@ -53,55 +177,100 @@ def calculate_business_days(start_date, end_date):
     Returns:
         int: The number of business days between the two dates, with same-day counting as 1
     """
-    if not start_date or not end_date:
-        return 0
-
-    # Ensure we're working with datetime objects
     if isinstance(start_date, str):
-        from datetime import datetime
         start_date = datetime.strptime(start_date, '%Y-%m-%d %H:%M:%S')
     if isinstance(end_date, str):
-        from datetime import datetime
         end_date = datetime.strptime(end_date, '%Y-%m-%d %H:%M:%S')
+    return business_days_between([start_date], [end_date])[0]
 
-    # If end_date is before start_date, return 0
-    if end_date < start_date:
-        return 0
+def calendar_days_between(start_dates, end_dates):
+    """
+    Calendar days between pairs of dates, counting both ends (same day is 1).
+
+    Returns:
+        list: Days of each pair, or None where a date is missing
+    """
+    days = []
+    for start, end in zip(start_dates, end_dates):
+        start, end = _to_date(start), _to_date(end)
+        days.append((end - start).days + 1 if start is not None and end is not None else None)
+    return days
+
+def processing_start_subquery(epv_ids=None):
+    """
+    Subquery of (epv_id, started_on): when processing of each EPV started.
+
+    Processing starts at the latest resubmission if the EPV was resubmitted,
+    otherwise at its first manager approval.
+
+    Args:
+        epv_ids: EPV primary keys (list or SELECT) to restrict it to
+    """
+    from sqlalchemy import select, func, case, and_
+    from models import EPVApproval
 
-    # Convert to date objects (removing time component)
-    from datetime import datetime, timedelta
-    start_date_only = start_date.date()
-    end_date_only = end_date.date()
+    resubmitted_on = func.max(case(
+        (and_(EPVApproval.status == 'resubmitted', EPVApproval.approver_email == RESUBMISSION_APPROVER),
+         EPVApproval.action_date)
+    ))
+    approved_on = func.min(case((EPVApproval.status == 'approved', EPVApproval.action_date)))
 
-    # If same day, return 1
-    if start_date_only == end_date_only:
-        return 1
+    query = select(
+        EPVApproval.epv_id.label('epv_id'),
+        func.coalesce(resubmitted_on, approved_on).label('started_on')
+    ).where(EPVApproval.status.in_(['resubmitted', 'approved']))
+    if epv_ids is not None:
+        query = query.where(EPVApproval.epv_id.in_(epv_ids))
+    return query.group_by(EPVApproval.epv_id).subquery()
 
-    # Calculate the number of days between the two dates
-    days = (end_date_only - start_date_only).days
+def get_processing_start_dates(epv_ids, connection=None):
+    """
+    When processing of each EPV started (see processing_start_subquery), in one query.
+
+    Args:
+        epv_ids (list): EPV primary keys
+        connection: SQLAlchemy connection or session to query with (default: db.session)
+
+    Returns:
+        dict: EPV id -> start datetime (EPVs without one are left out)
+    """
+    from sqlalchemy import select
+    from models import db
+
+    if not epv_ids:
+        return {}
 
-    # Add 1 to count the start day (since same-day should be 1)
-    calendar_days = days + 1
+    starts = processing_start_subquery(epv_ids)
+    rows = (connection or db.session).execute(select(starts.c.epv_id, starts.c.started_on)).all()
+    return {epv_id: started_on for epv_id, started_on in rows if started_on}
 
-    # Count business days by iterating through each day
-    business_days = 0
-    current_date = start_date_only
+def calculate_processing_days_batch(payment_dates, connection=None):
+    """
+    Processing days of many EPVs: business days from the processing start
+    (see get_processing_start_dates) to the payment date.
 
-    for _ in range(calendar_days):
-        # Check if current day is a weekday (0-4 are Monday to Friday)
-        if current_date.weekday() < 5:
-            business_days += 1
+    Args:
+        payment_dates (dict): EPV id -> payment date
+        connection: SQLAlchemy connection or session to query with (default: db.session)
 
-        # Move to next day
-        current_date += timedelta(days=1)
+    Returns:
+        dict: EPV id -> business days (0 when no start or payment date is recorded)
+    """
+    paid = {epv_id: paid_on for epv_id, paid_on in payment_dates.items() if paid_on}
+    start_dates = get_processing_start_dates(list(paid), connection)
 
-    return business_days
+    epv_ids = [epv_id for epv_id in paid if epv_id in start_dates]
+    counts = business_days_between([start_dates[epv_id] for epv_id in epv_ids], [paid[epv_id] for epv_id in epv_ids])
+
+    processing_days = dict.fromkeys(payment_dates, 0)
+    processing_days.update(zip(epv_ids, counts))
+    return processing_days
 
 def calculate_processing_days(epv, finance_entry):
     """
     Calculate the processing days for an EPV based on its status:
-    - For regular EPVs: Date of payment - Date of manager approval (excluding weekends)
-    - For resubmitted EPVs: Date of resubmission - Date of payment (excluding weekends)
+    - For regular EPVs: Date of payment - Date of manager approval (excluding weekends and holidays)
+    - For resubmitted EPVs: Date of resubmission - Date of payment (excluding weekends and holidays)
 
     Args:
         epv (EPV): The EPV record
@@ -110,44 +279,8 @@ def calculate_processing_days(epv, finance_entry):
     Returns:
         int: The number of business days for processing
     """
-    from datetime import datetime
-    from models import EPVApproval
-
     # If we don't have a finance entry with payment date, return 0
     if not finance_entry or not finance_entry.payment_date:
         return 0
 
-    # Check if this is a resubmitted EPV
-    is_resubmitted = False
-    resubmission_date = None
-
-    # Find the resubmission record (system approval with status='resubmitted')
-    resubmission = EPVApproval.query.filter_by(
-        epv_id=epv.id,
-        status='resubmitted',
-        approver_email='system@webapporbit.com'
-    ).order_by(EPVApproval.action_date.desc()).first()
-
-    if resubmission and resubmission.action_date:
-        is_resubmitted = True
-        resubmission_date = resubmission.action_date
-
-    # For resubmitted EPVs: Date of resubmission - Date of payment
-    if is_resubmitted and resubmission_date:
-        # Calculate business days between resubmission date and payment date
-        return calculate_business_days(resubmission_date, finance_entry.payment_date)
-
-    # For regular EPVs: Date of payment - Date of manager approval
-    else:
-        # Find the manager approval date (when status changed to 'approved')
-        manager_approval = EPVApproval.query.filter_by(
-            epv_id=epv.id,
-            status='approved'
-        ).order_by(EPVApproval.action_date).first()
-
-        # If we have both dates, calculate business days between them
-        if manager_approval and manager_approval.action_date:
-            return calculate_business_days(manager_approval.action_date, finance_entry.payment_date)
-
-    # Default return if we can't calculate
-    return 0
+    return calculate_processing_days_batch({epv.id: finance_entry.payment_date})[epv.id]
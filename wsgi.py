@@ -0,0 +1,25 @@
+"""
+WSGI entry point of the server.
+
+    gunicorn wsgi:application
+
+or, in passenger_wsgi.py:
+
+    from wsgi import application
+
+Importing app on its own (scripts, PDF conversion workers) neither sets up
+logging nor starts background jobs; this module does both in each server
+process. Run gunicorn without --preload, so that every worker starts its
+own jobs.
+"""
+
+import app_logging
+
+# Leveled, queued log output for the server (see app_logging.py), before app logs anything
+app_logging.configure_logging()
+
+from app import app, start_background_jobs
+
+start_background_jobs()
+
+application = app